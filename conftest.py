@@ -14,3 +14,5 @@ collect_ignore = []  # type: List[six.text_type]
 if sys.version_info < (3, 5):
     collect_ignore.append('tests/unit/server/internal/test_event_loop.py')
     collect_ignore.append('tests/unit/common/test_compatibility_async.py')
+    collect_ignore.append('tests/unit/client/test_asynchronous.py')
+    collect_ignore.append('tests/unit/server/test_server/test_concurrent_jobs.py')
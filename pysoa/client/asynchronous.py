@@ -0,0 +1,308 @@
+# The __future__ imports are only here to satisfy isort; they are not needed.
+from __future__ import (
+    absolute_import,
+    unicode_literals,
+)
+
+import asyncio
+from typing import (
+    TYPE_CHECKING,
+    AbstractSet,
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+    cast,
+)
+
+from pysoa.client.errors import ImproperlyConfigured
+from pysoa.common.transport.errors import (
+    MessageReceiveTimeout,
+    PySOATransportError,
+)
+from pysoa.common.types import (
+    ActionRequest,
+    ActionResponse,
+    Body,
+    Context,
+    Control,
+    JobResponse,
+)
+
+
+if TYPE_CHECKING:
+    from pysoa.client.client import ServiceHandler
+
+
+__all__ = (
+    'AsyncClientMixin',
+)
+
+
+class AsyncClientMixin:
+    """
+    The asyncio counterparts of the blocking `Client` methods, which are mixed into `Client` in Python 3. They require
+    a transport that supports asyncio, such as
+    :class:`pysoa.common.transport.redis_gateway.async_client.AsyncRedisClientTransport`. Requests pass through all
+    request and response middleware, synchronously, in the event loop's thread, and, unlike the blocking methods, these
+    methods do not perform expansions.
+
+    The `timeout` argument of each method works just like it does for the blocking methods, limiting both the expiry of
+    the requests and how long to wait for their responses. Cancelling the returned coroutine stops waiting for the
+    responses, which are then discarded when they arrive.
+    """
+
+    async def call_action_async(  # noqa: E999
+        self,
+        service_name: str,
+        action: str,
+        body: Optional[Body] = None,
+        raise_job_errors: bool = True,
+        raise_action_errors: bool = True,
+        timeout: Optional[float] = None,
+        switches: Optional[Union[List[int], AbstractSet[int]]] = None,
+        correlation_id: Optional[str] = None,
+        context: Optional[Context] = None,
+        control_extra: Optional[Control] = None,
+    ) -> ActionResponse:
+        """
+        The asyncio counterpart of :meth:`Client.call_action`, without expansions.
+
+        :return: The action response.
+
+        :raises: :class:`pysoa.common.transport.errors.PySOATransportError`,
+                 :class:`pysoa.client.errors.CallActionError`, :class:`pysoa.client.errors.CallJobError`
+        """
+        response = await self.call_actions_async(
+            service_name=service_name,
+            actions=[ActionRequest(action=action, body=body or {})],
+            raise_job_errors=raise_job_errors,
+            raise_action_errors=raise_action_errors,
+            timeout=timeout,
+            switches=switches,
+            correlation_id=correlation_id,
+            context=context,
+            control_extra=control_extra,
+        )
+        if response.errors:
+            # This can only happen if raise_job_errors is set to False, so return the list of errors, just like the
+            # blocking method does. Being sneaky with the cast, can only happen if caller asks.
+            return cast(ActionResponse, response.errors)
+        return response.actions[0]
+
+    async def call_actions_async(
+        self,
+        service_name: str,
+        actions: Iterable[Union[ActionRequest, Dict[str, Any]]],
+        raise_job_errors: bool = True,
+        raise_action_errors: bool = True,
+        timeout: Optional[float] = None,
+        switches: Optional[Union[List[int], AbstractSet[int]]] = None,
+        correlation_id: Optional[str] = None,
+        continue_on_error: bool = False,
+        context: Optional[Context] = None,
+        control_extra: Optional[Control] = None,
+    ) -> JobResponse:
+        """
+        The asyncio counterpart of :meth:`Client.call_actions`, without expansions.
+
+        :return: The job response.
+
+        :raises: :class:`pysoa.common.transport.errors.PySOATransportError`,
+                 :class:`pysoa.client.errors.CallActionError`, :class:`pysoa.client.errors.CallJobError`
+        """
+        responses = await self.call_jobs_parallel_async(
+            jobs=[{'service_name': service_name, 'actions': actions}],
+            raise_job_errors=raise_job_errors,
+            raise_action_errors=raise_action_errors,
+            timeout=timeout,
+            switches=switches,
+            correlation_id=correlation_id,
+            continue_on_error=continue_on_error,
+            context=context,
+            control_extra=control_extra,
+        )
+        return responses[0]
+
+    async def call_actions_parallel_async(
+        self,
+        service_name: str,
+        actions: Iterable[Union[ActionRequest, Dict[str, Any]]],
+        raise_job_errors: bool = True,
+        raise_action_errors: bool = True,
+        catch_transport_errors: bool = False,
+        timeout: Optional[float] = None,
+        switches: Optional[Union[List[int], AbstractSet[int]]] = None,
+        correlation_id: Optional[str] = None,
+        context: Optional[Context] = None,
+        control_extra: Optional[Control] = None,
+    ) -> List[ActionResponse]:
+        """
+        The asyncio counterpart of :meth:`Client.call_actions_parallel`, without expansions. The action responses are
+        returned as a list instead of a generator.
+
+        :return: A list of action responses
+
+        :raises: :class:`pysoa.common.transport.errors.PySOATransportError`,
+                 :class:`pysoa.client.errors.CallActionError`, :class:`pysoa.client.errors.CallJobError`
+        """
+        job_responses = await self.call_jobs_parallel_async(
+            jobs=[{'service_name': service_name, 'actions': [action]} for action in actions],
+            raise_job_errors=raise_job_errors,
+            raise_action_errors=raise_action_errors,
+            catch_transport_errors=catch_transport_errors,
+            timeout=timeout,
+            switches=switches,
+            correlation_id=correlation_id,
+            context=context,
+            control_extra=control_extra,
+        )
+
+        responses = []  # type: List[ActionResponse]
+        for job in job_responses:
+            if isinstance(job, Exception):
+                responses.append(cast(ActionResponse, job))  # sneaky cast, only happens if caller wants exceptions
+            elif job.errors:
+                responses.append(cast(ActionResponse, job.errors))  # sneaky cast, only happens if caller wants errors
+            else:
+                responses.append(job.actions[0])
+        return responses
+
+    async def call_jobs_parallel_async(
+        self,
+        jobs: Iterable[Dict[str, Any]],
+        raise_job_errors: bool = True,
+        raise_action_errors: bool = True,
+        catch_transport_errors: bool = False,
+        timeout: Optional[float] = None,
+        switches: Optional[Union[List[int], AbstractSet[int]]] = None,
+        correlation_id: Optional[str] = None,
+        continue_on_error: bool = False,
+        context: Optional[Context] = None,
+        control_extra: Optional[Control] = None,
+    ) -> List[JobResponse]:
+        """
+        The asyncio counterpart of :meth:`Client.call_jobs_parallel`, without expansions. All of the responses are
+        awaited at once.
+
+        :return: A list of job responses
+
+        :raises: :class:`pysoa.common.transport.errors.PySOATransportError`,
+                 :class:`pysoa.client.errors.CallActionError`, :class:`pysoa.client.errors.CallJobError`
+        """
+        # Each item is the handler and request ID of a sent request, or the handler and the error that prevented
+        # sending the request (only if catching transport errors)
+        requests = []  # type: List[Tuple[ServiceHandler, Union[int, PySOATransportError]]]
+        handlers = []  # type: List[ServiceHandler]
+
+        # The requests pass through request middleware now, but sending them is deferred so that it can be awaited
+        try:
+            for job in jobs:
+                handler = self._get_handler(job['service_name'])  # type: ignore
+                if not hasattr(handler.transport, 'send_request_messages_async'):
+                    raise ImproperlyConfigured(
+                        'The transport for service {} does not support asyncio'.format(job['service_name']),
+                    )
+                if handler not in handlers:
+                    handler.begin_send_batch()
+                    handlers.append(handler)
+
+                try:
+                    requests.append((handler, self.send_request(  # type: ignore
+                        service_name=job['service_name'],
+                        actions=job['actions'],
+                        switches=switches,
+                        correlation_id=correlation_id,
+                        continue_on_error=continue_on_error,
+                        context=context,
+                        control_extra=control_extra,
+                        message_expiry_in_seconds=timeout if timeout else None,
+                    )))
+                except PySOATransportError as e:
+                    if not catch_transport_errors:
+                        raise
+                    requests.append((handler, e))
+        finally:
+            batches = [(handler, handler.take_send_batch()) for handler in handlers]
+
+        send_errors = {}  # type: Dict[Tuple[ServiceHandler, int], PySOATransportError]
+        for handler, batch in batches:
+            for message_expiry_in_seconds, messages in batch.items():
+                try:
+                    results = await handler.transport.send_request_messages_async(  # type: ignore
+                        messages,
+                        message_expiry_in_seconds,
+                    )  # type: List[Optional[PySOATransportError]]
+                except PySOATransportError as e:
+                    results = [e] * len(messages)
+                for (request_id, _, _), result in zip(messages, results):
+                    if result is not None:
+                        send_errors[(handler, request_id)] = result
+                        handler.fail_request(request_id, result)
+
+        if send_errors and not catch_transport_errors:
+            # Nobody will await the responses to the requests that were sent, so discard them when they arrive
+            for handler, sent_request_id in requests:
+                if isinstance(sent_request_id, PySOATransportError) or (handler, sent_request_id) in send_errors:
+                    continue
+                if handler.is_coalesced_request(sent_request_id):
+                    handler.get_response_future(sent_request_id)
+                elif handler.get_local_response(sent_request_id) is None:
+                    handler.transport.get_response_future(sent_request_id)  # type: ignore
+            raise next(error for key, error in send_errors.items())
+
+        async def get_response(
+            handler: 'ServiceHandler',
+            request_id: Union[int, PySOATransportError],
+        ) -> Union[JobResponse, PySOATransportError]:
+            if isinstance(request_id, PySOATransportError):
+                return request_id
+            if (handler, request_id) in send_errors:
+                return send_errors[(handler, request_id)]
+            local_response = handler.get_local_response(request_id)
+            if local_response is not None:
+                return local_response
+            try:
+                if handler.is_coalesced_request(request_id):
+                    # The request was not sent, and its response is shared by the identical request that was
+                    coalesced_future = handler.get_response_future(request_id)
+                    try:
+                        return await asyncio.wait_for(asyncio.wrap_future(coalesced_future), timeout)
+                    except asyncio.TimeoutError:
+                        raise MessageReceiveTimeout(
+                            'No response received for a coalesced request to {}'.format(handler.service_name),
+                        )
+                transport = handler.transport  # type: Any
+                received_request_id, _, message = await transport.receive_response_message_async(request_id, timeout)
+            except PySOATransportError as e:
+                handler.fail_request(request_id, e)
+                if not catch_transport_errors:
+                    raise
+                return e
+            return handler.process_received_response(received_request_id, message)
+
+        receiving = [asyncio.ensure_future(get_response(handler, request_id)) for handler, request_id in requests]
+        try:
+            responses = await asyncio.gather(*receiving)
+        except BaseException:
+            # Stop waiting on the other responses, too
+            for future in receiving:
+                future.cancel()
+            raise
+
+        for response in responses:
+            if isinstance(response, Exception):
+                # A transport error, and we are catching errors, so leave it in the list
+                continue
+            if raise_job_errors and response.errors:
+                raise self.JobError(response.errors)  # type: ignore
+            if raise_action_errors:
+                error_actions = [action for action in response.actions if action.errors]
+                if error_actions:
+                    raise self.CallActionError(error_actions)  # type: ignore
+
+        # Sneaky cast, transport errors can only be in the list if the caller explicitly asked for it
+        return cast(List[JobResponse], responses)
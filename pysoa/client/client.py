@@ -7,6 +7,8 @@ import collections
 import logging
 import random
 import sys
+import threading
+import time
 from types import TracebackType
 from typing import (
     AbstractSet,
@@ -38,12 +40,15 @@ import six
 from pysoa.client.errors import (
     CallActionError,
     CallJobError,
+    DeadlineExceeded,
     ImproperlyConfigured,
     InvalidExpansionKey,
 )
 from pysoa.client.expander import (
     ExpansionConverter,
     ExpansionNode,
+    ExpansionObjects,
+    ExpansionPlan,
     Expansions,
     ExpansionSettings,
     TypeExpansions,
@@ -56,6 +61,7 @@ from pysoa.client.middleware import (
     ClientResponseMiddlewareTask,
 )
 from pysoa.client.settings import ClientSettings
+from pysoa.common.compatibility import ContextVar
 from pysoa.common.errors import Error
 from pysoa.common.transport.base import ClientTransport
 from pysoa.common.transport.errors import (
@@ -72,6 +78,10 @@ from pysoa.common.types import (
     JobResponse,
     UnicodeKeysDict,
 )
+from pysoa.utils import (
+    canonical_digest,
+    copy_job_response,
+)
 from pysoa.version import __version_info__
 
 
@@ -81,16 +91,52 @@ __all__ = (
 )
 
 
+try:
+    import concurrent.futures
+except ImportError:  # pragma: no cover
+    concurrent = None  # type: ignore
+
+try:
+    from pysoa.client.asynchronous import AsyncClientMixin
+except (ImportError, SyntaxError):
+    class AsyncClientMixin(object):  # type: ignore
+        """The asyncio `Client` methods are available only in Python 3.5+."""
+
+
 _MT = TypeVar('_MT', ClientRequestMiddlewareTask, ClientResponseMiddlewareTask)
+_OutgoingMessage = Tuple[int, Dict[six.text_type, Any], Dict[six.text_type, Any]]
+_DeferredMessage = Tuple[_OutgoingMessage, Optional[float]]
 
 _logger = logging.getLogger(__name__)
 
 
+class _CoalescedRequest(object):
+    """An outstanding request whose response is shared with the identical requests coalesced with it."""
+
+    def __init__(self, key, expires_at, owner):  # type: (Tuple[Any, ...], float, object) -> None
+        self.key = key
+        self.expires_at = expires_at
+        # Identifies the thread or asyncio task that sent the request and is responsible for receiving its response
+        self.owner = owner
+        self.done = threading.Event()
+        self.response = None  # type: Optional[JobResponse]
+        self.error = None  # type: Optional[Exception]
+        # Called, without arguments, once the request is done
+        self.callbacks = []  # type: List[Callable[[], None]]
+
+
 class ServiceHandler(object):
     """Does the low-level work of communicating with an individual service through its configured transport."""
 
     _client_version = list(__version_info__)
 
+    # How long identical requests are coalesced with a request sent without a message expiry, which matches the default
+    # message expiry of the Redis Gateway transport
+    DEFAULT_COALESCING_EXPIRY_IN_SECONDS = 60.0
+    # How long to wait for the response to a coalesced request when no receive timeout is given and the transport
+    # settings do not configure one, which matches the default receive timeout of the Redis Gateway transport
+    DEFAULT_RECEIVE_TIMEOUT_IN_SECONDS = 5.0
+
     def __init__(self, service_name, settings):  # type: (six.text_type, ClientSettings) -> None
         """
         :param service_name: The name of the service which this handler calls
@@ -111,6 +157,9 @@ class ServiceHandler(object):
                 m['object'](**m.get('kwargs', {}))
                 for m in settings['middleware']
             ]  # type: List[ClientMiddleware]
+            for middleware in self._middleware:
+                if isinstance(middleware, ClientMiddleware):
+                    middleware.initialize(self)
             self._middleware_send_request_wrapper = self._make_middleware_stack(
                 [m.request for m in self._middleware],
                 self._base_send_request,
@@ -124,6 +173,36 @@ class ServiceHandler(object):
         # sharing the same connection
         self.request_counter = random.randint(1, 1000000)  # type: int
 
+        # Holds, per thread and asyncio task, the requests whose sending is deferred until `flush_send_batch` is called
+        self._send_batch = ContextVar(
+            'pysoa_client_send_batch',
+            default=None,
+        )  # type: ContextVar[Optional[List[_DeferredMessage]]]
+        # Holds, per thread and asyncio task, the responses that request middleware provided instead of sending requests
+        self._local_responses = ContextVar(
+            'pysoa_client_local_responses',
+            default=None,
+        )  # type: ContextVar[Optional[collections.OrderedDict]]
+
+        # Outstanding requests of coalesced actions, by coalescing key and by request ID, and, per thread and asyncio
+        # task, the requests that were coalesced with them instead of being sent
+        self._coalesced_actions = frozenset(settings['coalesced_actions'])
+        self._coalescing_lock = threading.Lock()
+        self._coalescing_requests = {}  # type: Dict[Tuple[Any, ...], _CoalescedRequest]
+        self._coalescing_request_ids = collections.OrderedDict()  # type: Dict[int, _CoalescedRequest]
+        self._coalesced_requests = ContextVar(
+            'pysoa_client_coalesced_requests',
+            default=None,
+        )  # type: ContextVar[Optional[Dict[int, _CoalescedRequest]]]
+        self._coalescing_owner = ContextVar(
+            'pysoa_client_coalescing_owner',
+            default=None,
+        )  # type: ContextVar[Optional[object]]
+        self._coalesced_receive_timeout_in_seconds = (
+            settings['transport'].get('kwargs', {}).get('receive_timeout_in_seconds') or
+            self.DEFAULT_RECEIVE_TIMEOUT_IN_SECONDS
+        )  # type: float
+
     @staticmethod
     def _make_middleware_stack(middleware, base):  # type: (List[Callable[[_MT], _MT]], _MT) -> _MT
         """
@@ -136,7 +215,15 @@ class ServiceHandler(object):
         return base
 
     def _base_send_request(self, request_id, meta, job_request, message_expiry_in_seconds=None):
-        # type: (int, Dict[six.text_type, Any], JobRequest, Optional[int]) -> None
+        # type: (int, Dict[six.text_type, Any], JobRequest, Optional[float]) -> None
+        batch = self._send_batch.get()
+        if batch is not None:
+            batch.append((
+                (request_id, meta, attr.asdict(job_request, dict_factory=UnicodeKeysDict)),
+                message_expiry_in_seconds,
+            ))
+            return
+
         with self.metrics.timer('client.send.excluding_middleware', resolution=TimerResolution.MICROSECONDS):
             self.transport.send_request_message(
                 request_id,
@@ -145,8 +232,77 @@ class ServiceHandler(object):
                 message_expiry_in_seconds,
             )
 
+    def begin_send_batch(self):  # type: () -> None
+        """
+        Start deferring requests sent on the current thread until :meth:`flush_send_batch` is called, so that the
+        transport can send them all at once. Requests still pass through all request middleware when
+        :meth:`send_request` is called, but transport errors are reported by :meth:`flush_send_batch` instead of
+        being raised through that middleware.
+        """
+        if self._send_batch.get() is None:
+            self._send_batch.set([])
+
+    def flush_send_batch(self):  # type: () -> Dict[int, PySOATransportError]
+        """
+        Send all requests deferred since :meth:`begin_send_batch` was called on the current thread, and stop deferring
+        requests.
+
+        :return: A dict of request IDs to the transport errors that prevented those requests from being sent (empty if
+                 all requests were sent)
+        """
+        batches = self.take_send_batch()
+        if not batches:
+            return {}
+
+        errors = {}  # type: Dict[int, PySOATransportError]
+        try:
+            for message_expiry_in_seconds, batch in six.iteritems(batches):
+                with self.metrics.timer('client.send.excluding_middleware', resolution=TimerResolution.MICROSECONDS):
+                    try:
+                        results = self.transport.send_request_messages(
+                            batch,
+                            message_expiry_in_seconds,
+                        )  # type: List[Optional[PySOATransportError]]
+                    except PySOATransportError as e:
+                        results = [e] * len(batch)
+                for (request_id, _, _), result in zip(batch, results):
+                    if result is not None:
+                        errors[request_id] = result
+                        self.fail_request(request_id, result)
+        finally:
+            self.metrics.publish_all()
+
+        return errors
+
+    def take_send_batch(self):  # type: () -> Dict[Optional[float], List[_OutgoingMessage]]
+        """
+        Stop deferring requests on the current thread, like :meth:`flush_send_batch`, but return the deferred requests
+        instead of sending them, so that the caller can send them (for example, with an asyncio transport).
+
+        :return: An ordered dict of message expiries to lists of `(request_id, meta, body)` messages with that expiry
+        """
+        messages = self._send_batch.get()
+        self._send_batch.set(None)
+
+        # Requests with different expiries cannot share a transport call, but, in practice, a batch has just one
+        batches = collections.OrderedDict()  # type: Dict[Optional[float], List[_OutgoingMessage]]
+        for message, message_expiry_in_seconds in messages or []:
+            batches.setdefault(message_expiry_in_seconds, []).append(message)
+        return batches
+
+    def discard_send_batch(self, error):  # type: (Exception) -> None
+        """
+        Stop deferring requests on the current thread, like :meth:`flush_send_batch`, but discard the deferred requests
+        instead of sending them, so that requests coalesced with them fail instead of waiting.
+
+        :param error: The error that prevented the requests from being sent
+        """
+        for batch in six.itervalues(self.take_send_batch()):
+            for request_id, _, _ in batch:
+                self.fail_request(request_id, error)
+
     def send_request(self, job_request, message_expiry_in_seconds=None):
-        # type: (JobRequest, Optional[int]) -> int
+        # type: (JobRequest, Optional[float]) -> int
         """
         Send a JobRequest, and return a request ID.
 
@@ -160,6 +316,13 @@ class ServiceHandler(object):
         """
         request_id = self.request_counter
         self.request_counter += 1
+
+        coalescing_key = self._get_coalescing_key(job_request)
+        if coalescing_key and self._coalesce_request(request_id, coalescing_key, message_expiry_in_seconds):
+            self.metrics.counter('client.send.coalesced').increment()
+            self.metrics.publish_all()
+            return request_id
+
         meta = {
             'client_version': self._client_version,
         }  # type: Dict[six.text_type, Any]
@@ -167,11 +330,185 @@ class ServiceHandler(object):
             with self.metrics.timer('client.send.including_middleware', resolution=TimerResolution.MICROSECONDS):
                 self._middleware_send_request_wrapper(request_id, meta, job_request, message_expiry_in_seconds)
             return request_id
+        except Exception as e:
+            if coalescing_key:
+                self.fail_request(request_id, e)
+            raise
         finally:
             self.metrics.publish_all()
 
+    def _get_coalescing_key(self, job_request):  # type: (JobRequest) -> Optional[Tuple[Any, ...]]
+        if (
+            not self._coalesced_actions or
+            not job_request.actions or
+            job_request.control.get('suppress_response') or
+            any(action_request.action not in self._coalesced_actions for action_request in job_request.actions)
+        ):
+            return None
+
+        try:
+            digest = canonical_digest([
+                [action_request.body for action_request in job_request.actions],
+                bool(job_request.control.get('continue_on_error')),
+            ])
+        except (TypeError, ValueError):
+            return None
+        return (
+            tuple(action_request.action for action_request in job_request.actions),
+            digest,
+            tuple(sorted(job_request.context.get('switches') or [])),
+        )
+
+    def _coalesce_request(self, request_id, key, message_expiry_in_seconds):
+        # type: (int, Tuple[Any, ...], Optional[float]) -> bool
+        """
+        Coalesce the request with an identical outstanding request, if there is one, or else record it as outstanding.
+
+        :return: `True` if the request was coalesced and must not be sent, `False` if it must be sent.
+        """
+        now = time.time()
+        with self._coalescing_lock:
+            outstanding = self._coalescing_requests.get(key)
+            if outstanding is not None and not outstanding.done.is_set() and outstanding.expires_at > now:
+                coalesced = self._coalesced_requests.get()
+                if coalesced is None:
+                    coalesced = collections.OrderedDict()
+                    self._coalesced_requests.set(coalesced)
+                coalesced[request_id] = outstanding
+                return True
+
+            self._coalescing_requests[key] = self._coalescing_request_ids[request_id] = _CoalescedRequest(
+                key,
+                now + (message_expiry_in_seconds or self.DEFAULT_COALESCING_EXPIRY_IN_SECONDS),
+                self._get_coalescing_owner(),
+            )
+
+            # Forget requests whose responses were never received (the request IDs are roughly in order of expiry)
+            while self._coalescing_request_ids:
+                oldest_request_id, oldest = next(six.iteritems(self._coalescing_request_ids))
+                if oldest.expires_at > now:
+                    break
+                del self._coalescing_request_ids[oldest_request_id]
+                self._forget_coalescing_request(oldest)
+            return False
+
+    def _get_coalescing_owner(self):  # type: () -> object
+        owner = self._coalescing_owner.get()
+        if owner is None:
+            owner = object()
+            self._coalescing_owner.set(owner)
+        return owner
+
+    def _forget_coalescing_request(self, outstanding):  # type: (_CoalescedRequest) -> None
+        # Must be called with the coalescing lock held
+        key = outstanding.key
+        if self._coalescing_requests.get(key) is outstanding:
+            del self._coalescing_requests[key]
+
+    def _finish_coalescing(self, request_id, response=None, error=None):
+        # type: (int, Optional[JobResponse], Optional[Exception]) -> None
+        if not self._coalescing_request_ids:
+            return
+
+        with self._coalescing_lock:
+            outstanding = self._coalescing_request_ids.pop(request_id, None)
+            if outstanding is None:
+                return
+            self._forget_coalescing_request(outstanding)
+            # Copy the response now, before its receiver can change it
+            outstanding.response = copy_job_response(response) if response is not None else None
+            outstanding.error = error
+            outstanding.done.set()
+            callbacks, outstanding.callbacks = outstanding.callbacks, []
+
+        for callback in callbacks:
+            callback()
+
+    def fail_request(self, request_id, error):  # type: (int, Exception) -> None
+        """
+        Report that the response to a request will not be received because of the given error, so that any requests
+        coalesced with it fail with the same error instead of waiting. This is called automatically for errors raised
+        by this handler's methods.
+
+        :param request_id: The request ID of the failed request
+        :param error: The error
+        """
+        self._finish_coalescing(request_id, error=error)
+
+    def is_coalesced_request(self, request_id):  # type: (int) -> bool
+        """
+        :param request_id: The request ID of a request sent by this thread whose response has not yet been received
+
+        :return: `True` if the request was coalesced with an identical outstanding request instead of being sent (see
+                 the `coalesced_actions` setting), in which case its response is not received from the transport.
+        """
+        return request_id in (self._coalesced_requests.get() or {})
+
+    def _get_coalesced_response(self, receive_timeout_in_seconds=None):
+        # type: (Optional[float]) -> Tuple[Optional[int], Optional[JobResponse]]
+        coalesced = self._coalesced_requests.get()
+        if not coalesced:
+            return None, None
+
+        request_id, outstanding = next(
+            (item for item in six.iteritems(coalesced) if item[1].done.is_set()),
+            next(six.iteritems(coalesced)),
+        )
+        if not outstanding.done.wait(
+            self._coalesced_receive_timeout_in_seconds if receive_timeout_in_seconds is None
+            else receive_timeout_in_seconds
+        ):
+            raise MessageReceiveTimeout('No response received for a coalesced request to {}'.format(self.service_name))
+
+        del coalesced[request_id]
+        if outstanding.error is not None:
+            raise outstanding.error
+        return request_id, copy_job_response(cast(JobResponse, outstanding.response))
+
+    def add_local_response(self, request_id, job_response):  # type: (int, JobResponse) -> None
+        """
+        Provide the response to a request that request middleware answered itself instead of calling the next level
+        down to send it. The response is then received, through all response middleware, just like a response from the
+        service. This must be called in the thread (or asyncio task) that sent the request.
+
+        :param request_id: The request ID of the request that was not sent
+        :param job_response: The response to that request
+        """
+        responses = self._local_responses.get()
+        if responses is None:
+            responses = collections.OrderedDict()
+            self._local_responses.set(responses)
+        responses[request_id] = job_response
+
+    def get_local_response(self, request_id):  # type: (int) -> Optional[JobResponse]
+        """
+        Take the response to the given request, passed through all response middleware, if request middleware answered
+        the request itself (see :meth:`add_local_response`).
+
+        :param request_id: The request ID of a request sent by this thread whose response has not yet been received
+
+        :return: The job response, or `None` if the request was sent to the service
+        """
+        _, response = self._pop_local_response(request_id)
+        if response is None:
+            return None
+        return self._process_response(request_id, response)
+
+    def _pop_local_response(self, request_id=None):
+        # type: (Optional[int]) -> Tuple[Optional[int], Optional[JobResponse]]
+        responses = self._local_responses.get()
+        if not responses:
+            return None, None
+        if request_id is None:
+            return responses.popitem(last=False)
+        return request_id, responses.pop(request_id, None)
+
     def _base_get_response(self, receive_timeout_in_seconds=None):
-        # type: (int) -> Tuple[Optional[int], Optional[JobResponse]]
+        # type: (Optional[float]) -> Tuple[Optional[int], Optional[JobResponse]]
+        request_id, response = self._pop_local_response()
+        if response is not None:
+            return request_id, response
+
         with self.metrics.timer('client.receive.excluding_middleware', resolution=TimerResolution.MICROSECONDS):
             request_id, meta, message = self.transport.receive_response_message(receive_timeout_in_seconds)
             if message is None:
@@ -180,7 +517,7 @@ class ServiceHandler(object):
                 return request_id, JobResponse(**message)
 
     def get_all_responses(self, receive_timeout_in_seconds=None):
-        # type: (Optional[int]) -> Generator[Tuple[int, JobResponse], None, None]
+        # type: (Optional[float]) -> Generator[Tuple[int, JobResponse], None, None]
         """
         Receive all available responses from the transport as a generator.
 
@@ -194,14 +531,115 @@ class ServiceHandler(object):
         """
         try:
             while True:
-                with self.metrics.timer('client.receive.including_middleware', resolution=TimerResolution.MICROSECONDS):
-                    request_id, response = self._middleware_get_response_wrapper(receive_timeout_in_seconds)
+                try:
+                    with self.metrics.timer(
+                        'client.receive.including_middleware',
+                        resolution=TimerResolution.MICROSECONDS,
+                    ):
+                        request_id, response = self._middleware_get_response_wrapper(receive_timeout_in_seconds)
+                except Exception as e:
+                    # The requests this thread or task sent will not be received now, so fail any coalesced with them
+                    owner = self._coalescing_owner.get()
+                    with self._coalescing_lock:
+                        failed_ids = [
+                            outstanding_id
+                            for outstanding_id, outstanding in six.iteritems(self._coalescing_request_ids)
+                            if owner is not None and outstanding.owner is owner
+                        ]
+                    for outstanding_id in failed_ids:
+                        self.fail_request(outstanding_id, e)
+                    raise
+
                 if request_id is None or response is None:
-                    break
+                    # All sent requests have been received, so wait on the responses to coalesced requests, if any
+                    request_id, response = self._get_coalesced_response(receive_timeout_in_seconds)
+                    if request_id is None or response is None:
+                        break
+                else:
+                    self._finish_coalescing(request_id, response=response)
                 yield request_id, response
         finally:
             self.metrics.publish_all()
 
+    def get_response_future(self, request_id):  # type: (int) -> concurrent.futures.Future
+        """
+        Get a `concurrent.futures.Future` that completes with the job response to a request sent by this thread as soon
+        as the response arrives, without any further calls to this handler. The response passes through all response
+        middleware, in the thread that received it. Requires a transport that supports response futures, such as the
+        Redis Gateway transport with `demultiplex_responses` enabled.
+
+        :param request_id: The request ID of a request sent by this thread whose response has not yet been received
+
+        :return: A future of the `JobResponse`
+
+        :raises: :class:`ValueError`
+        """
+        coalesced = self._coalesced_requests.get() or {}
+        if request_id in coalesced:
+            outstanding = coalesced.pop(request_id)  # type: _CoalescedRequest
+            coalesced_future = concurrent.futures.Future()  # type: concurrent.futures.Future
+            coalesced_future.set_running_or_notify_cancel()
+
+            def deliver():  # type: () -> None
+                if outstanding.error is not None:
+                    coalesced_future.set_exception(outstanding.error)
+                else:
+                    coalesced_future.set_result(copy_job_response(cast(JobResponse, outstanding.response)))
+
+            with self._coalescing_lock:
+                if not outstanding.done.is_set():
+                    outstanding.callbacks.append(deliver)
+                    return coalesced_future
+            deliver()
+            return coalesced_future
+
+        local_response = self.get_local_response(request_id)
+        if local_response is not None:
+            local_future = concurrent.futures.Future()  # type: concurrent.futures.Future
+            local_future.set_running_or_notify_cancel()
+            local_future.set_result(local_response)
+            return local_future
+
+        get_transport_future = getattr(self.transport, 'get_response_future', None)
+        if get_transport_future is None:
+            raise ValueError('The transport for service {} does not support response futures'.format(self.service_name))
+
+        transport_future = get_transport_future(request_id)  # type: concurrent.futures.Future
+        future = concurrent.futures.Future()  # type: concurrent.futures.Future
+        future.set_running_or_notify_cancel()
+
+        def complete(done):  # type: (concurrent.futures.Future) -> None
+            try:
+                received_request_id, _, message = done.result()
+                future.set_result(self.process_received_response(received_request_id, message))
+            except Exception as e:
+                self.fail_request(request_id, e)
+                future.set_exception(e)
+
+        transport_future.add_done_callback(complete)
+        return future
+
+    def process_received_response(self, request_id, message):
+        # type: (int, Dict[six.text_type, Any]) -> JobResponse
+        """
+        Pass a response message that was received directly from the transport (instead of with
+        :meth:`get_all_responses`) through all response middleware.
+
+        :param request_id: The request ID of the received response
+        :param message: The received response message body
+
+        :return: The job response returned by the response middleware
+        """
+        return self._process_response(request_id, JobResponse(**message))
+
+    def _process_response(self, request_id, job_response):  # type: (int, JobResponse) -> JobResponse
+        def get_response(_timeout):  # type: (Optional[float]) -> Tuple[Optional[int], Optional[JobResponse]]
+            return request_id, job_response
+
+        _, response = self._make_middleware_stack([m.response for m in self._middleware], get_response)(None)
+        self._finish_coalescing(request_id, response=response)
+        return cast(JobResponse, response)
+
 
 _FR = TypeVar(
     '_FR',
@@ -238,12 +676,12 @@ class FutureSOAResponse(Generic[_FR]):
         ('tb', Optional[TracebackType]),
     ))
 
-    def __init__(self, get_response):  # type: (Callable[[Optional[int]], _FR]) -> None
-        self._get_response = get_response  # type: Callable[[Optional[int]], _FR]
+    def __init__(self, get_response):  # type: (Callable[[Optional[float]], _FR]) -> None
+        self._get_response = get_response  # type: Callable[[Optional[float]], _FR]
         self._response = None  # type: Optional[_FR]
         self._raise = None  # type: Optional[FutureSOAResponse.DelayedException]
 
-    def result(self, timeout=None):  # type: (Optional[int]) -> _FR
+    def result(self, timeout=None):  # type: (Optional[float]) -> _FR
         """
         Obtain the result of this future response.
 
@@ -290,7 +728,7 @@ class FutureSOAResponse(Generic[_FR]):
             self._raise = self.DelayedException(t, e, tb)
             raise
 
-    def exception(self, timeout=None):  # type: (int) -> Optional[BaseException]
+    def exception(self, timeout=None):  # type: (Optional[float]) -> Optional[BaseException]
         """
         Obtain the exception raised by the call, blocking if necessary, per the rules specified in the
         documentation for :meth:`result`. If the call completed without raising an exception, `None` is returned.
@@ -338,7 +776,7 @@ class FutureSOAResponse(Generic[_FR]):
         return bool(self._response or self._raise)
 
 
-class Client(object):
+class Client(AsyncClientMixin):
     """
     The `Client` provides a simple interface for calling actions on services and supports both sequential and
     parallel action invocation.
@@ -353,6 +791,7 @@ class Client(object):
         expansion_config=None,  # type: Optional[SettingsData]
         settings_class=None,  # type: Optional[Type[ClientSettings]]
         context=None,  # type: Optional[Context]
+        deadline=None,  # type: Optional[float]
     ):
         # type: (...) -> None
         """
@@ -364,9 +803,14 @@ class Client(object):
                                :class:`pysoa.client.settings.ClientSettings`
         :param context: An optional base request context that will be used for all requests this client instance sends
                         (individual calls can add to and override the values supplied in this context dict)
+        :param deadline: An optional Unix-epoch timestamp after which this client will no longer send requests or
+                         receive responses; every request sent before then expires no later than the deadline, and
+                         receive timeouts passed to this client are shortened to end no later than it, too. The
+                         deadline is propagated to the called services in the `deadline` context key.
         """
         self.settings_class = settings_class or self.__class__.settings_class
         self.context = context or {}  # type: Context
+        self.deadline = deadline
 
         self.handlers = {}  # type: Dict[six.text_type, ServiceHandler]
         self.settings = {}  # type: Dict[six.text_type, ClientSettings]
@@ -374,6 +818,14 @@ class Client(object):
         for service_name, service_config in self.config.items():
             self.settings[service_name] = self.settings_class(service_config)
 
+        # Holds, per thread and asyncio task, the handlers that are deferring requests for batched sending, and how
+        # deeply batches are nested
+        self._send_batch_handlers = ContextVar(
+            'pysoa_client_send_batch_handlers',
+            default=None,
+        )  # type: ContextVar[Optional[List[ServiceHandler]]]
+        self._send_batch_depth = ContextVar('pysoa_client_send_batch_depth', default=0)  # type: ContextVar[int]
+
         if expansion_config:
             expansion_settings = ExpansionSettings(expansion_config)
             self.expansion_converter = ExpansionConverter(
@@ -400,6 +852,9 @@ class Client(object):
     CallActionError = CallActionError
     """Convenience alias for :class:`pysoa.client.errors.CallActionError`"""
 
+    DeadlineExceeded = DeadlineExceeded
+    """Convenience alias for :class:`pysoa.client.errors.DeadlineExceeded`"""
+
     # Blocking methods that send a request and wait until a response is available
 
     def call_action(
@@ -410,7 +865,7 @@ class Client(object):
         expansions=None,  # type: Expansions
         raise_job_errors=True,  # type: bool
         raise_action_errors=True,  # type: bool
-        timeout=None,  # type: Optional[int]
+        timeout=None,  # type: Optional[float]
         switches=None,  # type: Optional[Union[List[int], AbstractSet[int]]]
         correlation_id=None,  # type: Optional[six.text_type]
         context=None,  # type: Optional[Context]
@@ -436,7 +891,8 @@ class Client(object):
                                     responses contain errors (defaults to `True`).
         :param timeout: If provided, this will override the default transport timeout values to; requests will expire
                         after this number of seconds plus some buffer defined by the transport, and the client will not
-                        block waiting for a response for longer than this amount of time.
+                        block waiting for a response for longer than this amount of time. It may be a fractional number
+                        of seconds, such as `0.15`.
         :param switches: A list of switch value integers.
         :param correlation_id: The request correlation ID.
         :param context: A dictionary of extra values to include in the context header.
@@ -468,7 +924,7 @@ class Client(object):
         expansions=None,  # type: Expansions
         raise_job_errors=True,  # type: bool
         raise_action_errors=True,  # type: bool
-        timeout=None,  # type: Optional[int]
+        timeout=None,  # type: Optional[float]
         switches=None,  # type: Optional[Union[List[int], AbstractSet[int]]]
         correlation_id=None,  # type: Optional[six.text_type]
         continue_on_error=False,  # type: bool
@@ -495,7 +951,8 @@ class Client(object):
                                     responses contain errors (defaults to `True`).
         :param timeout: If provided, this will override the default transport timeout values to; requests will expire
                         after this number of seconds plus some buffer defined by the transport, and the client will not
-                        block waiting for a response for longer than this amount of time.
+                        block waiting for a response for longer than this amount of time. It may be a fractional number
+                        of seconds, such as `0.15`.
         :param switches: A list of switch value integers.
         :param correlation_id: The request correlation ID.
         :param continue_on_error: Whether the service should continue executing further actions once one action has
@@ -530,7 +987,7 @@ class Client(object):
         raise_job_errors=True,  # type: bool
         raise_action_errors=True,  # type: bool
         catch_transport_errors=False,  # type: bool
-        timeout=None,  # type: Optional[int]
+        timeout=None,  # type: Optional[float]
         switches=None,  # type: Optional[Union[List[int], AbstractSet[int]]]
         correlation_id=None,  # type: Optional[six.text_type]
         context=None,  # type: Optional[Context]
@@ -565,7 +1022,8 @@ class Client(object):
                                        the successful responses even if there are errors getting other responses.
         :param timeout: If provided, this will override the default transport timeout values to; requests will expire
                         after this number of seconds plus some buffer defined by the transport, and the client will not
-                        block waiting for a response for longer than this amount of time.
+                        block waiting for a response for longer than this amount of time. It may be a fractional number
+                        of seconds, such as `0.15`.
         :param switches: A list of switch value integers.
         :param correlation_id: The request correlation ID.
         :param context: A dictionary of extra values to include in the context header.
@@ -597,7 +1055,7 @@ class Client(object):
         raise_job_errors=True,  # type: bool
         raise_action_errors=True,  # type: bool
         catch_transport_errors=False,  # type: bool
-        timeout=None,  # type: Optional[int]
+        timeout=None,  # type: Optional[float]
         switches=None,  # type: Optional[Union[List[int], AbstractSet[int]]]
         correlation_id=None,  # type: Optional[six.text_type]
         continue_on_error=False,  # type: bool
@@ -633,7 +1091,8 @@ class Client(object):
                                        the successful responses even if there are errors getting other responses.
         :param timeout: If provided, this will override the default transport timeout values to; requests will expire
                         after this number of seconds plus some buffer defined by the transport, and the client will not
-                        block waiting for a response for longer than this amount of time.
+                        block waiting for a response for longer than this amount of time. It may be a fractional number
+                        of seconds, such as `0.15`.
         :param switches: A list of switch value integers.
         :param correlation_id: The request correlation ID.
         :param continue_on_error: Whether the service should continue executing further actions once one action has
@@ -670,7 +1129,7 @@ class Client(object):
         expansions=None,  # type: Expansions
         raise_job_errors=True,  # type: bool
         raise_action_errors=True,  # type: bool
-        timeout=None,  # type: Optional[int]
+        timeout=None,  # type: Optional[float]
         switches=None,  # type: Optional[Union[List[int], AbstractSet[int]]]
         correlation_id=None,  # type: Optional[six.text_type]
         context=None,  # type: Optional[Context]
@@ -705,7 +1164,7 @@ class Client(object):
             control_extra=control_extra,
         )
 
-        def get_result(_timeout):  # type: (Optional[int]) -> ActionResponse
+        def get_result(_timeout):  # type: (Optional[float]) -> ActionResponse
             result = future.result(_timeout)
             if result.errors:
                 # This can only happen if raise_job_errors is set to False, so return the list of errors, just like
@@ -722,7 +1181,7 @@ class Client(object):
         expansions=None,  # type: Expansions
         raise_job_errors=True,  # type: bool
         raise_action_errors=True,  # type: bool
-        timeout=None,  # type: Optional[int]
+        timeout=None,  # type: Optional[float]
         switches=None,  # type: Optional[Union[List[int], AbstractSet[int]]]
         correlation_id=None,  # type: Optional[six.text_type]
         continue_on_error=False,  # type: bool
@@ -752,7 +1211,7 @@ class Client(object):
             message_expiry_in_seconds=timeout if timeout else None,
         )
 
-        def get_response(_timeout):  # type: (Optional[int]) -> JobResponse
+        def get_response(_timeout):  # type: (Optional[float]) -> JobResponse
             # Get all responses
             responses = list(
                 self.get_all_responses(service_name, receive_timeout_in_seconds=_timeout or timeout)
@@ -806,7 +1265,7 @@ class Client(object):
         raise_job_errors=True,  # type: bool
         raise_action_errors=True,  # type: bool
         catch_transport_errors=False,  # type: bool
-        timeout=None,  # type: Optional[int]
+        timeout=None,  # type: Optional[float]
         switches=None,  # type: Optional[Union[List[int], AbstractSet[int]]]
         correlation_id=None,  # type: Optional[six.text_type]
         context=None,  # type: Optional[Context]
@@ -854,7 +1313,7 @@ class Client(object):
                 else:
                     yield job.actions[0]
 
-        def get_response(_timeout):  # type: (Optional[int]) -> Generator[ActionResponse, None, None]
+        def get_response(_timeout):  # type: (Optional[float]) -> Generator[ActionResponse, None, None]
             # This looks weird, but we want `job_response.result` to be called eagerly, before they actually start
             # iterating over it.
             return parse_results(job_responses.result(_timeout))
@@ -868,7 +1327,7 @@ class Client(object):
         raise_job_errors=True,  # type: bool
         raise_action_errors=True,  # type: bool
         catch_transport_errors=False,  # type: bool
-        timeout=None,  # type: Optional[int]
+        timeout=None,  # type: Optional[float]
         switches=None,  # type: Optional[Union[List[int], AbstractSet[int]]]
         correlation_id=None,  # type: Optional[six.text_type]
         continue_on_error=False,  # type: bool
@@ -892,28 +1351,44 @@ class Client(object):
 
         response_reassembly_keys = []  # type: List[Tuple[six.text_type, int]]
         service_request_ids = {}  # type: Dict[six.text_type, Set[int]]
-        for job in jobs:
-            try:
-                sent_request_id = self.send_request(
-                    service_name=job['service_name'],
-                    actions=job['actions'],
-                    switches=switches,
-                    correlation_id=correlation_id,
-                    continue_on_error=continue_on_error,
-                    context=context,
-                    control_extra=control_extra,
-                    message_expiry_in_seconds=timeout if timeout else None,
-                )
-                service_request_ids.setdefault(job['service_name'], set()).add(sent_request_id)
-            except PySOATransportError as e:
-                if not catch_transport_errors:
-                    raise
-                sent_request_id = error_key = error_key - 1
-                transport_errors[(job['service_name'], sent_request_id)] = e
+        # Requests are deferred and then sent together, per service, when the batch is flushed
+        self._begin_send_batch()
+        try:
+            for job in jobs:
+                try:
+                    sent_request_id = self.send_request(
+                        service_name=job['service_name'],
+                        actions=job['actions'],
+                        switches=switches,
+                        correlation_id=correlation_id,
+                        continue_on_error=continue_on_error,
+                        context=context,
+                        control_extra=control_extra,
+                        message_expiry_in_seconds=timeout if timeout else None,
+                    )
+                    service_request_ids.setdefault(job['service_name'], set()).add(sent_request_id)
+                except PySOATransportError as e:
+                    if not catch_transport_errors:
+                        raise
+                    sent_request_id = error_key = error_key - 1
+                    transport_errors[(job['service_name'], sent_request_id)] = e
 
-            response_reassembly_keys.append((job['service_name'], sent_request_id))
+                response_reassembly_keys.append((job['service_name'], sent_request_id))
+        finally:
+            send_errors = self._flush_send_batch()
 
-        def get_response(_timeout):  # type: (Optional[int]) -> List[JobResponse]
+        if send_errors:
+            for key in response_reassembly_keys:
+                if key in send_errors:
+                    if not catch_transport_errors:
+                        raise send_errors[key]
+                    transport_errors[key] = send_errors[key]
+                    service_request_ids[key[0]].discard(key[1])
+                    if not service_request_ids[key[0]]:
+                        # Nothing was sent to this service, so there is nothing to receive from it
+                        del service_request_ids[key[0]]
+
+        def get_response(_timeout):  # type: (Optional[float]) -> List[JobResponse]
             service_responses = {}
             for service_name, request_ids in six.iteritems(service_request_ids):
                 try:
@@ -993,7 +1468,7 @@ class Client(object):
         continue_on_error=False,  # type: bool
         context=None,  # type: Optional[Context]
         control_extra=None,  # type: Optional[Control]
-        message_expiry_in_seconds=None,  # type: Optional[int]
+        message_expiry_in_seconds=None,  # type: Optional[float]
         suppress_response=False,  # type: bool
     ):
         # type: (...) -> int
@@ -1018,14 +1493,30 @@ class Client(object):
 
         :return: The request ID
 
-        :raises: :class:`pysoa.common.transport.errors.PySOATransportError`
+        :raises: :class:`pysoa.common.transport.errors.PySOATransportError`, :class:`DeadlineExceeded`
         """
 
+        handler = self._get_handler(service_name)
+
+        if self.deadline:
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                handler.metrics.counter('client.send.error.deadline_exceeded').increment()
+                raise self.DeadlineExceeded(
+                    'Not sending the request to service "{}" because the deadline has passed'.format(service_name),
+                )
+            # The request must not outlive the deadline, even if no expiry was requested
+            message_expiry_in_seconds = min(message_expiry_in_seconds or remaining, remaining)
+
         control_extra = control_extra.copy() if control_extra else {}
         if message_expiry_in_seconds and 'timeout' not in control_extra:
             control_extra['timeout'] = message_expiry_in_seconds
 
-        handler = self._get_handler(service_name)
+        batching_handlers = self._send_batch_handlers.get()
+        if batching_handlers is not None and handler not in batching_handlers:
+            handler.begin_send_batch()
+            batching_handlers.append(handler)
+
         control = self._make_control_header(
             continue_on_error=continue_on_error,
             control_extra=control_extra,
@@ -1040,7 +1531,7 @@ class Client(object):
         return handler.send_request(job_request, message_expiry_in_seconds)
 
     def get_all_responses(self, service_name, receive_timeout_in_seconds=None):
-        # type: (six.text_type, Optional[int]) -> Generator[Tuple[int, JobResponse], None, None]
+        # type: (six.text_type, Optional[float]) -> Generator[Tuple[int, JobResponse], None, None]
         """
         Receive all available responses from the service as a generator.
 
@@ -1051,14 +1542,77 @@ class Client(object):
 
         :return: A generator that yields a two-tuple of request ID, job response
 
-        :raises: :class:`pysoa.common.transport.errors.PySOATransportError`
+        :raises: :class:`pysoa.common.transport.errors.PySOATransportError`, :class:`DeadlineExceeded`
         """
 
         handler = self._get_handler(service_name)
+        if self.deadline:
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                handler.metrics.counter('client.receive.error.deadline_exceeded').increment()
+                raise self.DeadlineExceeded(
+                    'Not receiving responses from service "{}" because the deadline has passed'.format(service_name),
+                )
+            if receive_timeout_in_seconds:
+                # Waiting beyond the deadline is pointless
+                receive_timeout_in_seconds = min(receive_timeout_in_seconds, remaining)
         return handler.get_all_responses(receive_timeout_in_seconds)
 
+    def get_response_future(self, service_name, request_id):  # type: (six.text_type, int) -> concurrent.futures.Future
+        """
+        Get a `concurrent.futures.Future` that completes with the job response to a request sent (by this thread) with
+        `send_request` as soon as the response arrives, without any further calls to the client. Unlike
+        `FutureSOAResponse`, these futures support `add_done_callback`, `concurrent.futures.wait`, and
+        `concurrent.futures.as_completed`. The transport must support response futures, such as the Redis Gateway
+        transport with `demultiplex_responses` enabled, and a response whose future has been got is no longer returned
+        by `get_all_responses`.
+
+        :param service_name: The name of the service to which the request was sent
+        :param request_id: The request ID returned by `send_request`
+
+        :return: A future of the `JobResponse`, which raises `MessageReceiveTimeout` if the request expires without a
+                 response.
+
+        :raises: :class:`ValueError`
+        """
+        return self._get_handler(service_name).get_response_future(request_id)
+
     # Private methods used to support all of the above methods
 
+    def _begin_send_batch(self):  # type: () -> None
+        # Nested batches are merged into the outermost batch, which does all of the flushing
+        if self._send_batch_handlers.get() is None:
+            self._send_batch_handlers.set([])
+            self._send_batch_depth.set(0)
+        self._send_batch_depth.set(self._send_batch_depth.get() + 1)
+
+    def _flush_send_batch(self):  # type: () -> Dict[Tuple[six.text_type, int], PySOATransportError]
+        depth = self._send_batch_depth.get() - 1
+        self._send_batch_depth.set(depth)
+        if depth > 0:
+            return {}
+
+        handlers = self._send_batch_handlers.get() or []
+        self._send_batch_handlers.set(None)
+
+        errors = {}  # type: Dict[Tuple[six.text_type, int], PySOATransportError]
+        for handler in handlers:
+            for request_id, error in six.iteritems(handler.flush_send_batch()):
+                errors[(handler.service_name, request_id)] = error
+        return errors
+
+    def _discard_send_batch(self, error):  # type: (Exception) -> None
+        depth = self._send_batch_depth.get() - 1
+        self._send_batch_depth.set(depth)
+        if depth > 0:
+            return
+
+        handlers = self._send_batch_handlers.get() or []
+        self._send_batch_handlers.set(None)
+
+        for handler in handlers:
+            handler.discard_send_batch(error)
+
     def _perform_expansion(
         self,
         actions,  # type: Iterable[ActionResponse]
@@ -1068,42 +1622,18 @@ class Client(object):
         # Perform expansions
         if expansions and getattr(self, 'expansion_converter', None):
             try:
-                trees = self.expansion_converter.dict_to_trees(expansions)
-                objects_to_expand = self._extract_candidate_objects(actions, trees)
+                plan = self.expansion_converter.compile(expansions)
             except KeyError as e:
                 raise self.InvalidExpansionKey('Invalid key in expansion request: {}'.format(e.args[0]))
             else:
-                self._expand_objects(objects_to_expand, trees, **kwargs)
-
-    @classmethod
-    def _extract_candidate_objects(
-        cls,
-        actions,  # type: Iterable[ActionResponse]
-        expansion_trees,  # type: List[TypeNode]
-    ):
-        # type: (...) -> List[Tuple[Dict[Any, Any], List[ExpansionNode]]]
-        # Build initial list of objects to expand
-        objects_to_expand = []  # type: List[Tuple[Dict[Any, Any], List[ExpansionNode]]]
-        for type_node in expansion_trees:
-            for action in actions:
-                cls._extend_expansion_objects(objects_to_expand, type_node, action.body)
-        return objects_to_expand
-
-    @staticmethod
-    def _extend_expansion_objects(
-        objects_to_expand,  # type: List[Tuple[Dict[Any, Any], List[ExpansionNode]]]
-        type_node,  # type: TypeNode
-        body,  # type: Body
-    ):
-        objects_to_expand.extend(
-            (expansion_object, type_node.expansions)
-            for expansion_object in type_node.find_objects(body)
-        )
+                # Build initial list of objects to expand
+                objects_to_expand = plan.find_objects(action.body for action in actions)
+                self._expand_objects(objects_to_expand, plan, **kwargs)
 
     def _expand_objects(
         self,
-        objects_to_expand,  # type: List[Tuple[Dict[Any, Any], List[ExpansionNode]]]
-        expansion_trees,  # type: List[TypeNode]
+        objects_to_expand,  # type: ExpansionObjects
+        expansion_plan,  # type: ExpansionPlan
         **kwargs  # type: Any
     ):
         # Keep track of expansion action errors that need to be raised
@@ -1119,10 +1649,9 @@ class Client(object):
                 lambda: collections.defaultdict(dict),
             )  # type: Dict[six.text_type, Dict[six.text_type, Dict[six.text_type, Any]]]
 
-            # Initialize mapping of service request IDs to expansion objects
-            expansion_service_requests = collections.defaultdict(
-                dict
-            )  # type: Dict[six.text_type, Dict[int, List[Dict[six.text_type, Any]]]]
+            # Keep track of the expansion nodes and objects expanded from caches, and the values they were expanded with
+            cached_expansions = []  # type: List[Tuple[ExpansionNode, Dict[Any, Any]]]
+            cached_values = collections.defaultdict(set)  # type: Dict[six.text_type, Set[Any]]
 
             # Formulate pending expansion requests to services
             for object_to_expand, expansion_nodes in objects_to_expand:
@@ -1134,10 +1663,32 @@ class Client(object):
                     ):
                         # Get the expansion identifier value
                         value = object_to_expand[expansion_node.source_field]
+                        if expansion_node.cache is not None:
+                            # Values already expanded are left to the duplicate check below, to prevent infinite
+                            # recursion just as if they were not cached
+                            key = '{}.{}.{}'.format(
+                                expansion_node.service,
+                                expansion_node.action,
+                                expansion_node.request_field,
+                            )
+                            if value not in expansion_requests_made.get(key, ()):
+                                found, cached_object = expansion_node.cache.get(value)
+                                if found:
+                                    object_to_expand[expansion_node.destination_field] = cached_object
+                                    cached_expansions.append((expansion_node, cached_object))
+                                    cached_values[key].add(value)
+                                    continue
                         # Call the action and map the request_id to the object we're expanding and the corresponding
                         # expansion node.
                         request_instruction = pending_expansion_requests[expansion_node.service][expansion_node.action]
                         request_instruction.setdefault('field', expansion_node.request_field)
+                        max_values_per_request = expansion_node.max_values_per_request
+                        if max_values_per_request:
+                            # All the expansions sharing this request get requests no larger than they allow
+                            request_instruction['max_values_per_request'] = min(
+                                max_values_per_request,
+                                request_instruction.get('max_values_per_request') or max_values_per_request,
+                            )
                         request_instruction.setdefault('values', set()).add(value)
                         request_instruction.setdefault('object_nodes', []).append({
                             'object': object_to_expand,
@@ -1145,6 +1696,106 @@ class Client(object):
                         })
 
             # Make expansion requests
+            expansion_service_requests = self._send_expansion_requests(
+                pending_expansion_requests,
+                expansion_requests_made,
+                **kwargs
+            )
+
+            # We have queued up requests for all expansions. Empty the queue, but we may add more to it.
+            objects_to_expand = []
+
+            # Potentially add additional pending expansion requests from cached objects, the same as from responses
+            for key, values in six.iteritems(cached_values):
+                expansion_requests_made.setdefault(key, set()).update(values)
+            for expansion_node, cached_object in cached_expansions:
+                objects_to_expand.extend(expansion_plan.find_objects(
+                    [cached_object],
+                    ([expansion_node] if expansion_node.expansions else []) + expansion_plan.trees,
+                ))
+
+            # Receive expansion responses from services for which we have outstanding requests
+            for service_name, request_id, response in self._receive_expansion_responses(
+                expansion_service_requests,
+                kwargs.get('message_expiry_in_seconds'),
+            ):
+                request_ids_to_objects = expansion_service_requests[service_name]
+                action_response = None  # type: Optional[ActionResponse]
+                newly_cached_keys = set()  # type: Set[Any]
+                nested_expansion_nodes = []  # type: List[TypeNode]
+                # Pop the request mapping off the list of pending requests and get the value of the expansion
+                # from the response.
+                for object_node in request_ids_to_objects.pop(request_id):
+                    object_to_expand = object_node['object']
+                    expansion_node = object_node['expansion']
+
+                    if response.errors:
+                        if expansion_node.raise_action_errors:
+                            expansion_job_errors_to_raise.extend(response.errors)
+                        continue
+
+                    action_response = response.actions[0]
+                    if action_response.errors and expansion_node.raise_action_errors:
+                        expansion_action_errors_to_raise.append(action_response)
+
+                    # If everything is okay, replace the expansion object with the response value
+                    if action_response.body:
+                        response_values = action_response.body[expansion_node.response_field]
+                        response_key = object_to_expand[expansion_node.source_field]
+                        if response_key in response_values:
+                            # It's okay if there isn't a matching value for this expansion; just means no match
+                            object_to_expand[expansion_node.destination_field] = response_values[response_key]
+                            if (
+                                expansion_node.cache is not None and
+                                not action_response.errors and
+                                response_key not in newly_cached_keys
+                            ):
+                                # Cache it before any nested expansions are added to it
+                                expansion_node.cache.put(response_key, response_values[response_key])
+                                newly_cached_keys.add(response_key)
+
+                        # Potentially add additional pending expansion requests (nested approach), once
+                        # for each expansion node with nested expansions.
+                        if (
+                            expansion_node.expansions and
+                            not any(n is expansion_node for n in nested_expansion_nodes)
+                        ):
+                            nested_expansion_nodes.append(expansion_node)
+
+                if action_response and action_response.body:
+                    # Potentially add additional pending expansion requests (global approach), finding the
+                    # objects for both approaches in a single pass over the response body.
+                    type_nodes = nested_expansion_nodes
+                    if not action_response.errors:
+                        type_nodes = type_nodes + expansion_plan.trees
+                    if type_nodes:
+                        objects_to_expand.extend(
+                            expansion_plan.find_objects([action_response.body], type_nodes),
+                        )
+
+            if expansion_action_errors_to_raise:
+                raise self.CallActionError(expansion_action_errors_to_raise)
+
+            if expansion_job_errors_to_raise:
+                raise self.JobError(expansion_job_errors_to_raise)
+
+    def _send_expansion_requests(
+        self,
+        pending_expansion_requests,  # type: Dict[six.text_type, Dict[six.text_type, Dict[six.text_type, Any]]]
+        expansion_requests_made,  # type: Dict[six.text_type, Set[Any]]
+        **kwargs  # type: Any
+    ):
+        # type: (...) -> Dict[six.text_type, Dict[int, List[Dict[six.text_type, Any]]]]
+        # Initialize mapping of service request IDs to expansion objects
+        expansion_service_requests = collections.defaultdict(
+            dict
+        )  # type: Dict[six.text_type, Dict[int, List[Dict[six.text_type, Any]]]]
+
+        # Requests are deferred and then sent together, per service, when the batch is flushed, so that the requests a
+        # large request is split into are processed in parallel by several server workers
+        send_order = []  # type: List[Tuple[six.text_type, int]]
+        self._begin_send_batch()
+        try:
             for service_name, actions in six.iteritems(pending_expansion_requests):
                 for action_name, instructions in six.iteritems(actions):
                     key = '{}.{}.{}'.format(service_name, action_name, instructions['field'])
@@ -1160,68 +1811,133 @@ class Client(object):
                             continue
                     expansion_requests_made[key].update(values)  # record that we have now expanded these values
 
-                    request_id = self.send_request(
-                        service_name,
-                        actions=[
-                            {'action': action_name, 'body': {instructions['field']: list(values)}},
-                        ],
-                        **kwargs
-                    )
-                    expansion_service_requests[service_name][request_id] = instructions['object_nodes']
-
-            # We have queued up requests for all expansions. Empty the queue, but we may add more to it.
-            objects_to_expand = []
-
-            # Receive expansion responses from services for which we have outstanding requests
-            for service_name, request_ids_to_objects in expansion_service_requests.items():
-                if request_ids_to_objects:
-                    # Receive all available responses from the service
-                    for request_id, response in self.get_all_responses(
-                        service_name,
-                        receive_timeout_in_seconds=kwargs.get('message_expiry_in_seconds'),
+                    for request_values, object_nodes in self._split_expansion_request(
+                        list(values),
+                        instructions['object_nodes'],
+                        instructions.get('max_values_per_request'),
                     ):
-                        action_response = None  # type: Optional[ActionResponse]
-                        # Pop the request mapping off the list of pending requests and get the value of the expansion
-                        # from the response.
-                        for object_node in request_ids_to_objects.pop(request_id):
-                            object_to_expand = object_node['object']
-                            expansion_node = object_node['expansion']
-
-                            if response.errors:
-                                if expansion_node.raise_action_errors:
-                                    expansion_job_errors_to_raise.extend(response.errors)
-                                continue
-
-                            action_response = response.actions[0]
-                            if action_response.errors and expansion_node.raise_action_errors:
-                                expansion_action_errors_to_raise.append(action_response)
-
-                            # If everything is okay, replace the expansion object with the response value
-                            if action_response.body:
-                                values = action_response.body[expansion_node.response_field]
-                                response_key = object_to_expand[expansion_node.source_field]
-                                if response_key in values:
-                                    # It's okay if there isn't a matching value for this expansion; just means no match
-                                    object_to_expand[expansion_node.destination_field] = values[response_key]
-
-                                # Potentially add additional pending expansion requests (nested approach).
-                                if expansion_node.expansions:
-                                    self._extend_expansion_objects(
-                                        objects_to_expand,
-                                        expansion_node,
-                                        action_response.body,
-                                    )
-
-                        if action_response and not action_response.errors and action_response.body:
-                            # Potentially add additional pending expansion requests (global approach).
-                            for type_node in expansion_trees:
-                                self._extend_expansion_objects(objects_to_expand, type_node, action_response.body)
+                        request_id = self.send_request(
+                            service_name,
+                            actions=[
+                                {'action': action_name, 'body': {instructions['field']: request_values}},
+                            ],
+                            **kwargs
+                        )
+                        expansion_service_requests[service_name][request_id] = object_nodes
+                        send_order.append((service_name, request_id))
+        except Exception as e:
+            exc_info = sys.exc_info()
+            # Nothing will receive the responses to this round, so the requests deferred so far are not sent, and any
+            # responses that request middleware provided for them are dropped
+            self._discard_send_batch(e)
+            self._discard_expansion_responses(expansion_service_requests, kwargs.get('message_expiry_in_seconds'))
+            six.reraise(*exc_info)
+
+        send_errors = self._flush_send_batch()
+        if send_errors:
+            error = next(send_errors[key] for key in send_order if key in send_errors)
+            # The other requests were sent, but nothing will receive their responses, so drain them before raising
+            for service_name, request_id in send_errors:
+                expansion_service_requests[service_name].pop(request_id, None)
+            self._discard_expansion_responses(expansion_service_requests, kwargs.get('message_expiry_in_seconds'))
+            raise error
+
+        return expansion_service_requests
+
+    def _discard_expansion_responses(
+        self,
+        expansion_service_requests,  # type: Dict[six.text_type, Dict[int, List[Dict[six.text_type, Any]]]]
+        receive_timeout_in_seconds,  # type: Optional[float]
+    ):  # type: (...) -> None
+        for service_name, request_ids_to_objects in six.iteritems(expansion_service_requests):
+            if not request_ids_to_objects:
+                continue
+            if concurrent:
+                try:
+                    for request_id in list(request_ids_to_objects):
+                        # Once its future has been got, a response is dropped when it arrives
+                        self.get_response_future(service_name, request_id)
+                        del request_ids_to_objects[request_id]
+                    continue
+                except (ValueError, self.ImproperlyConfigured):
+                    pass
+            try:
+                for _ in self.get_all_responses(service_name, receive_timeout_in_seconds=receive_timeout_in_seconds):
+                    pass
+            except PySOATransportError:
+                _logger.warning('Failed to receive discarded expansion responses from {}'.format(service_name))
 
-            if expansion_action_errors_to_raise:
-                raise self.CallActionError(expansion_action_errors_to_raise)
+    @staticmethod
+    def _split_expansion_request(
+        values,  # type: List[Any]
+        object_nodes,  # type: List[Dict[six.text_type, Any]]
+        max_values_per_request,  # type: Optional[int]
+    ):
+        # type: (...) -> List[Tuple[List[Any], List[Dict[six.text_type, Any]]]]
+        if not max_values_per_request or len(values) <= max_values_per_request:
+            return [(values, object_nodes)]
+
+        # Split the values into requests no larger than allowed, each with the objects to expand with its response
+        requests = [
+            (values[i:i + max_values_per_request], [])
+            for i in range(0, len(values), max_values_per_request)
+        ]  # type: List[Tuple[List[Any], List[Dict[six.text_type, Any]]]]
+        request_indexes = {value: i // max_values_per_request for i, value in enumerate(values)}
+        for object_node in object_nodes:
+            value = object_node['object'][object_node['expansion'].source_field]
+            # Objects whose values were already expanded in an earlier round go with the first request, as they would
+            # if the request were not split
+            requests[request_indexes.get(value, 0)][1].append(object_node)
+        return requests
+
+    def _receive_expansion_responses(
+        self,
+        expansion_service_requests,  # type: Dict[six.text_type, Dict[int, List[Dict[six.text_type, Any]]]]
+        receive_timeout_in_seconds,  # type: Optional[float]
+    ):
+        # type: (...) -> Generator[Tuple[six.text_type, int, JobResponse], None, None]
+        # When expanding with more than one service, receive the responses in the order they arrive, using response
+        # futures for the requests to services whose transports support them
+        futures = {}  # type: Dict[concurrent.futures.Future, Tuple[six.text_type, int]]
+        sequential_service_names = []  # type: List[six.text_type]
+        for service_name, request_ids_to_objects in six.iteritems(expansion_service_requests):
+            if not request_ids_to_objects:
+                continue
+            if concurrent and len(expansion_service_requests) > 1:
+                try:
+                    for request_id in request_ids_to_objects:
+                        futures[self.get_response_future(service_name, request_id)] = (service_name, request_id)
+                    continue
+                except (ValueError, self.ImproperlyConfigured):
+                    # The transport does not support response futures (or the service is stubbed and not configured),
+                    # so the remaining responses are received below (responses that came with futures, such as cached
+                    # responses, are not received again)
+                    pass
+            sequential_service_names.append(service_name)
+
+        def take_done_futures():  # type: () -> List[Tuple[six.text_type, int, JobResponse]]
+            done = [future for future in futures if future.done()]
+            return [futures.pop(future) + (future.result(), ) for future in done]
+
+        for service_name in sequential_service_names:
+            # Receive all available responses from the service, along with the responses whose futures completed while
+            # waiting on it
+            for item in take_done_futures():
+                yield item
+            for request_id, response in self.get_all_responses(
+                service_name,
+                receive_timeout_in_seconds=receive_timeout_in_seconds,
+            ):
+                for item in take_done_futures():
+                    yield item
+                yield service_name, request_id, response
 
-            if expansion_job_errors_to_raise:
-                raise self.JobError(expansion_job_errors_to_raise)
+        try:
+            for future in concurrent.futures.as_completed(list(futures), timeout=receive_timeout_in_seconds):
+                service_name, request_id = futures.pop(future)
+                yield service_name, request_id, future.result()
+        except concurrent.futures.TimeoutError:
+            raise MessageReceiveTimeout('Timed out waiting for expansion responses')
 
     def _get_handler(self, service_name):  # type: (six.text_type) -> ServiceHandler
         if not isinstance(service_name, six.text_type):
@@ -1269,5 +1985,7 @@ class Client(object):
         # Add any extra stuff
         if context_extra:
             context.update(context_extra)
+        if self.deadline and (not context.get('deadline') or self.deadline < context['deadline']):
+            context['deadline'] = self.deadline
         # context keys need to be guaranteed unicode
         return {six.text_type(k): v for k, v in six.iteritems(context)}
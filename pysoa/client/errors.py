@@ -33,6 +33,13 @@ class InvalidExpansionKey(PySOAClientError):
     """
 
 
+class DeadlineExceeded(PySOAClientError):
+    """
+    Raised when this client is asked to send a request or receive responses after its deadline has passed, because
+    the caller that supplied the deadline is no longer waiting for the results.
+    """
+
+
 class CallJobError(PySOAClientError):
     """
     Raised by `Client.call_***` methods when a job response contains one or more job errors. Stores a list of
@@ -3,15 +3,24 @@ from __future__ import (
     unicode_literals,
 )
 
+import collections
+import os
+import threading
+import time
 from typing import (
+    AbstractSet,
     Any,
     Dict,
+    Iterable,
     List,
     Optional,
+    Sequence,
+    Tuple,
     Union,
     cast,
 )
 
+import attr
 from conformity import fields
 from conformity.settings import (
     Settings,
@@ -19,10 +28,14 @@ from conformity.settings import (
 )
 import six
 
+from pysoa.utils import copy_preserving_keys
+
 
 __all__ = (
+    'ExpansionCache',
     'ExpansionConverter',
     'ExpansionNode',
+    'ExpansionPlan',
     'Expansions',
     'ExpansionSettings',
     'TypeExpansions',
@@ -106,8 +119,35 @@ class ExpansionSettings(Settings):
                                         'objects (by default, action errors are suppressed, which differs from the '
                                         'behavior of the `Client` to raise action errors during normal requests)',
                         ),
+                        'max_values_per_request': fields.Integer(
+                            gt=0,
+                            description='The maximum number of identifiers to send to the route in one request. If '
+                                        'more objects than this need to be expanded at once, their identifiers are '
+                                        'split into several requests, which are sent together so that several server '
+                                        'workers can handle them in parallel, and whose responses are merged. By '
+                                        'default, all the identifiers are sent in one request.',
+                        ),
+                        'cache': fields.Dictionary(
+                            {
+                                'ttl_in_seconds': fields.Float(
+                                    gt=0,
+                                    description='How long to cache each expansion object',
+                                ),
+                                'max_entries': fields.Integer(
+                                    gt=0,
+                                    description='The maximum number of expansion objects to cache, after which the '
+                                                'least recently used object is evicted; defaults to 1000',
+                                ),
+                            },
+                            optional_keys=('max_entries', ),
+                            description='If specified, the expansion objects obtained from the route are cached in '
+                                        'memory, across requests and `Client` instances in the same process, so that '
+                                        'only the identifiers missing from the cache are requested from the route. '
+                                        'Expansions that use the same route share one cache, whose settings are those '
+                                        'of whichever of these expansions is used first.',
+                        ),
                     },
-                    optional_keys=('raise_action_errors', ),
+                    optional_keys=('raise_action_errors', 'cache', 'max_values_per_request'),
                     description='The definition of one specific possible expansion for this object type',
                 ),
                 description='The definition of all possible expansions for this object type',
@@ -118,6 +158,91 @@ class ExpansionSettings(Settings):
     }  # type: SettingsSchema
 
 
+@attr.s
+class ExpansionCache(object):
+    """
+    A least-recently-used, in-memory cache of the expansion objects obtained from one expansion route, keyed by their
+    identifiers. Use `get_instance` to get the process-wide cache for a route instead of constructing one directly, so
+    that the cache outlives each `Client` (a server, for example, makes a new `Client` for each job).
+
+    Copies of the objects are stored and returned, so that callers (and nested expansions) can change them freely.
+
+    This class is thread-safe.
+    """
+
+    ttl_in_seconds = attr.ib(converter=float)  # type: float
+    max_entries = attr.ib(default=1000, converter=int)  # type: int
+
+    _instances = {}  # type: Dict[Tuple[int, six.text_type, six.text_type, six.text_type], ExpansionCache]
+    _instances_lock = threading.Lock()
+
+    def __attrs_post_init__(self):  # type: () -> None
+        self._lock = threading.Lock()
+        # Identifiers to tuples of the time of expiry and the object
+        self._entries = collections.OrderedDict()  # type: collections.OrderedDict
+
+    @classmethod
+    def get_instance(cls, service, action, request_field, **kwargs):
+        # type: (six.text_type, six.text_type, six.text_type, **Any) -> ExpansionCache
+        """
+        Get the cache for this process and the given expansion route, creating it with the given keyword arguments if
+        necessary (the arguments are ignored if the cache already exists). A process that forks gets new caches in the
+        child process.
+        """
+        key = (os.getpid(), service, action, request_field)
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(**kwargs)
+            return cls._instances[key]
+
+    def get(self, value):  # type: (Any) -> Tuple[bool, Any]
+        """
+        Get a copy of the cached expansion object with the given identifier.
+
+        :param value: The identifier
+
+        :return: A tuple of whether the object was cached (and has not expired) and the copy of the object.
+        """
+        try:
+            with self._lock:
+                entry = self._entries.pop(value, None)
+                if entry is None or entry[0] <= time.time():
+                    return False, None
+                # Move it to the most-recently-used end
+                self._entries[value] = entry
+        except TypeError:
+            # The identifier is not hashable
+            return False, None
+        return True, copy_preserving_keys(entry[1])
+
+    def put(self, value, obj):  # type: (Any, Any) -> None
+        """
+        Cache a copy of the expansion object with the given identifier.
+
+        :param value: The identifier
+        :param obj: The expansion object
+        """
+        entry = (time.time() + self.ttl_in_seconds, copy_preserving_keys(obj))
+        try:
+            with self._lock:
+                self._entries.pop(value, None)
+                self._entries[value] = entry
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        except TypeError:
+            pass
+
+    def clear(self):  # type: () -> None
+        """
+        Discard all cached expansion objects.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):  # type: () -> int
+        return len(self._entries)
+
+
 class TypeNode(object):
     """
     Represents a type node for an expansion tree.
@@ -230,6 +355,8 @@ class ExpansionNode(TypeNode):
         request_field,  # type: six.text_type
         response_field,  # type: six.text_type
         raise_action_errors=True,  # type: bool
+        cache=None,  # type: Optional[ExpansionCache]
+        max_values_per_request=None,  # type: Optional[int]
     ):
         # type: (...) -> None
         """
@@ -245,6 +372,9 @@ class ExpansionNode(TypeNode):
         :param response_field: The name of the field for the expansion response's body
         :param raise_action_errors: Tells the client whether to raise an exception if the expansion action returns an
                                     error response (defaults to True)
+        :param cache: The cache of the expansion objects obtained from the service action, if they are cached
+        :param max_values_per_request: The maximum number of identifiers to send to the service action in one request,
+                                       if limited
         """
         super(ExpansionNode, self).__init__(node_type)
         self.name = name
@@ -255,6 +385,8 @@ class ExpansionNode(TypeNode):
         self.request_field = request_field
         self.response_field = response_field
         self.raise_action_errors = raise_action_errors
+        self.cache = cache
+        self.max_values_per_request = max_values_per_request
 
     def to_strings(self):  # type: () -> List[six.text_type]
         """
@@ -283,13 +415,126 @@ TypeExpansions = Dict[
         six.text_type,
         Dict[
             six.text_type,
-            Union[six.text_type, bool],
+            Union[six.text_type, bool, Dict[six.text_type, Any]],
         ],
     ],
 ]
 Expansions = Dict[six.text_type, List[six.text_type]]
 
 
+ExpansionObjects = List[Tuple[Dict[Any, Any], List[ExpansionNode]]]
+
+
+def _find_objects(
+    obj,  # type: Union[Dict[Any, Any], List[Any]]
+    types,  # type: AbstractSet[Any]
+    indexes_by_type,  # type: Dict[Any, List[int]]
+    found,  # type: List[List[Dict[Any, Any]]]
+):
+    # type: (...) -> None
+    if isinstance(obj, dict):
+        object_type = obj.get('_type')
+        try:
+            matched = object_type in types
+        except TypeError:
+            # The type is not hashable, so it cannot match
+            matched = False
+        if matched:
+            for index in indexes_by_type[object_type]:
+                found[index].append(obj)
+            # Just like `TypeNode.find_objects`, stop looking for this type in this object
+            if len(types) == 1:
+                return
+            types = types - {object_type}
+        children = obj.values()  # type: Iterable[Any]
+    else:
+        children = obj
+
+    for child in children:
+        if isinstance(child, (dict, list)):
+            _find_objects(child, types, indexes_by_type, found)
+
+
+class _TypeMatcher(object):
+    """
+    Finds the objects matching any of a sequence of type nodes in a single pass, with the same results as calling
+    `find_objects` on each of the type nodes in turn.
+    """
+
+    def __init__(self, type_nodes):  # type: (Sequence[TypeNode]) -> None
+        self.indexes_by_type = {}  # type: Dict[Any, List[int]]
+        for index, type_node in enumerate(type_nodes):
+            self.indexes_by_type.setdefault(type_node.type, []).append(index)
+        self.types = frozenset(self.indexes_by_type)
+        self.expansions = [type_node.expansions for type_node in type_nodes]
+
+    def find_objects(self, bodies):  # type: (Iterable[Any]) -> ExpansionObjects
+        found = [[] for _ in self.expansions]  # type: List[List[Dict[Any, Any]]]
+        for body in bodies:
+            if isinstance(body, (dict, list)):
+                _find_objects(body, self.types, self.indexes_by_type, found)
+
+        return [
+            (obj, expansions)
+            for objects, expansions in zip(found, self.expansions)
+            if expansions
+            for obj in objects
+        ]
+
+
+class ExpansionPlan(object):
+    """
+    An expansion dictionary compiled into expansion trees, along with indexes of the types to find in response bodies,
+    so that the objects to expand can be found in a single pass over each body instead of one pass per type. Get plans
+    from :meth:`ExpansionConverter.compile`, which reuses them for identical expansion dictionaries.
+    """
+
+    def __init__(self, trees):  # type: (List[TypeNode]) -> None
+        """
+        Create a new `ExpansionPlan` instance.
+
+        :param trees: The expansion trees
+        """
+        self.trees = trees
+        self._matchers = collections.OrderedDict()  # type: collections.OrderedDict
+        self._matchers_lock = threading.Lock()
+
+    # The maximum number of type matchers to keep, after which the least recently used matcher is discarded
+    MAX_CACHED_MATCHERS = 64
+
+    def find_objects(self, bodies, type_nodes=None):
+        # type: (Iterable[Any], Optional[Sequence[TypeNode]]) -> ExpansionObjects
+        """
+        Find all the objects to expand in the given bodies.
+
+        :param bodies: The response bodies (or other dictionaries and lists) to search, recursively
+        :param type_nodes: The type nodes (which must belong to this plan) whose objects to find, which defaults to the
+                           expansion trees
+
+        :return: a list of tuples of each object and the expansion nodes with which to expand it, in the same order as
+                 calling `find_objects` on each of the type nodes in turn. Objects of types with no expansions are
+                 omitted.
+        """
+        if type_nodes is None:
+            type_nodes = self.trees
+
+        # The type nodes belong to this plan, so their IDs are stable for as long as the plan exists
+        key = tuple(id(type_node) for type_node in type_nodes)
+        with self._matchers_lock:
+            matcher = self._matchers.pop(key, None)  # type: Optional[_TypeMatcher]
+            if matcher is not None:
+                # Move it to the most-recently-used end
+                self._matchers[key] = matcher
+
+        if matcher is None:
+            matcher = _TypeMatcher(type_nodes)
+            with self._matchers_lock:
+                self._matchers[key] = matcher
+                while len(self._matchers) > self.MAX_CACHED_MATCHERS:
+                    self._matchers.popitem(last=False)
+        return matcher.find_objects(bodies)
+
+
 class ExpansionConverter(object):
     """
     A utility class for converting the compact dictionary representation of expansions to expansion trees (and back
@@ -344,6 +589,8 @@ class ExpansionConverter(object):
                         "source_field": "<source field name>",
                         "destination_field": "<destination field name>",
                         "raise_action_errors": <bool>,
+                        "cache": {"ttl_in_seconds": <float>, "max_entries": <int>},
+                        "max_values_per_request": <int>,
                     },
                     ...
                 },
@@ -363,12 +610,49 @@ class ExpansionConverter(object):
                 identifier for obtaining the expansion object.
             <destination field name> is the name of the destination field into which
                 the expansion object will be placed.
+            "cache" is optional, and caches the expansion objects obtained from the
+                route (see :class:`ExpansionCache`).
+            "max_values_per_request" is optional, and splits the identifiers to
+                send to the route into requests of at most this many identifiers.
 
         :param type_routes: A type route configuration dictionary
         :param type_expansions: A type expansions configuration dictionary
         """
         self.type_routes = type_routes
         self.type_expansions = type_expansions
+        self._plans = collections.OrderedDict()  # type: collections.OrderedDict
+        self._plans_lock = threading.Lock()
+
+    # The maximum number of compiled expansion plans to keep, after which the least recently used plan is discarded
+    MAX_CACHED_PLANS = 256
+
+    def compile(self, expansion_dict):  # type: (Expansions) -> ExpansionPlan
+        """
+        Compile an expansion dictionary into an expansion plan. Plans are kept and reused for equivalent expansion
+        dictionaries (regardless of the order of their types and expansions), so changes to the expansion configuration
+        do not apply to expansion dictionaries already compiled.
+
+        :param expansion_dict: An expansion dictionary (see :meth:`dict_to_trees`)
+
+        :return: the expansion plan.
+        """
+        key = tuple(sorted(
+            (node_type, tuple(sorted(set(expansion_list))))
+            for node_type, expansion_list in six.iteritems(expansion_dict)
+        ))
+        with self._plans_lock:
+            plan = self._plans.pop(key, None)  # type: Optional[ExpansionPlan]
+            if plan is not None:
+                # Move it to the most-recently-used end
+                self._plans[key] = plan
+                return plan
+
+        plan = ExpansionPlan(self.dict_to_trees(expansion_dict))
+        with self._plans_lock:
+            self._plans[key] = plan
+            while len(self._plans) > self.MAX_CACHED_PLANS:
+                self._plans.popitem(last=False)
+        return plan
 
     def dict_to_trees(self, expansion_dict):  # type: (Expansions) -> List[TypeNode]
         """
@@ -402,6 +686,7 @@ class ExpansionConverter(object):
                     if not child_expansion_node:
                         type_expansion = self.type_expansions[expansion_node.type][expansion_name]
                         type_route = self.type_routes[cast(six.text_type, type_expansion['route'])]
+                        cache_settings = cast(Optional[Dict[six.text_type, Any]], type_expansion.get('cache'))
                         if type_expansion['destination_field'] == type_expansion['source_field']:
                             raise ValueError(
                                 'Expansion configuration destination_field error: '
@@ -418,6 +703,13 @@ class ExpansionConverter(object):
                             request_field=type_route['request_field'],
                             response_field=type_route['response_field'],
                             raise_action_errors=cast(bool, type_expansion.get('raise_action_errors', False)),
+                            cache=ExpansionCache.get_instance(
+                                type_route['service'],
+                                type_route['action'],
+                                type_route['request_field'],
+                                **cache_settings
+                            ) if cache_settings else None,
+                            max_values_per_request=cast(Optional[int], type_expansion.get('max_values_per_request')),
                         )
                         expansion_node.add_expansion(child_expansion_node)
 
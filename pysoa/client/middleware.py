@@ -3,7 +3,11 @@ from __future__ import (
     unicode_literals,
 )
 
+import collections
+import threading
+import time
 from typing import (
+    TYPE_CHECKING,
     Any,
     Callable,
     Dict,
@@ -18,17 +22,26 @@ from pysoa.common.types import (
     JobRequest,
     JobResponse,
 )
+from pysoa.utils import (
+    canonical_digest,
+    copy_job_response,
+)
+
+
+if TYPE_CHECKING:
+    from pysoa.client.client import ServiceHandler
 
 
 __all__ = (
     'ClientMiddleware',
     'ClientRequestMiddlewareTask',
     'ClientResponseMiddlewareTask',
+    'ResponseCacheMiddleware',
 )
 
 
-ClientRequestMiddlewareTask = Callable[[int, Dict[six.text_type, Any], JobRequest, Optional[int]], None]
-ClientResponseMiddlewareTask = Callable[[Optional[int]], Tuple[Optional[int], Optional[JobResponse]]]
+ClientRequestMiddlewareTask = Callable[[int, Dict[six.text_type, Any], JobRequest, Optional[float]], None]
+ClientResponseMiddlewareTask = Callable[[Optional[float]], Tuple[Optional[int], Optional[JobResponse]]]
 
 
 @fields.ClassConfigurationSchema.provider(fields.Dictionary(
@@ -45,6 +58,16 @@ class ClientMiddleware(object):
     down, return a callable that takes the appropriate arguments and returns the appropriate value.
     """
 
+    def initialize(self, service_handler):  # type: (ServiceHandler) -> None
+        """
+        Called once, right after the middleware is constructed, with the service handler whose requests it will
+        process. In this simple implementation, does nothing. Sub-classes can use it to get the service name and
+        metrics recorder, or to answer requests without sending them (see
+        :meth:`pysoa.client.client.ServiceHandler.add_local_response`).
+
+        :param service_handler: The :class:`pysoa.client.client.ServiceHandler` that uses this middleware
+        """
+
     def request(self, send_request):  # type: (ClientRequestMiddlewareTask) -> ClientRequestMiddlewareTask
         """
         In sub-classes, used for creating a wrapper around `send_request`. In this simple implementation, just
@@ -74,3 +97,195 @@ class ClientMiddleware(object):
 
         # Remove ourselves from the stack
         return get_response
+
+
+_CacheKey = Tuple[six.text_type, Tuple[six.text_type, ...], six.text_type, Tuple[int, ...]]
+# The cache key, the time-to-live for a successful response, and the time-to-live for a response with action errors
+_CacheInstructions = Tuple[_CacheKey, float, float]
+
+
+@fields.ClassConfigurationSchema.provider(fields.Dictionary(
+    {
+        'actions': fields.SchemalessDictionary(
+            key_type=fields.UnicodeString(description='The name of a cacheable action'),
+            value_type=fields.Dictionary(
+                {
+                    'ttl_in_seconds': fields.Float(
+                        gt=0,
+                        description='How long to cache a successful response to this action',
+                    ),
+                    'error_ttl_in_seconds': fields.Float(
+                        gte=0,
+                        description='How long to cache a response to this action with action errors (such as a "not '
+                                    'found" error); defaults to 0, meaning responses with errors are not cached',
+                    ),
+                },
+                optional_keys=('error_ttl_in_seconds', ),
+            ),
+            description='The actions of the service whose responses may be cached. These actions must not have side '
+                        'effects and must be safe to answer with slightly out-of-date responses.',
+        ),
+        'max_entries': fields.Integer(
+            gt=0,
+            description='The maximum number of responses to cache, after which the least recently used response is '
+                        'evicted; defaults to 1000',
+        ),
+    },
+    optional_keys=('max_entries', ),
+    description='Settings for caching the responses to idempotent actions in the client',
+))
+class ResponseCacheMiddleware(ClientMiddleware):
+    """
+    Client middleware that caches the responses to idempotent actions, such as lookups, so that repeating a request
+    within the configured time-to-live returns a copy of the earlier response without a round trip to the service.
+
+    Only jobs whose actions are all configured as cacheable are cached. The cache key is made of the service name, the
+    action names, a canonical hash of the action bodies, and the switches; the rest of the context (such as the
+    correlation ID) is ignored. Responses with job errors are never cached, and responses with action errors are
+    cached only if `error_ttl_in_seconds` is set for every action in the job. The cache is an in-memory LRU cache
+    bounded by `max_entries`. Cache hits are answered in place of sending the request, so they work with all of the
+    `Client` methods, including `call_actions_parallel`, expansions, futures, and the asyncio methods.
+
+    This middleware is thread-safe.
+    """
+
+    # Responses to requests that were sent longer ago than this are not cached when they arrive (which only matters for
+    # requests whose responses never arrived, which must eventually be forgotten)
+    PENDING_TIMEOUT_IN_SECONDS = 600.0
+
+    def __init__(self, actions, max_entries=1000):
+        # type: (Dict[six.text_type, Dict[six.text_type, float]], int) -> None
+        self.actions = actions
+        self.max_entries = max_entries
+
+        self._service_handler = None  # type: Optional[ServiceHandler]
+        self._lock = threading.Lock()
+        # Cache keys to tuples of the time of expiry and the response
+        self._entries = collections.OrderedDict()  # type: collections.OrderedDict
+        # Request IDs of sent requests to tuples of cache instructions and the time of sending
+        self._pending = collections.OrderedDict()  # type: collections.OrderedDict
+
+    def initialize(self, service_handler):  # type: (ServiceHandler) -> None
+        self._service_handler = service_handler
+
+    def clear(self):  # type: () -> None
+        """
+        Discard all cached responses.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def request(self, send_request):  # type: (ClientRequestMiddlewareTask) -> ClientRequestMiddlewareTask
+        def handler(request_id, meta, job_request, message_expiry_in_seconds=None):
+            # type: (int, Dict[six.text_type, Any], JobRequest, Optional[float]) -> None
+            service_handler = self._service_handler
+            instructions = None  # type: Optional[_CacheInstructions]
+            if service_handler:
+                instructions = self._get_cache_instructions(service_handler.service_name, job_request)
+            if service_handler is None or instructions is None:
+                send_request(request_id, meta, job_request, message_expiry_in_seconds)
+                return
+
+            response = self._get(instructions[0])
+            if response is not None:
+                service_handler.add_local_response(request_id, response)
+                return
+
+            with self._lock:
+                now = time.time()
+                self._pending[request_id] = (instructions, now)
+                while self._pending:
+                    oldest_request_id, (_, sent) = next(six.iteritems(self._pending))
+                    if now - sent <= self.PENDING_TIMEOUT_IN_SECONDS:
+                        break
+                    del self._pending[oldest_request_id]
+            try:
+                send_request(request_id, meta, job_request, message_expiry_in_seconds)
+            except Exception:
+                with self._lock:
+                    self._pending.pop(request_id, None)
+                raise
+
+        return handler
+
+    def response(self, get_response):  # type: (ClientResponseMiddlewareTask) -> ClientResponseMiddlewareTask
+        def handler(receive_timeout_in_seconds=None):
+            # type: (Optional[float]) -> Tuple[Optional[int], Optional[JobResponse]]
+            request_id, response = get_response(receive_timeout_in_seconds)
+            if request_id is not None and response is not None:
+                with self._lock:
+                    pending = self._pending.pop(request_id, None)
+                if pending:
+                    self._put(pending[0], response)
+            return request_id, response
+
+        return handler
+
+    def _get_cache_instructions(self, service_name, job_request):
+        # type: (six.text_type, JobRequest) -> Optional[_CacheInstructions]
+        if not job_request.actions or job_request.control.get('suppress_response'):
+            return None
+
+        ttl = error_ttl = None  # type: Optional[float]
+        for action_request in job_request.actions:
+            action_settings = self.actions.get(action_request.action)
+            if not action_settings:
+                return None
+            action_ttl = action_settings['ttl_in_seconds']
+            action_error_ttl = action_settings.get('error_ttl_in_seconds', 0)
+            ttl = action_ttl if ttl is None else min(ttl, action_ttl)
+            error_ttl = action_error_ttl if error_ttl is None else min(error_ttl, action_error_ttl)
+
+        try:
+            digest = canonical_digest([
+                [action_request.body for action_request in job_request.actions],
+                bool(job_request.control.get('continue_on_error')),
+            ])
+        except (TypeError, ValueError):
+            # For example, a dict with keys of mixed types cannot be sorted
+            return None
+
+        key = (
+            service_name,
+            tuple(action_request.action for action_request in job_request.actions),
+            digest,
+            tuple(sorted(job_request.context.get('switches') or [])),
+        )  # type: _CacheKey
+        return key, ttl or 0.0, error_ttl or 0.0
+
+    def _get(self, key):  # type: (_CacheKey) -> Optional[JobResponse]
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] > time.time():
+                # Move it to the most-recently-used end
+                self._entries[key] = entry
+            else:
+                entry = None
+
+        self._increment('miss' if entry is None else 'hit')
+        return copy_job_response(entry[1]) if entry is not None else None
+
+    def _put(self, instructions, response):  # type: (_CacheInstructions, JobResponse) -> None
+        key, ttl, error_ttl = instructions
+        if response.errors:
+            return
+        if any(action_response.errors for action_response in response.actions):
+            ttl = error_ttl
+        if not ttl:
+            return
+
+        entry = (time.time() + ttl, copy_job_response(response))
+        evictions = 0
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                evictions += 1
+
+        if evictions:
+            self._increment('eviction', evictions)
+
+    def _increment(self, name, amount=1):  # type: (six.text_type, int) -> None
+        if self._service_handler:
+            self._service_handler.metrics.counter('client.middleware.response_cache.{}'.format(name)).increment(amount)
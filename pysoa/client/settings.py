@@ -34,9 +34,17 @@ class ClientSettings(SOASettings):
                         'client to the associated service',
         ),
         'transport': fields.ClassConfigurationSchema(base_class=BaseClientTransport),
+        'coalesced_actions': fields.Set(
+            fields.UnicodeString(),
+            description='The actions of the service whose identical requests (with the same actions, bodies, and '
+                        'switches) are coalesced: while such a request is outstanding, an identical request sent '
+                        'from any thread in the same process is not sent, but instead receives its own copy of the '
+                        'outstanding request\'s response. Only use this for actions without side effects.',
+        ),
     }  # type: SettingsSchema
 
     defaults = {
+        'coalesced_actions': set(),
         'transport': {
             'path': 'pysoa.common.transport.redis_gateway.client:RedisClientTransport',
         },
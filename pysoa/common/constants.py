@@ -3,16 +3,20 @@ from __future__ import (
     unicode_literals,
 )
 
+from typing import Tuple
+
 from conformity.error import (
     ERROR_CODE_INVALID,
     ERROR_CODE_MISSING,
     ERROR_CODE_UNKNOWN,
 )
+import six
 
 
 __all__ = (
     'ERROR_CODE_ACCESS_DENIED',
     'ERROR_CODE_ACTION_TIMEOUT',
+    'ERROR_CODE_DEADLINE_EXCEEDED',
     'ERROR_CODE_INVALID',
     'ERROR_CODE_JOB_TIMEOUT',
     'ERROR_CODE_MISSING',
@@ -22,14 +26,30 @@ __all__ = (
     'ERROR_CODE_RESPONSE_TOO_LARGE',
     'ERROR_CODE_SERVER_ERROR',
     'ERROR_CODE_UNKNOWN',
+    'REQUEST_PRIORITIES',
+    'REQUEST_PRIORITY_HIGH',
+    'REQUEST_PRIORITY_LOW',
+    'REQUEST_PRIORITY_NORMAL',
 )
 
 
 ERROR_CODE_ACCESS_DENIED = 'ACCESS_DENIED'
 ERROR_CODE_ACTION_TIMEOUT = 'ACTION_TIMEOUT'
+ERROR_CODE_DEADLINE_EXCEEDED = 'DEADLINE_EXCEEDED'
 ERROR_CODE_JOB_TIMEOUT = 'JOB_TIMEOUT'
 ERROR_CODE_NOT_AUTHORIZED = 'NOT_AUTHORIZED'
 ERROR_CODE_NOT_FOUND = 'NOT_FOUND'
 ERROR_CODE_RESPONSE_NOT_SERIALIZABLE = 'RESPONSE_NOT_SERIALIZABLE'
 ERROR_CODE_RESPONSE_TOO_LARGE = 'RESPONSE_TOO_LARGE'
 ERROR_CODE_SERVER_ERROR = 'SERVER_ERROR'
+
+# Request priorities, highest first, which clients may set in the request control header (transports that do not
+# support priorities ignore them)
+REQUEST_PRIORITY_HIGH = 'high'
+REQUEST_PRIORITY_NORMAL = 'normal'
+REQUEST_PRIORITY_LOW = 'low'
+REQUEST_PRIORITIES = (
+    REQUEST_PRIORITY_HIGH,
+    REQUEST_PRIORITY_NORMAL,
+    REQUEST_PRIORITY_LOW,
+)  # type: Tuple[six.text_type, ...]
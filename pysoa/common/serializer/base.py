@@ -5,6 +5,7 @@ from __future__ import (
 
 import abc
 from typing import (
+    TYPE_CHECKING,
     Dict,
     FrozenSet,
     Type,
@@ -65,6 +66,11 @@ class Serializer(object):
     """
     mime_type = None  # type: six.text_type
 
+    if TYPE_CHECKING:
+        # Provided by `_SerializerMeta`, which type checkers do not see through `six.add_metaclass`
+        _mime_type_to_serializer_map = {}  # type: Dict[six.text_type, Type[Serializer]]
+        all_supported_mime_types = frozenset()  # type: FrozenSet[six.text_type]
+
     @classmethod
     def resolve_serializer(cls, mime_type):  # type: (six.text_type) -> Serializer
         """
@@ -22,18 +22,24 @@ import threading
 from typing import (
     Any,
     Dict,
+    Iterable,
+    List,
     NamedTuple,
     Optional,
+    Tuple,
 )
 
 from pymetrics.recorders.base import MetricsRecorder
 from pymetrics.recorders.noop import noop_metrics
 import six
 
+from pysoa.common.transport.errors import PySOATransportError
+
 
 __all__ = (
     'ClientTransport',
     'get_hex_thread_id',
+    'QueueStats',
     'ReceivedMessage',
     'ServerTransport',
     'Transport',
@@ -56,6 +62,21 @@ ReceivedMessage = NamedTuple(
 """The representation of a message received through a transport."""
 
 
+QueueStats = NamedTuple(
+    'QueueStats',
+    (
+        ('priority', Optional[six.text_type]),
+        ('shard', int),
+        ('depth', int),
+        ('oldest_message_age_in_seconds', Optional[float]),
+    ),
+)
+"""
+The depth of one shard of a request queue (or of one priority lane of it, if `priority` is not `None`) and the
+approximate age of the oldest message in it (`None` if the queue is empty or the age is unknown).
+"""
+
+
 @six.add_metaclass(abc.ABCMeta)
 class Transport(object):
     """
@@ -87,7 +108,7 @@ class ClientTransport(Transport):
 
     @abc.abstractmethod
     def send_request_message(self, request_id, meta, body, message_expiry_in_seconds=None):
-        # type: (int, Dict[six.text_type, Any], Dict[six.text_type, Any], Optional[int]) -> None
+        # type: (int, Dict[six.text_type, Any], Dict[six.text_type, Any], Optional[float]) -> None
         """
         Send a request message.
 
@@ -100,9 +121,39 @@ class ClientTransport(Transport):
         :raise: ConnectionError, MessageSendError, MessageSendTimeout, MessageTooLarge
         """
 
+    def send_request_messages(
+        self,
+        messages,  # type: Iterable[Tuple[int, Dict[six.text_type, Any], Dict[six.text_type, Any]]]
+        message_expiry_in_seconds=None,  # type: Optional[float]
+    ):
+        # type: (...) -> List[Optional[PySOATransportError]]
+        """
+        Send multiple request messages. Transports that can send many messages more efficiently than one at a time
+        (such as with a single network round trip) should override this; the default implementation calls
+        `send_request_message` once for each message.
+
+        Errors that affect only some messages are not raised. Instead, one result is returned for each message, in
+        the same order as `messages`, which is `None` if that message was sent or the transport error that prevented
+        it from being sent.
+
+        :param messages: An iterable of three-tuples of request ID, meta dict, and body dict
+        :param message_expiry_in_seconds: How soon the messages should expire if not retrieved by a server
+                                          (implementations should provide a sane default or setting for default)
+
+        :return: A list of `None` or transport errors, one for each message.
+        """
+        results = []  # type: List[Optional[PySOATransportError]]
+        for request_id, meta, body in messages:
+            try:
+                self.send_request_message(request_id, meta, body, message_expiry_in_seconds)
+                results.append(None)
+            except PySOATransportError as e:
+                results.append(e)
+        return results
+
     @abc.abstractmethod
     def receive_response_message(self, receive_timeout_in_seconds=None):
-        # type: (Optional[int]) -> ReceivedMessage
+        # type: (Optional[float]) -> ReceivedMessage
         """
         Receive a response message from the backend and return a 3-tuple of (request_id, meta dict, message dict).
 
@@ -114,6 +165,18 @@ class ClientTransport(Transport):
         :raise: ConnectionError, MessageReceiveError, MessageReceiveTimeout
         """
 
+    def get_request_queue_stats(self):  # type: () -> Optional[List[QueueStats]]
+        """
+        Get the depth of each shard of the request queue of the service to which this transport sends requests, along
+        with the age of the oldest request in each. The default implementation returns `None`, which means that the
+        transport does not support this.
+
+        :return: One `QueueStats` for each shard (and priority lane) of the request queue, or `None`.
+
+        :raise: ConnectionError, MessageReceiveError
+        """
+        return None
+
 
 @six.add_metaclass(abc.ABCMeta)
 class ServerTransport(Transport):
@@ -156,3 +219,24 @@ class ServerTransport(Transport):
 
         :raise: ConnectionError, MessageSendError, MessageSendTimeout, MessageTooLarge
         """
+
+    def get_request_queue_stats(self):  # type: () -> Optional[List[QueueStats]]
+        """
+        Get the depth of each shard of the request queue from which this transport receives requests, along with the
+        age of the oldest request in each. The default implementation returns `None`, which means that the transport
+        does not support this.
+
+        :return: One `QueueStats` for each shard (and priority lane) of the request queue, or `None`.
+
+        :raise: ConnectionError, MessageReceiveError
+        """
+        return None
+
+    def shutdown(self):  # type: () -> None
+        """
+        Called by the server when it is shutting down, after it has received its last request and sent its last
+        response. Transports that hold on to any resources, such as requests received from the backend ahead of
+        time, should release them here. The default implementation does nothing.
+
+        :raise: ConnectionError, MessageSendError
+        """
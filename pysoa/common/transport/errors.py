@@ -14,6 +14,7 @@ __all__ = (
     'MessageReceiveError',
     'MessageReceiveTimeout',
     'MessageSendError',
+    'MessageSendRejected',
     'MessageSendTimeout',
     'MessageTooLarge',
     'PySOATransportError',
@@ -87,6 +88,14 @@ class MessageSendError(TransientPySOATransportError):
     """
 
 
+class MessageSendRejected(MessageSendError):
+    """
+    Raised when the transport refuses to send a message, without trying, because the destination queue is congested
+    and sending to it is currently being limited (see the Redis transport `admission_control` setting). Callers should
+    shed this load instead of retrying right away.
+    """
+
+
 class ConnectionError(TransientPySOATransportError):
     """
     Raised when the transport cannot obtain the necessary connection to send or receive a message.
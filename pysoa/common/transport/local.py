@@ -138,7 +138,7 @@ class LocalClientTransport(ClientTransport, ServerTransport):
         self.server.setup()
 
     def send_request_message(self, request_id, meta, body, _=None):
-        # type: (int, Dict[six.text_type, Any], Dict[six.text_type, Any], Optional[int]) -> None
+        # type: (int, Dict[six.text_type, Any], Dict[six.text_type, Any], Optional[float]) -> None
         """
         Receives a request from the client and handles and dispatches in in-thread. `message_expiry_in_seconds` is not
         supported. Messages do not expire, as the server handles the request immediately in the same thread before
@@ -172,7 +172,7 @@ class LocalClientTransport(ClientTransport, ServerTransport):
         self.response_messages.append(ReceivedMessage(request_id, meta, body))
 
     def receive_response_message(self, _=None):
-        # type: (Optional[int]) -> ReceivedMessage
+        # type: (Optional[float]) -> ReceivedMessage
         """
         Receives a message from the deque. `receive_timeout_in_seconds` is not supported. Receive does not time out,
         because by the time the thread calls this method, a response is already available in the deque, or something
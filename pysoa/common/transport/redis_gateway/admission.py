@@ -0,0 +1,192 @@
+from __future__ import (
+    absolute_import,
+    unicode_literals,
+)
+
+import os
+import threading
+import time
+from typing import (
+    Dict,
+    Optional,
+    Tuple,
+)
+
+import attr
+import six
+
+
+__all__ = (
+    'AdmissionLimiter',
+)
+
+
+def _valid_fraction(_, attribute, value):  # type: (object, attr.Attribute, float) -> None
+    if not 0 < value <= 1:
+        raise ValueError('{} must be greater than 0 and no greater than 1'.format(attribute.name))
+
+
+def _valid_positive(_, attribute, value):  # type: (object, attr.Attribute, float) -> None
+    if value <= 0:
+        raise ValueError('{} must be greater than 0'.format(attribute.name))
+
+
+@attr.s
+class AdmissionLimiter(object):
+    """
+    Limits the rate at which one process sends requests to one service's request queue, using a token bucket whose
+    rate is controlled by additive increase, multiplicative decrease (AIMD) based on the queue depths reported each
+    time a request is sent. The limiter allows all requests until the queue depth reaches the high-water mark (or the
+    queue is full). From then on, requests are admitted at a limited rate, which starts at a fraction of the observed
+    demand and is decreased at most once per `DECREASE_INTERVAL_IN_SECONDS` for as long as the queue stays congested.
+    While the queue is below the high-water mark, the rate increases steadily, and the limiter goes back to allowing
+    all requests once the rate is well above the demand. Use `get_instance` to get the process-wide limiter for a
+    service instead of constructing one directly.
+
+    This class is thread-safe.
+    """
+
+    # How often, at most, the rate is decreased while the queue stays congested
+    DECREASE_INTERVAL_IN_SECONDS = 1.0
+    # How often the demand (the rate of requests to send, whether admitted or not) is measured
+    DEMAND_WINDOW_IN_SECONDS = 1.0
+
+    high_water_mark = attr.ib(
+        # The fraction of the queue capacity at or above which the queue is considered congested
+        default=0.8,
+        converter=float,
+        validator=_valid_fraction,
+    )  # type: float
+
+    minimum_rate = attr.ib(
+        # The rate, in requests per second, below which the limit is never decreased
+        default=1.0,
+        converter=float,
+        validator=_valid_positive,
+    )  # type: float
+
+    rate_increase_per_second = attr.ib(
+        # How many requests per second the rate increases for each second that the queue is not congested
+        default=10.0,
+        converter=float,
+        validator=_valid_positive,
+    )  # type: float
+
+    rate_decrease_factor = attr.ib(
+        # The factor by which the rate is multiplied each time it is decreased
+        default=0.5,
+        converter=float,
+        validator=_valid_fraction,
+    )  # type: float
+
+    _instances = {}  # type: Dict[Tuple[int, six.text_type], AdmissionLimiter]
+    _instances_lock = threading.Lock()
+
+    def __attrs_post_init__(self):  # type: () -> None
+        self._lock = threading.Lock()
+        # The current rate limit in requests per second, or `None` while all requests are allowed
+        self._rate = None  # type: Optional[float]
+        self._tokens = 0.0
+        self._last_refill = time.time()
+        self._last_decrease = 0.0
+        self._last_increase = 0.0
+        self._queue_depth = 0
+        # The measured rate of requests to send, and the requests counted towards the next measurement
+        self._demand = 0.0
+        self._demand_count = 0
+        self._demand_window_start = time.time()
+
+    @classmethod
+    def get_instance(cls, queue_name, **kwargs):  # type: (six.text_type, **float) -> AdmissionLimiter
+        """
+        Get the limiter for this process and the given request queue, creating it with the given keyword arguments if
+        necessary (the arguments are ignored if the limiter already exists). A process that forks gets new limiters
+        in the child process.
+        """
+        key = (os.getpid(), queue_name)
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(**kwargs)
+            return cls._instances[key]
+
+    @property
+    def rate(self):  # type: () -> Optional[float]
+        """
+        The current rate limit in requests per second, or `None` if all requests are currently allowed.
+        """
+        return self._rate
+
+    @property
+    def queue_depth(self):  # type: () -> int
+        """
+        The queue depth most recently reported to this limiter.
+        """
+        return self._queue_depth
+
+    def try_acquire(self, count=1):  # type: (int) -> bool
+        """
+        Try to take permission to send the given number of requests.
+
+        :param count: The number of requests to send
+
+        :return: `True` if the requests may be sent, or `False` if they should be rejected.
+        """
+        with self._lock:
+            now = time.time()
+            self._measure_demand(now, count)
+            if self._rate is None:
+                return True
+
+            self._tokens = min(self._burst, self._tokens + (now - self._last_refill) * self._rate)
+            self._last_refill = now
+            if self._tokens < count:
+                return False
+            self._tokens -= count
+            return True
+
+    def record_queue_depth(self, queue_depth, queue_capacity):  # type: (Optional[int], int) -> None
+        """
+        Adjust the rate limit according to the depth of the queue after a send (or a send attempt).
+
+        :param queue_depth: The depth of the queue (which equals `queue_capacity` if the queue was full), or `None` if
+                            the queue depth is unknown but the queue accepted the requests
+        :param queue_capacity: The capacity of the queue
+        """
+        with self._lock:
+            now = time.time()
+            if queue_depth is not None:
+                self._queue_depth = queue_depth
+
+            if queue_depth is not None and queue_depth >= queue_capacity * self.high_water_mark:
+                if now - self._last_decrease < self.DECREASE_INTERVAL_IN_SECONDS:
+                    return
+                if self._rate is None:
+                    # Measure the demand up to now, in case the queue filled up before the first measurement
+                    self._rate = max(self._demand, self._demand_count / max(now - self._demand_window_start, 0.001))
+                    self._tokens = 0.0
+                    self._last_refill = now
+                self._rate = max(self.minimum_rate, self._rate * self.rate_decrease_factor)
+                self._tokens = min(self._tokens, self._burst)
+                self._last_decrease = self._last_increase = now
+                return
+
+            if self._rate is None:
+                return
+            self._rate += self.rate_increase_per_second * (now - self._last_increase)
+            self._last_increase = now
+            if self._rate > max(self._demand * 2, self.minimum_rate * 4):
+                # The limit is no longer holding anything back
+                self._rate = None
+
+    @property
+    def _burst(self):  # type: () -> float
+        # The bucket holds up to one second's worth of requests, but always at least one
+        return max(1.0, self._rate or 0.0)
+
+    def _measure_demand(self, now, count):  # type: (float, int) -> None
+        self._demand_count += count
+        elapsed = now - self._demand_window_start
+        if elapsed >= self.DEMAND_WINDOW_IN_SECONDS:
+            self._demand = self._demand_count / elapsed
+            self._demand_count = 0
+            self._demand_window_start = now
@@ -0,0 +1,130 @@
+# The __future__ imports are only here to satisfy isort; they are not needed.
+from __future__ import (
+    absolute_import,
+    unicode_literals,
+)
+
+import asyncio
+import collections
+import functools
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+
+from pymetrics.instruments import TimerResolution
+from pymetrics.recorders.base import MetricsRecorder
+
+from pysoa.common.transport.base import ReceivedMessage
+from pysoa.common.transport.errors import (
+    MessageReceiveTimeout,
+    PySOATransportError,
+)
+from pysoa.common.transport.redis_gateway.client import RedisClientTransport
+
+
+__all__ = (
+    'AsyncRedisClientTransport',
+)
+
+
+class AsyncRedisClientTransport(RedisClientTransport):
+    """
+    A Redis Gateway client transport with asyncio counterparts of its send and receive methods, for use with the
+    `Client` asyncio methods (such as `call_actions_async`). It always demultiplexes responses (see the
+    `demultiplex_responses` setting), so responses arrive without blocking the event loop, and each is awaited by its
+    request ID. Sending is done in the event loop's default executor, using the same core (and so the same
+    serializers, compression, chunking, and wire format) as the synchronous transport.
+
+    Unlike the synchronous transport, outstanding responses are tracked per transport instead of per thread, so that
+    requests sent from the executor can be awaited from the event loop.
+    """
+
+    def __init__(self, service_name, metrics, **kwargs):  # type: (str, MetricsRecorder, **Any) -> None
+        kwargs['demultiplex_responses'] = True
+        super(AsyncRedisClientTransport, self).__init__(service_name, metrics, **kwargs)
+
+        self._async_response_futures = collections.OrderedDict()  # type: collections.OrderedDict
+
+    def _get_response_futures(self):  # type: () -> collections.OrderedDict
+        return self._async_response_futures
+
+    async def send_request_message_async(  # noqa: E999
+        self,
+        request_id: int,
+        meta: Dict[str, Any],
+        body: Dict[str, Any],
+        message_expiry_in_seconds: Optional[float] = None,
+    ) -> None:
+        """
+        The asyncio counterpart of `send_request_message`. If this is cancelled, the request may still be sent, but
+        its response is discarded.
+        """
+        await self._run_send(
+            [request_id],
+            functools.partial(self.send_request_message, request_id, meta, body, message_expiry_in_seconds),
+        )
+
+    async def send_request_messages_async(
+        self,
+        messages: Iterable[Tuple[int, Dict[str, Any], Dict[str, Any]]],
+        message_expiry_in_seconds: Optional[float] = None,
+    ) -> List[Optional[PySOATransportError]]:
+        """
+        The asyncio counterpart of `send_request_messages`. If this is cancelled, the requests may still be sent, but
+        their responses are discarded.
+        """
+        messages = list(messages)
+        return await self._run_send(
+            [request_id for request_id, _, _ in messages],
+            functools.partial(self.send_request_messages, messages, message_expiry_in_seconds),
+        )
+
+    async def _run_send(self, request_ids: List[int], send: functools.partial) -> Any:
+        sending = asyncio.get_event_loop().run_in_executor(None, send)
+        try:
+            return await asyncio.shield(sending)
+        except asyncio.CancelledError:
+            # The executor can't be interrupted, so stop waiting on the responses once sending is done
+            def unregister(_: asyncio.Future) -> None:
+                for request_id in request_ids:
+                    self._unregister_response_future(request_id)
+
+            sending.add_done_callback(unregister)
+            raise
+
+    async def receive_response_message_async(
+        self,
+        request_id: int,
+        receive_timeout_in_seconds: Optional[float] = None,
+    ) -> ReceivedMessage:
+        """
+        Wait for the response to the request with the given request ID. Responses can be awaited in any order, and
+        many at once.
+
+        :param request_id: The request ID of a request sent with this transport whose response has not been received
+        :param receive_timeout_in_seconds: How long to wait for the response before raising `MessageReceiveTimeout`,
+                                           which defaults to the setting with the same name
+
+        :return: The received response
+
+        :raise: MessageReceiveTimeout, ValueError
+        """
+        future = self.get_response_future(request_id)
+        try:
+            with self.metrics.timer('client.transport.redis_gateway.receive', resolution=TimerResolution.MICROSECONDS):
+                return await asyncio.wait_for(
+                    asyncio.wrap_future(future),
+                    receive_timeout_in_seconds or self.core.receive_timeout_in_seconds,
+                )
+        except (asyncio.TimeoutError, MessageReceiveTimeout):
+            self.metrics.counter('client.transport.redis_gateway.receive.error.timeout').increment()
+            raise MessageReceiveTimeout('No message received for service {}'.format(self.service_name))
+        finally:
+            if not future.done():
+                # Timed out or cancelled, so the demultiplexer can discard the response if it does arrive
+                self._unregister_response_future(request_id)
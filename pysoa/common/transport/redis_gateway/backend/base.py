@@ -8,18 +8,30 @@ import abc
 import binascii
 import itertools
 import random
+import time
 from typing import (
     Any,
     Callable,
     List,
     Optional,
+    Tuple,
 )
+import weakref
 
 from pymetrics.instruments import Counter
 import redis
 import redis.client
 import six
 
+from pysoa.common.transport.redis_gateway.constants import (
+    CONSISTENT_HASHING_ALGORITHM_JUMP,
+    CONSISTENT_HASHING_ALGORITHM_LEGACY,
+    CONSISTENT_HASHING_ALGORITHMS,
+    REQUEST_QUEUE_ROUTING_LOAD_AWARE,
+    REQUEST_QUEUE_ROUTING_ROUND_ROBIN,
+    REQUEST_QUEUE_ROUTINGS,
+)
+
 
 _no_op_counter = Counter('')
 
@@ -28,6 +40,26 @@ class CannotGetConnectionError(Exception):
     pass
 
 
+def jump_consistent_hash(key, buckets):  # type: (int, int) -> int
+    """
+    Maps a 64-bit key to one of `buckets` buckets using the jump consistent hash algorithm (Lamping and Veach, "A Fast,
+    Minimal Memory, Consistent Hash Algorithm"). When the number of buckets grows from N to N + 1, only about
+    1 / (N + 1) of all keys move, and they all move to the new bucket.
+
+    :param key: The key to map, which must be a non-negative integer less than 2 ** 64
+    :param buckets: The number of buckets
+
+    :return: The bucket, between 0 and `buckets - 1`.
+    """
+    bucket = -1
+    jump = 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941143 + 1) & 0xffffffffffffffff
+        jump = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
 class LuaRedisCommand(object):
     _script = ''
 
@@ -49,12 +81,14 @@ class SendMessageToQueueCommand(LuaRedisCommand):
     # ARGV[1] = expiry
     # ARGV[2] = queue capacity
     # ARGV[3] = message
+    # Returns the length of the queue after pushing the message.
     _script = """
 if redis.call('llen', KEYS[1]) >= tonumber(ARGV[2]) then
     return redis.error_reply("queue full")
 end
-redis.call('rpush', KEYS[1], ARGV[3])
+local length = redis.call('rpush', KEYS[1], ARGV[3])
 redis.call('expire', KEYS[1], ARGV[1])
+return length
 """
 
     def __call__(
@@ -64,9 +98,138 @@ redis.call('expire', KEYS[1], ARGV[1])
         expiry,  # type: int
         capacity,  # type: int
         connection,  # type: redis.StrictRedis
+    ):
+        # type: (...) -> int
+        """
+        :return: The length of the queue after the message was pushed.
+        """
+        return int(self._call(keys=[queue_key], args=[expiry, capacity, message], connection=connection) or 0)
+
+
+class SendMessagesToQueueCommand(LuaRedisCommand):
+    # KEYS[1] = queue key
+    # ARGV[1] = expiry
+    # ARGV[2] = queue capacity
+    # ARGV[3...] = messages
+    # Pushes, in order, as many messages as the queue has capacity for and returns the number of messages pushed. The
+    # messages are pushed in slices to stay well below Lua's limit on the number of values `unpack` can return.
+    _script = """
+local count = #ARGV - 2
+local accepted = math.min(count, tonumber(ARGV[2]) - redis.call('llen', KEYS[1]))
+if accepted <= 0 then
+    return 0
+end
+local i = 3
+while i <= accepted + 2 do
+    local j = math.min(i + 99, accepted + 2)
+    redis.call('rpush', KEYS[1], unpack(ARGV, i, j))
+    i = j + 1
+end
+redis.call('expire', KEYS[1], ARGV[1])
+return accepted
+"""
+
+    def __call__(
+        self,
+        queue_key,  # type: six.text_type
+        messages,  # type: List[six.binary_type]
+        expiry,  # type: int
+        capacity,  # type: int
+        connection,  # type: redis.StrictRedis
+    ):
+        # type: (...) -> int
+        """
+        :return: The number of messages, from the front of `messages`, that were accepted into the queue; the rest
+                 were rejected because the queue reached capacity.
+        """
+        return int(self._call(keys=[queue_key], args=[expiry, capacity] + list(messages), connection=connection))
+
+
+class SendAllMessagesToQueueCommand(LuaRedisCommand):
+    # KEYS[1] = queue key
+    # ARGV[1] = expiry
+    # ARGV[2] = queue capacity
+    # ARGV[3...] = messages
+    # Pushes, in order, either all of the messages or, if the queue lacks capacity for all of them, none of them.
+    # Used for the chunks of a single message, which are useless to the receiver unless all of them are sent. Returns
+    # the length of the queue after pushing the messages.
+    _script = """
+if redis.call('llen', KEYS[1]) + #ARGV - 2 > tonumber(ARGV[2]) then
+    return redis.error_reply("queue full")
+end
+local length = 0
+local i = 3
+while i <= #ARGV do
+    local j = math.min(i + 99, #ARGV)
+    length = redis.call('rpush', KEYS[1], unpack(ARGV, i, j))
+    i = j + 1
+end
+redis.call('expire', KEYS[1], ARGV[1])
+return length
+"""
+
+    def __call__(
+        self,
+        queue_key,  # type: six.text_type
+        messages,  # type: List[six.binary_type]
+        expiry,  # type: int
+        capacity,  # type: int
+        connection,  # type: redis.StrictRedis
+    ):
+        # type: (...) -> int
+        """
+        :return: The length of the queue after the messages were pushed.
+        """
+        return int(self._call(keys=[queue_key], args=[expiry, capacity] + list(messages), connection=connection) or 0)
+
+
+class PopMessagesFromQueueCommand(LuaRedisCommand):
+    # KEYS[1] = queue key
+    # ARGV[1] = maximum number of messages to pop
+    # Atomically removes and returns up to the requested number of messages from the head of the queue, without
+    # blocking, so that another consumer can never receive the same messages.
+    _script = """
+local messages = redis.call('lrange', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #messages > 0 then
+    redis.call('ltrim', KEYS[1], #messages, -1)
+end
+return messages
+"""
+
+    def __call__(
+        self,
+        queue_key,  # type: six.text_type
+        count,  # type: int
+        connection,  # type: redis.StrictRedis
+    ):
+        # type: (...) -> List[six.binary_type]
+        return list(self._call(keys=[queue_key], args=[count], connection=connection) or [])
+
+
+class ReturnMessagesToQueueCommand(LuaRedisCommand):
+    # KEYS[1] = queue key
+    # ARGV[1] = expiry
+    # ARGV[2...] = messages, in the order in which they should be at the head of the queue
+    # Pushes the messages back onto the head of the queue, ignoring capacity (they were already in the queue once), and
+    # makes sure the queue still expires if the messages were all that was left in it.
+    _script = """
+for i = #ARGV, 2, -1 do
+    redis.call('lpush', KEYS[1], ARGV[i])
+end
+if redis.call('ttl', KEYS[1]) < 0 then
+    redis.call('expire', KEYS[1], ARGV[1])
+end
+"""
+
+    def __call__(
+        self,
+        queue_key,  # type: six.text_type
+        messages,  # type: List[six.binary_type]
+        expiry,  # type: int
+        connection,  # type: redis.StrictRedis
     ):
         # type: (...) -> None
-        self._call(keys=[queue_key], args=[expiry, capacity, message], connection=connection)
+        self._call(keys=[queue_key], args=[expiry] + list(messages), connection=connection)
 
 
 @six.add_metaclass(abc.ABCMeta)
@@ -74,9 +237,35 @@ class BaseRedisClient(object):
     DEFAULT_RECEIVE_TIMEOUT = 5
     RESPONSE_QUEUE_SPECIFIER = '!'
 
-    def __init__(self, ring_size):  # type: (int) -> None
+    # With load-aware request queue routing, how much each new send latency counts toward a server's average latency,
+    # and how old a server's load statistics may get before they are ignored (so that a server that was avoided while
+    # it was slow or backed up gets tried again)
+    LOAD_LATENCY_WEIGHT = 0.2
+    LOAD_STATISTICS_MAXIMUM_AGE_IN_SECONDS = 5.0
+
+    def __init__(
+        self,
+        ring_size,  # type: int
+        consistent_hashing_algorithm=CONSISTENT_HASHING_ALGORITHM_LEGACY,  # type: six.text_type
+        request_queue_routing=REQUEST_QUEUE_ROUTING_ROUND_ROBIN,  # type: six.text_type
+    ):
+        # type: (...) -> None
         self.metrics_counter_getter = None  # type: Optional[Callable[[six.text_type], Counter]]
 
+        if consistent_hashing_algorithm not in CONSISTENT_HASHING_ALGORITHMS:
+            raise ValueError('Unknown consistent hashing algorithm {} (must be one of {})'.format(
+                consistent_hashing_algorithm,
+                ', '.join(CONSISTENT_HASHING_ALGORITHMS),
+            ))
+        self._consistent_hashing_algorithm = consistent_hashing_algorithm
+
+        if request_queue_routing not in REQUEST_QUEUE_ROUTINGS:
+            raise ValueError('Unknown request queue routing {} (must be one of {})'.format(
+                request_queue_routing,
+                ', '.join(REQUEST_QUEUE_ROUTINGS),
+            ))
+        self._request_queue_routing = request_queue_routing
+
         # These should not be overridden by subclasses. The standard or Sentinel base class determines the ring size
         # and passes it in, and then we create a randomized cycle-iterator (which can be infinitely next-ed) of
         # connection indexes to use for choosing a connection when posting to request queues (response queues use a
@@ -84,10 +273,19 @@ class BaseRedisClient(object):
         self._ring_size = ring_size
         self._connection_index_generator = itertools.cycle(random.sample(range(self._ring_size), k=self._ring_size))
 
+        # For load-aware request queue routing, the (average send latency, queue depth, time updated) of each ring
+        # index, and the ring index of each connection handed out for a request queue
+        self._load_statistics = [None] * self._ring_size  # type: List[Optional[Tuple[float, int, float]]]
+        self._request_queue_connection_indexes = weakref.WeakKeyDictionary()  # type: weakref.WeakKeyDictionary
+
         # It doesn't matter which connection we use for this. The underlying socket connection isn't even used (or
         # established, for that matter). But constructing a Script with the `redis` library requires passing it a
         # "default" connection that will be used if we ever call that script without a connection (we won't).
         self.send_message_to_queue = SendMessageToQueueCommand(self._get_connection(0))
+        self.send_messages_to_queue = SendMessagesToQueueCommand(self._get_connection(0))
+        self.send_all_messages_to_queue = SendAllMessagesToQueueCommand(self._get_connection(0))
+        self.pop_messages_from_queue = PopMessagesFromQueueCommand(self._get_connection(0))
+        self.return_messages_to_queue = ReturnMessagesToQueueCommand(self._get_connection(0))
 
     def get_connection(self, queue_key):  # type: (six.text_type) -> redis.StrictRedis
         """
@@ -99,10 +297,92 @@ class BaseRedisClient(object):
         if self.RESPONSE_QUEUE_SPECIFIER in queue_key:
             # It's a response queue, so use a consistent connection
             return self._get_connection(self._get_consistent_hash_index(queue_key))
+        elif self._request_queue_routing == REQUEST_QUEUE_ROUTING_LOAD_AWARE and self._ring_size > 1:
+            # It's a request queue, so use the less-loaded of two random connections
+            index = self._get_least_loaded_index()
+            connection = self._get_connection(index)
+            self._request_queue_connection_indexes[connection] = index
+            return connection
         else:
             # It's a request queue, so use a random connection
             return self._get_connection(next(self._connection_index_generator))
 
+    def record_request_queue_send(self, queue_key, connection, latency, queue_depth):
+        # type: (six.text_type, redis.StrictRedis, float, Optional[int]) -> None
+        """
+        Record how long it took to send a message to a request queue and how many messages that queue held afterward,
+        for use by load-aware request queue routing. Does nothing unless load-aware routing is enabled and the
+        connection was returned by `get_connection` for a request queue.
+
+        :param queue_key: The queue key to which the message was sent
+        :param connection: The connection used to send the message
+        :param latency: How long, in seconds, the send took
+        :param queue_depth: The length of the queue after the send, or `None` if unknown
+        """
+        if (
+            self._request_queue_routing != REQUEST_QUEUE_ROUTING_LOAD_AWARE or
+            self.RESPONSE_QUEUE_SPECIFIER in queue_key
+        ):
+            return
+
+        index = self._request_queue_connection_indexes.get(connection)
+        if index is None:
+            return
+
+        now = time.time()
+        previous = self._load_statistics[index]
+        if previous and now - previous[2] <= self.LOAD_STATISTICS_MAXIMUM_AGE_IN_SECONDS:
+            latency = previous[0] + self.LOAD_LATENCY_WEIGHT * (latency - previous[0])
+            if queue_depth is None:
+                queue_depth = previous[1]
+        self._load_statistics[index] = (latency, queue_depth or 0, now)
+
+    def _get_least_loaded_index(self):  # type: () -> int
+        """
+        Picks two random ring indexes and returns the one with the lower expected cost, which is its average send
+        latency multiplied by one more than its queue depth, so that both a slow server and a backed-up queue are
+        avoided. Servers without recent load statistics have no cost, so they are always tried. Choosing between two
+        random servers, instead of always choosing the least-loaded server, keeps all clients from piling onto the
+        same server between updates.
+        """
+        now = time.time()
+        best_index = -1
+        best_cost = 0.0
+        for index in random.sample(range(self._ring_size), k=2):
+            statistics = self._load_statistics[index]
+            if statistics and now - statistics[2] <= self.LOAD_STATISTICS_MAXIMUM_AGE_IN_SECONDS:
+                cost = statistics[0] * (1 + statistics[1])
+            else:
+                cost = 0.0
+            if best_index < 0 or cost < best_cost:
+                best_index, best_cost = index, cost
+        return best_index
+
+    def get_all_connections(self, queue_key):  # type: (six.text_type) -> List[redis.StrictRedis]
+        """
+        Get all the Redis connections on which the given queue key may live, in ring order. Request queues may live on
+        every server, because requests are sent to any of them, while response queues live on just one server.
+
+        :param queue_key: The queue key for which to get the connections
+        :return: the Redis connections.
+        """
+        if self.RESPONSE_QUEUE_SPECIFIER in queue_key:
+            return [self.get_connection(queue_key)]
+        return [self._get_connection(index) for index in range(self._ring_size)]
+
+    def get_colocated_connection(self, queue_key, connection):
+        # type: (six.text_type, redis.StrictRedis) -> redis.StrictRedis
+        """
+        Get the correct Redis connection for a queue key that must live alongside another queue, given the connection
+        that was used for the other queue. For example, the chunks of a chunked request must be on the same server as
+        the first chunk, which was sent to the request queue on a random server.
+
+        :param queue_key: The queue key for which to get the appropriate connection
+        :param connection: The connection that was used for the other queue
+        :return: the Redis connection.
+        """
+        return connection
+
     @abc.abstractmethod
     def _get_connection(self, index):  # type: (int) -> redis.StrictRedis
         """
@@ -116,12 +396,21 @@ class BaseRedisClient(object):
 
     def _get_consistent_hash_index(self, value):  # type: (six.text_type) -> int
         """
-        Maps the value to a node value between 0 and 4095 using CRC, then down to one of the ring nodes.
+        Maps the value to one of the ring nodes using the configured consistent hashing algorithm. With the legacy
+        algorithm, the value is mapped to a node value between 0 and 4095 using CRC, then down to one of the ring nodes
+        by dividing that range into equal parts, which remaps most values whenever the ring size changes. With the jump
+        algorithm, the CRC is mapped to a ring node using jump consistent hashing, which remaps only about 1 / N of
+        values when a node is added to the end of the ring.
 
         :param value: The value for which to calculate a hash
         :return: The Redis server ring index from the calculated hash
         """
-        big_value = binascii.crc32(value.encode('utf8') if isinstance(value, six.text_type) else value) & 0xfff
+        crc = binascii.crc32(value.encode('utf8') if isinstance(value, six.text_type) else value) & 0xffffffff
+
+        if self._consistent_hashing_algorithm == CONSISTENT_HASHING_ALGORITHM_JUMP:
+            return jump_consistent_hash(crc, self._ring_size)
+
+        big_value = crc & 0xfff
         ring_divisor = 4096.0 / self._ring_size
         return int(big_value / ring_divisor)
 
@@ -0,0 +1,410 @@
+from __future__ import (
+    absolute_import,
+    unicode_literals,
+)
+
+import binascii
+import logging
+import re
+import threading
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+    cast,
+)
+
+import redis
+import six
+
+from pysoa.common.transport.redis_gateway.backend.base import (
+    BaseRedisClient,
+    CannotGetConnectionError,
+)
+from pysoa.common.transport.redis_gateway.constants import (
+    CONSISTENT_HASHING_ALGORITHM_LEGACY,
+    REQUEST_QUEUE_ROUTING_ROUND_ROBIN,
+)
+
+
+__all__ = (
+    'ClusterRedisClient',
+    'hash_tag_queue_name',
+    'key_slot',
+)
+
+
+_logger = logging.getLogger(__name__)
+
+CLUSTER_SLOT_COUNT = 16384
+
+# Errors from pipelines are prefixed with information about the failed command, so the redirect may not be at the start
+REDIRECT_ERROR_RE = re.compile(r'(?P<type>MOVED|ASK) (?P<slot>[0-9]+) (?P<host>\S*):(?P<port>[0-9]+)$')
+
+# `StrictPipeline` is the pipeline of `StrictRedis` in redis-py 2.x, while 3.x only has `Pipeline`
+_Pipeline = getattr(redis.client, 'StrictPipeline', redis.client.Pipeline)
+
+# The suffixes of the companion queues (priority lanes and chunk queues) that must share their owning queue's hash slot
+COMPANION_QUEUE_SUFFIX_RE = re.compile(r'\.(?:priority|chunks)\.')
+
+
+def key_slot(key):  # type: (Union[six.text_type, six.binary_type]) -> int
+    """
+    Calculate the Redis Cluster hash slot for a key. If the key contains a hash tag (a non-empty substring between the
+    first `{` and the first `}` after it), only the hash tag is hashed, so that keys with the same hash tag always land
+    on the same slot.
+
+    :param key: The key
+
+    :return: The hash slot, between 0 and 16383.
+    """
+    if isinstance(key, six.text_type):
+        key = key.encode('utf-8')
+
+    start = key.find(b'{')
+    if start > -1:
+        end = key.find(b'}', start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+
+    # CRC-CCITT (XModem), which is the CRC16 variant Redis Cluster uses
+    return binascii.crc_hqx(key, 0) % CLUSTER_SLOT_COUNT
+
+
+def hash_tag_queue_name(queue_name):  # type: (six.text_type) -> six.text_type
+    """
+    Wrap the owning queue's name in a hash tag, so that a queue and its priority lanes (`service.foo` and
+    `service.foo.priority.high`) or a response queue and its chunk queues (`service.foo.abc!` and
+    `service.foo.abc!.chunks.17`) all live in the same hash slot. Names that already have a hash tag are unchanged.
+
+    :param queue_name: The queue name
+
+    :return: The hash-tagged queue name.
+    """
+    if '{' in queue_name:
+        return queue_name
+
+    match = COMPANION_QUEUE_SUFFIX_RE.search(queue_name)
+    end = match.start() if match else len(queue_name)
+    return '{{{}}}{}'.format(queue_name[:end], queue_name[end:])
+
+
+class _ClusterNodeRedis(redis.StrictRedis):
+    """
+    A connection to a single Redis Cluster master that follows MOVED and ASK redirects (by way of the cluster client
+    that owns it) instead of raising them, so that neither the Lua commands nor the transport core need to know about
+    redirects.
+    """
+
+    def __init__(self, cluster, **kwargs):  # type: (ClusterRedisClient, **Any) -> None
+        super(_ClusterNodeRedis, self).__init__(**kwargs)
+        self._cluster = cluster
+
+    def execute_command(self, *args, **options):
+        try:
+            return super(_ClusterNodeRedis, self).execute_command(*args, **options)
+        except redis.exceptions.ResponseError as e:
+            redirect = self._cluster.parse_redirect(e)
+            if not redirect:
+                raise
+            return self._cluster.execute_redirected_command(redirect, args, options)
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+            # The node may have failed over, so ask the cluster who owns which slots before the next command
+            self._cluster.reset_clients()
+            raise
+
+    def pipeline(self, transaction=True, shard_hint=None):  # type: (bool, Any) -> _ClusterNodePipeline
+        return _ClusterNodePipeline(
+            self._cluster,
+            self.connection_pool,
+            self.response_callbacks,
+            transaction,
+            shard_hint,
+        )
+
+
+class _ClusterNodePipeline(_Pipeline):  # type: ignore
+    """
+    A pipeline on a single Redis Cluster master that follows the MOVED and ASK redirects of its commands one at a time,
+    the way `_ClusterNodeRedis` does for single commands, so that a pipeline does not fail while a slot is migrating.
+    Commands in a transaction cannot be redirected individually, so transactions raise redirects as usual.
+    """
+
+    def __init__(self, cluster, *args, **kwargs):  # type: (ClusterRedisClient, *Any, **Any) -> None
+        super(_ClusterNodePipeline, self).__init__(*args, **kwargs)
+        self._cluster = cluster
+
+    def execute(self, raise_on_error=True):  # type: (bool) -> List[Any]
+        if self.transaction or self.explicit_transaction:
+            return super(_ClusterNodePipeline, self).execute(raise_on_error)
+
+        # Executing the pipeline resets it, so keep the commands in case any of them are redirected
+        commands = list(self.command_stack)
+        try:
+            results = super(_ClusterNodePipeline, self).execute(raise_on_error=False)
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+            self._cluster.reset_clients()
+            raise
+
+        for i, ((args, options), result) in enumerate(zip(commands, results)):
+            if not isinstance(result, redis.exceptions.ResponseError):
+                continue
+            redirect = self._cluster.parse_redirect(result)
+            if redirect:
+                try:
+                    results[i] = self._cluster.execute_redirected_command(redirect, args, options)
+                except redis.exceptions.ResponseError as e:
+                    results[i] = e
+
+        if raise_on_error:
+            self.raise_first_error(commands, results)
+        return results
+
+
+class ClusterRedisClient(BaseRedisClient):
+    """
+    Variant of the Redis client that supports Redis Cluster.
+
+    "hosts" in this arrangement is used to list the startup nodes, any of which (once reachable) is asked for the
+    cluster's slot map. Connections to the masters are created as they are discovered.
+
+    Instead of spreading request queues across servers at random and response queues by consistent hashing, every
+    queue lives in exactly one hash slot, and each key is sent to the master that owns its slot, using hash tags if the
+    key has them. The transport hash tags queue names (see `hash_tag_queue_name`), so that each queue's priority lanes
+    and chunk queues share its hash slot. Because every command the transport runs touches only a single key (or, when
+    receiving from priority lanes, the keys of a single hash slot), this requires no changes to the Lua commands.
+    Redirects (MOVED after resharding or failover, ASK during slot migration) are followed transparently, up to
+    `MAXIMUM_REDIRECTS` times per command, including the commands of pipelines.
+    """
+    DEFAULT_PORT = 6379
+    MAXIMUM_REDIRECTS = 5
+
+    def __init__(
+        self,
+        hosts=None,  # type: Optional[Iterable[Union[six.text_type, Tuple[six.text_type, int]]]]
+        connection_kwargs=None,  # type: Dict[six.text_type, Any]
+        consistent_hashing_algorithm=CONSISTENT_HASHING_ALGORITHM_LEGACY,  # type: six.text_type
+        request_queue_routing=REQUEST_QUEUE_ROUTING_ROUND_ROBIN,  # type: six.text_type
+    ):
+        # type: (...) -> None
+        connection_kwargs = dict(connection_kwargs) if connection_kwargs else {}
+        if 'socket_connect_timeout' not in connection_kwargs:
+            connection_kwargs['socket_connect_timeout'] = 5.0  # so that we don't wait indefinitely during failover
+        if 'socket_keepalive' not in connection_kwargs:
+            connection_kwargs['socket_keepalive'] = True
+        self._connection_kwargs = connection_kwargs
+
+        self._startup_nodes = self._convert_hosts(hosts)
+        self._nodes = {}  # type: Dict[Tuple[six.text_type, int], _ClusterNodeRedis]
+        self._slots = []  # type: List[Optional[Tuple[six.text_type, int]]]
+        self._slots_lock = threading.Lock()
+
+        # The startup nodes are only used (for Lua script registration) until the slot map is loaded on first use, and
+        # hash slots, not the consistent hashing algorithm or request queue routing, determine where queues live
+        super(ClusterRedisClient, self).__init__(
+            ring_size=len(self._startup_nodes),
+            consistent_hashing_algorithm=consistent_hashing_algorithm,
+            request_queue_routing=request_queue_routing,
+        )
+
+        self._scripts_by_sha = {}  # type: Dict[six.text_type, six.text_type]
+        for command in (
+            self.send_message_to_queue,
+            self.send_messages_to_queue,
+            self.send_all_messages_to_queue,
+            self.pop_messages_from_queue,
+            self.return_messages_to_queue,
+        ):
+            # The `redis` stubs omit the `sha` and `script` attributes of registered scripts
+            script = cast(Any, command._redis_script)
+            self._scripts_by_sha[script.sha] = script.script
+
+    @classmethod
+    def _convert_hosts(
+        cls,
+        hosts,  # type: Optional[Iterable[Union[six.text_type, Tuple[six.text_type, int]]]]
+    ):
+        # type: (...) -> List[Tuple[six.text_type, int]]
+        if not hosts:
+            hosts = [('localhost', cls.DEFAULT_PORT)]
+
+        if isinstance(hosts, six.string_types):
+            raise ValueError('Redis hosts must be specified as an iterable of hosts.')
+
+        final_hosts = []  # type: List[Tuple[six.text_type, int]]
+        for entry in hosts:
+            if isinstance(entry, six.string_types):
+                final_hosts.append((entry, cls.DEFAULT_PORT))
+            elif (
+                isinstance(entry, tuple) and len(entry) == 2 and isinstance(entry[0], six.string_types) and
+                isinstance(entry[1], int)
+            ):
+                final_hosts.append(entry)
+            else:
+                raise ValueError(
+                    'Each Cluster Redis `hosts` entries must be specified as either a string host name (which will '
+                    'default to port {}) or a two-tuple of (string, int) host and port. `{}` did not fit this '
+                    'requirement.'.format(cls.DEFAULT_PORT, repr(entry)),
+                )
+        return final_hosts
+
+    def reset_clients(self):  # type: () -> None
+        """
+        Forget the slot map, so that it is loaded again before the next command.
+        """
+        self._slots = []
+
+    def _get_node(self, host, port):  # type: (six.text_type, int) -> _ClusterNodeRedis
+        node = self._nodes.get((host, port))
+        if node is None:
+            node = self._nodes.setdefault(
+                (host, port),
+                _ClusterNodeRedis(self, host=host, port=port, **self._connection_kwargs),
+            )
+        return node
+
+    def _load_slots(self):  # type: () -> List[Optional[Tuple[six.text_type, int]]]
+        with self._slots_lock:
+            if self._slots:
+                return self._slots  # another thread loaded them while this one was waiting
+
+            self._get_counter('backend.cluster.load_slots').increment()
+
+            connection_errors = []
+            candidates = list(self._nodes.keys()) + [n for n in self._startup_nodes if n not in self._nodes]
+            for host, port in candidates:
+                try:
+                    # Bypass redirect handling, which could otherwise try to load the slots from within this method
+                    cluster_slots = redis.StrictRedis.execute_command(self._get_node(host, port), 'CLUSTER SLOTS')
+                except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+                    connection_errors.append('Failed to connect to {}:{} due to error: "{}".'.format(host, port, e))
+                    continue
+
+                slots = [None] * CLUSTER_SLOT_COUNT  # type: List[Optional[Tuple[six.text_type, int]]]
+                for slot_range in cluster_slots:
+                    # Each entry is [start slot, end slot, [master host, master port, ...], [replica ...], ...]
+                    master_host = slot_range[2][0]
+                    if isinstance(master_host, six.binary_type):
+                        master_host = master_host.decode('utf-8')
+                    master = (master_host or host, int(slot_range[2][1]))
+                    for slot in range(int(slot_range[0]), int(slot_range[1]) + 1):
+                        slots[slot] = master
+
+                self._slots = slots
+                return slots
+
+            raise CannotGetConnectionError(
+                'Could not get slots from any Redis Cluster node\n{}'.format('\n'.join(connection_errors)),
+            )
+
+    def get_connection(self, queue_key):  # type: (six.text_type) -> redis.StrictRedis
+        """
+        Get the connection to the master that owns the given queue key's hash slot.
+
+        :param queue_key: The queue key for which to get the appropriate connection
+        :return: the Redis connection.
+        """
+        slots = self._slots or self._load_slots()
+        master = slots[key_slot(queue_key)]
+        if not master:
+            raise CannotGetConnectionError('No Redis Cluster node serves the hash slot for {}.'.format(queue_key))
+        return self._get_node(*master)
+
+    def get_all_connections(self, queue_key):  # type: (six.text_type) -> List[redis.StrictRedis]
+        # Every queue, including request queues, lives in exactly one hash slot
+        return [self.get_connection(queue_key)]
+
+    def get_colocated_connection(self, queue_key, connection):
+        # type: (six.text_type, redis.StrictRedis) -> redis.StrictRedis
+        # In a cluster, the key's own slot, not the other queue's server, determines where the key lives, and any node
+        # can be reached from any client and server
+        return self.get_connection(queue_key)
+
+    def _get_connection(self, index):  # type: (int) -> redis.StrictRedis
+        if not 0 <= index < self._ring_size:
+            raise ValueError(
+                'There are only {count} hosts, but you asked for connection {index}.'.format(
+                    count=self._ring_size,
+                    index=index,
+                )
+            )
+        return self._get_node(*self._startup_nodes[index])
+
+    @staticmethod
+    def parse_redirect(error):
+        # type: (redis.exceptions.ResponseError) -> Optional[Tuple[six.text_type, int, six.text_type, int]]
+        """
+        Parse a MOVED or ASK error into a tuple of redirect type, slot, host, and port.
+
+        :param error: The error returned by Redis
+
+        :return: The parsed redirect, or `None` if the error is not a redirect.
+        """
+        match = REDIRECT_ERROR_RE.search(six.text_type(error.args[0]) if error.args else '')
+        if not match:
+            return None
+        return match.group('type'), int(match.group('slot')), match.group('host'), int(match.group('port'))
+
+    def execute_redirected_command(
+        self,
+        redirect,  # type: Tuple[six.text_type, int, six.text_type, int]
+        args,  # type: Tuple[Any, ...]
+        options,  # type: Dict[six.text_type, Any]
+    ):
+        # type: (...) -> Any
+        """
+        Execute a command that was redirected with MOVED or ASK on the node to which it was redirected, following any
+        further redirects.
+        """
+        for _ in range(self.MAXIMUM_REDIRECTS):
+            redirect_type, slot, host, port = redirect
+            node = self._get_node(host, port)
+
+            try:
+                if redirect_type == 'MOVED':
+                    self._get_counter('backend.cluster.moved').increment()
+                    slots = self._slots
+                    if slots and slots[slot] != (host, port):
+                        # The slot really has moved (as opposed to the command having been sent to the wrong node), so
+                        # other slots may have moved, too
+                        _logger.info('Redis Cluster slot {} moved to {}:{}, reloading slots'.format(slot, host, port))
+                        self.reset_clients()
+                    return self._execute_on_node(node, args, options, asking=False)
+
+                self._get_counter('backend.cluster.ask').increment()
+                return self._execute_on_node(node, args, options, asking=True)
+            except redis.exceptions.ResponseError as e:
+                next_redirect = self.parse_redirect(e)
+                if not next_redirect:
+                    raise
+                redirect = next_redirect
+
+        raise CannotGetConnectionError('Too many Redis Cluster redirects ({}).'.format(self.MAXIMUM_REDIRECTS))
+
+    def _execute_on_node(self, node, args, options, asking):
+        # type: (_ClusterNodeRedis, Tuple[Any, ...], Dict[six.text_type, Any], bool) -> Any
+        try:
+            return self._execute_on_node_once(node, args, options, asking)
+        except redis.exceptions.NoScriptError:
+            # The script was loaded on the node that redirected us, but this node may have never seen it
+            if args[0] != 'EVALSHA' or args[1] not in self._scripts_by_sha:
+                raise
+            redis.StrictRedis.execute_command(node, 'SCRIPT', 'LOAD', self._scripts_by_sha[args[1]])
+            return self._execute_on_node_once(node, args, options, asking)
+
+    @staticmethod
+    def _execute_on_node_once(node, args, options, asking):
+        # type: (_ClusterNodeRedis, Tuple[Any, ...], Dict[six.text_type, Any], bool) -> Any
+        if not asking:
+            return redis.StrictRedis.execute_command(node, *args, **options)
+
+        # ASKING only applies to the very next command on the same connection, which a pipeline guarantees (bypassing
+        # redirect handling, so that further redirects are followed, and counted, by `execute_redirected_command`)
+        pipeline = redis.StrictRedis.pipeline(node, transaction=False)
+        pipeline.execute_command('ASKING')
+        pipeline.execute_command(*args, **options)
+        return pipeline.execute()[1]
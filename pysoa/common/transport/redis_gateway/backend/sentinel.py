@@ -24,6 +24,10 @@ from pysoa.common.transport.redis_gateway.backend.base import (
     BaseRedisClient,
     CannotGetConnectionError,
 )
+from pysoa.common.transport.redis_gateway.constants import (
+    CONSISTENT_HASHING_ALGORITHM_LEGACY,
+    REQUEST_QUEUE_ROUTING_ROUND_ROBIN,
+)
 
 
 _logger = logging.getLogger(__name__)
@@ -61,6 +65,8 @@ class SentinelRedisClient(BaseRedisClient):
         sentinel_services=None,  # type: Iterable[six.text_type]
         sentinel_failover_retries=0,  # type: int
         sentinel_kwargs=None,  # type: Dict[six.text_type, Any]
+        consistent_hashing_algorithm=CONSISTENT_HASHING_ALGORITHM_LEGACY,  # type: six.text_type
+        request_queue_routing=REQUEST_QUEUE_ROUTING_ROUND_ROBIN,  # type: six.text_type
     ):
         # type: (...) -> None
         # Master client caching
@@ -101,7 +107,11 @@ class SentinelRedisClient(BaseRedisClient):
         else:
             self._services = self._get_service_names()
 
-        super(SentinelRedisClient, self).__init__(ring_size=len(self._services))
+        super(SentinelRedisClient, self).__init__(
+            ring_size=len(self._services),
+            consistent_hashing_algorithm=consistent_hashing_algorithm,
+            request_queue_routing=request_queue_routing,
+        )
 
     def reset_clients(self):  # type: () -> None
         self._master_clients = {}
@@ -19,6 +19,10 @@ import redis
 import six
 
 from pysoa.common.transport.redis_gateway.backend.base import BaseRedisClient
+from pysoa.common.transport.redis_gateway.constants import (
+    CONSISTENT_HASHING_ALGORITHM_LEGACY,
+    REQUEST_QUEUE_ROUTING_ROUND_ROBIN,
+)
 
 
 class StandardRedisClient(BaseRedisClient):
@@ -29,6 +33,8 @@ class StandardRedisClient(BaseRedisClient):
         self,
         hosts=None,  # type: Optional[Iterable[Union[six.text_type, Tuple[six.text_type, int]]]]
         connection_kwargs=None,  # type: Dict[six.text_type, Any]
+        consistent_hashing_algorithm=CONSISTENT_HASHING_ALGORITHM_LEGACY,  # type: six.text_type
+        request_queue_routing=REQUEST_QUEUE_ROUTING_ROUND_ROBIN,  # type: six.text_type
     ):
         # type: (...) -> None
         connection_kwargs = dict(connection_kwargs) if connection_kwargs else {}
@@ -39,7 +45,11 @@ class StandardRedisClient(BaseRedisClient):
 
         self._connection_list = self._get_connection_list(hosts, **connection_kwargs)
 
-        super(StandardRedisClient, self).__init__(ring_size=len(self._connection_list))
+        super(StandardRedisClient, self).__init__(
+            ring_size=len(self._connection_list),
+            consistent_hashing_algorithm=consistent_hashing_algorithm,
+            request_queue_routing=request_queue_routing,
+        )
 
     @classmethod
     def _get_connection_list(
@@ -3,10 +3,15 @@ from __future__ import (
     unicode_literals,
 )
 
+import collections
+import time
 from typing import (
     Any,
     Dict,
+    Iterable,
+    List,
     Optional,
+    Tuple,
 )
 import uuid
 
@@ -15,22 +20,38 @@ from pymetrics.instruments import TimerResolution
 from pymetrics.recorders.base import MetricsRecorder
 import six
 
+from pysoa.common.compatibility import ContextVar
 from pysoa.common.transport.base import (
     ClientTransport,
+    QueueStats,
     ReceivedMessage,
     get_hex_thread_id,
 )
 from pysoa.common.transport.errors import (
+    InvalidMessageError,
     MessageReceiveTimeout,
+    PySOATransportError,
     TransientPySOATransportError,
 )
 from pysoa.common.transport.redis_gateway.backend.base import BaseRedisClient
-from pysoa.common.transport.redis_gateway.constants import ProtocolVersion
+from pysoa.common.transport.redis_gateway.constants import (
+    REQUEST_PRIORITIES,
+    RESPONSE_ID_META_KEY,
+    SENT_TIME_META_KEY,
+    ProtocolVersion,
+)
 from pysoa.common.transport.redis_gateway.core import RedisTransportClientCore
+from pysoa.common.transport.redis_gateway.demultiplexer import ResponseDemultiplexer
 from pysoa.common.transport.redis_gateway.settings import RedisTransportSchema
 from pysoa.common.transport.redis_gateway.utils import make_redis_queue_name
 
 
+try:
+    import concurrent.futures
+except ImportError:  # pragma: no cover
+    concurrent = None  # type: ignore
+
+
 @fields.ClassConfigurationSchema.provider(RedisTransportSchema().extend(
     contents={
         'protocol_version': fields.Any(
@@ -41,10 +62,62 @@ from pysoa.common.transport.redis_gateway.utils import make_redis_queue_name
                         'detect what protocol the client is speaking and respond with the same protocol. However, '
                         'the client cannot pre-determine what protocol the server is speaking. So, if you need to '
                         'differ from the default (currently Version 2), use this setting to tell the client which '
-                        'protocol to speak.',
+                        'protocol to speak. Version 4 adds support for chunked requests (see '
+                        '`chunk_messages_larger_than_bytes`), so only use it once all servers support it. Version 5 '
+                        'adds support for compressed messages (see `compress_messages_larger_than_bytes`), and '
+                        'Version 6 adds plain-text expiry and routing headers that let servers drop expired requests '
+                        'without deserializing them. The same caution applies to both.',
+        ),
+        'demultiplex_responses': fields.Boolean(
+            description='If enabled, responses to all clients in this process that use the same Redis settings are '
+                        'received from a single response queue by one background thread, instead of from a queue per '
+                        'client and thread, and each response completes a `concurrent.futures.Future` as soon as it '
+                        'arrives (see `RedisClientTransport.get_response_future`). Requires Python 3 (or the '
+                        '`futures` library on Python 2).',
+        ),
+        'admission_control': fields.Nullable(fields.Dictionary(
+            {
+                'high_water_mark': fields.Float(
+                    gt=0,
+                    lte=1,
+                    description='The fraction of `queue_capacity` at or above which the request queue is considered '
+                                'congested (defaults to 0.8)',
+                ),
+                'minimum_rate': fields.Float(
+                    gt=0,
+                    description='The rate, in requests per second, below which the limit is never decreased (defaults '
+                                'to 1)',
+                ),
+                'rate_increase_per_second': fields.Float(
+                    gt=0,
+                    description='How many requests per second the limit increases for each second that the request '
+                                'queue is not congested (defaults to 10)',
+                ),
+                'rate_decrease_factor': fields.Float(
+                    gt=0,
+                    lte=1,
+                    description='The factor by which the limit is multiplied, at most once per second, while the '
+                                'request queue is congested (defaults to 0.5)',
+                ),
+            },
+            optional_keys=('high_water_mark', 'minimum_rate', 'rate_increase_per_second', 'rate_decrease_factor'),
+            description='If specified (even as an empty dictionary), the rate at which this process sends requests to '
+                        'each service is limited once the service\'s request queue becomes congested, using a limiter '
+                        'shared by all clients in the process. Sending a request beyond the limit fails immediately '
+                        'with `MessageSendRejected`, and sending to a full queue fails immediately instead of being '
+                        'retried (`queue_full_retries` is ignored). The limit is adjusted with additive increase, '
+                        'multiplicative decrease, based on the queue depths observed when sending, and is lifted '
+                        'entirely once the queue is no longer congested.',
+        )),
+        'default_priority': fields.Constant(
+            *REQUEST_PRIORITIES,
+            description='The priority of requests sent without a `priority` in their control header (by default, '
+                        'requests without a priority go to the same request queue as normal-priority requests). Only '
+                        'use a priority other than normal once all servers for the service have `priority_lanes` '
+                        'enabled.'
         ),
     },
-    optional_keys=('protocol_version', ),
+    optional_keys=('protocol_version', 'demultiplex_responses', 'admission_control', 'default_priority'),
     description='The constructor kwargs for the Redis client transport.',
 ))
 class RedisClientTransport(ClientTransport):
@@ -70,9 +143,21 @@ class RedisClientTransport(ClientTransport):
         )
         self._requests_outstanding = 0
         self._previous_error_was_transport_problem = False
+        demultiplex_responses = kwargs.pop('demultiplex_responses', False)
+        self._default_priority = kwargs.pop('default_priority', None)  # type: Optional[six.text_type]
         # noinspection PyArgumentList
         self.core = RedisTransportClientCore(service_name=service_name, metrics=metrics, **kwargs)
 
+        self._demultiplexer = None  # type: Optional[ResponseDemultiplexer]
+        if demultiplex_responses:
+            self._demultiplexer = ResponseDemultiplexer.get_instance(self.core)
+        # Holds, per thread and asyncio task, the futures for demultiplexed responses that still need to be received,
+        # by request ID
+        self._response_futures = ContextVar(
+            'pysoa_redis_client_response_futures',
+            default=None,
+        )  # type: ContextVar[Optional[collections.OrderedDict]]
+
     @property
     def requests_outstanding(self):  # type: () -> int
         """
@@ -80,38 +165,172 @@ class RedisClientTransport(ClientTransport):
         than 1, calling `receive_response_message` will result in a return value of `(None, None, None)` instead of
         raising a `MessageReceiveTimeout`.
         """
+        if self._demultiplexer:
+            return len(self._get_response_futures())
         return self._requests_outstanding
 
-    def send_request_message(self, request_id, meta, body, message_expiry_in_seconds=None):
-        # type: (int, Dict[six.text_type, Any], Dict[six.text_type, Any], Optional[int]) -> None
-        meta['reply_to'] = '{receive_queue_name}{thread_id}'.format(
+    def _get_response_futures(self):  # type: () -> collections.OrderedDict
+        futures = self._response_futures.get()
+        if futures is None:
+            futures = collections.OrderedDict()
+            self._response_futures.set(futures)
+        return futures
+
+    def _register_response_future(self, request_id, meta, message_expiry_in_seconds):
+        # type: (int, Dict[six.text_type, Any], Optional[float]) -> None
+        if not self._demultiplexer:
+            return
+
+        meta[RESPONSE_ID_META_KEY] = self._get_response_id(request_id)
+        # A response can take as long as the request's expiry plus the server's processing time to arrive
+        self._get_response_futures()[request_id] = self._demultiplexer.register(
+            meta[RESPONSE_ID_META_KEY],
+            (message_expiry_in_seconds or self.core.message_expiry_in_seconds) + self.core.receive_timeout_in_seconds,
+        )
+
+    def _unregister_response_future(self, request_id):  # type: (int) -> None
+        if not self._demultiplexer:
+            return
+
+        self._demultiplexer.unregister(self._get_response_id(request_id))
+        self._get_response_futures().pop(request_id, None)
+
+    def _get_response_id(self, request_id):  # type: (int) -> six.text_type
+        return '{client_id}.{request_id}'.format(client_id=self.client_id, request_id=request_id)
+
+    def get_response_future(self, request_id):  # type: (int) -> concurrent.futures.Future
+        """
+        Get the `concurrent.futures.Future` that completes with the `ReceivedMessage` response to a request sent by
+        this thread as soon as it arrives, without any further calls to this transport. It fails with
+        `MessageReceiveTimeout` if the request expires without a response. Once its future has been got, a response is
+        no longer returned by `receive_response_message`. Only available with `demultiplex_responses` enabled.
+
+        :param request_id: The request ID of a request sent by this thread whose response has not yet been received
+
+        :return: The response future, which supports `add_done_callback`, `concurrent.futures.wait`, and
+                 `concurrent.futures.as_completed`.
+        """
+        if not self._demultiplexer:
+            raise ValueError('Response futures are only available with `demultiplex_responses` enabled')
+
+        try:
+            return self._get_response_futures().pop(request_id)
+        except KeyError:
+            raise ValueError('No outstanding request {} for service {}'.format(request_id, self.service_name))
+
+    def _get_reply_to(self):  # type: () -> six.text_type
+        if self._demultiplexer:
+            return self._demultiplexer.queue_name
+        return '{receive_queue_name}{thread_id}'.format(
             receive_queue_name=self._receive_queue_name,
             thread_id=get_hex_thread_id(),
         )
 
+    def _get_priority(self, meta, body):
+        # type: (Dict[six.text_type, Any], Dict[six.text_type, Any]) -> Optional[six.text_type]
+        control = body.get('control')
+        priority = (control.get('priority') if isinstance(control, dict) else None) or self._default_priority
+        if priority is None:
+            return None
+        if priority not in REQUEST_PRIORITIES:
+            raise InvalidMessageError('Invalid request priority {} (must be one of {})'.format(
+                priority,
+                ', '.join(REQUEST_PRIORITIES),
+            ))
+        # Lets servers measure how long requests wait in each priority's request queue
+        meta[SENT_TIME_META_KEY] = time.time()
+        return priority
+
+    def send_request_message(self, request_id, meta, body, message_expiry_in_seconds=None):
+        # type: (int, Dict[six.text_type, Any], Dict[six.text_type, Any], Optional[float]) -> None
+        meta['reply_to'] = self._get_reply_to()
+        # The future must be registered before sending, in case the response arrives before sending returns
+        self._register_response_future(request_id, meta, message_expiry_in_seconds)
+
         with self.metrics.timer('client.transport.redis_gateway.send', resolution=TimerResolution.MICROSECONDS):
             try:
-                self.core.send_message(self._send_queue_name, request_id, meta, body, message_expiry_in_seconds)
+                priority = self._get_priority(meta, body)
+                queue_depth = self.core.send_message(
+                    make_redis_queue_name(self.service_name, priority),
+                    request_id,
+                    meta,
+                    body,
+                    message_expiry_in_seconds,
+                )
                 # If we increment this before sending and sending fails, the client will be broken forever, so only
                 # increment when sending succeeds.
                 self._requests_outstanding += 1
-            except TransientPySOATransportError:
+                if priority:
+                    self.metrics.histogram(
+                        'client.transport.redis_gateway.send.priority.{}.queue_depth'.format(priority),
+                    ).set(queue_depth)
+            except Exception as e:
+                self._unregister_response_future(request_id)
+                if isinstance(e, TransientPySOATransportError):
+                    self._previous_error_was_transport_problem = True
+                    self.metrics.counter('client.transport.redis_gateway.send.error.transient').increment()
+                raise
+
+    def send_request_messages(
+        self,
+        messages,  # type: Iterable[Tuple[int, Dict[six.text_type, Any], Dict[six.text_type, Any]]]
+        message_expiry_in_seconds=None,  # type: Optional[float]
+    ):
+        # type: (...) -> List[Optional[PySOATransportError]]
+        reply_to = self._get_reply_to()
+        messages = list(messages)
+        for request_id, meta, _ in messages:
+            meta['reply_to'] = reply_to
+            self._register_response_future(request_id, meta, message_expiry_in_seconds)
+
+        results = [None] * len(messages)  # type: List[Optional[PySOATransportError]]
+        # Requests of different priorities go to different request queues, so each priority is sent as its own batch
+        queues = collections.OrderedDict()  # type: Dict[six.text_type, List[Tuple[int, Tuple[int, Any, Any]]]]
+        for index, message in enumerate(messages):
+            try:
+                priority = self._get_priority(message[1], message[2])
+            except InvalidMessageError as e:
+                results[index] = e
+                continue
+            queues.setdefault(make_redis_queue_name(self.service_name, priority), []).append((index, message))
+
+        with self.metrics.timer('client.transport.redis_gateway.send', resolution=TimerResolution.MICROSECONDS):
+            try:
+                for queue_name, queue_messages in six.iteritems(queues):
+                    queue_results = self.core.send_messages(
+                        queue_name,
+                        [message for _, message in queue_messages],
+                        message_expiry_in_seconds,
+                    )
+                    for (index, _), result in zip(queue_messages, queue_results):
+                        results[index] = result
+            except Exception as e:
+                for request_id, _, _ in messages:
+                    self._unregister_response_future(request_id)
+                if isinstance(e, TransientPySOATransportError):
+                    self._previous_error_was_transport_problem = True
+                    self.metrics.counter('client.transport.redis_gateway.send.error.transient').increment()
+                raise
+
+        for (request_id, _, _), result in zip(messages, results):
+            if result is None:
+                self._requests_outstanding += 1
+                continue
+            self._unregister_response_future(request_id)
+            if isinstance(result, TransientPySOATransportError):
                 self._previous_error_was_transport_problem = True
                 self.metrics.counter('client.transport.redis_gateway.send.error.transient').increment()
-                raise
+        return results
 
     def receive_response_message(self, receive_timeout_in_seconds=None):
-        # type: (Optional[int]) -> ReceivedMessage
+        # type: (Optional[float]) -> ReceivedMessage
+        if self._demultiplexer:
+            return self._receive_demultiplexed_response_message(receive_timeout_in_seconds)
+
         if self._requests_outstanding > 0:
             with self.metrics.timer('client.transport.redis_gateway.receive', resolution=TimerResolution.MICROSECONDS):
                 try:
-                    received_message = self.core.receive_message(
-                        '{receive_queue_name}{thread_id}'.format(
-                            receive_queue_name=self._receive_queue_name,
-                            thread_id=get_hex_thread_id(),
-                        ),
-                        receive_timeout_in_seconds,
-                    )
+                    received_message = self.core.receive_message(self._get_reply_to(), receive_timeout_in_seconds)
                 except MessageReceiveTimeout:
                     if self._previous_error_was_transport_problem:
                         # We're almost certainly recovering from a failover
@@ -129,3 +348,33 @@ class RedisClientTransport(ClientTransport):
             self._previous_error_was_transport_problem = False
             # This tells Client.get_all_responses to stop waiting for more.
             return ReceivedMessage(None, None, None)
+
+    def get_request_queue_stats(self):  # type: () -> List[QueueStats]
+        # The client cannot know whether the servers have priority lanes enabled, so it reports every lane
+        return self.core.get_queue_stats(self._send_queue_name, priorities=REQUEST_PRIORITIES)
+
+    def _receive_demultiplexed_response_message(self, receive_timeout_in_seconds):
+        # type: (Optional[float]) -> ReceivedMessage
+        futures = self._get_response_futures()
+        if not futures:
+            # This tells Client.get_all_responses to stop waiting for more.
+            return ReceivedMessage(None, None, None)
+
+        with self.metrics.timer('client.transport.redis_gateway.receive', resolution=TimerResolution.MICROSECONDS):
+            done, _ = concurrent.futures.wait(
+                list(futures.values()),
+                timeout=receive_timeout_in_seconds or self.core.receive_timeout_in_seconds,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            if not done:
+                self.metrics.counter('client.transport.redis_gateway.receive.error.timeout').increment()
+                raise MessageReceiveTimeout('No message received for service {}'.format(self.service_name))
+
+            # Return responses in the order their requests were sent, when more than one has arrived
+            request_id = next(request_id for request_id, future in six.iteritems(futures) if future in done)
+            future = futures.pop(request_id)
+            try:
+                return future.result()
+            except MessageReceiveTimeout:
+                self.metrics.counter('client.transport.redis_gateway.receive.error.timeout').increment()
+                raise
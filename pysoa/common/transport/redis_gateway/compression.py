@@ -0,0 +1,136 @@
+from __future__ import (
+    absolute_import,
+    unicode_literals,
+)
+
+import abc
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    FrozenSet,
+    Type,
+)
+import zlib
+
+from conformity import fields
+import six
+
+
+__all__ = (
+    'Codec',
+    'ZlibCodec',
+)
+
+
+class _CodecMeta(abc.ABCMeta):
+    _encoding_to_codec_map = {}  # type: Dict[six.text_type, Type[Codec]]
+    _all_supported_encodings = frozenset()  # type: FrozenSet[six.text_type]
+
+    def __new__(mcs, name, bases, body):
+        cls = super(_CodecMeta, mcs).__new__(mcs, name, bases, body)
+
+        if bases and bases[0] is not object:
+            if not issubclass(cls, Codec):
+                raise TypeError('The internal _CodecMeta is only valid on Codecs')
+
+            if not cls.encoding or not cls.encoding.strip():
+                raise ValueError('All codecs must have a non-null, non-blank encoding')
+
+            if cls.encoding in mcs._all_supported_encodings:
+                raise ValueError('Another codec {cls} already supports encoding {encoding}'.format(
+                    cls=mcs._encoding_to_codec_map[cls.encoding],
+                    encoding=cls.encoding,
+                ))
+
+            mcs._encoding_to_codec_map[cls.encoding] = cls
+            mcs._all_supported_encodings = frozenset(mcs._encoding_to_codec_map.keys())
+
+        return cls
+
+    @property
+    def all_supported_encodings(cls):  # type: () -> FrozenSet[six.text_type]
+        """
+        Return all content encodings supported by all implementations of `Codec`.
+
+        :return: A frozen set of encodings.
+        """
+        return cls._all_supported_encodings
+
+
+@six.add_metaclass(_CodecMeta)
+class Codec(object):
+    """
+    The base class for all Redis Gateway compression codecs. Subclasses are registered automatically under their
+    `encoding`, which is sent in the `content-encoding` header of compressed messages so that the receiver can resolve
+    the same codec to decompress them. Because of that, an encoding may only contain the characters
+    `[a-zA-Z0-9_/.!-]`, and every receiver must be able to import the codec in order to receive messages encoded with
+    it.
+    """
+
+    encoding = None  # type: six.text_type
+
+    if TYPE_CHECKING:
+        # Provided by `_CodecMeta`, which type checkers do not see through `six.add_metaclass`
+        _encoding_to_codec_map = {}  # type: Dict[six.text_type, Type[Codec]]
+        all_supported_encodings = frozenset()  # type: FrozenSet[six.text_type]
+
+    @classmethod
+    def resolve_codec(cls, encoding):  # type: (six.text_type) -> Codec
+        """
+        Given the requested content encoding, return an initialized `Codec` that understands that encoding.
+
+        :param encoding: The content encoding for which to get a compatible `Codec`
+
+        :return: A compatible `Codec`.
+
+        :raises: ValueError if there is no `Codec` that understands this encoding.
+        """
+        if encoding not in cls.all_supported_encodings:
+            raise ValueError('Content encoding {} is not supported'.format(encoding))
+        return cls._encoding_to_codec_map[encoding]()
+
+    @abc.abstractmethod
+    def compress(self, data):  # type: (six.binary_type) -> six.binary_type
+        """
+        Compress the serialized message.
+
+        :param data: The serialized message
+
+        :return: The compressed message.
+        """
+
+    @abc.abstractmethod
+    def decompress(self, data):  # type: (six.binary_type) -> six.binary_type
+        """
+        Decompress a message compressed with `compress`.
+
+        :param data: The compressed message
+
+        :return: The serialized message.
+        """
+
+
+@fields.ClassConfigurationSchema.provider(fields.Dictionary(
+    {
+        'level': fields.Integer(
+            gte=-1,
+            lte=9,
+            description='The zlib compression level, from 1 (fastest) to 9 (smallest), or -1 for the zlib default',
+        ),
+    },
+    optional_keys=('level', ),
+))
+class ZlibCodec(Codec):
+    """
+    Compresses messages with the standard library's zlib module.
+    """
+    encoding = 'zlib'
+
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION):  # type: (int) -> None
+        self.level = level
+
+    def compress(self, data):  # type: (six.binary_type) -> six.binary_type
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):  # type: (six.binary_type) -> six.binary_type
+        return zlib.decompress(data)
@@ -9,28 +9,77 @@ from typing import Tuple
 
 import six
 
+from pysoa.common.constants import (
+    REQUEST_PRIORITIES,
+    REQUEST_PRIORITY_HIGH,
+    REQUEST_PRIORITY_LOW,
+    REQUEST_PRIORITY_NORMAL,
+)
+
 
 __all__ = (
+    'CONSISTENT_HASHING_ALGORITHM_JUMP',
+    'CONSISTENT_HASHING_ALGORITHM_LEGACY',
+    'CONSISTENT_HASHING_ALGORITHMS',
     'DEFAULT_MAXIMUM_MESSAGE_BYTES_CLIENT',
     'DEFAULT_MAXIMUM_MESSAGE_BYTES_SERVER',
     'MINIMUM_CHUNKED_MESSAGE_BYTES',
     'ProtocolFeature',
     'ProtocolVersion',
+    'REDIS_BACKEND_TYPE_CLUSTER',
     'REDIS_BACKEND_TYPE_SENTINEL',
     'REDIS_BACKEND_TYPE_STANDARD',
     'REDIS_BACKEND_TYPES',
+    'REQUEST_PRIORITIES',
+    'REQUEST_PRIORITY_HIGH',
+    'REQUEST_PRIORITY_LOW',
+    'REQUEST_PRIORITY_NORMAL',
+    'REQUEST_QUEUE_ROUTING_LOAD_AWARE',
+    'REQUEST_QUEUE_ROUTING_ROUND_ROBIN',
+    'REQUEST_QUEUE_ROUTINGS',
+    'RESPONSE_ID_META_KEY',
+    'SENT_TIME_META_KEY',
 )
 
 
 # Common Redis constants for discovery and transport classes
 REDIS_BACKEND_TYPE_STANDARD = 'redis.standard'
 REDIS_BACKEND_TYPE_SENTINEL = 'redis.sentinel'
+REDIS_BACKEND_TYPE_CLUSTER = 'redis.cluster'
 
 REDIS_BACKEND_TYPES = (
     REDIS_BACKEND_TYPE_STANDARD,
     REDIS_BACKEND_TYPE_SENTINEL,
+    REDIS_BACKEND_TYPE_CLUSTER,
+)  # type: Tuple[six.text_type, ...]
+
+# How response queues are spread across Redis hosts or Sentinel services (clients and servers must agree)
+CONSISTENT_HASHING_ALGORITHM_LEGACY = 'legacy'
+CONSISTENT_HASHING_ALGORITHM_JUMP = 'jump'
+
+CONSISTENT_HASHING_ALGORITHMS = (
+    CONSISTENT_HASHING_ALGORITHM_LEGACY,
+    CONSISTENT_HASHING_ALGORITHM_JUMP,
 )  # type: Tuple[six.text_type, ...]
 
+# How request queues are picked from among Redis hosts or Sentinel services when sending requests
+REQUEST_QUEUE_ROUTING_ROUND_ROBIN = 'round_robin'
+REQUEST_QUEUE_ROUTING_LOAD_AWARE = 'load_aware'
+
+REQUEST_QUEUE_ROUTINGS = (
+    REQUEST_QUEUE_ROUTING_ROUND_ROBIN,
+    REQUEST_QUEUE_ROUTING_LOAD_AWARE,
+)  # type: Tuple[six.text_type, ...]
+
+# The request meta key, echoed back by servers in response meta, by which demultiplexed responses are routed
+RESPONSE_ID_META_KEY = '__response_id__'
+
+# Each request priority (re-exported above from `pysoa.common.constants`) has its own request queue, except that normal
+# priority uses the same request queue as requests sent without a priority
+
+# The request meta key holding the time at which a request with a priority was sent, for measuring how long it waited
+SENT_TIME_META_KEY = '__sent__'
+
 DEFAULT_MAXIMUM_MESSAGE_BYTES_CLIENT = 1024 * 100
 DEFAULT_MAXIMUM_MESSAGE_BYTES_SERVER = 1024 * 250
 MINIMUM_CHUNKED_MESSAGE_BYTES = 1024 * 100
@@ -47,6 +96,9 @@ class ProtocolVersion(enum.IntEnum):
     VERSION_1 = 1
     VERSION_2 = 2
     VERSION_3 = 3
+    VERSION_4 = 4
+    VERSION_5 = 5
+    VERSION_6 = 6
 
     @property
     def prefix(self):  # type: () -> six.binary_type
@@ -67,12 +119,25 @@ class ProtocolVersion(enum.IntEnum):
         :return: A tuple of the identified protocol version and the binary message data with the protocol message
                  prefix removed.
         """
+        version, offset = ProtocolVersion.find_version(message_data)
+        return version, message_data[offset:] if offset else message_data
+
+    @staticmethod
+    def find_version(message_data):  # type: (six.binary_type) -> Tuple[ProtocolVersion, int]
+        """
+        Like :meth:`extract_version`, but, instead of copying the binary message data without the protocol message
+        prefix, return the offset at which the data following the prefix begins.
+
+        :param message_data: The binary message data to examine
+
+        :return: A tuple of the identified protocol version and the length of the protocol message prefix.
+        """
         match = PROTOCOL_VERSION_RE.match(message_data)
         if match:
-            return ProtocolVersion(int(match.group('version'))), message_data[match.end():]
+            return ProtocolVersion(int(match.group('version'))), match.end()
         if message_data.startswith(b'content-type'):
-            return ProtocolVersion.VERSION_2, message_data
-        return ProtocolVersion.VERSION_1, message_data
+            return ProtocolVersion.VERSION_2, 0
+        return ProtocolVersion.VERSION_1, 0
 
 
 class ProtocolFeature(enum.Enum):
@@ -83,6 +148,9 @@ class ProtocolFeature(enum.Enum):
     CONTENT_TYPE_HEADER = (1, ProtocolVersion.VERSION_2)
     VERSION_MARKER = (2, ProtocolVersion.VERSION_3)
     CHUNKED_RESPONSES = (3, ProtocolVersion.VERSION_3)
+    CHUNKED_REQUESTS = (4, ProtocolVersion.VERSION_4)
+    CONTENT_ENCODING_HEADER = (5, ProtocolVersion.VERSION_5)
+    ROUTING_HEADERS = (6, ProtocolVersion.VERSION_6)
 
     def supported_in(self, version):  # type: (ProtocolVersion) -> bool
         """
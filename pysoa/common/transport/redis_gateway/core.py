@@ -5,27 +5,34 @@ from __future__ import (
 )
 
 import abc
+import collections
 from copy import deepcopy
+import itertools
 import logging
 import math
 import random
 import re
+import threading
 import time
 from typing import (
     Any,
+    Deque,
     Dict,
     FrozenSet,
     Hashable,
+    Iterable,
     List,
     Optional,
     Tuple,
     Union,
     cast,
 )
+import uuid
 
 import attr
 from pymetrics.instruments import (
     Counter,
+    Gauge,
     Histogram,
     Timer,
     TimerResolution,
@@ -38,29 +45,51 @@ import six
 from pysoa.common.logging import RecursivelyCensoredDictWrapper
 from pysoa.common.serializer.base import Serializer
 from pysoa.common.serializer.msgpack_serializer import MsgpackSerializer
-from pysoa.common.transport.base import ReceivedMessage
+from pysoa.common.transport.base import (
+    QueueStats,
+    ReceivedMessage,
+)
 from pysoa.common.transport.errors import (
     InvalidMessageError,
     MessageReceiveError,
     MessageReceiveTimeout,
     MessageSendError,
+    MessageSendRejected,
     MessageTooLarge,
+    PySOATransportError,
 )
+from pysoa.common.transport.redis_gateway.admission import AdmissionLimiter
 from pysoa.common.transport.redis_gateway.backend.base import (
     BaseRedisClient,
     CannotGetConnectionError,
 )
+from pysoa.common.transport.redis_gateway.backend.cluster import (
+    ClusterRedisClient,
+    hash_tag_queue_name,
+)
 from pysoa.common.transport.redis_gateway.backend.sentinel import SentinelRedisClient
 from pysoa.common.transport.redis_gateway.backend.standard import StandardRedisClient
+from pysoa.common.transport.redis_gateway.compression import (
+    Codec,
+    ZlibCodec,
+)
 from pysoa.common.transport.redis_gateway.constants import (
     DEFAULT_MAXIMUM_MESSAGE_BYTES_CLIENT,
     DEFAULT_MAXIMUM_MESSAGE_BYTES_SERVER,
     MINIMUM_CHUNKED_MESSAGE_BYTES,
+    REDIS_BACKEND_TYPE_CLUSTER,
     REDIS_BACKEND_TYPE_SENTINEL,
     REDIS_BACKEND_TYPES,
+    REQUEST_PRIORITIES,
+    REQUEST_PRIORITY_HIGH,
+    REQUEST_PRIORITY_LOW,
+    REQUEST_PRIORITY_NORMAL,
+    RESPONSE_ID_META_KEY,
+    SENT_TIME_META_KEY,
     ProtocolFeature,
     ProtocolVersion,
 )
+from pysoa.common.transport.redis_gateway.utils import make_priority_queue_name
 from pysoa.utils import dict_to_hashable
 
 
@@ -89,6 +118,26 @@ def _valid_chunk_threshold(_, __, value):
         )
 
 
+def _valid_prefetch_count(_, __, value):
+    if value < 0:
+        raise ValueError('prefetch_count must be >= 0, got {}'.format(value))
+
+
+def _seconds(value):  # type: (Union[int, float, six.text_type]) -> Union[int, float]
+    # Whole numbers of seconds stay integers, so that they are sent to Redis exactly as before fractional seconds were
+    # supported (Redis versions before 6.0 accept only integer blocking timeouts)
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+def _blocking_pop_timeout(timeout_in_seconds):  # type: (Union[int, float]) -> Union[int, float]
+    # Redis 6.0+ accepts fractional blocking timeouts with millisecond precision, but a timeout that rounds down to 0
+    # milliseconds would block forever
+    if isinstance(timeout_in_seconds, float):
+        return max(0.001, round(timeout_in_seconds, 3))
+    return timeout_in_seconds
+
+
 _DEFAULT_METRICS_RECORDER = noop_metrics  # type: MetricsRecorder
 
 
@@ -104,8 +153,10 @@ class RedisTransportCore(object):
     _backend_layer_cache = {}  # type: Dict[Tuple[six.text_type, FrozenSet[Tuple[Hashable, ...]]], BaseRedisClient]
 
     SUPPORTED_HEADERS_RE = re.compile(
-        b'\\s*(?P<header_name>content-type|chunk-count|chunk-id)\\s*:\\s*(?P<header_value>[a-zA-Z0-9_/.-]+)\\s*;',
+        b'\\s*(?P<header_name>content-type|content-encoding|chunk-count|chunk-id|chunk-queue|expiry|sent|request-id|'
+        b'actions)\\s*:\\s*(?P<header_value>[a-zA-Z0-9_/.!,-]+)\\s*;',
     )
+    VALID_HEADER_VALUE_RE = re.compile('^[a-zA-Z0-9_/.!-]+$')
 
     backend_type = attr.ib(validator=_valid_backend_type)  # type: six.text_type
 
@@ -125,14 +176,32 @@ class RedisTransportCore(object):
         converter=int,
     )  # type: int
 
-    chunk_messages_larger_than_bytes = -1
+    chunk_messages_larger_than_bytes = attr.ib(
+        # Messages larger than this will be sent in chunks (-1 = disabled); clients can only chunk requests if their
+        # protocol version supports chunked requests
+        default=-1,
+        converter=int,
+        validator=_valid_chunk_threshold,
+    )  # type: int
+
+    compress_messages_larger_than_bytes = attr.ib(
+        # Messages larger than this will be compressed before they are checked against the maximum size and chunked
+        # (-1 = disabled), but only if the protocol version in use supports the content-encoding header
+        default=-1,
+        converter=int,
+    )  # type: int
+
+    compression_codec_config = attr.ib(
+        # Configuration for which codec should be used by this transport to compress messages
+        default={'object': ZlibCodec, 'kwargs': {}},
+    )  # type: Dict[six.text_type, Any]
 
     message_expiry_in_seconds = attr.ib(
         # How long after a message is sent before it's considered "expired" and not received by default, unless
-        # overridden in the send_message argument `message_expiry_in_seconds`
+        # overridden in the send_message argument `message_expiry_in_seconds` (may be fractional)
         default=60,
-        converter=int,
-    )  # type: int
+        converter=_seconds,
+    )  # type: Union[int, float]
 
     metrics = attr.ib(
         default=_DEFAULT_METRICS_RECORDER,
@@ -153,10 +222,10 @@ class RedisTransportCore(object):
 
     receive_timeout_in_seconds = attr.ib(
         # How long to block when waiting to receive a message by default, unless overridden in the receive_message
-        # argument `receive_timeout_in_seconds`
+        # argument `receive_timeout_in_seconds` (fractional timeouts require Redis 6.0+)
         default=5,
-        converter=int,
-    )  # type: int
+        converter=_seconds,
+    )  # type: Union[int, float]
 
     default_serializer_config = attr.ib(
         # Configuration for which serializer should be used by this transport
@@ -170,6 +239,9 @@ class RedisTransportCore(object):
     )  # type: six.text_type
 
     protocol_version = ProtocolVersion.VERSION_3
+    prefetch_count = 0
+    receive_from_all_shards = False
+    priority_lanes = None  # type: Optional[Dict[six.text_type, int]]
 
     EXPONENTIAL_BACK_OFF_FACTOR = 4.0
     QUEUE_NAME_PREFIX = 'pysoa:'
@@ -194,8 +266,23 @@ class RedisTransportCore(object):
         self.backend_layer_kwargs.pop('redis_db', None)
         self.backend_layer_kwargs.pop('redis_port', None)
 
+        if self.maximum_message_size_in_bytes < self.chunk_messages_larger_than_bytes * 5:
+            raise ValueError(
+                'If chunk_messages_larger_than_bytes is enabled (non-negative), maximum_message_size_in_bytes must '
+                'be at least 5 times larger to allow for multiple chunks to be sent.',
+            )
+
         self._backend_layer = None  # type: Optional[BaseRedisClient]
         self._default_serializer = None  # type: Optional[Serializer]
+        self._compression_codec = None  # type: Optional[Codec]
+        # Server worker threads share this core, so the receive state below is only read and changed under this lock
+        self._receive_lock = threading.Lock()
+        # Messages popped ahead of time (see `prefetch_count`), per queue key, each with the connection it came from
+        self._prefetched_messages = {}  # type: Dict[six.text_type, Deque[Tuple[redis.StrictRedis, six.binary_type]]]
+        # Which shard to check first in the next receive from all shards (see `receive_from_all_shards`)
+        self._shard_offsets = itertools.count(random.randint(0, 1000))
+        # The smooth weighted round-robin credit of each priority lane (see `priority_lanes`)
+        self._priority_lane_credits = {priority: 0 for priority in REQUEST_PRIORITIES}
 
     @property
     @abc.abstractmethod
@@ -214,6 +301,8 @@ class RedisTransportCore(object):
                     backend_layer_kwargs = deepcopy(self.backend_layer_kwargs)
                     if self.backend_type == REDIS_BACKEND_TYPE_SENTINEL:
                         self._backend_layer_cache[cache_key] = SentinelRedisClient(**backend_layer_kwargs)
+                    elif self.backend_type == REDIS_BACKEND_TYPE_CLUSTER:
+                        self._backend_layer_cache[cache_key] = ClusterRedisClient(**backend_layer_kwargs)
                     else:
                         self._backend_layer_cache[cache_key] = StandardRedisClient(**backend_layer_kwargs)
 
@@ -234,6 +323,17 @@ class RedisTransportCore(object):
 
         return self._default_serializer
 
+    # noinspection PyAttributeOutsideInit
+    @property
+    def compression_codec(self):  # type: () -> Codec
+        if self._compression_codec is None:
+            self._compression_codec = cast(
+                Codec,
+                self.compression_codec_config['object'](**self.compression_codec_config.get('kwargs', {})),
+            )
+
+        return self._compression_codec
+
     def _get_redis_connection(self, for_send, queue_key):
         # type: (bool, six.text_type) -> redis.StrictRedis
         try:
@@ -243,16 +343,40 @@ class RedisTransportCore(object):
             self._get_counter('{}.error.connection'.format('send' if for_send else 'receive')).increment()
             raise (MessageSendError if for_send else MessageReceiveError)('Cannot get connection: {}'.format(e.args[0]))
 
+    def _get_queue_key(self, queue_name):  # type: (six.text_type) -> six.text_type
+        if self.backend_type == REDIS_BACKEND_TYPE_CLUSTER:
+            # Keep each queue's priority lanes and chunk queues in its hash slot
+            queue_name = hash_tag_queue_name(queue_name)
+        return self.QUEUE_NAME_PREFIX + queue_name
+
     def _serialize_check_and_chunk_message(
         self,
         protocol_version,  # type: ProtocolVersion
         message,  # type: Dict[six.text_type, Any]
         serializer,  # type: Serializer
+        chunk_queue_name=None,  # type: Optional[six.text_type]
+        sent_time=None,  # type: Optional[float]
     ):
         # type: (...) -> List[six.binary_type]
         with self._get_timer('send.serialize'):
             serialized_message = serializer.dict_to_blob(message)
 
+            content_encoding_header = b''
+            if (
+                0 <= self.compress_messages_larger_than_bytes < len(serialized_message) and
+                ProtocolFeature.CONTENT_ENCODING_HEADER.supported_in(protocol_version)
+            ):
+                # Compress before checking the size and chunking, because it's the compressed size that matters
+                with self._get_timer('send.compress'):
+                    compressed_message = self.compression_codec.compress(serialized_message)
+                self._get_histogram('send.compression.bytes_before').set(len(serialized_message))
+                self._get_histogram('send.compression.bytes_after').set(len(compressed_message))
+                if len(compressed_message) < len(serialized_message):
+                    serialized_message = compressed_message
+                    content_encoding_header = 'content-encoding:{};'.format(
+                        self.compression_codec.encoding,
+                    ).encode('utf-8')
+
             message_size_in_bytes = len(serialized_message)
             self._get_histogram('send.message_size').set(message_size_in_bytes)
 
@@ -271,26 +395,40 @@ class RedisTransportCore(object):
                 )
 
             content_type_header = 'content-type:{};'.format(serializer.mime_type).encode('utf-8')
-
-            if self.is_server and 0 < self.chunk_messages_larger_than_bytes < message_size_in_bytes:
-                # chunking is enabled on the server and the message is big enough to chunk
-                if not ProtocolFeature.CHUNKED_RESPONSES.supported_in(protocol_version):
+            content_type_header += content_encoding_header
+            if ProtocolFeature.ROUTING_HEADERS.supported_in(protocol_version):
+                content_type_header += self._make_routing_headers(message, sent_time)
+
+            if 0 < self.chunk_messages_larger_than_bytes < message_size_in_bytes:
+                # chunking is enabled and the message is big enough to chunk
+                feature = ProtocolFeature.CHUNKED_RESPONSES if self.is_server else ProtocolFeature.CHUNKED_REQUESTS
+                if not feature.supported_in(protocol_version):
                     self._get_counter('send.error.message_too_large').increment()
                     raise MessageTooLarge(
                         message_size_in_bytes,
-                        'Message exceeds chunking threshold but client does not support chunking',
+                        'Message exceeds chunking threshold but {} does not support chunking'.format(
+                            'client' if self.is_server else 'protocol version',
+                        ),
                     )
 
                 chunk_count = int(math.ceil(message_size_in_bytes / self.chunk_messages_larger_than_bytes))
                 self._get_histogram('send.chunk_count').set(chunk_count)
                 headers = protocol_version.prefix + content_type_header + (b'chunk-count:%d;' % (chunk_count, ))
-                return [
+                chunks = [
                     headers + (b'chunk-id:%d;' % (i + 1, )) + serialized_message[
                          i * self.chunk_messages_larger_than_bytes:
                          (i + 1) * self.chunk_messages_larger_than_bytes
                     ]
                     for i in range(chunk_count)
                 ]
+                if chunk_queue_name:
+                    # The first chunk goes on the shared request queue, and it tells the server that receives it where
+                    # to find the rest of the chunks, so that no other server can receive them
+                    chunks[0] = (
+                        headers + b'chunk-id:1;chunk-queue:' + chunk_queue_name.encode('utf-8') + b';' +
+                        serialized_message[:self.chunk_messages_larger_than_bytes]
+                    )
+                return chunks
 
             if ProtocolFeature.CONTENT_TYPE_HEADER.supported_in(protocol_version):
                 serialized_message = content_type_header + serialized_message
@@ -298,35 +436,52 @@ class RedisTransportCore(object):
                 serialized_message = protocol_version.prefix + serialized_message
             return [serialized_message]
 
-    def send_message(
+    @classmethod
+    def _make_routing_headers(cls, message, sent_time=None):
+        # type: (Dict[six.text_type, Any], Optional[float]) -> six.binary_type
+        # These duplicate a few envelope fields in plain text, so that receivers can, for example, drop expired messages
+        # without paying to deserialize them
+        headers = 'expiry:{!r};'.format(float(message['meta']['__expiry__']))
+        if sent_time:
+            headers += 'sent:{!r};'.format(float(sent_time))
+
+        request_id = six.text_type(message['request_id'])
+        if cls.VALID_HEADER_VALUE_RE.match(request_id):
+            headers += 'request-id:{};'.format(request_id)
+
+        body = message.get('body')
+        if isinstance(body, dict) and isinstance(body.get('actions'), list):
+            action_names = [
+                action.get('action') for action in body['actions'] if isinstance(action, dict)
+            ]  # type: List[Any]
+            if action_names and all(
+                isinstance(name, six.text_type) and cls.VALID_HEADER_VALUE_RE.match(name) for name in action_names
+            ):
+                headers += 'actions:{};'.format(','.join(action_names))
+
+        return headers.encode('utf-8')
+
+    def _prepare_message(
         self,
-        queue_name,  # type: six.text_type
         request_id,  # type: int
         meta,  # type: Dict[six.text_type, Any]
         body,  # type: Dict[six.text_type, Any]
-        message_expiry_in_seconds=None,  # type: Optional[int]
+        message_expiry_in_seconds=None,  # type: Optional[float]
     ):
-        # type: (...) -> None
-        """
-        Send a message to the specified queue in Redis.
-
-        :param queue_name: The name of the queue to which to send the message
-        :param request_id: The message's request ID
-        :param meta: The message meta information, if any (should be an empty dict if no metadata)
-        :param body: The message body (should be a dict)
-        :param message_expiry_in_seconds: The optional message expiry, which defaults to the setting with the same name
-
-        :raise: InvalidMessageError, MessageTooLarge, MessageSendError
-        """
+        # type: (...) -> Tuple[List[six.binary_type], int, Optional[six.text_type]]
         if request_id is None:
             raise InvalidMessageError('No request ID')
 
+        chunk_queue_name = None if self.is_server else self._get_request_chunk_queue_name(request_id, meta)
+
+        # Redis key expiry works in whole seconds, so fractional message expiries are rounded up for the queue key
+        sent_time = time.time()
         if message_expiry_in_seconds:
-            message_expiry = time.time() + message_expiry_in_seconds
-            redis_expiry = message_expiry_in_seconds + 10
+            message_expiry = sent_time + message_expiry_in_seconds
+            redis_expiry = int(math.ceil(message_expiry_in_seconds)) + 10
         else:
-            message_expiry = time.time() + self.message_expiry_in_seconds
-            redis_expiry = self.message_expiry_in_seconds
+            message_expiry = sent_time + self.message_expiry_in_seconds
+            redis_expiry = int(math.ceil(self.message_expiry_in_seconds))
 
         meta['__expiry__'] = message_expiry
         protocol_version = meta.pop('protocol_version', self.protocol_version)  # type: ProtocolVersion
@@ -337,64 +492,356 @@ class RedisTransportCore(object):
             protocol_version,
             message,
             cast(Serializer, meta.pop('serializer', self.default_serializer)),
+            chunk_queue_name,
+            sent_time,
+        )
+
+        return messages_to_send, redis_expiry, chunk_queue_name
+
+    @staticmethod
+    def _get_request_chunk_queue_name(request_id, meta):  # type: (int, Dict[six.text_type, Any]) -> six.text_type
+        # Request IDs are only unique per client, but the reply-to queue is unique to the client (and thread), so the
+        # two together are unique across all clients sending requests to the same service. Demultiplexed clients share
+        # one reply-to queue per process, but their response IDs are unique to the client and request.
+        return '{reply_to}.chunks.{request_id}'.format(
+            reply_to=meta.get('reply_to') or uuid.uuid4().hex,
+            request_id=meta.get(RESPONSE_ID_META_KEY) or request_id,
+        )
+
+    def _make_send_error(self, e):  # type: (Exception) -> MessageSendError
+        if isinstance(self.backend_layer, SentinelRedisClient):
+            self.backend_layer.reset_clients()
+
+        if isinstance(e, redis.exceptions.ResponseError):
+            self._get_counter('send.error.response').increment()
+            return MessageSendError('Redis error sending message for service {}'.format(self.service_name), *e.args)
+
+        self._get_counter('send.error.unknown').increment()
+        _logger.exception('Unknown error sending message in Redis transport core')
+        return MessageSendError(
+            'Unknown error sending message for service {}'.format(self.service_name),
+            six.text_type(type(e).__name__),
+            *e.args
+        )
+
+    def _make_queue_full_error(self, queue_name):  # type: (six.text_type) -> MessageSendError
+        self._get_counter('send.error.redis_queue_full').increment()
+        return MessageSendError(
+            'Redis queue {queue_name} was full after {retries} retries'.format(
+                queue_name=queue_name,
+                retries=self._get_queue_full_retries(queue_name),
+            )
+        )
+
+    def _get_admission_limiter(self, queue_name):  # type: (six.text_type) -> Optional[AdmissionLimiter]
+        """
+        Get the limiter for sending to the given queue, or `None` if sending to it is not limited.
+        """
+        return None
+
+    def _get_queue_full_retries(self, queue_name):  # type: (six.text_type) -> int
+        # A limited queue is not retried when full; the limiter sheds the load that would otherwise keep retrying
+        return 0 if self._get_admission_limiter(queue_name) else self.queue_full_retries
+
+    def _admit(self, queue_name, count=1):  # type: (six.text_type, int) -> Optional[MessageSendRejected]
+        limiter = self._get_admission_limiter(queue_name)
+        if not limiter or limiter.try_acquire(count):
+            return None
+
+        self._get_counter('send.admission.rejected').increment(count)
+        return MessageSendRejected(
+            'Redis queue {queue_name} is congested, and sending to it is limited to {rate:.1f} messages per '
+            'second'.format(queue_name=queue_name, rate=limiter.rate or 0),
+        )
+
+    def _record_queue_depth(self, queue_name, queue_depth):  # type: (six.text_type, Optional[int]) -> None
+        limiter = self._get_admission_limiter(queue_name)
+        if not limiter:
+            return
+
+        limiter.record_queue_depth(queue_depth, self.queue_capacity)
+        self._get_gauge('send.admission.queue_depth').set(limiter.queue_depth)
+        self._get_gauge('send.admission.rate_limit').set(int(round(limiter.rate or 0)))
+
+    def _back_off_before_retry(self, retry):  # type: (int) -> None
+        time.sleep((2 ** retry + random.random()) / self.EXPONENTIAL_BACK_OFF_FACTOR)
+        self._get_counter('send.queue_full_retry').increment()
+        self._get_counter('send.queue_full_retry.retry_{}'.format(retry + 1)).increment()
+
+    def send_message(
+        self,
+        queue_name,  # type: six.text_type
+        request_id,  # type: int
+        meta,  # type: Dict[six.text_type, Any]
+        body,  # type: Dict[six.text_type, Any]
+        message_expiry_in_seconds=None,  # type: Optional[float]
+    ):
+        # type: (...) -> int
+        """
+        Send a message to the specified queue in Redis.
+
+        :param queue_name: The name of the queue to which to send the message
+        :param request_id: The message's request ID
+        :param meta: The message meta information, if any (should be an empty dict if no metadata)
+        :param body: The message body (should be a dict)
+        :param message_expiry_in_seconds: The optional message expiry, which defaults to the setting with the same name
+
+        :return: The length of the queue after the message was sent.
+
+        :raise: InvalidMessageError, MessageTooLarge, MessageSendError
+        """
+        messages_to_send, redis_expiry, chunk_queue_name = self._prepare_message(
+            request_id,
+            meta,
+            body,
+            message_expiry_in_seconds,
         )
 
-        queue_key = self.QUEUE_NAME_PREFIX + queue_name
+        queue_key = self._get_queue_key(queue_name)
+
+        rejected = self._admit(queue_name)
+        if rejected:
+            raise rejected
 
         connection = self._get_redis_connection(for_send=True, queue_key=queue_key)
 
-        for message_to_send in messages_to_send:
-            # Try at least once, up to queue_full_retries times, then error
-            for i in range(-1, self.queue_full_retries):
-                if i >= 0:
-                    time.sleep((2 ** i + random.random()) / self.EXPONENTIAL_BACK_OFF_FACTOR)
-                    self._get_counter('send.queue_full_retry').increment()
-                    self._get_counter('send.queue_full_retry.retry_{}'.format(i + 1)).increment()
-                try:
-                    with self._get_timer('send.send_message_to_redis_queue'):
-                        self.backend_layer.send_message_to_queue(
+        if chunk_queue_name and len(messages_to_send) > 1:
+            return self._send_request_chunks(
+                queue_name,
+                queue_key,
+                chunk_queue_name,
+                messages_to_send,
+                redis_expiry,
+                connection,
+            )
+
+        return self._send_with_retries(queue_name, queue_key, messages_to_send, redis_expiry, connection)
+
+    def _send_request_chunks(
+        self,
+        queue_name,  # type: six.text_type
+        queue_key,  # type: six.text_type
+        chunk_queue_name,  # type: six.text_type
+        messages_to_send,  # type: List[six.binary_type]
+        redis_expiry,  # type: int
+        connection,  # type: redis.StrictRedis
+    ):
+        # type: (...) -> int
+        # All chunks but the first go on a queue of their own, on the same Redis server as the request queue. They go
+        # there first, so that they are all waiting by the time a server receives the first chunk from the request
+        # queue.
+        chunk_queue_key = self._get_queue_key(chunk_queue_name)
+        try:
+            chunk_connection = self.backend_layer.get_colocated_connection(chunk_queue_key, connection)
+            with self._get_timer('send.send_request_chunks_to_redis_queue'):
+                self.backend_layer.send_all_messages_to_queue(
+                    queue_key=chunk_queue_key,
+                    messages=messages_to_send[1:],
+                    expiry=redis_expiry,
+                    capacity=len(messages_to_send) - 1,
+                    connection=chunk_connection,
+                )
+        except redis.exceptions.ResponseError as e:
+            if e.args[0] == 'queue full':
+                # This could only happen if the chunk queue already existed, which should not be possible
+                self._get_counter('send.error.request_chunks').increment()
+                raise MessageSendError('Could not send all request chunks for service {}'.format(self.service_name))
+            raise self._make_send_error(e)
+        except Exception as e:
+            raise self._make_send_error(e)
+
+        try:
+            return self._send_with_retries(queue_name, queue_key, messages_to_send[:1], redis_expiry, connection)
+        except MessageSendError:
+            # No server will ever receive these chunks, so clean them up instead of waiting for them to expire
+            # noinspection PyBroadException
+            try:
+                chunk_connection.delete(chunk_queue_key)
+            except Exception:
+                _logger.warning('Could not clean up request chunks after failing to send request', exc_info=True)
+            raise
+
+    def _send_with_retries(
+        self,
+        queue_name,  # type: six.text_type
+        queue_key,  # type: six.text_type
+        messages_to_send,  # type: List[six.binary_type]
+        redis_expiry,  # type: int
+        connection,  # type: redis.StrictRedis
+    ):
+        # type: (...) -> int
+        # Multiple messages are the chunks of a single message, so they are sent all-or-nothing in a single round trip,
+        # with capacity for all of them checked up front, so that a full queue can never leave a message half-sent.
+        # Try at least once, up to queue_full_retries times, then error
+        for i in range(-1, self._get_queue_full_retries(queue_name)):
+            if i >= 0:
+                self._back_off_before_retry(i)
+            start = time.time()
+            try:
+                with self._get_timer('send.send_message_to_redis_queue'):
+                    if len(messages_to_send) == 1:
+                        queue_depth = self.backend_layer.send_message_to_queue(
                             queue_key=queue_key,
-                            message=message_to_send,
+                            message=messages_to_send[0],
                             expiry=redis_expiry,
                             capacity=self.queue_capacity,
                             connection=connection,
                         )
-                    break
-                except redis.exceptions.ResponseError as e:
-                    # The Lua script handles capacity checking and sends the "full" error back
-                    if e.args[0] == 'queue full':
-                        continue
-                    if isinstance(self.backend_layer, SentinelRedisClient):
-                        self.backend_layer.reset_clients()
-                    self._get_counter('send.error.response').increment()
-                    raise MessageSendError(
-                        'Redis error sending message for service {}'.format(self.service_name), *e.args
-                    )
-                except Exception as e:
-                    if isinstance(self.backend_layer, SentinelRedisClient):
-                        self.backend_layer.reset_clients()
-                    self._get_counter('send.error.unknown').increment()
-                    _logger.exception('Unknown error sending message in Redis transport core')
-                    raise MessageSendError(
-                        'Unknown error sending message for service {}'.format(self.service_name),
-                        six.text_type(type(e).__name__),
-                        *e.args
+                    else:
+                        queue_depth = self.backend_layer.send_all_messages_to_queue(
+                            queue_key=queue_key,
+                            messages=messages_to_send,
+                            expiry=redis_expiry,
+                            capacity=self.queue_capacity,
+                            connection=connection,
+                        )
+                self.backend_layer.record_request_queue_send(queue_key, connection, time.time() - start, queue_depth)
+                self._record_queue_depth(queue_name, queue_depth)
+                return queue_depth
+            except redis.exceptions.ResponseError as e:
+                # The Lua script handles capacity checking and sends the "full" error back
+                if e.args[0] == 'queue full':
+                    self.backend_layer.record_request_queue_send(
+                        queue_key,
+                        connection,
+                        time.time() - start,
+                        self.queue_capacity,
                     )
+                    self._record_queue_depth(queue_name, self.queue_capacity)
+                    continue
+                raise self._make_send_error(e)
+            except Exception as e:
+                raise self._make_send_error(e)
+
+        # The loop (number of retries) was exhausted; it was not terminated with return / successful send.
+        raise self._make_queue_full_error(queue_name)
+
+    def send_messages(
+        self,
+        queue_name,  # type: six.text_type
+        messages,  # type: Iterable[Tuple[int, Dict[six.text_type, Any], Dict[six.text_type, Any]]]
+        message_expiry_in_seconds=None,  # type: Optional[float]
+    ):
+        # type: (...) -> List[Optional[PySOATransportError]]
+        """
+        Send multiple messages to the specified queue in Redis, using a single Redis round trip in the common case.
+        Capacity is checked once for the whole batch, and, if the queue can accept only some of the messages, the
+        accepted messages stay in the queue and the rest are retried (with the same back-off as `send_message`) until
+        they are accepted or `queue_full_retries` is exhausted. Messages that must be chunked are sent individually,
+        each with all of its chunks sent together.
+
+        Unlike `send_message`, this method does not raise errors that affect only some messages. Instead, it returns
+        one result per message, in the same order as `messages`, which is `None` if that message was sent or the
+        transport error that prevented it from being sent.
+
+        :param queue_name: The name of the queue to which to send the messages
+        :param messages: An iterable of three-tuples of request ID, meta dict, and body dict
+        :param message_expiry_in_seconds: The optional message expiry, which defaults to the setting with the same name
+
+        :return: A list of `None` or transport errors, one for each message.
+
+        :raise: MessageSendError if a connection could not be obtained
+        """
+        results = []  # type: List[Optional[PySOATransportError]]
+        pending = []  # type: List[Tuple[int, six.binary_type]]
+        chunked = []  # type: List[Tuple[int, List[six.binary_type], Optional[six.text_type]]]
+        redis_expiry = 0
+        for index, (request_id, meta, body) in enumerate(messages):
+            results.append(None)
+            try:
+                messages_to_send, redis_expiry, chunk_queue_name = self._prepare_message(
+                    request_id,
+                    meta,
+                    body,
+                    message_expiry_in_seconds,
+                )
+            except PySOATransportError as e:
+                results[index] = e
+                continue
+            results[index] = self._admit(queue_name)
+            if results[index]:
+                continue
+            if len(messages_to_send) == 1:
+                pending.append((index, messages_to_send[0]))
             else:
+                chunked.append((index, messages_to_send, chunk_queue_name))
+
+        if not pending and not chunked:
+            return results
+
+        queue_key = self._get_queue_key(queue_name)
+
+        connection = self._get_redis_connection(for_send=True, queue_key=queue_key)
+
+        self._get_histogram('send.batch_size').set(len(pending))
+        for i in range(-1, self._get_queue_full_retries(queue_name)):
+            if not pending:
+                break
+            if i >= 0:
+                self._back_off_before_retry(i)
+            start = time.time()
+            try:
+                with self._get_timer('send.send_messages_to_redis_queue'):
+                    accepted = self.backend_layer.send_messages_to_queue(
+                        queue_key=queue_key,
+                        messages=[m for _, m in pending],
+                        expiry=redis_expiry,
+                        capacity=self.queue_capacity,
+                        connection=connection,
+                    )
+            except Exception as e:
+                error = self._make_send_error(e)
+                for index, _ in pending:
+                    results[index] = error
+                pending = []
+                break
+            # The batch command does not return the queue depth, except that the queue is full if it rejected messages
+            queue_depth = self.queue_capacity if accepted < len(pending) else None
+            self.backend_layer.record_request_queue_send(queue_key, connection, time.time() - start, queue_depth)
+            self._record_queue_depth(queue_name, queue_depth)
+            if 0 < accepted < len(pending):
+                self._get_counter('send.queue_full_partial_accept').increment()
+            pending = pending[accepted:]
+        else:
+            if pending:
                 # The loop (number of retries) was exhausted; it was not terminated with break / successful send.
-                self._get_counter('send.error.redis_queue_full').increment()
-                raise MessageSendError(
-                    'Redis queue {queue_name} was full after {retries} retries'.format(
-                        queue_name=queue_name,
-                        retries=self.queue_full_retries,
+                error = self._make_queue_full_error(queue_name)
+                for index, _ in pending:
+                    results[index] = error
+
+        for index, messages_to_send, chunk_queue_name in chunked:
+            try:
+                if chunk_queue_name:
+                    self._send_request_chunks(
+                        queue_name,
+                        queue_key,
+                        chunk_queue_name,
+                        messages_to_send,
+                        redis_expiry,
+                        connection,
                     )
-                )
+                else:
+                    self._send_with_retries(queue_name, queue_key, messages_to_send, redis_expiry, connection)
+            except PySOATransportError as e:
+                results[index] = e
+
+        return results
 
     @classmethod
     def _extract_supported_headers(cls, serialized_message):
         # type: (six.binary_type) -> Tuple[Dict[six.text_type, six.text_type], six.binary_type]
+        headers, offset = cls._find_supported_headers(serialized_message)
+        return headers, serialized_message[offset:] if offset else serialized_message
+
+    @classmethod
+    def _find_supported_headers(cls, serialized_message, offset=0):
+        # type: (six.binary_type, int) -> Tuple[Dict[six.text_type, six.text_type], int]
+        """
+        Parse the headers starting at `offset` and return them along with the offset at which the data following the
+        headers begins. The message data is never copied or sliced, which matters for large, chunked messages.
+        """
         headers = {}  # type: Dict[six.text_type, six.text_type]
-        match = cls.SUPPORTED_HEADERS_RE.match(serialized_message)
+        match = cls.SUPPORTED_HEADERS_RE.match(serialized_message, offset)
         while match:
             headers[match.group('header_name').decode('utf-8')] = match.group('header_value').decode('utf-8')
 
@@ -402,53 +849,342 @@ class RedisTransportCore(object):
             # https://github.com/eventbrite/pysoa/issues/240, so we do not strip whitespace there anymore. It was never
             # really necessary, anyway. There should never be whitespace after the final semicolon, and the regex takes
             # care of whitespace within the headers themselves.
-            serialized_message = serialized_message[match.end():]
-            match = cls.SUPPORTED_HEADERS_RE.match(serialized_message)
+            offset = match.end()
+            match = cls.SUPPORTED_HEADERS_RE.match(serialized_message, offset)
 
-        return headers, serialized_message
+        return headers, offset
+
+    def _make_receive_error(self, e):  # type: (Exception) -> MessageReceiveError
+        if isinstance(self.backend_layer, SentinelRedisClient):
+            self.backend_layer.reset_clients()
+
+        self._get_counter('receive.error.unknown').increment()
+        return MessageReceiveError(
+            'Unknown error receiving message for service {}'.format(self.service_name),
+            six.text_type(type(e).__name__),
+            *e.args
+        )
 
     def _receive_message(self, connection, queue_key, receive_timeout_in_seconds):
-        # type: (redis.StrictRedis, six.text_type, int) -> six.binary_type
+        # type: (redis.StrictRedis, six.text_type, float) -> six.binary_type
+        serialized_message = None  # type: Optional[six.binary_type]
         try:
             # returns message or None if no new messages within timeout
             with self._get_timer('receive.pop_from_redis_queue'):
-                result = connection.blpop([queue_key], timeout=receive_timeout_in_seconds)
-            serialized_message = None  # type: Optional[six.binary_type]
+                result = connection.blpop([queue_key], timeout=_blocking_pop_timeout(receive_timeout_in_seconds))
             if result:
                 serialized_message = cast(six.binary_type, result[1])
         except Exception as e:
-            if isinstance(self.backend_layer, SentinelRedisClient):
-                self.backend_layer.reset_clients()
-            self._get_counter('receive.error.unknown').increment()
-            raise MessageReceiveError(
-                'Unknown error receiving message for service {}'.format(self.service_name),
-                six.text_type(type(e).__name__),
-                *e.args
-            )
+            raise self._make_receive_error(e)
 
         if serialized_message is None:
             raise MessageReceiveTimeout('No message received for service {}'.format(self.service_name))
 
+        if self.prefetch_count > 0:
+            self._prefetch_messages(connection, queue_key)
+
         return serialized_message
 
-    def receive_message(self, queue_name, receive_timeout_in_seconds=None):
-        # type: (six.text_type, Optional[int]) -> ReceivedMessage
+    def _receive_from_all_shards(self, queue_key, receive_timeout_in_seconds):
+        # type: (six.text_type, float) -> Optional[Tuple[redis.StrictRedis, six.binary_type]]
         """
-        Receive a message from the specified queue in Redis.
+        Receive a message from whichever shard (Redis server) of the queue has one (prefetching any messages after it)
+        and return the connection for that shard along with the message. Returns `None`, without receiving anything, if
+        the queue has only one shard.
 
-        :param queue_name: The name of the queue to which to send the message
-        :param receive_timeout_in_seconds: The optional timeout, which defaults to the setting with the same name
+        Each round first checks every shard without blocking, starting with a different shard each round so that no
+        shard can be starved by the others, and then blocks on one shard (also a different one each round) for one
+        second (or for the rest of the receive timeout, if that is shorter) before starting the next round. This way, a
+        message waiting on any shard is received within about a second, while an idle server makes only one round trip
+        per shard per second.
 
-        :return: A tuple of request ID, message meta-information dict, and message body dict
+        :raise: MessageReceiveError, MessageReceiveTimeout
+        """
+        try:
+            with self._get_timer('receive.get_redis_connection'):
+                connections = self.backend_layer.get_all_connections(queue_key)
+        except CannotGetConnectionError as e:
+            self._get_counter('receive.error.connection').increment()
+            raise MessageReceiveError('Cannot get connection: {}'.format(e.args[0]))
 
-        :raise: MessageReceiveError, MessageReceiveTimeout, InvalidMessageError
+        if len(connections) < 2:
+            return None
+
+        start = time.time()
+        deadline = start + receive_timeout_in_seconds
+        shard = -1
+        serialized_message = None  # type: Optional[six.binary_type]
+        try:
+            with self._get_timer('receive.pop_from_redis_queue'):
+                while serialized_message is None:
+                    with self._receive_lock:
+                        offset = next(self._shard_offsets)
+                    for i in range(len(connections)):
+                        shard = (offset + i) % len(connections)
+                        serialized_message = connections[shard].lpop(queue_key)
+                        if serialized_message is not None:
+                            break
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        shard = offset % len(connections)
+                        result = connections[shard].blpop(
+                            [queue_key],
+                            timeout=_blocking_pop_timeout(min(1, remaining)),
+                        )
+                        if result:
+                            serialized_message = cast(six.binary_type, result[1])
+        except Exception as e:
+            raise self._make_receive_error(e)
+
+        if serialized_message is None:
+            raise MessageReceiveTimeout('No message received for service {}'.format(self.service_name))
+
+        self._get_timer('receive.shard.{}.wait'.format(shard)).set(
+            int(round((time.time() - start) * TimerResolution.MICROSECONDS)),
+        )
+
+        connection = connections[shard]
+        if self.prefetch_count > 0:
+            self._prefetch_messages(connection, queue_key)
+        return connection, serialized_message
+
+    def _get_priority_lane_order(self):  # type: () -> List[six.text_type]
+        """
+        Get the priorities in the order in which their lanes should be received from next. Normally, this is highest
+        priority first, but, using smooth weighted round-robin over the `priority_lanes` weights, each lane is moved to
+        the front in proportion to its weight, so that, while all lanes are backed up, each gets its share of receives
+        and no lane is starved.
         """
-        queue_key = self.QUEUE_NAME_PREFIX + queue_name
-        receive_timeout_in_seconds = receive_timeout_in_seconds or self.receive_timeout_in_seconds
+        assert self.priority_lanes
+        total = sum(self.priority_lanes.values())
+        with self._receive_lock:
+            for priority, weight in six.iteritems(self.priority_lanes):
+                self._priority_lane_credits[priority] += weight
+            # Ties go to the higher priority
+            first = max(
+                REQUEST_PRIORITIES,
+                key=lambda p: (self._priority_lane_credits[p], -REQUEST_PRIORITIES.index(p)),
+            )
+            self._priority_lane_credits[first] -= total
+        return [first] + [priority for priority in REQUEST_PRIORITIES if priority != first]
+
+    def _receive_from_priority_lanes(self, queue_name, receive_timeout_in_seconds):
+        # type: (six.text_type, float) -> Tuple[six.text_type, redis.StrictRedis, six.binary_type]
+        """
+        Receive a message from the first lane (in the order from `_get_priority_lane_order`) that has one, with a
+        single multi-key blocking pop (prefetching any messages after it from the same lane), and return the message's
+        priority, the connection it came from, and the message. Messages already prefetched from a lane are received
+        first, without going to Redis.
+
+        :raise: MessageReceiveError, MessageReceiveTimeout
+        """
+        priorities = self._get_priority_lane_order()
+        queue_keys = [self._get_queue_key(make_priority_queue_name(queue_name, p)) for p in priorities]
+        for priority, queue_key in zip(priorities, queue_keys):
+            prefetched = self._take_prefetched_message(queue_key)
+            if prefetched:
+                return priority, prefetched[0], prefetched[1]
+
+        connection = self._get_redis_connection(for_send=False, queue_key=queue_keys[0])
+        try:
+            with self._get_timer('receive.pop_from_redis_queue'):
+                result = connection.blpop(queue_keys, timeout=_blocking_pop_timeout(receive_timeout_in_seconds))
+        except Exception as e:
+            raise self._make_receive_error(e)
+
+        if not result:
+            raise MessageReceiveTimeout('No message received for service {}'.format(self.service_name))
+
+        queue_key = result[0]
+        if isinstance(queue_key, six.binary_type):
+            queue_key = queue_key.decode('utf-8')
+        if self.prefetch_count > 0:
+            self._prefetch_messages(connection, queue_key)
+        return priorities[queue_keys.index(queue_key)], connection, cast(six.binary_type, result[1])
 
-        connection = self._get_redis_connection(for_send=False, queue_key=queue_key)
-        serialized_message = self._receive_message(connection, queue_key, receive_timeout_in_seconds)
+    def _prefetch_messages(self, connection, queue_key):  # type: (redis.StrictRedis, six.text_type) -> None
+        try:
+            with self._get_timer('receive.prefetch_from_redis_queue'):
+                prefetched = self.backend_layer.pop_messages_from_queue(
+                    queue_key=queue_key,
+                    count=self.prefetch_count,
+                    connection=connection,
+                )
+        except Exception:
+            # We already have the message that was blocked on, so a failed prefetch is no reason to fail the receive
+            self._get_counter('receive.prefetch.error').increment()
+            _logger.exception('Error prefetching messages in Redis transport core')
+            return
+
+        self._get_histogram('receive.prefetch.messages').set(len(prefetched))
+        if prefetched:
+            with self._receive_lock:
+                # Other worker threads may still be receiving messages prefetched earlier, so add to those
+                self._prefetched_messages.setdefault(queue_key, collections.deque()).extend(
+                    (connection, message) for message in prefetched
+                )
+
+    def _take_prefetched_message(self, queue_key):
+        # type: (six.text_type) -> Optional[Tuple[redis.StrictRedis, six.binary_type]]
+        """
+        Take the next prefetched message for the given queue key, along with the connection it came from, or return
+        `None` if there are none.
+        """
+        with self._receive_lock:
+            prefetched = self._prefetched_messages.get(queue_key)
+            if not prefetched:
+                return None
+            message = prefetched.popleft()
+            if not prefetched:
+                del self._prefetched_messages[queue_key]
+            return message
+
+    def get_queue_stats(self, queue_name, priorities=None):
+        # type: (six.text_type, Optional[Iterable[six.text_type]]) -> List[QueueStats]
+        """
+        Get the depth of the given queue on each shard (Redis server) on which it may live, along with the age of the
+        oldest message in it, with one round trip per shard. The age comes from the plain-text `sent` header of the
+        message at the head of the queue. For messages without that header, the age is estimated from the plain-text
+        `expiry` header, assuming they were sent with the `message_expiry_in_seconds` that this transport is configured
+        with. Message bodies are never deserialized for this, so the age of messages with neither header (sent with
+        protocol versions before 6) is unknown.
 
+        :param queue_name: The name of the queue
+        :param priorities: If specified, get the depth of each of these priority lanes of the queue instead
+
+        :return: One `QueueStats` per shard (and priority lane), in shard order.
+
+        :raise: MessageReceiveError
+        """
+        queue_names = [(None, queue_name)]  # type: List[Tuple[Optional[six.text_type], six.text_type]]
+        if priorities:
+            queue_names = [(p, make_priority_queue_name(queue_name, p)) for p in priorities]
+
+        try:
+            connections = self.backend_layer.get_all_connections(self._get_queue_key(queue_name))
+        except CannotGetConnectionError as e:
+            self._get_counter('receive.error.connection').increment()
+            raise MessageReceiveError('Cannot get connection: {}'.format(e.args[0]))
+
+        stats = []  # type: List[QueueStats]
+        for shard, connection in enumerate(connections):
+            try:
+                pipeline = connection.pipeline(transaction=False)
+                for _, name in queue_names:
+                    pipeline.llen(self._get_queue_key(name))
+                    pipeline.lindex(self._get_queue_key(name), 0)
+                results = pipeline.execute()
+            except Exception as e:
+                raise MessageReceiveError(
+                    'Unknown error getting queue stats for service {}'.format(self.service_name),
+                    six.text_type(type(e).__name__),
+                    *e.args
+                )
+
+            now = time.time()
+            for i, (priority, _) in enumerate(queue_names):
+                depth, head = int(results[i * 2] or 0), results[i * 2 + 1]
+                age = None  # type: Optional[float]
+                sent_time = self._peek_message_sent_time(head) if head else None
+                if sent_time is not None:
+                    age = max(0.0, now - sent_time)
+                stats.append(QueueStats(priority=priority, shard=shard, depth=depth, oldest_message_age_in_seconds=age))
+
+        return stats
+
+    def _peek_message_sent_time(self, serialized_message):  # type: (six.binary_type) -> Optional[float]
+        # noinspection PyBroadException
+        try:
+            _, serialized_message = ProtocolVersion.extract_version(serialized_message)
+            headers, _ = self._extract_supported_headers(serialized_message)
+            if 'sent' in headers:
+                return float(headers['sent'])
+            if 'expiry' in headers:
+                return float(headers['expiry']) - self.message_expiry_in_seconds
+            # Deserializing the message body just to get its age is too costly, so the age is unknown
+            return None
+        except Exception:
+            # This is only used for introspection, so a message that cannot be read just has an unknown age
+            return None
+
+    def return_prefetched_messages(self):  # type: () -> None
+        """
+        Push all prefetched messages that have not yet been received back onto the head of the queues they came from,
+        in their original order, so that another server can process them. Servers must call this when shutting down
+        if `prefetch_count` is enabled, or else the prefetched messages will be lost.
+
+        :raise: MessageSendError
+        """
+        with self._receive_lock:
+            prefetched_messages, self._prefetched_messages = self._prefetched_messages, {}
+        for queue_key, prefetched in six.iteritems(prefetched_messages):
+            # Messages prefetched from different shards go back to the shards they came from, each in its original order
+            messages_by_connection = collections.OrderedDict()  # type: Dict[redis.StrictRedis, List[six.binary_type]]
+            for connection, message in prefetched:
+                messages_by_connection.setdefault(connection, []).append(message)
+            for connection, messages in six.iteritems(messages_by_connection):
+                try:
+                    self.backend_layer.return_messages_to_queue(
+                        queue_key=queue_key,
+                        messages=messages,
+                        expiry=int(math.ceil(self.message_expiry_in_seconds)),
+                        connection=connection,
+                    )
+                except Exception as e:
+                    raise self._make_send_error(e)
+                self._get_counter('receive.prefetch.returned').increment(len(messages))
+
+    def _receive_request_chunks(self, connection, chunk_queue_name, count):
+        # type: (redis.StrictRedis, six.text_type, int) -> List[six.binary_type]
+        chunk_queue_key = self._get_queue_key(chunk_queue_name)
+        try:
+            with self._get_timer('receive.pop_request_chunks_from_redis_queue'):
+                return self.backend_layer.pop_messages_from_queue(
+                    queue_key=chunk_queue_key,
+                    count=count,
+                    connection=self.backend_layer.get_colocated_connection(chunk_queue_key, connection),
+                )
+        except Exception as e:
+            if isinstance(self.backend_layer, SentinelRedisClient):
+                self.backend_layer.reset_clients()
+            self._get_counter('receive.error.unknown').increment()
+            raise MessageReceiveError(
+                'Unknown error receiving request chunks for service {}'.format(self.service_name),
+                six.text_type(type(e).__name__),
+                *e.args
+            )
+
+    def _discard_remaining_chunks(self, connection, queue_key, headers, count, receive_timeout_in_seconds):
+        # type: (redis.StrictRedis, six.text_type, Dict[six.text_type, six.text_type], int, float) -> None
+        if self.is_server:
+            # The rest of the request's chunks are on a queue of their own, which can be deleted without receiving them
+            chunk_queue_key = self._get_queue_key(headers['chunk-queue'])
+            try:
+                self.backend_layer.get_colocated_connection(chunk_queue_key, connection).delete(chunk_queue_key)
+            except Exception as e:
+                raise self._make_receive_error(e)
+            return
+
+        # The rest of the response's chunks are next on the response queue, so they must still be received, but they
+        # need not be parsed or reassembled
+        for _ in range(count):
+            self._receive_message(connection, queue_key, receive_timeout_in_seconds)
+
+    def _drop_expired_message(self, headers):  # type: (Dict[six.text_type, six.text_type]) -> None
+        self._get_counter('receive.message_expired_before_deserialize').increment()
+        _logger.debug(
+            'Dropping expired message with request ID {} (actions: {}) for service {} without deserializing '
+            'it'.format(headers.get('request-id'), headers.get('actions'), self.service_name),
+        )
+
+    def _deserialize_received_message(self, connection, queue_key, serialized_message, receive_timeout_in_seconds):
+        # type: (redis.StrictRedis, six.text_type, six.binary_type, float) -> Optional[Dict[six.text_type, Any]]
+        """
+        Deserialize a received message (receiving the rest of its chunks from the Redis server it came from, if it is
+        chunked), or return `None` if the message's headers show that it has expired.
+        """
         with self._get_timer('receive.deserialize') as deserialize_timer:
             protocol_version, serialized_message = ProtocolVersion.extract_version(serialized_message)
             headers, serialized_message = self._extract_supported_headers(serialized_message)
@@ -457,57 +1193,195 @@ class RedisTransportCore(object):
             if 'content-type' in headers and headers['content-type'] in Serializer.all_supported_mime_types:
                 serializer = Serializer.resolve_serializer(headers['content-type'])
 
+        expired = False
+        if 'expiry' in headers:
+            try:
+                expired = float(headers['expiry']) < time.time()
+            except ValueError:
+                raise InvalidMessageError('Invalid expiry header {} for service {}'.format(
+                    headers['expiry'],
+                    self.service_name,
+                ))
+
+        codec = None  # type: Optional[Codec]
+        if 'content-encoding' in headers:
+            if headers['content-encoding'] not in Codec.all_supported_encodings:
+                self._get_counter('receive.error.unsupported_content_encoding').increment()
+                raise InvalidMessageError('Unsupported content encoding {} for service {}'.format(
+                    headers['content-encoding'],
+                    self.service_name,
+                ))
+            codec = Codec.resolve_codec(headers['content-encoding'])
+
         if 'chunk-count' in headers:
-            if self.is_server:
+            if self.is_server and (
+                'chunk-queue' not in headers or
+                not ProtocolFeature.CHUNKED_REQUESTS.supported_in(protocol_version)
+            ):
                 raise InvalidMessageError('Unsupported chunked request on server Redis backend')
+            message_kind = 'request' if self.is_server else 'response'
             if 'chunk-id' not in headers:
                 raise InvalidMessageError(
-                    'Invalid chunked response missing chunk ID for service {}'.format(self.service_name),
+                    'Invalid chunked {} missing chunk ID for service {}'.format(message_kind, self.service_name),
                 )
 
             chunk_headers = headers
             chunk_id, chunk_count = int(chunk_headers['chunk-id']), int(chunk_headers['chunk-count'])
+
+            if expired:
+                # The first chunk's headers are enough to know that the message has expired, so don't reassemble it
+                self._discard_remaining_chunks(
+                    connection,
+                    queue_key,
+                    headers,
+                    chunk_count - chunk_id,
+                    receive_timeout_in_seconds,
+                )
+                self._drop_expired_message(headers)
+                return None
+
+            # Appending each chunk to the message so far would copy everything received so far for each chunk, which is
+            # quadratic in the number of chunks. Instead, collect zero-copy views of the chunk payloads (after their
+            # headers) and join them once, at the end.
+            serialized_chunks = [serialized_message]  # type: List[Union[six.binary_type, memoryview]]
+
+            request_chunks = None  # type: Optional[Deque[six.binary_type]]
+            if self.is_server:
+                # The rest of the request's chunks are on a queue of their own, so that only this server receives them
+                request_chunks = collections.deque(
+                    self._receive_request_chunks(connection, headers['chunk-queue'], chunk_count - chunk_id),
+                )
+
             while chunk_id < chunk_count:
                 expected_chunk = chunk_id + 1
-                next_chunk = self._receive_message(connection, queue_key, receive_timeout_in_seconds)
+                if request_chunks is None:
+                    next_chunk = self._receive_message(connection, queue_key, receive_timeout_in_seconds)
+                elif request_chunks:
+                    next_chunk = request_chunks.popleft()
+                else:
+                    raise InvalidMessageError(
+                        'Invalid chunked request missing chunk {} of {} for service {}.'.format(
+                            expected_chunk,
+                            chunk_count,
+                            self.service_name,
+                        )
+                    )
 
                 with deserialize_timer:
-                    protocol_version, next_chunk = ProtocolVersion.extract_version(next_chunk)
-                    chunk_headers, next_chunk = self._extract_supported_headers(next_chunk)
-                    serialized_message += next_chunk
+                    protocol_version, payload_offset = ProtocolVersion.find_version(next_chunk)
+                    chunk_headers, payload_offset = self._find_supported_headers(next_chunk, payload_offset)
+                    serialized_chunks.append(memoryview(next_chunk)[payload_offset:])
 
                 if 'chunk-count' not in chunk_headers or 'chunk-id' not in chunk_headers:
                     raise InvalidMessageError(
-                        'Invalid chunked response missing chunk headers expecting chunk {} of {} for service '
-                        '{}.'.format(expected_chunk, chunk_count, self.service_name)
+                        'Invalid chunked {} missing chunk headers expecting chunk {} of {} for service '
+                        '{}.'.format(message_kind, expected_chunk, chunk_count, self.service_name)
                     )
                 if int(chunk_headers['chunk-count']) != chunk_count:
                     raise InvalidMessageError(
-                        'Invalid chunked response has different chunk count {} expecting chunk {} of {} for service '
-                        '{}.'.format(chunk_headers['chunk-count'], expected_chunk, chunk_count, self.service_name)
+                        'Invalid chunked {} has different chunk count {} expecting chunk {} of {} for service '
+                        '{}.'.format(
+                            message_kind,
+                            chunk_headers['chunk-count'],
+                            expected_chunk,
+                            chunk_count,
+                            self.service_name,
+                        )
                     )
                 if int(chunk_headers['chunk-id']) != expected_chunk:
                     raise InvalidMessageError(
-                        'Invalid chunked response has incorrect chunk ID {} expected {} of {} for service '
-                        '{}.'.format(chunk_headers['chunk-id'], expected_chunk, chunk_count, self.service_name)
+                        'Invalid chunked {} has incorrect chunk ID {} expected {} of {} for service '
+                        '{}.'.format(
+                            message_kind,
+                            chunk_headers['chunk-id'],
+                            expected_chunk,
+                            chunk_count,
+                            self.service_name,
+                        )
                     )
 
                 chunk_id, chunk_count = int(chunk_headers['chunk-id']), int(chunk_headers['chunk-count'])
 
+            with deserialize_timer:
+                serialized_message = b''.join(serialized_chunks)
+
+        if expired:
+            # There is no need to decompress or deserialize the message
+            self._drop_expired_message(headers)
+            return None
+
+        if codec:
+            # Chunks were compressed as a whole before chunking, so decompress only after they have been reassembled
+            with self._get_timer('receive.decompress'):
+                serialized_message = codec.decompress(serialized_message)
+
         with deserialize_timer:
             message = serializer.blob_to_dict(serialized_message)
             message.setdefault('meta', {})['serializer'] = serializer
             message['meta']['protocol_version'] = protocol_version
 
-        if self._is_message_expired(message):
+        return message
+
+    def receive_message(self, queue_name, receive_timeout_in_seconds=None):
+        # type: (six.text_type, Optional[float]) -> ReceivedMessage
+        """
+        Receive a message from the specified queue in Redis.
+
+        :param queue_name: The name of the queue to which to send the message
+        :param receive_timeout_in_seconds: The optional timeout, which defaults to the setting with the same name and
+                                           may be fractional (which requires Redis 6.0+)
+
+        :return: A tuple of request ID, message meta-information dict, and message body dict
+
+        :raise: MessageReceiveError, MessageReceiveTimeout, InvalidMessageError
+        """
+        queue_key = self._get_queue_key(queue_name)
+        receive_timeout_in_seconds = _seconds(receive_timeout_in_seconds or self.receive_timeout_in_seconds)
+
+        # Prefetched messages came from a particular Redis server, which is also where any request chunks are, so each
+        # message is received along with its connection
+        received = None  # type: Optional[Tuple[redis.StrictRedis, six.binary_type]]
+        priority = None  # type: Optional[six.text_type]
+        if self.priority_lanes:
+            priority, connection, serialized_message = self._receive_from_priority_lanes(
+                queue_name,
+                receive_timeout_in_seconds,
+            )
+            queue_key = self._get_queue_key(make_priority_queue_name(queue_name, priority))
+            received = connection, serialized_message
+        else:
+            received = self._take_prefetched_message(queue_key)
+            if received is None and self.receive_from_all_shards:
+                received = self._receive_from_all_shards(queue_key, receive_timeout_in_seconds)
+        if received is None:
+            connection = self._get_redis_connection(for_send=False, queue_key=queue_key)
+            received = connection, self._receive_message(connection, queue_key, receive_timeout_in_seconds)
+        message = self._deserialize_received_message(received[0], queue_key, received[1], receive_timeout_in_seconds)
+
+        while message is None or self._is_message_expired(message):
             self._get_counter('receive.error.message_expired').increment()
-            raise MessageReceiveTimeout('Message expired for service {}'.format(self.service_name))
+            # Drop the expired message and move straight on to the next prefetched message, if one is already here
+            received = self._take_prefetched_message(queue_key)
+            if received is None:
+                raise MessageReceiveTimeout('Message expired for service {}'.format(self.service_name))
+            message = self._deserialize_received_message(
+                received[0],
+                queue_key,
+                received[1],
+                receive_timeout_in_seconds,
+            )
 
         request_id = message.get('request_id')
         if request_id is None:
             self._get_counter('receive.error.no_request_id').increment()
             raise InvalidMessageError('No request ID for service {}'.format(self.service_name))
 
+        if priority and message.get('meta', {}).get(SENT_TIME_META_KEY):
+            # How long the request waited in its lane (subject to clock differences between the client and server)
+            self._get_timer('receive.priority.{}.wait'.format(priority)).set(
+                max(0, int(round((time.time() - message['meta'][SENT_TIME_META_KEY]) * TimerResolution.MICROSECONDS))),
+            )
+
         return ReceivedMessage(request_id, message.get('meta', {}), message.get('body'))
 
     @staticmethod
@@ -529,6 +1403,9 @@ class RedisTransportCore(object):
     def _get_timer(self, name):  # type: (six.text_type) -> Timer
         return self.metrics.timer(self._get_metric_name(name), resolution=TimerResolution.MICROSECONDS)
 
+    def _get_gauge(self, name):  # type: (six.text_type) -> Gauge
+        return self.metrics.gauge(self._get_metric_name(name))
+
 
 def _convert_protocol_version(value):  # type: (Union[ProtocolVersion, int]) -> ProtocolVersion
     if isinstance(value, ProtocolVersion):
@@ -543,10 +1420,44 @@ class RedisTransportClientCore(RedisTransportCore):
         converter=_convert_protocol_version,
     )  # type: ProtocolVersion
 
+    admission_control = attr.ib(
+        # Keyword args for the process-wide `AdmissionLimiter` of each request queue, or `None` to send without limits
+        default=None,
+        validator=attr.validators.optional(attr.validators.instance_of(dict)),
+    )  # type: Optional[Dict[six.text_type, Any]]
+
+    def __attrs_post_init__(self):
+        super(RedisTransportClientCore, self).__attrs_post_init__()
+
+        if (
+            self.chunk_messages_larger_than_bytes > 0 and
+            not ProtocolFeature.CHUNKED_REQUESTS.supported_in(self.protocol_version)
+        ):
+            raise ValueError(
+                'If chunk_messages_larger_than_bytes is enabled (non-negative) on the client, protocol_version must be '
+                'at least {} (and all servers must support it).'.format(ProtocolFeature.CHUNKED_REQUESTS.value[1]),
+            )
+
+        if (
+            self.compress_messages_larger_than_bytes >= 0 and
+            not ProtocolFeature.CONTENT_ENCODING_HEADER.supported_in(self.protocol_version)
+        ):
+            raise ValueError(
+                'If compress_messages_larger_than_bytes is enabled (non-negative) on the client, protocol_version '
+                'must be at least {} (and all servers must support it).'.format(
+                    ProtocolFeature.CONTENT_ENCODING_HEADER.value[1],
+                ),
+            )
+
     @property
     def is_server(self):  # type: () -> bool
         return False
 
+    def _get_admission_limiter(self, queue_name):  # type: (six.text_type) -> Optional[AdmissionLimiter]
+        if self.admission_control is None:
+            return None
+        return AdmissionLimiter.get_instance(queue_name, **self.admission_control)
+
     def _get_metric_name(self, name):  # type: (six.text_type) -> six.text_type
         return 'client.transport.redis_gateway.{name}'.format(name=name)
 
@@ -563,20 +1474,47 @@ class RedisTransportServerCore(RedisTransportCore):
         converter=int,
     )  # type: int
 
-    chunk_messages_larger_than_bytes = attr.ib(
-        default=-1,
+    prefetch_count = attr.ib(
+        # How many more requests to pop, along with the request that was blocked on, in one round trip (0 = disabled)
+        default=0,
         converter=int,
-        validator=_valid_chunk_threshold,
+        validator=_valid_prefetch_count,
     )  # type: int
 
+    receive_from_all_shards = attr.ib(
+        # Whether to receive requests from whichever Redis server has one, instead of blocking on one server at a time
+        default=False,
+        converter=bool,
+    )  # type: bool
+
+    priority_lanes = attr.ib(
+        # The weights of the request priority lanes (missing priorities get the default weights), or `None` to receive
+        # only requests sent without a priority or with normal priority
+        default=None,
+        validator=attr.validators.optional(attr.validators.instance_of(dict)),
+    )  # type: Optional[Dict[six.text_type, int]]
+
+    DEFAULT_PRIORITY_LANE_WEIGHTS = {
+        REQUEST_PRIORITY_HIGH: 4,
+        REQUEST_PRIORITY_NORMAL: 2,
+        REQUEST_PRIORITY_LOW: 1,
+    }
+
     def __attrs_post_init__(self):
         super(RedisTransportServerCore, self).__attrs_post_init__()
 
-        if self.maximum_message_size_in_bytes < self.chunk_messages_larger_than_bytes * 5:
-            raise ValueError(
-                'If chunk_messages_larger_than_bytes is enabled (non-negative), maximum_message_size_in_bytes must '
-                'be at least 5 times larger to allow for multiple chunks to be sent.',
-            )
+        if self.priority_lanes is not None:
+            unknown = set(self.priority_lanes) - set(REQUEST_PRIORITIES)
+            if unknown:
+                raise ValueError('Unknown request priorities {} (must be among {})'.format(
+                    ', '.join(sorted(unknown)),
+                    ', '.join(REQUEST_PRIORITIES),
+                ))
+            if any(weight < 1 for weight in self.priority_lanes.values()):
+                raise ValueError('Priority lane weights must be at least 1')
+            if self.receive_from_all_shards:
+                raise ValueError('priority_lanes cannot be combined with receive_from_all_shards')
+            self.priority_lanes = dict(self.DEFAULT_PRIORITY_LANE_WEIGHTS, **self.priority_lanes)
 
     @property
     def is_server(self):  # type: () -> bool
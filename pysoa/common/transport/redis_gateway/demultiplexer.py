@@ -0,0 +1,191 @@
+from __future__ import (
+    absolute_import,
+    unicode_literals,
+)
+
+from copy import deepcopy
+import logging
+import os
+import threading
+import time
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    Hashable,
+    Optional,
+    Tuple,
+    cast,
+)
+import uuid
+
+from pymetrics.recorders.noop import noop_metrics
+import six
+
+from pysoa.common.transport.base import ReceivedMessage
+from pysoa.common.transport.errors import (
+    InvalidMessageError,
+    MessageReceiveTimeout,
+    TransientPySOATransportError,
+)
+from pysoa.common.transport.redis_gateway.backend.base import BaseRedisClient
+from pysoa.common.transport.redis_gateway.constants import RESPONSE_ID_META_KEY
+from pysoa.common.transport.redis_gateway.core import RedisTransportClientCore
+from pysoa.utils import dict_to_hashable
+
+
+try:
+    import concurrent.futures
+except ImportError:  # pragma: no cover
+    concurrent = None  # type: ignore
+
+
+__all__ = (
+    'ResponseDemultiplexer',
+)
+
+
+_logger = logging.getLogger(__name__)
+
+_DemultiplexerKey = Tuple[int, six.text_type, FrozenSet[Tuple[Hashable, ...]]]
+
+
+class ResponseDemultiplexer(object):
+    """
+    Receives the responses to the requests sent by all clients in a process (that share the same Redis configuration)
+    from a single response queue, in a background thread, and completes the `concurrent.futures.Future` registered for
+    each response as soon as it arrives. Use `get_instance` to get the process-wide demultiplexer for a given transport
+    core instead of constructing one directly.
+    """
+
+    # How long the receiver thread blocks in each receive, which also limits how late futures are failed after expiring
+    RECEIVE_TIMEOUT_IN_SECONDS = 1
+
+    _instances = {}  # type: Dict[_DemultiplexerKey, ResponseDemultiplexer]
+    _instances_lock = threading.Lock()
+
+    def __init__(self, backend_type, backend_layer_kwargs):  # type: (six.text_type, Dict[six.text_type, Any]) -> None
+        """
+        :param backend_type: The Redis backend type shared by all clients using this demultiplexer
+        :param backend_layer_kwargs: The Redis backend layer arguments shared by all clients using this demultiplexer
+        """
+        if concurrent is None:  # pragma: no cover
+            raise ValueError('Demultiplexing responses requires `concurrent.futures` (Python 3 or the futures library)')
+
+        # noinspection PyArgumentList
+        self.core = RedisTransportClientCore(
+            service_name='pysoa.demultiplexer',
+            metrics=noop_metrics,
+            backend_type=backend_type,
+            backend_layer_kwargs=deepcopy(backend_layer_kwargs),
+            receive_timeout_in_seconds=self.RECEIVE_TIMEOUT_IN_SECONDS,
+        )
+        self.queue_name = 'pysoa.demultiplexer.{id}{response_queue_specifier}'.format(
+            id=uuid.uuid4().hex,
+            response_queue_specifier=BaseRedisClient.RESPONSE_QUEUE_SPECIFIER,
+        )
+
+        # Response ID -> (future, time after which the response is no longer expected)
+        self._futures = {}  # type: Dict[six.text_type, Tuple[concurrent.futures.Future, float]]
+        self._lock = threading.Lock()
+        self._futures_registered = threading.Event()
+        self._receiver = None  # type: Optional[threading.Thread]
+
+    @classmethod
+    def get_instance(cls, core):  # type: (RedisTransportClientCore) -> ResponseDemultiplexer
+        """
+        Get the demultiplexer for this process and the Redis configuration of the given transport core, creating it if
+        necessary. A process that forks gets new demultiplexers in the child process.
+        """
+        key = (
+            os.getpid(),
+            core.backend_type,
+            dict_to_hashable(cast(Dict[Hashable, Any], core.backend_layer_kwargs)),
+        )  # type: _DemultiplexerKey
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(core.backend_type, core.backend_layer_kwargs)
+            return cls._instances[key]
+
+    @property
+    def futures_outstanding(self):  # type: () -> int
+        """
+        Indicates the number of futures that have not yet been completed with a response or failed because it expired.
+        """
+        return len(self._futures)
+
+    def register(self, response_id, timeout_in_seconds):  # type: (six.text_type, float) -> concurrent.futures.Future
+        """
+        Register a future for the response with the given ID, which must be included in the request meta under the key
+        `RESPONSE_ID_META_KEY`.
+
+        :param response_id: The process-unique response ID
+        :param timeout_in_seconds: How long until the future fails with `MessageReceiveTimeout` if no response arrives
+
+        :return: The future, which will be completed with a `ReceivedMessage`
+        """
+        future = concurrent.futures.Future()  # type: concurrent.futures.Future
+        future.set_running_or_notify_cancel()
+
+        with self._lock:
+            self._futures[response_id] = (future, time.time() + timeout_in_seconds)
+            self._futures_registered.set()
+            if self._receiver is None or not self._receiver.is_alive():
+                self._receiver = threading.Thread(target=self._receive_responses, name='pysoa-response-demultiplexer')
+                self._receiver.daemon = True
+                self._receiver.start()
+
+        return future
+
+    def unregister(self, response_id):  # type: (six.text_type) -> None
+        """
+        Forget the future for the given response ID, for example because the request could not be sent.
+        """
+        with self._lock:
+            self._futures.pop(response_id, None)
+
+    def _receive_responses(self):  # type: () -> None
+        while True:
+            # Don't block on Redis (or hold a connection) while nobody is waiting on a response
+            self._futures_registered.wait()
+            self._expire_futures()
+
+            try:
+                request_id, meta, body = self.core.receive_message(self.queue_name)
+            except MessageReceiveTimeout:
+                continue
+            except TransientPySOATransportError:
+                # Futures whose responses are lost to this Redis error will expire
+                time.sleep(0.1)
+                continue
+            except InvalidMessageError:
+                _logger.exception('Invalid response received by the PySOA response demultiplexer')
+                continue
+            except Exception:
+                _logger.exception('Unknown error in the PySOA response demultiplexer')
+                time.sleep(0.1)
+                continue
+
+            response_id = (meta or {}).pop(RESPONSE_ID_META_KEY, None)
+            with self._lock:
+                future, _ = self._futures.pop(response_id, (None, None))
+            if future is None:
+                _logger.warning(
+                    'Dropped response {} received after its request expired or without a response ID'.format(
+                        request_id,
+                    ),
+                )
+                continue
+
+            future.set_result(ReceivedMessage(request_id, meta, body))
+
+    def _expire_futures(self):  # type: () -> None
+        now = time.time()
+        with self._lock:
+            expired = [response_id for response_id, (_, expires) in six.iteritems(self._futures) if expires < now]
+            expired_futures = [self._futures.pop(response_id)[0] for response_id in expired]
+            if not self._futures:
+                self._futures_registered.clear()
+
+        for future in expired_futures:
+            future.set_exception(MessageReceiveTimeout('No response received before the request expired'))
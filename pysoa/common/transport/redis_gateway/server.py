@@ -6,6 +6,7 @@ from __future__ import (
 from typing import (
     Any,
     Dict,
+    List,
 )
 
 from conformity import fields
@@ -14,6 +15,7 @@ from pymetrics.recorders.base import MetricsRecorder
 import six
 
 from pysoa.common.transport.base import (
+    QueueStats,
     ReceivedMessage,
     ServerTransport,
 )
@@ -21,6 +23,7 @@ from pysoa.common.transport.errors import (
     InvalidMessageError,
     MessageReceiveTimeout,
 )
+from pysoa.common.transport.redis_gateway.constants import REQUEST_PRIORITIES
 from pysoa.common.transport.redis_gateway.core import RedisTransportServerCore
 from pysoa.common.transport.redis_gateway.settings import RedisServerTransportSchema
 from pysoa.common.transport.redis_gateway.utils import make_redis_queue_name
@@ -69,3 +72,12 @@ class RedisServerTransport(ServerTransport):
 
         with self.metrics.timer('server.transport.redis_gateway.send', resolution=TimerResolution.MICROSECONDS):
             self.core.send_message(queue_name, request_id, meta, body)
+
+    def get_request_queue_stats(self):  # type: () -> List[QueueStats]
+        return self.core.get_queue_stats(
+            self._receive_queue_name,
+            priorities=REQUEST_PRIORITIES if self.core.priority_lanes else None,
+        )
+
+    def shutdown(self):  # type: () -> None
+        self.core.return_prefetched_messages()
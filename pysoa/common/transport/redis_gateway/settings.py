@@ -6,7 +6,15 @@ from __future__ import (
 from conformity import fields
 
 from pysoa.common.serializer.base import Serializer as BaseSerializer
-from pysoa.common.transport.redis_gateway.constants import REDIS_BACKEND_TYPES
+from pysoa.common.transport.redis_gateway.compression import Codec
+from pysoa.common.transport.redis_gateway.constants import (
+    CONSISTENT_HASHING_ALGORITHMS,
+    REDIS_BACKEND_TYPES,
+    REQUEST_PRIORITY_HIGH,
+    REQUEST_PRIORITY_LOW,
+    REQUEST_PRIORITY_NORMAL,
+    REQUEST_QUEUE_ROUTINGS,
+)
 
 
 class RedisTransportSchema(fields.Dictionary):
@@ -16,13 +24,22 @@ class RedisTransportSchema(fields.Dictionary):
                 'connection_kwargs': fields.SchemalessDictionary(
                     description='The arguments used when creating all Redis connections (see Redis-Py docs)',
                 ),
+                'consistent_hashing_algorithm': fields.Constant(
+                    *CONSISTENT_HASHING_ALGORITHMS,
+                    description='How response queues are spread across Redis hosts or Sentinel services. "legacy" '
+                                '(the default) remaps most response queues whenever a host or service is added, '
+                                'while "jump" (jump consistent hashing) remaps only about 1/N of them when a host '
+                                'or service is added to the end of the list. All clients and servers sharing the '
+                                'same Redis hosts must use the same algorithm; does not apply to the Cluster '
+                                'backend type',
+                ),
                 'hosts': fields.List(
                     fields.Any(
                         fields.Tuple(fields.UnicodeString(), fields.Integer()),
                         fields.UnicodeString(),
                     ),
-                    description='The list of Redis hosts, where each is a tuple of `("address", port)` or the '
-                                'simple string address.',
+                    description='The list of Redis hosts (or Sentinel hosts or Cluster startup nodes), where each '
+                                'is a tuple of `("address", port)` or the simple string address.',
                 ),
                 'redis_db': fields.Integer(
                     description='The Redis database, a shortcut for putting this in `connection_kwargs`.',
@@ -30,6 +47,13 @@ class RedisTransportSchema(fields.Dictionary):
                 'redis_port': fields.Integer(
                     description='The port number, a shortcut for putting this on all hosts',
                 ),
+                'request_queue_routing': fields.Constant(
+                    *REQUEST_QUEUE_ROUTINGS,
+                    description='How clients pick the Redis host or Sentinel service to which to send each request. '
+                                '"round_robin" (the default) cycles through them, while "load_aware" picks the less '
+                                'loaded of two random ones based on their recent send latency and request queue '
+                                'depth; does not apply to the Cluster backend type',
+                ),
                 'sentinel_failover_retries': fields.Integer(
                     description='How many times to retry (with a delay) getting a connection from the Sentinel '
                                 'when a master cannot be found (cluster is in the middle of a failover); '
@@ -49,9 +73,11 @@ class RedisTransportSchema(fields.Dictionary):
             },
             optional_keys=(
                 'connection_kwargs',
+                'consistent_hashing_algorithm',
                 'hosts',
                 'redis_db',
                 'redis_port',
+                'request_queue_routing',
                 'sentinel_failover_retries',
                 'sentinel_kwargs',
                 'sentinel_services',
@@ -61,7 +87,7 @@ class RedisTransportSchema(fields.Dictionary):
         ),
         'backend_type': fields.Constant(
             *REDIS_BACKEND_TYPES,
-            description='Which backend (standard or sentinel) should be used for this Redis transport'
+            description='Which backend (standard, sentinel, or cluster) should be used for this Redis transport'
         ),
         'log_messages_larger_than_bytes': fields.Integer(
             description='By default, messages larger than 100KB that do not trigger errors (see '
@@ -74,8 +100,9 @@ class RedisTransportSchema(fields.Dictionary):
             description='The maximum message size, in bytes, that is permitted to be transmitted over this '
                         'transport (defaults to 100KB on the client and 250KB on the server)',
         ),
-        'message_expiry_in_seconds': fields.Integer(
-            description='How long after a message is sent that it is considered expired, dropped from queue',
+        'message_expiry_in_seconds': fields.Float(
+            description='How long after a message is sent that it is considered expired, dropped from queue (may be '
+                        'fractional, such as 0.5)',
         ),
         'queue_capacity': fields.Integer(
             description='The capacity of the message queue to which this transport will send messages',
@@ -83,17 +110,46 @@ class RedisTransportSchema(fields.Dictionary):
         'queue_full_retries': fields.Integer(
             description='How many times to retry sending a message to a full queue before giving up',
         ),
-        'receive_timeout_in_seconds': fields.Integer(
-            description='How long to block waiting on a message to be received',
+        'receive_timeout_in_seconds': fields.Float(
+            description='How long to block waiting on a message to be received (may be fractional, such as 0.15, but '
+                        'fractional timeouts require Redis 6.0 or newer)',
         ),
         'default_serializer_config': fields.ClassConfigurationSchema(
             base_class=BaseSerializer,
             description='The configuration for the serializer this transport should use.',
         ),
+        'chunk_messages_larger_than_bytes': fields.Integer(
+            description='If set, messages larger than this setting will be chunked and sent in pieces, to prevent '
+                        'blocking single-threaded Redis for long periods of time to handle large messages. On the '
+                        'server, this applies to responses. On the client, this applies to requests, and requires '
+                        '`protocol_version` 4 or higher (so all servers must support protocol version 4). When set, '
+                        'this value must be greater than or equal to 102400, and `maximum_message_size_in_bytes` must '
+                        'also be set and must be at least 5 times greater than this value (because '
+                        '`maximum_message_size_in_bytes` is still enforced).',
+        ),
+        'compress_messages_larger_than_bytes': fields.Integer(
+            description='If set, messages larger than this setting (after serialization) will be compressed with the '
+                        'codec configured in `compression_codec_config`, before the message size is checked against '
+                        '`maximum_message_size_in_bytes` and before the message is chunked. Messages that compression '
+                        'would not make smaller are sent uncompressed. On the server, this applies to responses, and '
+                        'only to clients that sent their requests with protocol version 5 or higher. On the client, '
+                        'this applies to requests, and requires `protocol_version` 5 or higher (so all servers must '
+                        'support protocol version 5). Set to 0 to compress all messages. Disabled by default.',
+        ),
+        'compression_codec_config': fields.ClassConfigurationSchema(
+            base_class=Codec,
+            description='The configuration for the codec this transport should use to compress messages (see '
+                        '`compress_messages_larger_than_bytes`). Defaults to the standard library zlib codec. '
+                        'Receivers resolve codecs by the encoding name in each message, so every client and server '
+                        'must be able to import any custom codec.',
+        ),
     }
 
     optional_keys = (
         'backend_layer_kwargs',
+        'chunk_messages_larger_than_bytes',
+        'compress_messages_larger_than_bytes',
+        'compression_codec_config',
         'log_messages_larger_than_bytes',
         'maximum_message_size_in_bytes',
         'message_expiry_in_seconds',
@@ -108,16 +164,45 @@ class RedisTransportSchema(fields.Dictionary):
 
 RedisServerTransportSchema = RedisTransportSchema().extend(
     contents={
-        'chunk_messages_larger_than_bytes': fields.Integer(
-            description='If set, responses larger than this setting will be chunked and sent back to the client in '
-                        'pieces, to prevent blocking single-threaded Redis for long periods of time to handle large '
-                        'responses. When set, this value must be greater than or equal to 102400, and '
-                        '`maximum_message_size_in_bytes` must also be set and must be at least 5 times greater than '
-                        'this value (because `maximum_message_size_in_bytes` is still enforced).',
+        'prefetch_count': fields.Integer(
+            gte=0,
+            description='If set, each time the server receives a request, it also pops up to this many more '
+                        'requests from the queue in the same round trip and buffers them in memory, saving a Redis '
+                        'round trip for each of them. Buffered requests that expire before they are processed are '
+                        'dropped, and any left in the buffer when the server shuts down are pushed back onto the '
+                        'head of the queue. Keep this small, because buffered requests cannot be processed by any '
+                        'other server until this server gets to them. Defaults to 0 (disabled).',
+        ),
+        'receive_from_all_shards': fields.Boolean(
+            description='By default, each time the server receives a request, it blocks waiting on the request queue '
+                        'on just one Redis host or Sentinel service (a different one each time), for up to '
+                        '`receive_timeout_in_seconds`, even if requests are waiting on the others. If this is enabled, '
+                        'the server instead receives a request from whichever one has a request, checking all of them '
+                        'without blocking (starting with a different one each time, so that none is starved), and '
+                        'then blocking on one of them for just one second, until the receive times out. This costs '
+                        'an idle server one Redis round trip per host or service per second. Has no effect with just '
+                        'one Redis host or Sentinel service or with the Cluster backend type.',
         ),
+        'priority_lanes': fields.Nullable(fields.Dictionary(
+            {
+                REQUEST_PRIORITY_HIGH: fields.Integer(gte=1, description='The weight of the high lane (defaults to 4)'),
+                REQUEST_PRIORITY_NORMAL: fields.Integer(
+                    gte=1,
+                    description='The weight of the normal lane (defaults to 2)',
+                ),
+                REQUEST_PRIORITY_LOW: fields.Integer(gte=1, description='The weight of the low lane (defaults to 1)'),
+            },
+            optional_keys=(REQUEST_PRIORITY_HIGH, REQUEST_PRIORITY_NORMAL, REQUEST_PRIORITY_LOW),
+            description='If specified (even as an empty dictionary), the server receives requests from the request '
+                        'queue of each priority (high, normal, and low) with a single blocking pop across all of '
+                        'them, which takes a request from the first of them, in order, that has one. Normally, '
+                        'higher priorities come first, but each priority comes first in proportion to its weight, so '
+                        'that lower priorities are not starved while higher priorities are backed up. Not supported '
+                        'with the Cluster backend type or with `receive_from_all_shards`.',
+        )),
     },
 
-    optional_keys=('chunk_messages_larger_than_bytes',),
+    optional_keys=('prefetch_count', 'receive_from_all_shards', 'priority_lanes'),
 
     description='The constructor kwargs for the Redis server transport.',
 )
@@ -3,8 +3,20 @@ from __future__ import (
     unicode_literals,
 )
 
+from typing import Optional
+
 import six
 
+from pysoa.common.transport.redis_gateway.constants import REQUEST_PRIORITY_NORMAL
+
+
+def make_redis_queue_name(service_name, priority=None):
+    # type: (six.text_type, Optional[six.text_type]) -> six.text_type
+    return make_priority_queue_name('service.' + service_name, priority)
+
 
-def make_redis_queue_name(service_name):  # type: (six.text_type) -> six.text_type
-    return 'service.' + service_name
+def make_priority_queue_name(queue_name, priority):  # type: (six.text_type, Optional[six.text_type]) -> six.text_type
+    # Normal priority shares the request queue of requests sent without a priority
+    if priority and priority != REQUEST_PRIORITY_NORMAL:
+        return '{}.priority.{}'.format(queue_name, priority)
+    return queue_name
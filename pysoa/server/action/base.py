@@ -4,6 +4,7 @@ from __future__ import (
 )
 
 import abc
+import inspect
 from typing import (
     Any,
     Dict,
@@ -32,6 +33,9 @@ __all__ = (
 )
 
 
+_is_coroutine = getattr(inspect, 'iscoroutine', lambda _: False)
+
+
 @six.add_metaclass(abc.ABCMeta)
 class Action(ActionInterface):
     """
@@ -39,7 +43,8 @@ class Action(ActionInterface):
 
     Contains the basic framework for implementing an action:
 
-    - Subclass and override `run()` with the body of your code
+    - Subclass and override `run()` with the body of your code (in Python 3.5+, `run()` may be a coroutine method,
+      `async def run`, which the server runs on its async event loop; see the `max_concurrent_jobs` server setting)
     - Optionally provide a `description` attribute, which should be a unicode string and is used to display
       introspection information for the action.
     - Optionally provide `request_schema` and/or `response_schema` attributes. These should be Conformity Dictionaries,
@@ -119,6 +124,12 @@ class Action(ActionInterface):
         self.validate(action_request)
         # Run the body of the action
         response_body = self.run(action_request)
+        if _is_coroutine(response_body):
+            # A coroutine-based action (`async def run`) runs on the server's async event loop, and this waits for it
+            if action_request.run_coroutine is None:
+                response_body.close()  # type: ignore
+                raise RuntimeError('Coroutine-based actions require Python 3.5+ and a server async event loop.')
+            response_body = action_request.run_coroutine(response_body).result()  # type: ignore
         # Validate the response body. Errors in a response are the problem of
         # the service, and so we just raise a Python exception and let error
         # middleware catch it. The server will return a SERVER_ERROR response.
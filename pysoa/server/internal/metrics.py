@@ -0,0 +1,79 @@
+from __future__ import (
+    absolute_import,
+    unicode_literals,
+)
+
+import threading
+from typing import Any
+
+from pymetrics.instruments import (
+    Counter,
+    Gauge,
+    Histogram,
+    Timer,
+    TimerResolution,
+)
+from pymetrics.recorders.base import MetricsRecorder
+import six
+
+
+__all__ = (
+    'ThreadSafeMetricsRecorder',
+)
+
+
+class ThreadSafeMetricsRecorder(MetricsRecorder):
+    """
+    Wraps a metrics recorder, which need not be thread-safe, so that metrics can be recorded from many threads at once.
+    Getting metrics and publishing them are serialized with a lock, so that one thread cannot add a metric while
+    another is publishing. The metrics returned are those of the wrapped recorder.
+    """
+
+    def __init__(self, recorder):  # type: (MetricsRecorder) -> None
+        self.recorder = recorder
+        self._lock = threading.RLock()
+
+    def counter(self, name, initial_value=0, **tags):  # type: (six.text_type, int, **Any) -> Counter
+        with self._lock:
+            return self.recorder.counter(name, initial_value=initial_value, **tags)
+
+    def histogram(self, name, force_new=False, initial_value=0, **tags):
+        # type: (six.text_type, bool, int, **Any) -> Histogram
+        with self._lock:
+            return self.recorder.histogram(name, force_new=force_new, initial_value=initial_value, **tags)
+
+    def timer(self, name, force_new=False, resolution=TimerResolution.MILLISECONDS, initial_value=0, **tags):
+        # type: (six.text_type, bool, TimerResolution, int, **Any) -> Timer
+        with self._lock:
+            return self.recorder.timer(
+                name,
+                force_new=force_new,
+                resolution=resolution,
+                initial_value=initial_value,
+                **tags
+            )
+
+    def gauge(self, name, force_new=False, initial_value=0, **tags):
+        # type: (six.text_type, bool, int, **Any) -> Gauge
+        with self._lock:
+            return self.recorder.gauge(name, force_new=force_new, initial_value=initial_value, **tags)
+
+    def publish_all(self):  # type: () -> None
+        with self._lock:
+            self.recorder.publish_all()
+
+    def publish_if_full_or_old(self, max_metrics=18, max_age=10):  # type: (int, int) -> None
+        with self._lock:
+            self.recorder.publish_if_full_or_old(max_metrics=max_metrics, max_age=max_age)
+
+    def throttled_publish_all(self, delay=10):  # type: (int) -> None
+        with self._lock:
+            self.recorder.throttled_publish_all(delay=delay)
+
+    def clear(self, only_published=False):  # type: (bool) -> None
+        with self._lock:
+            self.recorder.clear(only_published=only_published)
+
+    def __getattr__(self, item):  # type: (str) -> Any
+        # Anything else, such as `get_all_metrics` on the default recorder, goes straight to the wrapped recorder
+        return getattr(self.recorder, item)
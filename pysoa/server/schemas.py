@@ -5,13 +5,17 @@ from __future__ import (
 
 from conformity.fields import (
     Boolean,
+    Constant,
     Dictionary,
+    Float,
     Integer,
     List,
     SchemalessDictionary,
     UnicodeString,
 )
 
+from pysoa.common.constants import REQUEST_PRIORITIES
+
 
 __all__ = (
     'ActionRequestSchema',
@@ -40,9 +44,15 @@ ControlHeaderSchema = Dictionary(
             description='Whether to complete processing a request without sending a response back to the client '
                         '(defaults to false).'
         ),
+        'priority': Constant(
+            *REQUEST_PRIORITIES,
+            description='The priority of the request, which transports that support priorities (such as the Redis '
+                        'Gateway transport) use to pick the request queue to which the request is sent (defaults to '
+                        'the client transport\'s default priority).',
+        ),
     },
     allow_extra_keys=True,
-    optional_keys=('suppress_response', ),
+    optional_keys=('suppress_response', 'priority'),
 )
 
 ContextHeaderSchema = Dictionary(
@@ -68,10 +78,17 @@ ContextHeaderSchema = Dictionary(
                         'correlation ID, and the client available in `request.client` automatically inherits the '
                         'correlation ID from the request.',
         ),
+        'deadline': Float(
+            description='The Unix-epoch timestamp in seconds after which the original caller will no longer wait for '
+                        'a response. The server sets this from the request message expiry (or keeps the earlier '
+                        'deadline if the caller already supplied one) and stops running further actions once it has '
+                        'passed, and the client available in `request.client` propagates it to nested requests and '
+                        'makes them expire no later than it.',
+        ),
         'switches': List(Integer(), description='See: :ref:`api-versioning-using-switches`.'),
     },
     allow_extra_keys=True,
-    optional_keys=('caller', 'calling_service'),
+    optional_keys=('caller', 'calling_service', 'deadline'),
 )
 
 JobRequestSchema = Dictionary(
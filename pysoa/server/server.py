@@ -6,7 +6,9 @@ from __future__ import (
 import argparse
 import atexit
 import codecs
+import ctypes
 import importlib
+import inspect
 import logging
 import logging.config
 import os
@@ -24,6 +26,8 @@ from typing import (
     List,
     Mapping,
     Optional,
+    Set,
+    Tuple,
     Type,
     TypeVar,
     cast,
@@ -38,8 +42,10 @@ from pymetrics.recorders.base import MetricsRecorder
 import six
 
 from pysoa.client.client import Client
+from pysoa.common.compatibility import ContextVar
 from pysoa.common.constants import (
     ERROR_CODE_ACTION_TIMEOUT,
+    ERROR_CODE_DEADLINE_EXCEEDED,
     ERROR_CODE_JOB_TIMEOUT,
     ERROR_CODE_RESPONSE_NOT_SERIALIZABLE,
     ERROR_CODE_RESPONSE_TOO_LARGE,
@@ -56,6 +62,7 @@ from pysoa.common.transport.base import ServerTransport
 from pysoa.common.transport.errors import (
     MessageReceiveTimeout,
     MessageTooLarge,
+    PySOATransportError,
     TransientPySOATransportError,
 )
 from pysoa.common.types import (
@@ -73,6 +80,7 @@ from pysoa.server.errors import (
     ActionError,
     JobError,
 )
+from pysoa.server.internal.metrics import ThreadSafeMetricsRecorder
 from pysoa.server.internal.types import RequestSwitchSet
 from pysoa.server.schemas import JobRequestSchema
 from pysoa.server.settings import ServerSettings
@@ -90,6 +98,12 @@ try:
 except (ImportError, SyntaxError):
     AsyncEventLoopThread = None  # type: ignore
 
+try:
+    # noinspection PyCompatibility
+    import concurrent.futures
+except ImportError:
+    concurrent = None  # type: ignore
+
 try:
     from django.conf import settings as django_settings
     from django.core.cache import caches as django_caches
@@ -132,6 +146,58 @@ class HarakiriInterrupt(BaseException):
     """
 
 
+_is_coroutine_function = getattr(inspect, 'iscoroutinefunction', lambda _: False)
+
+
+class _ConcurrentJob(object):
+    """
+    A job running concurrently with other jobs (see the `max_concurrent_jobs` setting). The job's coroutines are run
+    through it, so that harakiri can interrupt this job without interrupting the others: The futures the job is waiting
+    on raise `HarakiriInterrupt`, and the coroutines behind them are cancelled.
+    """
+
+    def __init__(self, request_id, run_coroutine):  # type: (int, Callable[[Any], Any]) -> None
+        self.request_id = request_id
+        self.started = time.time()
+        self.interrupted = False
+        self._run_coroutine = run_coroutine
+        self._futures = {}  # type: Dict[Any, Any]
+        self._lock = threading.RLock()
+
+    def run_coroutine(self, coroutine):  # type: (Any) -> Any
+        future = concurrent.futures.Future()  # type: concurrent.futures.Future
+        with self._lock:
+            if self.interrupted:
+                coroutine.close()
+                future.set_exception(HarakiriInterrupt())
+                return future
+
+            running = self._run_coroutine(coroutine)
+            self._futures[running] = future
+        running.add_done_callback(lambda _: self._relay(running, future))
+        return future
+
+    def _relay(self, running, future):  # type: (Any, Any) -> None
+        with self._lock:
+            self._futures.pop(running, None)
+            if future.done():
+                return
+            if running.cancelled():
+                future.cancel()
+            elif running.exception() is not None:
+                future.set_exception(running.exception())
+            else:
+                future.set_result(running.result())
+
+    def interrupt(self):  # type: () -> None
+        with self._lock:
+            self.interrupted = True
+            for running, future in list(self._futures.items()):
+                if not future.done():
+                    future.set_exception(HarakiriInterrupt())
+                running.cancel()
+
+
 class Server(object):
     """
     The base class from which all PySOA service servers inherit, and contains the code that does all of the heavy
@@ -186,6 +252,15 @@ class Server(object):
         self.metrics = self.settings['metrics']['object'](
             **self.settings['metrics'].get('kwargs', {})
         )  # type: MetricsRecorder
+
+        self._max_concurrent_jobs = 1
+        if AsyncEventLoopThread and concurrent:  # type: ignore
+            self._max_concurrent_jobs = self.settings['max_concurrent_jobs']
+        self._worker_threads = self.settings['worker_threads']  # type: int
+        if self._max_concurrent_jobs > 1 or self._worker_threads > 1:
+            # Concurrent jobs and worker threads record metrics from many threads at once
+            self.metrics = ThreadSafeMetricsRecorder(self.metrics)
+
         self.transport = self.settings['transport']['object'](
             self.service_name,
             self.metrics,
@@ -231,20 +306,49 @@ class Server(object):
 
         self._default_status_action_class = None  # type: Optional[ActionType]
 
-        self._idle_timer = None  # type: Optional[Timer]
+        self._worker_idle_timer = ContextVar(
+            'pysoa_server_worker_idle_timer',
+            default=None,
+        )  # type: ContextVar[Optional[Timer]]
+        self._worker_deadlines = {}  # type: Dict[threading.Thread, float]
+        self._worker_interruptions = {}  # type: Dict[threading.Thread, float]
+        self._worker_deadlines_lock = threading.Lock()
+        self._busy_workers = set()  # type: Set[threading.Thread]
+        self._busy_workers_lock = threading.Lock()
 
         self._heartbeat_file = None  # type: Optional[codecs.StreamReaderWriter]
         self._heartbeat_file_path = None  # type: Optional[six.text_type]
         self._heartbeat_file_last_update = 0.0
+        self._heartbeat_file_lock = threading.Lock()
         self._forked_process_id = forked_process_id
 
+        self._queue_stats_last_publish = 0.0
+        self._queue_stats_lock = threading.Lock()
+
         self._skip_django_database_cleanup = False
 
+        self._concurrent_jobs = set()  # type: Set[_ConcurrentJob]
+        self._concurrent_jobs_condition = threading.Condition()
+        self._concurrent_job_executor = None  # type: Optional[concurrent.futures.ThreadPoolExecutor]
+        self._concurrent_job = ContextVar(
+            'pysoa_server_concurrent_job',
+            default=None,
+        )  # type: ContextVar[Optional[_ConcurrentJob]]
+        if self.settings['max_concurrent_jobs'] > self._max_concurrent_jobs:
+            self.logger.warning('The `max_concurrent_jobs` setting requires Python 3.5+ and will be ignored')
+
     def handle_next_request(self):  # type: () -> None
         """
         Retrieves the next request from the transport, or returns if it times out (no request has been made), and then
-        processes that request, sends its response, and returns when done.
+        processes that request, sends its response, and returns when done. If `max_concurrent_jobs` is greater than 1,
+        this first waits until fewer than that many jobs are in flight, and a request whose actions are all
+        coroutine-based is handed off to run concurrently instead of being processed before this returns.
         """
+        if self._concurrent_job_executor:
+            # Backpressure: Do not receive another request until there is room to handle it
+            if not self._wait_for_concurrent_jobs(self._max_concurrent_jobs - 1, stop_on_shutdown=True):
+                return
+
         if not self._idle_timer:
             # This method may be called multiple times before receiving a request, so we only create and start a timer
             # if it's the first call or if the idle timer was stopped on the last call.
@@ -271,6 +375,14 @@ class Server(object):
         self._set_busy_metrics(True)
         self.metrics.publish_all()
 
+        if self._concurrent_job_executor and self._is_coroutine_job(job_request):
+            self._submit_concurrent_job(request_id, meta, job_request)
+            self._set_busy_metrics(False)
+        else:
+            self._handle_job(request_id, meta, job_request)
+
+    def _handle_job(self, request_id, meta, job_request):
+        # type: (int, Dict[six.text_type, Any], Dict[six.text_type, Any]) -> None
         try:
             PySOALogContextFilter.set_logging_request_context(request_id=request_id, **job_request.get('context', {}))
         except TypeError:
@@ -297,6 +409,9 @@ class Server(object):
         try:
             self.perform_pre_request_actions()
 
+            # Let the actions and any nested service calls know when the caller will stop waiting for the response
+            self._set_job_deadline(meta, job_request)
+
             # Process and run the Job
             job_response = self.process_job(job_request)
 
@@ -359,11 +474,103 @@ class Server(object):
             self.perform_post_request_actions()
             self._set_busy_metrics(False)
 
+    @staticmethod
+    def _set_job_deadline(meta, job_request):  # type: (Dict[six.text_type, Any], Dict[six.text_type, Any]) -> None
+        context = job_request.get('context')
+        if not isinstance(context, dict):
+            return  # validation will catch this
+
+        deadline = meta.get('__expiry__')
+        if isinstance(context.get('deadline'), (int, float)) and (not deadline or context['deadline'] < deadline):
+            deadline = context['deadline']
+        if deadline:
+            context['deadline'] = float(deadline)
+
+    def _is_coroutine_job(self, job_request):  # type: (Dict[six.text_type, Any]) -> bool
+        actions = job_request.get('actions')
+        if not actions or not isinstance(actions, list):
+            return False
+        for action_request in actions:
+            action_name = action_request.get('action') if isinstance(action_request, dict) else None
+            if not action_name or action_name not in self.action_class_map:
+                return False
+            if not _is_coroutine_function(getattr(self.action_class_map[action_name], 'run', None)):
+                return False
+        return True
+
+    def _submit_concurrent_job(self, request_id, meta, job_request):
+        # type: (int, Dict[six.text_type, Any], Dict[six.text_type, Any]) -> None
+        job = _ConcurrentJob(request_id, cast(AsyncEventLoopThread, self._async_event_loop_thread).run_coroutine)
+        with self._concurrent_jobs_condition:
+            self._concurrent_jobs.add(job)
+            self.metrics.gauge('server.worker.concurrent_jobs').set(len(self._concurrent_jobs))
+        cast(concurrent.futures.ThreadPoolExecutor, self._concurrent_job_executor).submit(
+            self._run_concurrent_job,
+            job,
+            request_id,
+            meta,
+            job_request,
+        )
+
+    def _run_concurrent_job(self, job, request_id, meta, job_request):
+        # type: (_ConcurrentJob, int, Dict[six.text_type, Any], Dict[six.text_type, Any]) -> None
+        token = self._concurrent_job.set(job)
+        # noinspection PyBroadException
+        try:
+            self._handle_job(request_id, meta, job_request)
+        except Exception:
+            self.metrics.counter('server.error.unknown').increment()
+            self.logger.exception('Unhandled error while handling concurrent job')
+        finally:
+            self._concurrent_job.reset(token)
+            with self._concurrent_jobs_condition:
+                self._concurrent_jobs.discard(job)
+                self.metrics.gauge('server.worker.concurrent_jobs').set(len(self._concurrent_jobs))
+                self._concurrent_jobs_condition.notify_all()
+            self._set_busy_metrics(False)
+
+    def _wait_for_concurrent_jobs(self, max_in_flight, stop_on_shutdown):  # type: (int, bool) -> bool
+        """
+        Waits until no more than `max_in_flight` concurrent jobs are in flight, interrupting any that have run for
+        longer than the harakiri timeout while waiting.
+
+        :return: `True` unless it stopped waiting because the server is shutting down.
+        """
+        with self._concurrent_jobs_condition:
+            self._interrupt_overdue_concurrent_jobs()
+            if len(self._concurrent_jobs) > max_in_flight:
+                self.metrics.counter('server.worker.concurrent_jobs.backpressure').increment()
+            while len(self._concurrent_jobs) > max_in_flight:
+                if stop_on_shutdown and self.shutting_down:
+                    return False
+                self._concurrent_jobs_condition.wait(0.1)
+                self._interrupt_overdue_concurrent_jobs()
+        return True
+
+    def _interrupt_overdue_concurrent_jobs(self):  # type: () -> None
+        timeout = self.settings['harakiri']['timeout']
+        if not timeout:
+            return
+
+        now = time.time()
+        for job in self._concurrent_jobs:
+            if not job.interrupted and now - job.started > timeout:
+                self.logger.warning(
+                    'Concurrent job for request {} ran for more than {} seconds, interrupting it'.format(
+                        job.request_id,
+                        timeout,
+                    ),
+                )
+                job.interrupt()
+
     def make_client(self, context, extra_context=None, **kwargs):
         # type: (Context, Optional[Context], **Any) -> Client
         """
         Gets a `Client` that will propagate the passed `context` in order to to pass it down to middleware or Actions.
-        The server code will call this method only with the `context` argument and no other arguments. Subclasses can
+        If the context contains a `deadline`, the `Client` also makes every request it sends expire no later than that
+        deadline (and refuses to send requests once it has passed), so that nested service calls do not keep running
+        after the original caller has given up. The server code will call this method only with the `context` argument
+        and no other arguments. Subclasses can
         override this method and replace its behavior completely or call `super` to pass `extra_context` data or
         keyword arguments that will be passed to the client. The supplied `context` argument will not be modified in
         any way (it will be copied); the same promise is not made for the `extra_context` argument.
@@ -379,6 +586,8 @@ class Server(object):
         if extra_context:
             context.update(extra_context)
         context['calling_service'] = self.service_name
+        if context.get('deadline') and 'deadline' not in kwargs:
+            kwargs['deadline'] = context['deadline']
         return self.client_class(self.settings['client_routing'], context=context, **kwargs)
 
     # noinspection PyShadowingNames
@@ -425,7 +634,10 @@ class Server(object):
             job_request['client'] = self.make_client(job_request['context'])
 
             # Add the run_coroutine in case a middleware or action wishes to use it
-            if self._async_event_loop_thread:
+            concurrent_job = self._concurrent_job.get()
+            if concurrent_job:
+                job_request['run_coroutine'] = concurrent_job.run_coroutine
+            elif self._async_event_loop_thread:
                 job_request['run_coroutine'] = self._async_event_loop_thread.run_coroutine
             else:
                 job_request['run_coroutine'] = None
@@ -543,7 +755,20 @@ class Server(object):
         harakiri = False
         job_response = JobResponse()
         job_switches = RequestSwitchSet(job_request.context['switches'])
+        deadline = job_request.context.get('deadline')
         for i, simple_action_request in enumerate(job_request.actions):
+            if deadline and time.time() >= deadline:
+                # The caller has stopped waiting for the response, so running the remaining actions is wasted work
+                self.metrics.counter('server.error.deadline_exceeded').increment()
+                self.metrics.counter('server.action.skipped.deadline_exceeded').increment(len(job_request.actions) - i)
+                job_response.errors.append(Error(
+                    code=ERROR_CODE_DEADLINE_EXCEEDED,
+                    message='The job deadline passed before all of its actions could run; {} of {} actions were '
+                            'skipped.'.format(len(job_request.actions) - i, len(job_request.actions)),
+                    is_caller_error=False,
+                ))
+                break
+
             # noinspection PyArgumentList
             action_request = self.request_class(
                 action=simple_action_request.action,
@@ -816,10 +1041,49 @@ class Server(object):
         if self._heartbeat_file and time.time() - self._heartbeat_file_last_update > 2.5:
             # Only update the heartbeat file if one is configured and it has been at least 2.5 seconds since the last
             # update. This prevents us from dragging down service performance by constantly updating the file system.
-            self._heartbeat_file.seek(0)
-            self._heartbeat_file.write(six.text_type(time.time()))
-            self._heartbeat_file.flush()
-            self._heartbeat_file_last_update = time.time()
+            # Worker threads may get here at the same time, and, if so, only one of them needs to update the file.
+            if not self._heartbeat_file_lock.acquire(False):
+                return
+            try:
+                self._heartbeat_file.seek(0)
+                self._heartbeat_file.write(six.text_type(time.time()))
+                self._heartbeat_file.flush()
+                self._heartbeat_file_last_update = time.time()
+            finally:
+                self._heartbeat_file_lock.release()
+
+    def _publish_request_queue_stats(self):  # type: () -> None
+        interval = self.settings['queue_stats_interval_in_seconds']
+        if not interval or time.time() - self._queue_stats_last_publish < interval:
+            return
+        # Worker threads may get here at the same time, and, if so, only one of them needs to publish the stats.
+        if not self._queue_stats_lock.acquire(False):
+            return
+        try:
+            self._queue_stats_last_publish = time.time()
+            try:
+                stats = self.transport.get_request_queue_stats()
+            except PySOATransportError:
+                self.metrics.counter('server.error.queue_stats').increment()
+                self.logger.warning('Error getting the request queue stats', exc_info=True)
+                return
+            if stats is None:
+                return  # the transport does not support this
+
+            groups = {}  # type: Dict[six.text_type, List[Tuple[int, Optional[float]]]]
+            for stat in stats:
+                age = stat.oldest_message_age_in_seconds
+                groups.setdefault('server.queue', []).append((stat.depth, age))
+                groups.setdefault('server.queue.shard.{}'.format(stat.shard), []).append((stat.depth, age))
+                if stat.priority:
+                    groups.setdefault('server.queue.priority.{}'.format(stat.priority), []).append((stat.depth, age))
+            for prefix, values in six.iteritems(groups):
+                self.metrics.gauge('{}.depth'.format(prefix)).set(sum(depth for depth, _ in values))
+                self.metrics.gauge('{}.oldest_message_age'.format(prefix)).set(
+                    int(round(max(age or 0.0 for _, age in values) * 1000)),
+                )
+        finally:
+            self._queue_stats_lock.release()
 
     def perform_pre_request_actions(self):  # type: () -> None
         """
@@ -846,6 +1110,9 @@ class Server(object):
 
         self._update_heartbeat_file()
 
+        # A busy server may not be idle for a long time, which is exactly when the queue stats matter most
+        self._publish_request_queue_stats()
+
     def perform_idle_actions(self):  # type: () -> None
         """
         Runs periodically when the server is idle, if it has been too long since it last received a request. Call
@@ -856,9 +1123,157 @@ class Server(object):
 
         self._update_heartbeat_file()
 
+        self._publish_request_queue_stats()
+
+    @property
+    def _idle_timer(self):  # type: () -> Optional[Timer]
+        # Each worker thread idles separately
+        return self._worker_idle_timer.get()
+
+    @_idle_timer.setter
+    def _idle_timer(self, value):  # type: (Optional[Timer]) -> None
+        self._worker_idle_timer.set(value)
+
     def _set_busy_metrics(self, busy, running=True):  # type: (bool, bool) -> None
-        self.metrics.gauge('server.worker.running').set(1 if running else 0)
-        self.metrics.gauge('server.worker.busy').set(1 if busy else 0)
+        # The busy gauge counts the worker threads that are processing a job, or is 1 while concurrent jobs are in
+        # flight, while the running gauge counts the worker threads, so that their ratio is always the busyness.
+        with self._busy_workers_lock:
+            if busy:
+                self._busy_workers.add(threading.current_thread())
+            else:
+                self._busy_workers.discard(threading.current_thread())
+            busy_count = len(self._busy_workers) or (1 if self._concurrent_jobs else 0)
+            self.metrics.gauge('server.worker.running').set(self._worker_threads if running else 0)
+            self.metrics.gauge('server.worker.busy').set(busy_count)
+
+    def _reset_harakiri_timeout(self):  # type: () -> None
+        if self._worker_threads > 1:
+            timeout = self.settings['harakiri']['timeout']
+            if timeout:
+                with self._worker_deadlines_lock:
+                    self._worker_deadlines[threading.current_thread()] = time.time() + timeout
+                    self._worker_interruptions.pop(threading.current_thread(), None)
+        else:
+            signal.alarm(self.settings['harakiri']['timeout'])
+
+    def _interrupt_overdue_worker_threads(self):  # type: () -> bool
+        """
+        Triggers harakiri for each worker thread that has been processing a job or waiting on the transport for longer
+        than the harakiri timeout, by raising `HarakiriInterrupt` in that thread.
+
+        :return: `True` if any interrupted worker thread has failed to recover within the harakiri shutdown grace
+                 period, which means the whole server has to fall back on harakiri.
+        """
+        now = time.time()
+        grace = self.settings['harakiri']['shutdown_grace']
+        failed = False
+
+        with self._worker_deadlines_lock:
+            for thread, deadline in self._worker_deadlines.items():
+                if now < deadline:
+                    continue
+
+                if thread in self._worker_interruptions:
+                    if now - self._worker_interruptions[thread] > grace:
+                        failed = True
+                    continue
+
+                # noinspection PyProtectedMember
+                frame = sys._current_frames().get(cast(int, thread.ident))
+                self.logger.warning(
+                    'No activity for {} seconds in worker thread {}, triggering harakiri for the thread'.format(
+                        self.settings['harakiri']['timeout'],
+                        thread.name,
+                    ),
+                    extra={'data': {'thread_status': {
+                        thread.name: traceback.format_stack(frame) if frame else ['Unknown'],
+                    }}},
+                )
+                self._worker_interruptions[thread] = now
+                set_async_exc = getattr(getattr(ctypes, 'pythonapi', None), 'PyThreadState_SetAsyncExc', None)
+                if thread.ident is None or not set_async_exc or set_async_exc(
+                    (ctypes.c_ulong if six.PY3 else ctypes.c_long)(thread.ident),
+                    ctypes.py_object(HarakiriInterrupt),
+                ) != 1:
+                    # This Python implementation cannot interrupt a thread, or the thread is gone
+                    failed = True
+
+        if failed:
+            self.logger.error('A worker thread did not recover from harakiri; falling back to server harakiri')
+        return failed
+
+    def _run_worker(self):  # type: () -> None
+        transient_failures = 0
+
+        while not self.shutting_down:
+            # reset harakiri timeout
+            self._reset_harakiri_timeout()
+
+            # Get, process, and execute the next JobRequest
+            try:
+                self.handle_next_request()
+                if transient_failures > 0:
+                    transient_failures -= 1
+            except TransientPySOATransportError:
+                if transient_failures > 5:
+                    self.logger.exception('Too many errors receiving message from transport; shutting down!')
+                    # Setting this stops the other worker threads, too, and keeps this one from being restarted
+                    self.shutting_down = True
+                    break
+
+                # This sleeps using an exponential back-off period in the hopes that the problem will recover
+                sleep = (2 ** transient_failures + random.random()) / 4.0
+                self.logger.info(
+                    'Transient error receiving message from transport, sleeping {} seconds and continuing.'.format(
+                        sleep,
+                    ),
+                )
+                time.sleep(sleep)
+                transient_failures += 1
+            finally:
+                self.metrics.publish_all()
+
+    def _run_worker_thread(self):  # type: () -> None
+        # noinspection PyBroadException
+        try:
+            while not self.shutting_down:
+                try:
+                    self._run_worker()
+                except HarakiriInterrupt:
+                    # Unlike in the main thread, this only interrupts this worker thread, which can keep going
+                    self.metrics.counter('server.error.harakiri', harakiri_level='server').increment()
+                    self.logger.error('Harakiri interrupt occurred outside of action or job handling')
+        except Exception:
+            self.metrics.counter('server.error.unknown').increment()
+            self.logger.exception('Unhandled server error in worker thread; shutting down')
+        finally:
+            # If one worker thread stops, the whole server shuts down (just like it does without worker threads)
+            self.shutting_down = True
+            with self._worker_deadlines_lock:
+                self._worker_deadlines.pop(threading.current_thread(), None)
+                self._worker_interruptions.pop(threading.current_thread(), None)
+
+    def _run_worker_threads(self):  # type: () -> None
+        threads = [
+            threading.Thread(target=self._run_worker_thread, name='pysoa-worker-{}'.format(i))
+            for i in range(1, self._worker_threads + 1)
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            while not self.shutting_down:
+                # Harakiri is enforced for each worker thread separately, and the server-wide harakiri timeout is reset
+                # as long as every worker thread that needs to be interrupted actually is interrupted.
+                if not self._interrupt_overdue_worker_threads():
+                    signal.alarm(self.settings['harakiri']['timeout'])
+                time.sleep(0.5)
+        finally:
+            self.shutting_down = True
+            self.logger.info('Waiting for worker threads to finish')
+            for thread in threads:
+                thread.join()
 
     def run(self):  # type: () -> None
         """
@@ -883,41 +1298,23 @@ class Server(object):
         if self._async_event_loop_thread:
             self._async_event_loop_thread.start()
 
+        if self._max_concurrent_jobs > 1:
+            self._concurrent_job_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self._max_concurrent_jobs,
+            )
+
         self._create_heartbeat_file()
 
         signal.signal(signal.SIGINT, self.handle_shutdown_signal)  # type: ignore
         signal.signal(signal.SIGTERM, self.handle_shutdown_signal)  # type: ignore
         signal.signal(signal.SIGALRM, self.harakiri)  # type: ignore
 
-        transient_failures = 0
-
         # noinspection PyBroadException
         try:
-            while not self.shutting_down:
-                # reset harakiri timeout
-                signal.alarm(self.settings['harakiri']['timeout'])
-
-                # Get, process, and execute the next JobRequest
-                try:
-                    self.handle_next_request()
-                    if transient_failures > 0:
-                        transient_failures -= 1
-                except TransientPySOATransportError:
-                    if transient_failures > 5:
-                        self.logger.exception('Too many errors receiving message from transport; shutting down!')
-                        break
-
-                    # This sleeps using an exponential back-off period in the hopes that the problem will recover
-                    sleep = (2 ** transient_failures + random.random()) / 4.0
-                    self.logger.info(
-                        'Transient error receiving message from transport, sleeping {} seconds and continuing.'.format(
-                            sleep,
-                        ),
-                    )
-                    time.sleep(sleep)
-                    transient_failures += 1
-                finally:
-                    self.metrics.publish_all()
+            if self._worker_threads > 1:
+                self._run_worker_threads()
+            else:
+                self._run_worker()
         except HarakiriInterrupt:
             self.metrics.counter('server.error.harakiri', harakiri_level='server')
             self.logger.error('Harakiri interrupt occurred outside of action or job handling')
@@ -925,6 +1322,18 @@ class Server(object):
             self.metrics.counter('server.error.unknown').increment()
             self.logger.exception('Unhandled server error; shutting down')
         finally:
+            if self._concurrent_job_executor:
+                self.logger.info('Waiting for concurrent jobs to finish')
+                self._wait_for_concurrent_jobs(0, stop_on_shutdown=False)
+                self._concurrent_job_executor.shutdown()
+                self._concurrent_job_executor = None
+
+            # noinspection PyBroadException
+            try:
+                self.transport.shutdown()
+            except Exception:
+                self.metrics.counter('server.error.transport_shutdown').increment()
+                self.logger.exception('Error shutting down transport')
             self.teardown()
             self.metrics.counter('server.worker.shutdown').increment()
             self._set_busy_metrics(False, False)
@@ -973,16 +1382,21 @@ class Server(object):
                   -> self.setup
                   -> [async event loop started if Python 3.5+]
                   -> [heartbeat file created if configured]
+                  -> [worker threads started if worker_threads is greater than 1, each running the loop below]
                   -> loop: self.handle_next_request while not self.shutting_down
                             |
+                            -> [wait for room if max_concurrent_jobs jobs are in flight]
                             -> transport.receive_request_message
                             -> self.perform_idle_actions (if no request)
+                            -> [the rest happens in another thread if the job runs concurrently]
                             -> self.perform_pre_request_actions
                             -> self.process_job
                                 |
                                 -> middleware(self.execute_job)
                             -> transport.send_response_message
                             -> self.perform_post_request_actions
+                  -> [wait for worker threads and concurrent jobs to finish]
+                  -> transport.shutdown
                   -> self.teardown
                   -> [async event loop joined in Python 3.5+; this make take a few seconds to finish running tasks]
                   -> [Django resources cleaned up]
@@ -102,6 +102,31 @@ class ServerSettings(SOASettings):
                             'server is started with the --fork option (the minimum value is always 1 and the maximum '
                             'value is always equal to the value of the --fork option).',
             )),
+            'max_concurrent_jobs': fields.Integer(
+                gte=1,
+                description='The maximum number of jobs this server process will handle at once (Python 3.5+ only). '
+                            'The default, 1, handles one job at a time. When this is greater than 1, jobs whose '
+                            'actions are all coroutine-based (`async def run`) run concurrently, with their coroutines '
+                            'sharing the async event loop, while any other job still runs alone in the main thread. '
+                            'Once this many jobs are in flight, the server stops receiving requests until one '
+                            'finishes. Harakiri applies to each concurrent job separately. Middleware must be '
+                            'thread-safe to use this.',
+            ),
+            'worker_threads': fields.Integer(
+                gte=1,
+                description='The number of worker threads that receive and process requests in this server process. '
+                            'The default, 1, processes requests in the main thread. When this is greater than 1, each '
+                            'worker thread receives requests and processes jobs independently, while the main thread '
+                            'enforces harakiri for each worker thread separately. Actions, middleware, and the '
+                            'transport must be thread-safe to use this.',
+            ),
+            'queue_stats_interval_in_seconds': fields.Integer(
+                gte=0,
+                description='How often, in seconds, the server publishes the depth of each shard of its request queue '
+                            'and the age of the oldest request in it as gauges, when the transport supports this (the '
+                            'Redis Gateway transport does). The stats are checked after each request and whenever the '
+                            'server is idle. The default, 0, disables this.',
+            ),
             'extra_fields_to_redact': fields.Set(
                 fields.UnicodeString(),
                 description='Use this field to supplement the set of fields that are automatically redacted/censored '
@@ -162,6 +187,9 @@ class ServerSettings(SOASettings):
             'request_log_success_level': 'INFO',
             'request_log_error_level': 'INFO',
             'heartbeat_file': None,
+            'max_concurrent_jobs': 1,
+            'worker_threads': 1,
+            'queue_stats_interval_in_seconds': 0,
             'extra_fields_to_redact': set(),
             'transport': {
                 'path': 'pysoa.common.transport.redis_gateway.server:RedisServerTransport',
@@ -4,7 +4,10 @@ from __future__ import (
     unicode_literals,
 )
 
+import copy
 import ctypes
+import hashlib
+import json
 import sys
 from typing import (
     Any,
@@ -17,8 +20,16 @@ from typing import (
 
 import six
 
+from pysoa.common.types import (
+    ActionResponse,
+    JobResponse,
+)
+
 
 __all__ = (
+    'canonical_digest',
+    'copy_job_response',
+    'copy_preserving_keys',
     'dict_to_hashable',
     'get_python_interpreter_arguments',
 )
@@ -47,6 +58,66 @@ def dict_to_hashable(d):  # type: (Dict[Hashable, Any]) -> FrozenSet[Tuple[Hasha
     )
 
 
+def _canonical_json_default(value):  # type: (Any) -> Any
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=repr)
+    return repr(value)
+
+
+def canonical_digest(value):  # type: (Any) -> six.text_type
+    """
+    Takes a JSON-like value (such as a request body) and returns a SHA-256 hex digest of its canonical form, so that any
+    two values with the same content, regardless of dict ordering, have the same digest. Sets are treated like sorted
+    lists, and other values that are not JSON-serializable are represented by their `repr`.
+
+    :param value: The value
+    :return: The hex digest
+
+    :raises: :class:`TypeError` if the value contains a dict whose keys cannot be sorted (for example, keys of mixed
+             types in Python 3)
+    """
+    canonical = json.dumps(value, sort_keys=True, separators=(',', ':'), default=_canonical_json_default)
+    return six.text_type(hashlib.sha256(canonical.encode('utf-8')).hexdigest())
+
+
+def copy_preserving_keys(value):  # type: (Any) -> Any
+    """
+    Takes a JSON-like value (such as a response body or an object in one) and returns a deep copy of it. Unlike
+    `copy.deepcopy`, this preserves the non-string keys of the `UnicodeKeysDict`s in a response received from a local
+    transport (such as the IDs keying expansion responses), which it copies as plain dicts.
+
+    :param value: The value
+    :return: The copy
+    """
+    if isinstance(value, dict):
+        return {k: copy_preserving_keys(v) for k, v in six.iteritems(value)}
+    if isinstance(value, list):
+        return [copy_preserving_keys(v) for v in value]
+    return copy.deepcopy(value)
+
+
+def copy_job_response(response):  # type: (JobResponse) -> JobResponse
+    """
+    Takes a job response and returns a deep copy of it, so that a response can be shared with several callers without
+    any of them seeing the changes the others make. See :func:`copy_preserving_keys`.
+
+    :param response: The job response
+    :return: The copy
+    """
+    return JobResponse(
+        errors=copy.deepcopy(response.errors),
+        context=copy_preserving_keys(response.context),
+        actions=[
+            ActionResponse(
+                action=action_response.action,
+                errors=copy.deepcopy(action_response.errors),
+                body=copy_preserving_keys(action_response.body),
+            )
+            for action_response in response.actions
+        ],
+    )
+
+
 def get_python_interpreter_arguments():  # type: () -> List[six.text_type]
     """
     Returns a list of all the arguments passed to the Python interpreter, up to but not including the arguments
@@ -0,0 +1,75 @@
+"""
+Benchmarks reassembling chunked messages in the Redis Gateway transport core. The time per chunk should not grow with
+the number of chunks (as it would if reassembly copied everything received so far for each new chunk).
+
+Run with `python -m tests.benchmark.chunked_receive`.
+"""
+from __future__ import (
+    absolute_import,
+    print_function,
+    unicode_literals,
+)
+
+import math
+import timeit
+from typing import List
+
+from pysoa.common.serializer.msgpack_serializer import MsgpackSerializer
+from pysoa.common.transport.redis_gateway.constants import REDIS_BACKEND_TYPE_STANDARD
+from pysoa.common.transport.redis_gateway.core import RedisTransportClientCore
+from pysoa.test.compatibility import mock
+
+
+CHUNK_COUNTS = (25, 100, 400)
+BYTES_PER_CHUNK = 20480
+REPEAT = 3
+
+
+def time_chunked_receive(client_core, connection, chunk_count):
+    # type: (RedisTransportClientCore, mock.MagicMock, int) -> float
+    """
+    Time receiving a message of `chunk_count` chunks, returning the best of `REPEAT` runs, in seconds.
+    """
+    data = b'x' * (chunk_count * BYTES_PER_CHUNK)
+    serialized = MsgpackSerializer().dict_to_blob({'request_id': 27, 'meta': {}, 'body': {'data': data}})
+    chunk_size = int(math.ceil(len(serialized) / float(chunk_count)))
+    messages = [
+        [True, b'pysoa-redis/3//content-type:application/msgpack;chunk-count:%d;chunk-id:%d;' % (
+            chunk_count,
+            i + 1,
+        ) + serialized[i * chunk_size:(i + 1) * chunk_size]]
+        for i in range(chunk_count)
+    ]
+
+    timings = []  # type: List[float]
+    for _ in range(REPEAT):
+        connection.blpop.side_effect = messages
+        start = timeit.default_timer()
+        _, _, body = client_core.receive_message('benchmark_chunked_receive')
+        timings.append(timeit.default_timer() - start)
+
+        assert body is not None and body['data'] == data
+
+    return min(timings)
+
+
+def main():  # type: () -> None
+    with mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient') as mock_standard:
+        # noinspection PyArgumentList
+        client_core = RedisTransportClientCore(
+            backend_type=REDIS_BACKEND_TYPE_STANDARD,
+            maximum_message_size_in_bytes=1024 * 1024 * 50,
+        )
+        connection = mock_standard.return_value.get_connection.return_value
+
+        for chunk_count in CHUNK_COUNTS:
+            elapsed = time_chunked_receive(client_core, connection, chunk_count)
+            print('{:>5} chunks: {:8.2f} ms total, {:6.1f} us per chunk'.format(
+                chunk_count,
+                elapsed * 1000,
+                elapsed / chunk_count * 1000000,
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Benchmarks finding the objects to expand in a large response body. The compiled expansion plan finds the objects for
+all types in one pass over the body, where the original traversal made one pass over the body for each type node.
+
+Run with `python -m tests.benchmark.expansion_traversal`.
+"""
+from __future__ import (
+    absolute_import,
+    print_function,
+    unicode_literals,
+)
+
+import timeit
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Tuple,
+)
+
+from pysoa.client.expander import (
+    ExpansionConverter,
+    ExpansionNode,
+    TypeNode,
+)
+
+
+OBJECT_COUNT = 10000
+REPEAT = 5
+
+EXPANSIONS = {'event': ['owner.avatar', 'venue.image'], 'user': ['avatar'], 'venue': ['image']}
+
+
+def make_converter():  # type: () -> ExpansionConverter
+    return ExpansionConverter(
+        type_routes={
+            route: {'service': route, 'action': 'get', 'request_field': 'ids', 'response_field': 'objects'}
+            for route in ('user', 'venue', 'image')
+        },
+        type_expansions={
+            'event': {
+                'owner': {'type': 'user', 'route': 'user', 'source_field': 'owner_id', 'destination_field': 'o'},
+                'venue': {'type': 'venue', 'route': 'venue', 'source_field': 'venue_id', 'destination_field': 'v'},
+            },
+            'user': {
+                'avatar': {'type': 'image', 'route': 'image', 'source_field': 'image_id', 'destination_field': 'a'},
+            },
+            'venue': {
+                'image': {'type': None, 'route': 'image', 'source_field': 'image_id', 'destination_field': 'image'},
+            },
+        },
+    )
+
+
+def make_body(object_count):  # type: (int) -> Dict[str, Any]
+    return {
+        'events': [
+            {
+                '_type': 'event',
+                'id': i,
+                'owner_id': i,
+                'venue_id': i,
+                'tags': ['music', 'outdoors'],
+                'ticket_classes': [{'id': j, 'cost': {'currency': 'USD', 'value': 1000}} for j in range(2)],
+            }
+            for i in range(object_count)
+        ],
+    }
+
+
+def find_objects_by_type(bodies, type_nodes):
+    # type: (List[Any], List[TypeNode]) -> List[Tuple[Dict[Any, Any], List[ExpansionNode]]]
+    """
+    The original traversal, before expansion plans: one pass over each body for each type node.
+    """
+    return [
+        (obj, type_node.expansions)
+        for type_node in type_nodes
+        for body in bodies
+        for obj in type_node.find_objects(body)
+    ]
+
+
+def time_traversal(traverse):  # type: (Callable[[], List[Any]]) -> float
+    """
+    Time the given traversal, returning the best of `REPEAT` runs, in seconds.
+    """
+    return min(timeit.repeat(traverse, repeat=REPEAT, number=1))
+
+
+def main():  # type: () -> None
+    converter = make_converter()
+    bodies = [make_body(OBJECT_COUNT)]
+    type_nodes = converter.dict_to_trees(EXPANSIONS)
+    plan = converter.compile(EXPANSIONS)
+
+    by_type = find_objects_by_type(bodies, type_nodes)
+    with_plan = plan.find_objects(bodies)
+    assert [(id(o), [e.name for e in x]) for o, x in by_type] == [(id(o), [e.name for e in x]) for o, x in with_plan]
+
+    by_type_elapsed = time_traversal(lambda: find_objects_by_type(bodies, type_nodes))
+    with_plan_elapsed = time_traversal(lambda: plan.find_objects(bodies))
+    print('{} objects, {} found'.format(OBJECT_COUNT, len(with_plan)))
+    print('   by type: {:8.2f} ms'.format(by_type_elapsed * 1000))
+    print(' with plan: {:8.2f} ms'.format(with_plan_elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+from __future__ import (
+    absolute_import,
+    unicode_literals,
+)
+
+import threading
+import time
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+)
+from unittest import (
+    TestCase,
+    skipIf,
+)
+
+from conformity import fields
+from pymetrics.recorders.base import MetricsRecorder
+from pymetrics.recorders.noop import noop_metrics
+import six
+
+from pysoa.client.client import Client
+from pysoa.common.compatibility import ContextVar
+from pysoa.common.transport.base import (
+    ClientTransport,
+    ReceivedMessage,
+)
+from pysoa.common.transport.errors import (
+    MessageReceiveError,
+    MessageReceiveTimeout,
+    MessageSendError,
+)
+from pysoa.test.compatibility import mock
+
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None  # type: ignore
+
+
+SERVICE_NAME = 'event_service'
+
+
+@fields.ClassConfigurationSchema.provider(fields.Dictionary(
+    {'receive_timeout_in_seconds': fields.Float()},
+    optional_keys=('receive_timeout_in_seconds', ),
+))
+class HoldingClientTransport(ClientTransport):
+    """Sends requests only once the test releases them, and answers each request with its own bodies."""
+
+    sent = []  # type: List[Dict[six.text_type, Any]]
+    release = threading.Event()
+    fail = False
+    fail_receive = False
+
+    def __init__(self, service_name, metrics=noop_metrics, receive_timeout_in_seconds=None):
+        super(HoldingClientTransport, self).__init__(service_name, metrics)
+        self._outstanding = ContextVar(
+            'test_outstanding_requests',
+            default=None,
+        )  # type: ContextVar[Optional[List[Any]]]
+
+    def send_request_message(self, request_id, meta, body, message_expiry_in_seconds=None):
+        assert self.release.wait(5)
+        if self.fail:
+            raise MessageSendError('The message failed to send')
+        self.sent.append(body)
+        self._get_outstanding().append((request_id, body))
+
+    def receive_response_message(self, receive_timeout_in_seconds=None):
+        if self.fail_receive:
+            raise MessageReceiveError('The message failed to receive')
+        outstanding = self._get_outstanding()
+        if not outstanding:
+            return ReceivedMessage(None, None, None)
+        request_id, body = outstanding.pop(0)
+        return ReceivedMessage(request_id, {}, {'actions': [
+            {'action': a['action'], 'body': {'request': a['body'], 'tags': ['a']}} for a in body['actions']
+        ]})
+
+    def _get_outstanding(self):
+        outstanding = self._outstanding.get()
+        if outstanding is None:
+            outstanding = []
+            self._outstanding.set(outstanding)
+        return outstanding
+
+
+class TestRequestCoalescing(TestCase):
+    def setUp(self):
+        HoldingClientTransport.sent = []
+        HoldingClientTransport.release = threading.Event()
+        HoldingClientTransport.fail = False
+        HoldingClientTransport.fail_receive = False
+        self.coalesced = []  # type: List[int]
+
+        self.client = Client({
+            SERVICE_NAME: {
+                'transport': {'path': 'tests.integration.test_coalescing:HoldingClientTransport'},
+                'coalesced_actions': {'get_event', 'get_settings'},
+            },
+        })
+        metrics = mock.MagicMock(spec=MetricsRecorder)
+        metrics.counter.side_effect = lambda name, **_: mock.MagicMock(
+            increment=lambda amount=1: self.coalesced.append(amount) if name == 'client.send.coalesced' else None,
+        )
+        self.client._get_handler(SERVICE_NAME).metrics = metrics
+
+    def _call_in_threads(self, count, **kwargs):
+        results = [None] * count  # type: List[Any]
+
+        def call(i):
+            try:
+                results[i] = self.client.call_action(SERVICE_NAME, **kwargs)
+            except Exception as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=call, args=(i, )) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        # All but the first thread should be coalesced with the first, which is stuck sending
+        for _ in range(500):
+            if len(self.coalesced) == count - 1:
+                break
+            time.sleep(0.01)
+        HoldingClientTransport.release.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_identical_requests_in_threads(self):
+        results = self._call_in_threads(5, action='get_event', body={'id': 1, 'fields': ['name', 'date']})
+
+        self.assertEqual(1, len(HoldingClientTransport.sent))
+        self.assertEqual([1, 1, 1, 1], self.coalesced)
+        for result in results:
+            self.assertEqual({'request': {'id': 1, 'fields': ['name', 'date']}, 'tags': ['a']}, result.body)
+
+        # Each caller got its own copy
+        results[0].body['tags'].append('mutated')
+        self.assertEqual(['a'], results[1].body['tags'])
+        self.assertEqual(5, len({id(result.body) for result in results}))
+
+        # The response is not cached once received
+        self.client.call_action(SERVICE_NAME, 'get_event', body={'id': 1, 'fields': ['name', 'date']})
+        self.assertEqual(2, len(HoldingClientTransport.sent))
+
+    def test_different_or_uncoalesced_requests_in_threads(self):
+        HoldingClientTransport.release.set()
+        threads = [
+            threading.Thread(target=self.client.call_action, args=(SERVICE_NAME, action), kwargs={'body': body})
+            for action, body in (
+                ('get_event', {'id': 1}),
+                ('get_event', {'id': 2}),
+                ('get_venue', {'id': 1}),
+                ('get_venue', {'id': 1}),
+            )
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(4, len(HoldingClientTransport.sent))
+        self.assertEqual([], self.coalesced)
+
+    def test_call_actions_parallel(self):
+        HoldingClientTransport.release.set()
+
+        responses = list(self.client.call_actions_parallel(SERVICE_NAME, [
+            {'action': 'get_event', 'body': {'id': 1}},
+            {'action': 'get_settings', 'body': {'id': 1}},
+            {'action': 'get_event', 'body': {'id': 1}},
+            {'action': 'get_event', 'body': {'id': 2}},
+        ]))
+
+        self.assertEqual(
+            [('get_event', {'id': 1}), ('get_settings', {'id': 1}), ('get_event', {'id': 1}), ('get_event', {'id': 2})],
+            [(r.action, r.body['request']) for r in responses],
+        )
+        self.assertIsNot(responses[0].body, responses[2].body)
+        self.assertEqual(3, len(HoldingClientTransport.sent))
+        self.assertEqual([1], self.coalesced)
+        self.assertEqual([], list(self.client.get_all_responses(SERVICE_NAME)))
+
+    def test_send_error_fails_coalesced_requests(self):
+        HoldingClientTransport.fail = True
+
+        results = self._call_in_threads(3, action='get_event', body={'id': 1})
+
+        self.assertEqual([1, 1], self.coalesced)
+        for result in results:
+            self.assertIsInstance(result, MessageSendError)
+
+        # The failed request is no longer outstanding
+        HoldingClientTransport.fail = False
+        self.client.call_action(SERVICE_NAME, 'get_event', body={'id': 1})
+        self.assertEqual(1, len(HoldingClientTransport.sent))
+
+    @skipIf(contextvars is None, 'Requires context variables')
+    def test_receive_error_fails_only_requests_sent_by_the_same_task(self):
+        HoldingClientTransport.release.set()
+        actions = [{'action': 'get_event', 'body': {'id': 1}}]
+        # Separate contexts stand in for asyncio tasks running in the same thread
+        owner_context = contextvars.copy_context()
+        follower_context = contextvars.copy_context()
+        other_context = contextvars.copy_context()
+
+        request_id = owner_context.run(self.client.send_request, SERVICE_NAME, actions)
+        follower_request_id = follower_context.run(self.client.send_request, SERVICE_NAME, actions)
+        self.assertEqual([1], self.coalesced)
+
+        HoldingClientTransport.fail_receive = True
+        with self.assertRaises(MessageReceiveError):
+            other_context.run(list, self.client.get_all_responses(SERVICE_NAME))
+        HoldingClientTransport.fail_receive = False
+
+        responses = owner_context.run(list, self.client.get_all_responses(SERVICE_NAME))
+        self.assertEqual([request_id], [r for r, _ in responses])
+        responses = follower_context.run(list, self.client.get_all_responses(SERVICE_NAME, 1))
+        self.assertEqual([follower_request_id], [r for r, _ in responses])
+        self.assertEqual({'request': {'id': 1}, 'tags': ['a']}, responses[0][1].actions[0].body)
+
+    @skipIf(contextvars is None, 'Requires context variables')
+    def test_coalesced_request_waits_for_the_configured_receive_timeout(self):
+        HoldingClientTransport.release.set()
+        client = Client({
+            SERVICE_NAME: {
+                'transport': {
+                    'path': 'tests.integration.test_coalescing:HoldingClientTransport',
+                    'kwargs': {'receive_timeout_in_seconds': 0.05},
+                },
+                'coalesced_actions': {'get_event'},
+            },
+        })
+        actions = [{'action': 'get_event', 'body': {'id': 1}}]
+        contextvars.copy_context().run(client.send_request, SERVICE_NAME, actions, message_expiry_in_seconds=60)
+        follower_context = contextvars.copy_context()
+        follower_context.run(client.send_request, SERVICE_NAME, actions)
+
+        start = time.time()
+        with self.assertRaises(MessageReceiveTimeout):
+            follower_context.run(list, client.get_all_responses(SERVICE_NAME))
+        self.assertLess(time.time() - start, 5)
@@ -0,0 +1,174 @@
+from __future__ import (
+    absolute_import,
+    unicode_literals,
+)
+
+from typing import (
+    Any,
+    List,
+)
+from unittest import TestCase
+
+import freezegun
+
+from pysoa.client.client import Client
+from pysoa.client.expander import ExpansionCache
+from pysoa.common.types import ActionResponse
+from pysoa.server.action.base import Action
+from pysoa.server.server import Server
+
+
+USERS = {
+    1: {'_type': 'user', 'id': 1, 'name': 'Ada', 'manager_id': 2},
+    2: {'_type': 'user', 'id': 2, 'name': 'Grace', 'manager_id': 1},
+    3: {'_type': 'user', 'id': 3, 'name': 'Alan'},
+}
+
+
+class GetUsersByIdsAction(Action):
+    def run(self, request):
+        UserServer.calls.append(sorted(request.body['ids']))
+        return {'users': {i: dict(USERS[i]) for i in request.body['ids'] if i in USERS}}
+
+
+class UserServer(Server):
+    service_name = 'user_service'
+
+    calls = []  # type: List[Any]
+
+    action_class_map = {
+        'get_users_by_ids': GetUsersByIdsAction,
+    }
+
+
+class EventServer(Server):
+    service_name = 'event_service'
+
+    action_class_map = {
+        'get_events': lambda *_, **__: lambda request: ActionResponse(
+            action='get_events',
+            body={'events': [
+                {'_type': 'event', 'id': i, 'owner_id': owner_id} for i, owner_id in enumerate(request.body['owners'])
+            ]},
+        ),
+    }
+
+
+class TestExpansionCache(TestCase):
+    def setUp(self):
+        UserServer.calls = []
+        ExpansionCache._instances = {}
+
+    @staticmethod
+    def _make_client(cache=True):
+        owner_expansion = {
+            'type': 'user',
+            'route': 'user_route',
+            'source_field': 'owner_id',
+            'destination_field': 'owner',
+        }
+        if cache:
+            owner_expansion['cache'] = {'ttl_in_seconds': 30}
+        return Client(
+            {
+                'user_service': {
+                    'transport': {
+                        'path': 'pysoa.common.transport.local:LocalClientTransport',
+                        'kwargs': {'server_class': UserServer, 'server_settings': {}},
+                    },
+                },
+                'event_service': {
+                    'transport': {
+                        'path': 'pysoa.common.transport.local:LocalClientTransport',
+                        'kwargs': {'server_class': EventServer, 'server_settings': {}},
+                    },
+                },
+            },
+            expansion_config={
+                'type_routes': {
+                    'user_route': {
+                        'service': 'user_service',
+                        'action': 'get_users_by_ids',
+                        'request_field': 'ids',
+                        'response_field': 'users',
+                    },
+                },
+                'type_expansions': {
+                    'event': {'owner': owner_expansion},
+                    'user': {
+                        'manager': {
+                            'type': 'user',
+                            'route': 'user_route',
+                            'source_field': 'manager_id',
+                            'destination_field': 'manager',
+                        },
+                    },
+                },
+            },
+        )
+
+    def _get_owners(self, client, owners, expansions=None):
+        response = client.call_action(
+            'event_service',
+            'get_events',
+            body={'owners': owners},
+            expansions={'event': expansions or ['owner']},
+        )
+        return [event.get('owner') for event in response.body['events']]
+
+    def test_only_misses_are_requested(self):
+        owners = self._get_owners(self._make_client(), [1, 2, 1])
+        self.assertEqual([USERS[1], USERS[2], USERS[1]], owners)
+        self.assertEqual([[1, 2]], UserServer.calls)
+
+        # The cache is shared with new clients
+        owners = self._get_owners(self._make_client(), [3, 1, 2, 404])
+        self.assertEqual([USERS[3], USERS[1], USERS[2], None], owners)
+        self.assertEqual([[1, 2], [3, 404]], UserServer.calls)
+
+        # Each object gets its own copy
+        owners = self._get_owners(self._make_client(), [1, 1])
+        owners[0]['name'] = 'Mutated'
+        self.assertEqual('Ada', owners[1]['name'])
+        self.assertEqual([USERS[1]], self._get_owners(self._make_client(), [1]))
+        self.assertEqual(2, len(UserServer.calls))
+
+        # Missing values are not cached, and expansions without a cache always make requests
+        self._get_owners(self._make_client(), [404])
+        self._get_owners(self._make_client(cache=False), [1])
+        self.assertEqual([[1, 2], [3, 404], [404], [1]], UserServer.calls)
+
+    def test_ttl(self):
+        with freezegun.freeze_time() as frozen_time:
+            client = self._make_client()
+            self._get_owners(client, [1])
+
+            frozen_time.tick(29)
+            self._get_owners(client, [1])
+            self.assertEqual([[1]], UserServer.calls)
+
+            frozen_time.tick(2)
+            self._get_owners(client, [1])
+            self.assertEqual([[1], [1]], UserServer.calls)
+
+    def test_nested_expansions_of_cached_objects(self):
+        client = self._make_client()
+        expected = [dict(USERS[1], manager=USERS[2])]
+
+        self.assertEqual(expected, self._get_owners(client, [1], ['owner.manager']))
+        self.assertEqual([[1], [2]], UserServer.calls)
+
+        # The owner is cached without its manager, and the manager expansion, which is not configured with a cache,
+        # still makes requests
+        self.assertEqual([USERS[1]], self._get_owners(client, [1]))
+        self.assertEqual(expected, self._get_owners(client, [1], ['owner.manager']))
+        self.assertEqual([[1], [2], [2]], UserServer.calls)
+
+        # Expansions using the same route share its cache, and, just as without the cache, expansion stops at the first
+        # identifier that has already been expanded, so cached objects that refer to each other are not expanded forever
+        client.expansion_converter.type_expansions['user']['manager']['cache'] = {'ttl_in_seconds': 30}
+        for _ in range(2):
+            self.assertEqual(expected, self._get_owners(client, [1], ['owner.manager.manager']))
+        self.assertEqual([[1], [2], [2], [2]], UserServer.calls)
+        self.assertEqual(expected, self._get_owners(self._make_client(cache=False), [1], ['owner.manager.manager']))
+        self.assertEqual([[1], [2], [2], [2], [1], [2]], UserServer.calls)
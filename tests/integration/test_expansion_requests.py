@@ -0,0 +1,284 @@
+from __future__ import (
+    absolute_import,
+    unicode_literals,
+)
+
+import concurrent.futures
+import threading
+from typing import (
+    Any,
+    Dict,
+    List,
+    Tuple,
+)
+from unittest import TestCase
+
+from conformity import fields
+from pymetrics.recorders.noop import noop_metrics
+import six
+
+from pysoa.client.client import Client
+from pysoa.common.transport.base import (
+    ClientTransport,
+    ReceivedMessage,
+)
+from pysoa.common.transport.errors import MessageSendError
+from pysoa.common.types import ActionResponse
+from pysoa.server.server import Server
+from pysoa.test.compatibility import mock
+
+
+class EventServer(Server):
+    service_name = 'event_service'
+
+    action_class_map = {
+        'get_events': lambda *_, **__: lambda request: ActionResponse(
+            action='get_events',
+            body={'events': request.body['events']},
+        ),
+    }
+
+
+@fields.ClassConfigurationSchema.provider(fields.Dictionary(
+    {
+        'objects': fields.SchemalessDictionary(),
+        'delay_in_seconds': fields.Float(),
+    },
+    optional_keys=('delay_in_seconds', ),
+))
+class ExpansionClientTransport(ClientTransport):
+    """Answers requests for objects by ID, with response futures that complete after an optional delay."""
+
+    batches = []  # type: List[Tuple[six.text_type, List[List[Any]]]]
+    fail = False
+
+    def __init__(self, service_name, metrics=noop_metrics, objects=None, delay_in_seconds=0):
+        super(ExpansionClientTransport, self).__init__(service_name, metrics)
+        self.objects = objects or {}  # type: Dict[Any, Any]
+        self.delay_in_seconds = delay_in_seconds
+        self.futures = {}  # type: Dict[int, concurrent.futures.Future]
+
+    def send_request_message(self, request_id, meta, body, message_expiry_in_seconds=None):
+        self.send_request_messages([(request_id, meta, body)], message_expiry_in_seconds)
+
+    def send_request_messages(self, messages, message_expiry_in_seconds=None):
+        if self.fail:
+            raise MessageSendError('The messages failed to send')
+
+        self.batches.append((self.service_name, [body['actions'][0]['body']['ids'] for _, _, body in messages]))
+        for request_id, _, body in messages:
+            action = body['actions'][0]
+            future = self.futures[request_id] = concurrent.futures.Future()  # type: concurrent.futures.Future
+            message = ReceivedMessage(request_id, {}, {'actions': [{
+                'action': action['action'],
+                'body': {'objects': {i: self.objects[i] for i in action['body']['ids'] if i in self.objects}},
+            }]})
+            if self.delay_in_seconds:
+                threading.Timer(self.delay_in_seconds, future.set_result, (message, )).start()
+            else:
+                future.set_result(message)
+        return [None] * len(messages)
+
+    def receive_response_message(self, receive_timeout_in_seconds=None):
+        if not self.futures:
+            return ReceivedMessage(None, None, None)
+        request_id = sorted(self.futures)[0]
+        return self.futures.pop(request_id).result(receive_timeout_in_seconds)
+
+    def get_response_future(self, request_id):
+        try:
+            return self.futures.pop(request_id)
+        except KeyError:
+            raise ValueError('No outstanding request {} for service {}'.format(request_id, self.service_name))
+
+
+class TestExpansionRequests(TestCase):
+    def setUp(self):
+        ExpansionClientTransport.batches = []
+        ExpansionClientTransport.fail = False
+
+        self.client = Client(
+            {
+                'user_service': {
+                    'transport': {
+                        'path': 'tests.integration.test_expansion_requests:ExpansionClientTransport',
+                        'kwargs': {
+                            'objects': {i: {'_type': 'user', 'id': i} for i in range(1, 10)},
+                            'delay_in_seconds': 0.2,
+                        },
+                    },
+                },
+                'venue_service': {
+                    'transport': {
+                        'path': 'tests.integration.test_expansion_requests:ExpansionClientTransport',
+                        'kwargs': {'objects': {i: {'_type': 'venue', 'id': i} for i in range(1, 10)}},
+                    },
+                },
+                'event_service': {
+                    'transport': {
+                        'path': 'pysoa.common.transport.local:LocalClientTransport',
+                        'kwargs': {'server_class': EventServer, 'server_settings': {}},
+                    },
+                },
+            },
+            expansion_config={
+                'type_routes': {
+                    'user_route': {
+                        'service': 'user_service',
+                        'action': 'get_users_by_ids',
+                        'request_field': 'ids',
+                        'response_field': 'objects',
+                    },
+                    'venue_route': {
+                        'service': 'venue_service',
+                        'action': 'get_venues_by_ids',
+                        'request_field': 'ids',
+                        'response_field': 'objects',
+                    },
+                },
+                'type_expansions': {
+                    'event': {
+                        'owner': {
+                            'type': 'user',
+                            'route': 'user_route',
+                            'source_field': 'owner_id',
+                            'destination_field': 'owner',
+                            'max_values_per_request': 2,
+                        },
+                        'host': {
+                            'type': 'user',
+                            'route': 'user_route',
+                            'source_field': 'host_id',
+                            'destination_field': 'host',
+                            'max_values_per_request': 3,
+                        },
+                        'venue': {
+                            'type': 'venue',
+                            'route': 'venue_route',
+                            'source_field': 'venue_id',
+                            'destination_field': 'venue',
+                        },
+                    },
+                },
+            },
+        )
+
+        self.received = []  # type: List[six.text_type]
+        receive_expansion_responses = Client._receive_expansion_responses
+
+        def receive(client, *args):
+            for service_name, request_id, response in receive_expansion_responses(client, *args):
+                self.received.append(service_name)
+                yield service_name, request_id, response
+
+        patcher = mock.patch.object(Client, '_receive_expansion_responses', receive)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _expand(self, events, expansions):
+        return self.client.call_action(
+            'event_service',
+            'get_events',
+            body={'events': events},
+            expansions={'event': expansions},
+        ).body['events']
+
+    def test_split_into_parallel_requests(self):
+        events = [{'_type': 'event', 'id': i, 'owner_id': i % 5 + 1, 'venue_id': i + 1} for i in range(8)]
+
+        events = self._expand(events, ['owner', 'venue'])
+
+        for i, event in enumerate(events):
+            self.assertEqual({'_type': 'user', 'id': i % 5 + 1}, event['owner'])
+            self.assertEqual({'_type': 'venue', 'id': i + 1}, event['venue'])
+
+        # The user requests were sent together, no more than two IDs each, and the venue request was not split
+        self.assertEqual(['user_service', 'venue_service'], [service_name for service_name, _ in self.batches])
+        self.assertEqual([2, 2, 1], [len(ids) for ids in self.batches[0][1]])
+        self.assertEqual({1, 2, 3, 4, 5}, {i for ids in self.batches[0][1] for i in ids})
+        self.assertEqual([list(range(1, 9))], [sorted(ids) for ids in self.batches[1][1]])
+
+        # The faster service's response was handled first
+        self.assertEqual(['venue_service', 'user_service', 'user_service', 'user_service'], self.received)
+
+    def test_shared_requests_use_the_smallest_limit(self):
+        events = [{'_type': 'event', 'id': i, 'owner_id': i + 1, 'host_id': i + 4} for i in range(3)]
+
+        events = self._expand(events, ['owner', 'host'])
+
+        self.assertEqual([1, 2, 3], [event['owner']['id'] for event in events])
+        self.assertEqual([4, 5, 6], [event['host']['id'] for event in events])
+        self.assertEqual(1, len(self.batches))
+        self.assertEqual([2, 2, 2], [len(ids) for ids in self.batches[0][1]])
+        self.assertEqual(['user_service'] * 3, self.received)
+
+    def test_transports_without_response_futures(self):
+        events = [{'_type': 'event', 'id': i, 'owner_id': i + 1, 'venue_id': i + 1} for i in range(3)]
+
+        with mock.patch.object(ExpansionClientTransport, 'get_response_future', side_effect=ValueError):
+            events = self._expand(events, ['owner', 'venue'])
+
+        self.assertEqual([1, 2, 3], [event['owner']['id'] for event in events])
+        self.assertEqual([1, 2, 3], [event['venue']['id'] for event in events])
+        self.assertEqual(['user_service', 'user_service', 'venue_service'], self.received)
+
+    def test_send_error(self):
+        ExpansionClientTransport.fail = True
+
+        with self.assertRaises(MessageSendError):
+            self._expand([{'_type': 'event', 'id': 1, 'owner_id': 1}], ['owner'])
+
+    def test_responses_with_and_without_futures_are_received_in_order(self):
+        events = [{'_type': 'event', 'id': 1, 'owner_id': 1, 'venue_id': 1}]
+        self.client._get_handler('venue_service').transport.delay_in_seconds = 0.5  # type: ignore
+
+        with mock.patch.object(
+            self.client._get_handler('venue_service').transport,
+            'get_response_future',
+            side_effect=ValueError,
+        ):
+            events = self._expand(events, ['owner', 'venue'])
+
+        self.assertEqual(1, events[0]['owner']['id'])
+        self.assertEqual(1, events[0]['venue']['id'])
+        # The user response arrived while the client was waiting on the venue service, which has no response futures
+        self.assertEqual(['user_service', 'venue_service'], self.received)
+
+    def test_send_error_drains_the_requests_that_were_sent(self):
+        user_transport = self.client._get_handler('user_service').transport
+
+        with mock.patch.object(
+            self.client._get_handler('venue_service').transport,
+            'send_request_messages',
+            side_effect=MessageSendError('The messages failed to send'),
+        ), self.assertRaises(MessageSendError):
+            self._expand([{'_type': 'event', 'id': 1, 'owner_id': 1, 'venue_id': 1}], ['owner', 'venue'])
+
+        # The user request was sent, but its response will not be received
+        self.assertEqual([('user_service', [[1]])], self.batches)
+        self.assertEqual({}, user_transport.futures)  # type: ignore
+
+    def test_error_while_sending_discards_the_requests_not_yet_sent(self):
+        send_request = self.client.send_request
+        calls = []  # type: List[Any]
+
+        def fail_second_request(service_name, *args, **kwargs):
+            if service_name != 'event_service':
+                calls.append(service_name)
+                if len(calls) > 1:
+                    raise ValueError('Something went wrong')
+            return send_request(service_name, *args, **kwargs)
+
+        with mock.patch.object(self.client, 'send_request', side_effect=fail_second_request), \
+                self.assertRaises(ValueError):
+            self._expand([{'_type': 'event', 'id': 1, 'owner_id': 1, 'venue_id': 1}], ['owner', 'venue'])
+
+        # The request deferred before the error was not sent, and nothing is left to receive
+        self.assertEqual(2, len(calls))
+        self.assertEqual([], self.batches)
+        self.assertEqual({}, self.client._get_handler('user_service').transport.futures)  # type: ignore
+        self.assertEqual({}, self.client._get_handler('venue_service').transport.futures)  # type: ignore
+
+    @property
+    def batches(self):
+        return ExpansionClientTransport.batches
@@ -7,6 +7,7 @@ from typing import cast
 from unittest import TestCase
 
 from pysoa.client.client import Client
+from pysoa.client.expander import ExpansionConverter
 from pysoa.test.compatibility import mock
 from pysoa.test.stub_service import (
     StubClientTransport,
@@ -631,6 +632,23 @@ class TestClientWithExpansions(TestCase):
             expected_response,
         )
 
+    def test_expansion_plans_are_reused(self):
+        with mock.patch.object(
+            ExpansionConverter,
+            'dict_to_trees',
+            autospec=True,
+            side_effect=ExpansionConverter.dict_to_trees,
+        ) as mock_dict_to_trees:
+            for _ in range(3):
+                response = self.client.call_action(
+                    service_name='book_info_service',
+                    action='get_book',
+                    expansions={'book_type': ['author_rule', 'publisher_rule.address_rule']},
+                )
+                self.assertEqual(4, response.body['book_obj']['publisher_profile']['address_profile']['id'])
+
+        self.assertEqual(1, mock_dict_to_trees.call_count)
+
     def test_expansion_fail_silently(self):
         errors = [{
             'code': 'INVALID',
@@ -0,0 +1,274 @@
+from __future__ import (
+    absolute_import,
+    unicode_literals,
+)
+
+from typing import (
+    Any,
+    Dict,
+    List,
+)
+from unittest import TestCase
+
+import freezegun
+from pymetrics.recorders.base import MetricsRecorder
+import six
+
+from pysoa.client.client import Client
+from pysoa.client.middleware import ResponseCacheMiddleware
+from pysoa.common.constants import ERROR_CODE_NOT_FOUND
+from pysoa.common.errors import Error
+from pysoa.common.types import ActionResponse
+from pysoa.server.errors import ActionError
+from pysoa.server.server import Server
+from pysoa.test.compatibility import mock
+
+
+class UserServer(Server):
+    service_name = 'user_service'
+
+    calls = []  # type: List[Any]
+
+    @staticmethod
+    def _get_user(*_, **__):
+        def run(request):
+            UserServer.calls.append(('get_user', request.body, request.switches))
+            if request.body['id'] == 404:
+                raise ActionError(errors=[Error(code=ERROR_CODE_NOT_FOUND, message='No such user')])
+            return ActionResponse(action='get_user', body={'user': {'id': request.body['id'], 'tags': ['a']}})
+        return run
+
+    @staticmethod
+    def _get_users_by_ids(*_, **__):
+        def run(request):
+            UserServer.calls.append(('get_users_by_ids', request.body, request.switches))
+            return ActionResponse(
+                action='get_users_by_ids',
+                body={'users': {i: {'_type': 'user', 'id': i} for i in request.body['ids']}},
+            )
+        return run
+
+    @staticmethod
+    def _update_user(*_, **__):
+        def run(request):
+            UserServer.calls.append(('update_user', request.body, request.switches))
+            return ActionResponse(action='update_user', body={})
+        return run
+
+    action_class_map = {
+        'get_user': _get_user.__func__,  # type: ignore
+        'get_users_by_ids': _get_users_by_ids.__func__,  # type: ignore
+        'update_user': _update_user.__func__,  # type: ignore
+    }
+
+
+class EventServer(Server):
+    service_name = 'event_service'
+
+    action_class_map = {
+        'get_event': lambda *_, **__: lambda request: ActionResponse(
+            action='get_event',
+            body={'event': {'_type': 'event', 'id': request.body['id'], 'owner_id': 7}},
+        ),
+    }
+
+
+class TestResponseCacheMiddleware(TestCase):
+    def setUp(self):
+        UserServer.calls = []
+        self.counters = {}  # type: Dict[six.text_type, int]
+
+    def _make_client(self, max_entries=1000):
+        def counter(name, **_):
+            def increment(amount=1):
+                self.counters[name] = self.counters.get(name, 0) + amount
+            return mock.MagicMock(increment=increment)
+
+        metrics = mock.MagicMock(spec=MetricsRecorder)
+        metrics.counter.side_effect = counter
+
+        client = Client(
+            {
+                'user_service': {
+                    'transport': {
+                        'path': 'pysoa.common.transport.local:LocalClientTransport',
+                        'kwargs': {'server_class': UserServer, 'server_settings': {}},
+                    },
+                    'middleware': [{
+                        'path': 'pysoa.client.middleware:ResponseCacheMiddleware',
+                        'kwargs': {
+                            'actions': {
+                                'get_user': {'ttl_in_seconds': 30, 'error_ttl_in_seconds': 5},
+                                'get_users_by_ids': {'ttl_in_seconds': 10.5},
+                            },
+                            'max_entries': max_entries,
+                        },
+                    }],
+                },
+                'event_service': {
+                    'transport': {
+                        'path': 'pysoa.common.transport.local:LocalClientTransport',
+                        'kwargs': {'server_class': EventServer, 'server_settings': {}},
+                    },
+                },
+            },
+            expansion_config={
+                'type_routes': {
+                    'user_route': {
+                        'service': 'user_service',
+                        'action': 'get_users_by_ids',
+                        'request_field': 'ids',
+                        'response_field': 'users',
+                    },
+                },
+                'type_expansions': {
+                    'event': {
+                        'owner': {
+                            'type': 'user',
+                            'route': 'user_route',
+                            'source_field': 'owner_id',
+                            'destination_field': 'owner',
+                        },
+                    },
+                },
+            },
+        )
+        client._get_handler('user_service').metrics = metrics
+        return client
+
+    def _get_cache(self, client):  # type: (Client) -> ResponseCacheMiddleware
+        middleware = client._get_handler('user_service')._middleware[0]
+        assert isinstance(middleware, ResponseCacheMiddleware)
+        return middleware
+
+    def test_hit_and_miss(self):
+        client = self._make_client()
+
+        response = client.call_action('user_service', 'get_user', body={'id': 1, 'fields': ['a', 'b']})
+        self.assertEqual({'user': {'id': 1, 'tags': ['a']}}, response.body)
+        response.body['user']['tags'].append('mutated')
+
+        # Same body in a different order, and a different correlation ID
+        response = client.call_action(
+            'user_service',
+            'get_user',
+            body={'fields': ['a', 'b'], 'id': 1},
+            correlation_id='another',
+        )
+        self.assertEqual({'user': {'id': 1, 'tags': ['a']}}, response.body)
+        self.assertEqual(1, len(UserServer.calls))
+        self.assertEqual({'client.middleware.response_cache.miss': 1, 'client.middleware.response_cache.hit': 1},
+                         self.counters)
+
+        # A different body, different switches, and uncacheable actions are all sent
+        client.call_action('user_service', 'get_user', body={'id': 2, 'fields': ['a', 'b']})
+        client.call_action('user_service', 'get_user', body={'id': 1, 'fields': ['a', 'b']}, switches=[5])
+        client.call_action('user_service', 'get_user', body={'id': 1, 'fields': ['a', 'b']}, switches={5})
+        client.call_actions('user_service', [
+            {'action': 'get_user', 'body': {'id': 1, 'fields': ['a', 'b']}},
+            {'action': 'update_user', 'body': {'id': 1}},
+        ])
+        self.assertEqual(
+            [('get_user', {'id': 2, 'fields': ['a', 'b']}, set()), ('get_user', {'id': 1, 'fields': ['a', 'b']}, {5})],
+            [call for call in UserServer.calls[1:3]],
+        )
+        self.assertEqual(5, len(UserServer.calls))
+        self.assertEqual(3, self.counters['client.middleware.response_cache.miss'])
+        self.assertEqual(2, self.counters['client.middleware.response_cache.hit'])
+
+    def test_ttl_and_errors(self):
+        client = self._make_client()
+
+        with freezegun.freeze_time() as frozen_time:
+            client.call_action('user_service', 'get_user', body={'id': 1})
+            client.call_action('user_service', 'get_user', body={'id': 404}, raise_action_errors=False)
+            client.call_action('user_service', 'get_users_by_ids', body={'ids': [1]})
+            self.assertEqual(3, len(UserServer.calls))
+
+            frozen_time.tick(4)
+            client.call_action('user_service', 'get_user', body={'id': 1})
+            response = client.call_action('user_service', 'get_user', body={'id': 404}, raise_action_errors=False)
+            self.assertEqual(ERROR_CODE_NOT_FOUND, response.errors[0].code)
+            self.assertEqual(3, len(UserServer.calls))
+
+            # The error has expired
+            frozen_time.tick(2)
+            client.call_action('user_service', 'get_user', body={'id': 404}, raise_action_errors=False)
+            self.assertEqual(4, len(UserServer.calls))
+
+            # And then the success with the shorter TTL
+            frozen_time.tick(5)
+            client.call_action('user_service', 'get_users_by_ids', body={'ids': [1]})
+            client.call_action('user_service', 'get_user', body={'id': 1})
+            self.assertEqual(5, len(UserServer.calls))
+
+            # A job with two cacheable actions gets the shorter TTL of the two
+            client.call_actions('user_service', [
+                {'action': 'get_user', 'body': {'id': 3}},
+                {'action': 'get_users_by_ids', 'body': {'ids': [3]}},
+            ])
+            frozen_time.tick(20)
+            client.call_actions('user_service', [
+                {'action': 'get_user', 'body': {'id': 3}},
+                {'action': 'get_users_by_ids', 'body': {'ids': [3]}},
+            ])
+            self.assertEqual(9, len(UserServer.calls))
+
+    def test_lru_eviction(self):
+        client = self._make_client(max_entries=2)
+
+        for user_id in (1, 2, 1, 3, 1, 2):
+            client.call_action('user_service', 'get_user', body={'id': user_id})
+
+        self.assertEqual([1, 2, 3, 2], [call[1]['id'] for call in UserServer.calls])
+        self.assertEqual(2, self.counters['client.middleware.response_cache.eviction'])
+        self.assertEqual(2, len(self._get_cache(client)._entries))
+
+        self._get_cache(client).clear()
+        client.call_action('user_service', 'get_user', body={'id': 1})
+        self.assertEqual(5, len(UserServer.calls))
+
+    def test_call_actions_parallel(self):
+        client = self._make_client()
+        client.call_action('user_service', 'get_user', body={'id': 2})
+
+        responses = list(client.call_actions_parallel('user_service', [
+            {'action': 'get_user', 'body': {'id': 1}},
+            {'action': 'get_user', 'body': {'id': 2}},
+            {'action': 'update_user', 'body': {'id': 3}},
+            {'action': 'get_user', 'body': {'id': 1}},
+        ]))
+
+        self.assertEqual([1, 2, None, 1], [r.body['user']['id'] if 'user' in r.body else None for r in responses])
+        # Both requests for user 1 were sent, because neither had a response when they were sent
+        self.assertEqual(
+            [('get_user', 2), ('get_user', 1), ('update_user', 3), ('get_user', 1)],
+            [(call[0], call[1]['id']) for call in UserServer.calls],
+        )
+        self.assertEqual(1, self.counters['client.middleware.response_cache.hit'])
+        self.assertEqual(
+            [],
+            list(client.get_all_responses('user_service')),
+        )
+
+    def test_expansions(self):
+        client = self._make_client()
+
+        for _ in range(3):
+            response = client.call_action('event_service', 'get_event', body={'id': 1}, expansions={'event': ['owner']})
+            self.assertEqual(
+                {'event': {'_type': 'event', 'id': 1, 'owner_id': 7, 'owner': {'_type': 'user', 'id': 7}}},
+                response.body,
+            )
+
+        self.assertEqual([('get_users_by_ids', {'ids': [7]}, set())], UserServer.calls)
+        self.assertEqual(2, self.counters['client.middleware.response_cache.hit'])
+
+    def test_future(self):
+        client = self._make_client()
+        client.call_action('user_service', 'get_user', body={'id': 1})
+
+        future = client.call_action_future('user_service', 'get_user', body={'id': 1})
+
+        self.assertEqual({'user': {'id': 1, 'tags': ['a']}}, future.result().body)
+        self.assertEqual(1, len(UserServer.calls))
@@ -4,6 +4,7 @@ from __future__ import (
 )
 
 import sys
+import time
 import traceback
 import types
 from typing import (
@@ -387,6 +388,59 @@ class TestClientSendReceive(TestCase):
         self.assertIsNotNone(response)
         self.assertEqual([Error(code='BAD_JOB', message='You are a bad job')], response)
 
+    def test_send_request_clamped_to_deadline(self):
+        client = Client(self.client_settings, context={'deadline': time.time() + 600}, deadline=time.time() + 9.5)
+        handler = client._get_handler(SERVICE_NAME)
+
+        with mock.patch.object(handler, 'send_request') as mock_send_request:
+            client.send_request(SERVICE_NAME, [{'action': 'action_1'}])
+            client.send_request(SERVICE_NAME, [{'action': 'action_1'}], message_expiry_in_seconds=5)
+            client.send_request(SERVICE_NAME, [{'action': 'action_1'}], message_expiry_in_seconds=60)
+
+        expiries = [c[0][1] for c in mock_send_request.call_args_list]
+        self.assertEqual(5, expiries[1])
+        for expiry in (expiries[0], expiries[2]):
+            self.assertTrue(9 < expiry <= 9.5, expiries)
+        job_request = mock_send_request.call_args_list[0][0][0]
+        self.assertEqual(client.deadline, job_request.context['deadline'])
+        self.assertEqual(expiries[0], job_request.control['timeout'])
+
+        with mock.patch.object(handler, 'get_all_responses', return_value=[]) as mock_get_all_responses:
+            list(client.get_all_responses(SERVICE_NAME, receive_timeout_in_seconds=30))
+            list(client.get_all_responses(SERVICE_NAME, receive_timeout_in_seconds=2))
+            list(client.get_all_responses(SERVICE_NAME))
+
+        timeouts = [c[0][0] for c in mock_get_all_responses.call_args_list]
+        self.assertTrue(9 < timeouts[0] <= 9.5, timeouts)
+        self.assertEqual([2, None], timeouts[1:])
+
+    def test_send_request_clamped_to_sub_second_deadline(self):
+        client = Client(self.client_settings, deadline=time.time() + 0.5)
+        handler = client._get_handler(SERVICE_NAME)
+
+        with mock.patch.object(handler, 'send_request') as mock_send_request, \
+                mock.patch.object(handler, 'get_all_responses', return_value=[]) as mock_get_all_responses:
+            client.send_request(SERVICE_NAME, [{'action': 'action_1'}], message_expiry_in_seconds=60)
+            list(client.get_all_responses(SERVICE_NAME, receive_timeout_in_seconds=5))
+
+        self.assertTrue(0 < mock_send_request.call_args[0][1] <= 0.5)
+        self.assertTrue(0 < mock_get_all_responses.call_args[0][0] <= 0.5)
+
+    def test_send_request_after_deadline(self):
+        client = Client(self.client_settings, deadline=time.time() - 1)
+
+        with pytest.raises(Client.DeadlineExceeded):
+            client.call_action(SERVICE_NAME, 'action_1')
+
+        with pytest.raises(Client.DeadlineExceeded):
+            client.send_request(SERVICE_NAME, [{'action': 'action_1'}])
+
+        handler = client._get_handler(SERVICE_NAME)
+        with mock.patch.object(handler, 'get_all_responses') as mock_get_all_responses, \
+                pytest.raises(Client.DeadlineExceeded):
+            list(client.get_all_responses(SERVICE_NAME, receive_timeout_in_seconds=5))
+        self.assertEqual(0, mock_get_all_responses.call_count)
+
 
 class TestClientParallelSendReceive(TestCase):
     """
@@ -646,6 +700,37 @@ class TestClientParallelSendReceive(TestCase):
         self.assertEqual(1, len(job_responses[3].actions))
         self.assertEqual({'selected': True, 'count': 7}, job_responses[3].actions[0].body)
 
+    def test_call_jobs_parallel_sends_one_batch_per_service(self):
+        """
+        Test that call_jobs_parallel hands all of the requests for each service to that service's transport at once.
+        """
+        original_send_request_messages = ClientTransport.send_request_messages
+
+        with mock.patch.object(
+            ClientTransport,
+            'send_request_messages',
+            autospec=True,
+            side_effect=original_send_request_messages,
+        ) as mock_send_request_messages:
+            job_responses = self.client.call_jobs_parallel(
+                [
+                    {'service_name': 'service_1', 'actions': [{'action': 'action_1'}]},
+                    {'service_name': 'service_2', 'actions': [{'action': 'action_3'}]},
+                    {'service_name': 'service_1', 'actions': [{'action': 'action_2'}]},
+                    {'service_name': 'service_2', 'actions': [{'action': 'action_4'}]},
+                ],
+            )
+
+        self.assertEqual(2, mock_send_request_messages.call_count)
+        for call in mock_send_request_messages.call_args_list:
+            self.assertEqual(2, len(call[0][1]))
+
+        self.assertEqual(4, len(job_responses))
+        self.assertEqual({'foo': 'bar'}, job_responses[0].actions[0].body)
+        self.assertEqual({'cat': 'dog'}, job_responses[1].actions[0].body)
+        self.assertEqual({'baz': 3}, job_responses[2].actions[0].body)
+        self.assertEqual({'selected': True, 'count': 7}, job_responses[3].actions[0].body)
+
     def test_call_jobs_parallel_transport_send_errors_caught(self):
         """
         Test that call_jobs_parallel returns transport send errors instead of raising them when asked.
@@ -0,0 +1,196 @@
+from __future__ import (
+    absolute_import,
+    unicode_literals,
+)
+
+import asyncio
+import threading
+import time
+from typing import (
+    Dict,
+    List,
+)
+import unittest
+
+from pymetrics.recorders.noop import noop_metrics
+import six
+
+from pysoa.client.client import Client
+from pysoa.client.errors import (
+    CallActionError,
+    ImproperlyConfigured,
+)
+from pysoa.common.transport.errors import MessageReceiveTimeout
+from pysoa.common.transport.redis_gateway.constants import REDIS_BACKEND_TYPE_STANDARD
+from pysoa.common.transport.redis_gateway.demultiplexer import ResponseDemultiplexer
+from pysoa.common.transport.redis_gateway.server import RedisServerTransport
+
+
+class _FakeBackend(object):
+    def __init__(self):
+        self._container = {}  # type: Dict[six.text_type, List[six.binary_type]]
+        self._lock = threading.Lock()
+
+    def get_connection(self, *_):
+        return self
+
+    def send_message_to_queue(self, queue_key, message, *_, **__):
+        with self._lock:
+            self._container.setdefault(queue_key, list()).append(message)
+
+    def send_messages_to_queue(self, queue_key, messages, *_, **__):
+        with self._lock:
+            self._container.setdefault(queue_key, list()).extend(messages)
+        return len(messages)
+
+    def record_request_queue_send(self, *_, **__):
+        pass
+
+    def blpop(self, keys, *_, **__):
+        with self._lock:
+            if self._container.get(keys[0]):
+                return [keys[0], self._container[keys[0]].pop(0)]
+        time.sleep(0.01)
+        return None
+
+
+class _FakeServer(threading.Thread):
+    """
+    Responds to each action with its request body, or with an error for actions named "fail".
+    """
+    def __init__(self, service_name, backend):
+        self._transport = RedisServerTransport(service_name, noop_metrics, 1, backend_type=REDIS_BACKEND_TYPE_STANDARD)
+        self._transport.core._backend_layer = backend
+        self._continue = True
+
+        super(_FakeServer, self).__init__()
+
+    def shutdown(self):
+        self._continue = False
+        self.join(timeout=5)
+
+    def run(self):
+        while self._continue:
+            try:
+                request_id, meta, request = self._transport.receive_request_message()
+            except MessageReceiveTimeout:
+                continue
+
+            self._transport.send_response_message(request_id, meta, {'actions': [
+                {'action': a['action'], 'errors': [{'code': 'NOPE', 'message': 'Nope'}]} if a['action'] == 'fail' else
+                {'action': a['action'], 'body': a['body']}
+                for a in request['actions']
+            ]})
+
+
+class TestAsyncClient(unittest.TestCase):
+    def setUp(self):
+        ResponseDemultiplexer._instances.clear()
+        self.backend = _FakeBackend()
+        self.client = Client({
+            service_name: {
+                'transport': {
+                    'path': 'pysoa.common.transport.redis_gateway.async_client:AsyncRedisClientTransport',
+                    'kwargs': {'backend_type': REDIS_BACKEND_TYPE_STANDARD},
+                },
+            }
+            for service_name in ('async_1', 'async_2')
+        })
+        for service_name in ('async_1', 'async_2'):
+            transport = self.client._get_handler(service_name).transport
+            transport.core._backend_layer = self.backend  # type: ignore
+            transport._demultiplexer.core._backend_layer = self.backend  # type: ignore
+
+        self.servers = [_FakeServer('async_1', self.backend), _FakeServer('async_2', self.backend)]
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        for server in self.servers:
+            if server.is_alive():
+                server.shutdown()
+        self.loop.close()
+
+    def _start_servers(self):
+        for server in self.servers:
+            server.start()
+
+    def test_call_action_async(self):
+        self._start_servers()
+
+        response = self.loop.run_until_complete(self.client.call_action_async('async_1', 'hello', {'who': 'world'}))
+
+        self.assertEqual('hello', response.action)
+        self.assertEqual({'who': 'world'}, response.body)
+        self.assertEqual(0, self.client._get_handler('async_1').transport.requests_outstanding)
+
+    def test_call_actions_parallel_async_and_call_jobs_parallel_async(self):
+        self._start_servers()
+
+        responses = self.loop.run_until_complete(self.client.call_actions_parallel_async(
+            'async_1',
+            [{'action': 'hello', 'body': {'number': i}} for i in range(10)],
+        ))
+        self.assertEqual([{'number': i} for i in range(10)], [r.body for r in responses])
+
+        job_responses = self.loop.run_until_complete(self.client.call_jobs_parallel_async([
+            {'service_name': 'async_2', 'actions': [{'action': 'one'}, {'action': 'two'}]},
+            {'service_name': 'async_1', 'actions': [{'action': 'three'}]},
+            {'service_name': 'async_2', 'actions': [{'action': 'four'}]},
+        ]))
+        self.assertEqual(
+            [['one', 'two'], ['three'], ['four']],
+            [[a.action for a in r.actions] for r in job_responses],
+        )
+
+    def test_action_errors(self):
+        self._start_servers()
+
+        with self.assertRaises(CallActionError) as error_context:
+            self.loop.run_until_complete(self.client.call_actions_async('async_1', [{'action': 'fail'}]))
+        self.assertEqual('NOPE', error_context.exception.actions[0].errors[0].code)
+
+        response = self.loop.run_until_complete(self.client.call_actions_async(
+            'async_1',
+            [{'action': 'fail'}],
+            raise_action_errors=False,
+        ))
+        self.assertEqual('NOPE', response.actions[0].errors[0].code)
+
+    def test_timeout(self):
+        started = time.time()
+        with self.assertRaises(MessageReceiveTimeout):
+            self.loop.run_until_complete(self.client.call_action_async('async_1', 'hello', timeout=1))
+
+        self.assertLess(time.time() - started, 3)
+        self.assertEqual(0, self.client._get_handler('async_1').transport.requests_outstanding)
+
+    def test_cancellation(self):
+        async def call_and_cancel():
+            call = asyncio.ensure_future(self.client.call_actions_parallel_async(
+                'async_1',
+                [{'action': 'hello'}, {'action': 'hello'}],
+            ))
+            await asyncio.sleep(0.2)
+            call.cancel()
+            await asyncio.wait([call])
+            return call
+
+        call = self.loop.run_until_complete(call_and_cancel())
+
+        self.assertTrue(call.cancelled())
+        transport = self.client._get_handler('async_1').transport
+        self.assertEqual(0, transport.requests_outstanding)
+        self.assertEqual(0, transport._demultiplexer.futures_outstanding)
+
+    def test_transport_without_asyncio_support(self):
+        client = Client({
+            'sync': {
+                'transport': {
+                    'path': 'pysoa.common.transport.redis_gateway.client:RedisClientTransport',
+                    'kwargs': {'backend_type': REDIS_BACKEND_TYPE_STANDARD},
+                },
+            },
+        })
+
+        with self.assertRaises(ImproperlyConfigured):
+            self.loop.run_until_complete(client.call_action_async('sync', 'hello'))
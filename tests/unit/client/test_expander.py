@@ -3,11 +3,17 @@ from __future__ import (
     unicode_literals,
 )
 
+import collections
+import os
 from unittest import TestCase
 
+import freezegun
+
 from pysoa.client.expander import (
+    ExpansionCache,
     ExpansionConverter,
     ExpansionNode,
+    ExpansionPlan,
     TypeNode,
 )
 
@@ -376,6 +382,53 @@ class TestExpansionConverter(TestCase):
         self.assertEqual(qux_expansion_node.response_field, 'qux')
         self.assertEqual(len(qux_expansion_node.expansions), 0)
 
+        self.assertIsNone(bar_expansion_node.cache)
+        self.assertIsNone(bar_expansion_node.max_values_per_request)
+
+    def test_dict_to_trees_with_max_values_per_request(self):
+        self.converter.type_expansions['foo']['bar']['max_values_per_request'] = 100
+
+        bar_expansion_node = self.converter.dict_to_trees({'foo': ['bar']})[0].expansions[0]
+
+        self.assertEqual(100, bar_expansion_node.max_values_per_request)
+
+    def test_dict_to_trees_with_cache(self):
+        ExpansionCache._instances = {}
+        self.converter.type_expansions['foo']['bar']['cache'] = {'ttl_in_seconds': 30, 'max_entries': 50}
+
+        bar_expansion_node = self.converter.dict_to_trees({'foo': ['bar']})[0].expansions[0]
+
+        cache = bar_expansion_node.cache
+        assert cache is not None
+        self.assertEqual(30, cache.ttl_in_seconds)
+        self.assertEqual(50, cache.max_entries)
+        self.assertIs(cache, self.converter.dict_to_trees({'foo': ['bar']})[0].expansions[0].cache)
+
+    def test_compile(self):
+        plan = self.converter.compile({'foo': ['bar.baz', 'bar.qux']})
+
+        self.assertIsInstance(plan, ExpansionPlan)
+        self.assertEqual({'foo': ['bar.baz', 'bar.qux']}, self.converter.trees_to_dict(plan.trees))
+        self.assertIs(plan, self.converter.compile({'foo': ['bar.baz', 'bar.qux']}))
+        self.assertIs(plan, self.converter.compile({'foo': ['bar.qux', 'bar.baz']}))
+        self.assertIsNot(plan, self.converter.compile({'foo': ['bar.baz']}))
+
+        plan = self.converter.compile({'foo': ['bar'], 'bar': ['baz']})
+        self.assertIs(plan, self.converter.compile(collections.OrderedDict([('bar', ['baz']), ('foo', ['bar'])])))
+
+        with self.assertRaises(KeyError):
+            self.converter.compile({'foo': ['baz']})
+
+    def test_compile_discards_least_recently_used_plans(self):
+        self.converter.MAX_CACHED_PLANS = 2
+        plan = self.converter.compile({'foo': ['bar']})
+        self.converter.compile({'bar': ['baz']})
+        self.converter.compile({'foo': ['bar']})
+        self.converter.compile({'bar': ['qux']})
+
+        self.assertIs(plan, self.converter.compile({'foo': ['bar']}))
+        self.assertEqual(2, len(self.converter._plans))
+
     def test_trees_to_dict(self):
         foo_tree_node = TypeNode(node_type='foo')
         bar_expansion_node = ExpansionNode(
@@ -410,3 +463,181 @@ class TestExpansionConverter(TestCase):
                 'baz': ['qux'],
             },
         )
+
+
+class TestExpansionPlan(TestCase):
+    def setUp(self):
+        self.converter = ExpansionConverter(
+            type_routes={
+                route: {'service': route, 'action': 'get', 'request_field': 'ids', 'response_field': 'objects'}
+                for route in ('user', 'venue', 'image')
+            },
+            type_expansions={
+                'event': {
+                    'owner': {'type': 'user', 'route': 'user', 'source_field': 'owner_id', 'destination_field': 'o'},
+                    'venue': {'type': 'venue', 'route': 'venue', 'source_field': 'venue_id', 'destination_field': 'v'},
+                },
+                'user': {
+                    'avatar': {'type': 'image', 'route': 'image', 'source_field': 'image_id', 'destination_field': 'a'},
+                },
+                'venue': {
+                    'image': {'type': None, 'route': 'image', 'source_field': 'image_id', 'destination_field': 'image'},
+                },
+            },
+        )
+        self.expansions = {'event': ['owner.avatar', 'venue.image'], 'user': ['avatar'], 'venue': ['image']}
+
+    @staticmethod
+    def _find_objects_by_type(bodies, type_nodes):
+        # How objects were found before plans: one pass over each body for each type node
+        return [
+            (obj, type_node.expansions)
+            for type_node in type_nodes
+            for body in bodies
+            for obj in type_node.find_objects(body)
+        ]
+
+    def _assert_same_objects(self, expected, actual):
+        self.assertEqual(
+            [(id(o), [e.name for e in x]) for o, x in expected],
+            [(id(o), [e.name for e in x]) for o, x in actual],
+        )
+
+    def test_find_objects(self):
+        user = {'_type': 'user', 'id': 1, 'events': [{'_type': 'event', 'id': 3}]}
+        bodies = [
+            {
+                'events': [
+                    {'_type': 'event', 'id': 1, 'owner': user, 'parent': {'_type': 'event', 'id': 2}},
+                    {'_type': 'venue', 'id': 2, 'users': [{'_type': 'user', 'id': 2}]},
+                    {'_type': ['unhashable'], 'id': 3, 'venue': {'_type': 'venue', 'id': 3}},
+                ],
+            },
+            [{'_type': 'event', 'id': 4}, 'not an object', None],
+            'not an object',
+            {'_type': 'user', 'id': 5},
+        ]
+
+        plan = self.converter.compile(self.expansions)
+        objects = plan.find_objects(bodies)
+
+        self._assert_same_objects(self._find_objects_by_type(bodies, plan.trees), objects)
+        self.assertEqual(
+            [('event', 1), ('event', 4), ('user', 1), ('user', 2), ('user', 5), ('venue', 2), ('venue', 3)],
+            [(o['_type'], o['id']) for o, _ in objects],
+        )
+
+        # Nested expansion nodes, including expansion nodes without types, which match objects without types
+        owner_node = plan.trees[0].get_expansion('owner')
+        venue_node = plan.trees[0].get_expansion('venue')
+        assert owner_node is not None and venue_node is not None
+        type_nodes = [owner_node, venue_node.get_expansion('image')] + plan.trees  # type: ignore
+        objects = plan.find_objects(bodies, type_nodes)
+        self._assert_same_objects(
+            [(o, x) for o, x in self._find_objects_by_type(bodies, type_nodes) if x],
+            objects,
+        )
+        self.assertEqual([('user', 1), ('user', 2), ('user', 5)], [(o['_type'], o['id']) for o, _ in objects[:3]])
+
+    def test_find_objects_discards_least_recently_used_matchers(self):
+        plan = self.converter.compile(self.expansions)
+        plan.MAX_CACHED_MATCHERS = 2
+        body = {'_type': 'event', 'id': 1, 'owner_id': 1, 'venue_id': 1}
+        owner_node = plan.trees[0].get_expansion('owner')
+        venue_node = plan.trees[0].get_expansion('venue')
+        assert owner_node is not None and venue_node is not None
+
+        plan.find_objects([body])
+        plan.find_objects([body], [owner_node])
+        plan.find_objects([body])
+        plan.find_objects([body], [venue_node])
+
+        self.assertEqual(2, len(plan._matchers))
+        self.assertEqual([tuple(id(t) for t in plan.trees), (id(venue_node), )], list(plan._matchers))
+
+    def test_find_objects_in_10k_objects(self):
+        body = {
+            'events': [
+                {
+                    '_type': 'event',
+                    'id': i,
+                    'owner_id': i,
+                    'venue_id': i,
+                    'tags': ['music', 'outdoors'],
+                    'ticket_classes': [{'id': j, 'cost': {'currency': 'USD', 'value': 1000}} for j in range(2)],
+                }
+                for i in range(10000)
+            ],
+        }
+
+        def by_type():
+            return self._find_objects_by_type([body], self.converter.dict_to_trees(self.expansions))
+
+        def with_plan():
+            return self.converter.compile(self.expansions).find_objects([body])
+
+        # Timings are left to `python -m tests.benchmark.expansion_traversal`, because they are too noisy to assert on
+        self._assert_same_objects(by_type(), with_plan())
+
+
+class TestExpansionCache(TestCase):
+    def setUp(self):
+        ExpansionCache._instances = {}
+
+    def test_get_instance(self):
+        cache = ExpansionCache.get_instance('foo', 'get_foo', 'id', ttl_in_seconds=5)
+
+        self.assertEqual(5, cache.ttl_in_seconds)
+        self.assertEqual(1000, cache.max_entries)
+        self.assertIs(cache, ExpansionCache.get_instance('foo', 'get_foo', 'id', ttl_in_seconds=10))
+        self.assertIsNot(cache, ExpansionCache.get_instance('foo', 'get_foo', 'ids', ttl_in_seconds=5))
+        self.assertIs(cache, ExpansionCache._instances[(os.getpid(), 'foo', 'get_foo', 'id')])
+
+    def test_get_and_put(self):
+        cache = ExpansionCache(ttl_in_seconds=10)
+        obj = {'_type': 'foo', 'id': 1, 'tags': {2: ['a']}}
+
+        self.assertEqual((False, None), cache.get(1))
+        cache.put(1, obj)
+        obj['tags'][2].append('mutated')
+
+        found, cached = cache.get(1)
+        self.assertTrue(found)
+        self.assertEqual({'_type': 'foo', 'id': 1, 'tags': {2: ['a']}}, cached)
+        cached['tags'][2].append('mutated')
+        self.assertEqual({'_type': 'foo', 'id': 1, 'tags': {2: ['a']}}, cache.get(1)[1])
+        self.assertEqual((False, None), cache.get('1'))
+
+        # Unhashable identifiers are never cached
+        cache.put([1], obj)
+        self.assertEqual((False, None), cache.get([1]))
+        self.assertEqual(1, len(cache))
+
+        cache.clear()
+        self.assertEqual((False, None), cache.get(1))
+
+    def test_ttl(self):
+        with freezegun.freeze_time() as frozen_time:
+            cache = ExpansionCache(ttl_in_seconds=2.5)
+            cache.put(1, {'id': 1})
+
+            frozen_time.tick(2)
+            cache.put(2, {'id': 2})
+            self.assertTrue(cache.get(1)[0])
+
+            frozen_time.tick(1)
+            self.assertFalse(cache.get(1)[0])
+            self.assertTrue(cache.get(2)[0])
+            self.assertEqual(1, len(cache))
+
+    def test_lru_eviction(self):
+        cache = ExpansionCache(ttl_in_seconds=10, max_entries=2)
+
+        cache.put(1, {'id': 1})
+        cache.put(2, {'id': 2})
+        cache.get(1)
+        cache.put(3, {'id': 3})
+
+        self.assertTrue(cache.get(1)[0])
+        self.assertFalse(cache.get(2)[0])
+        self.assertTrue(cache.get(3)[0])
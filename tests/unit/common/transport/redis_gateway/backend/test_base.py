@@ -0,0 +1,191 @@
+from __future__ import (
+    absolute_import,
+    division,
+    unicode_literals,
+)
+
+import time
+import unittest
+
+from pysoa.common.transport.redis_gateway.backend.base import jump_consistent_hash
+from pysoa.common.transport.redis_gateway.backend.standard import StandardRedisClient
+from pysoa.common.transport.redis_gateway.constants import (
+    CONSISTENT_HASHING_ALGORITHM_JUMP,
+    CONSISTENT_HASHING_ALGORITHM_LEGACY,
+    REQUEST_QUEUE_ROUTING_LOAD_AWARE,
+)
+from pysoa.test.compatibility import mock
+
+
+RESPONSE_QUEUE_NAMES = ['service.{}!'.format(i) for i in range(20000)]
+
+
+class TestConsistentHashing(unittest.TestCase):
+    @staticmethod
+    def _get_indexes(ring_size, algorithm):
+        client = StandardRedisClient(
+            hosts=[('169.254.7.{}'.format(i), 6379) for i in range(ring_size)],
+            consistent_hashing_algorithm=algorithm,
+        )
+        return [client._get_consistent_hash_index(name) for name in RESPONSE_QUEUE_NAMES]
+
+    def test_invalid_algorithm(self):
+        with self.assertRaises(ValueError):
+            StandardRedisClient(consistent_hashing_algorithm='foo')
+
+    def test_legacy_is_the_default_and_unchanged(self):
+        client = StandardRedisClient(hosts=[('169.254.7.{}'.format(i), 6379) for i in range(3)])
+
+        self.assertEqual(self._get_indexes(3, CONSISTENT_HASHING_ALGORITHM_LEGACY), [
+            client._get_consistent_hash_index(name) for name in RESPONSE_QUEUE_NAMES
+        ])
+        # Pinned values calculated with the original implementation, so clients and servers using the legacy algorithm
+        # keep agreeing with older versions of PySOA
+        self.assertEqual(1, client._get_consistent_hash_index('service.0!'))
+        self.assertEqual(0, client._get_consistent_hash_index('service.250!'))
+        self.assertEqual(2, client._get_consistent_hash_index('service.1000!'))
+
+    def test_jump_consistent_hash(self):
+        self.assertEqual(0, jump_consistent_hash(0, 1))
+        self.assertEqual(0, jump_consistent_hash(0xffffffffffffffff, 1))
+
+        for key in list(range(0, 0xffffffff, 0x1234567)) + [0xffffffffffffffff]:
+            previous = 0
+            for buckets in range(1, 50):
+                bucket = jump_consistent_hash(key, buckets)
+                # Each additional bucket either keeps the key where it was or takes it
+                self.assertIn(bucket, (previous, buckets - 1))
+                previous = bucket
+
+    def test_jump_spreads_keys_evenly(self):
+        for ring_size in (2, 3, 5, 8):
+            indexes = self._get_indexes(ring_size, CONSISTENT_HASHING_ALGORITHM_JUMP)
+            expected = len(indexes) / ring_size
+            for index in range(ring_size):
+                self.assertTrue(
+                    0.9 * expected < indexes.count(index) < 1.1 * expected,
+                    'Ring node {} of {} got {} keys, expected about {}'.format(
+                        index,
+                        ring_size,
+                        indexes.count(index),
+                        expected,
+                    ),
+                )
+
+    def test_keys_moved_when_ring_grows(self):
+        for ring_size in (1, 2, 3, 4, 7):
+            legacy_before = self._get_indexes(ring_size, CONSISTENT_HASHING_ALGORITHM_LEGACY)
+            legacy_after = self._get_indexes(ring_size + 1, CONSISTENT_HASHING_ALGORITHM_LEGACY)
+            jump_before = self._get_indexes(ring_size, CONSISTENT_HASHING_ALGORITHM_JUMP)
+            jump_after = self._get_indexes(ring_size + 1, CONSISTENT_HASHING_ALGORITHM_JUMP)
+
+            legacy_moved = sum(1 for b, a in zip(legacy_before, legacy_after) if b != a) / len(RESPONSE_QUEUE_NAMES)
+            jump_moved = sum(1 for b, a in zip(jump_before, jump_after) if b != a) / len(RESPONSE_QUEUE_NAMES)
+            ideal = 1 / (ring_size + 1)
+
+            # Jump consistent hashing moves about the ideal fraction of keys, and only to the new node
+            self.assertTrue(
+                0.9 * ideal < jump_moved < 1.1 * ideal,
+                'Jump moved {:.3f} of keys going from {} to {} nodes, expected about {:.3f}'.format(
+                    jump_moved,
+                    ring_size,
+                    ring_size + 1,
+                    ideal,
+                ),
+            )
+            self.assertTrue(all(a == ring_size for b, a in zip(jump_before, jump_after) if b != a))
+
+            # The legacy algorithm moves about half of all keys, no matter how many nodes there are
+            self.assertTrue(legacy_moved > 0.45, 'Legacy moved only {:.3f}'.format(legacy_moved))
+            if ring_size > 2:
+                self.assertTrue(legacy_moved > 2 * jump_moved)
+
+
+class TestLoadAwareRouting(unittest.TestCase):
+    @staticmethod
+    def _set_up_client(ring_size=3, **kwargs):
+        return StandardRedisClient(
+            hosts=[('169.254.7.{}'.format(i), 6379) for i in range(ring_size)],
+            **kwargs
+        )
+
+    def test_invalid_routing(self):
+        with self.assertRaises(ValueError):
+            StandardRedisClient(request_queue_routing='foo')
+
+    def test_get_all_connections(self):
+        client = self._set_up_client()
+
+        self.assertEqual(client._connection_list, client.get_all_connections('service.a'))
+        self.assertEqual(
+            [client.get_connection('service.a!response')],
+            client.get_all_connections('service.a!response'),
+        )
+
+    def test_round_robin_is_the_default(self):
+        client = self._set_up_client()
+
+        connections = [client.get_connection('service.a') for _ in range(9)]
+        for i in range(3):
+            self.assertEqual(3, len([c for c in connections if c is client._connection_list[i]]))
+
+        # Nothing is recorded without load-aware routing
+        client.record_request_queue_send('service.a', connections[0], 10.0, 5000)
+        self.assertEqual([None, None, None], client._load_statistics)
+
+    def test_load_aware_avoids_slow_and_deep_queues(self):
+        client = self._set_up_client(request_queue_routing=REQUEST_QUEUE_ROUTING_LOAD_AWARE)
+
+        # Until there are statistics, all servers are used
+        connections = set()
+        for _ in range(100):
+            connection = client.get_connection('service.a')
+            connections.add(connection)
+            client.record_request_queue_send('service.a', connection, 0.001, 1)
+        self.assertEqual(3, len(connections))
+
+        slow, deep, healthy = client._connection_list
+        client.record_request_queue_send('service.a', slow, 1.0, 1)
+        client.record_request_queue_send('service.a', slow, 1.0, 1)
+        client.record_request_queue_send('service.a', deep, 0.001, 9000)
+
+        # Each choice is between two random servers, so the healthy server is always chosen when it's one of them, and
+        # the slow server (average latency above 0.3 seconds by now) never beats the deep queue (9 seconds of cost)
+        counts = {slow: 0, deep: 0, healthy: 0}
+        for _ in range(300):
+            counts[client.get_connection('service.a')] += 1
+        self.assertEqual(0, counts[deep])
+        self.assertTrue(counts[healthy] > 150)
+        self.assertTrue(counts[slow] > 0)
+
+    def test_load_aware_statistics_expire(self):
+        client = self._set_up_client(request_queue_routing=REQUEST_QUEUE_ROUTING_LOAD_AWARE, ring_size=2)
+
+        while len(client._request_queue_connection_indexes) < 2:
+            client.get_connection('service.a')
+        deep, healthy = client._connection_list
+        client.record_request_queue_send('service.a', deep, 0.001, 9000)
+        client.record_request_queue_send('service.a', healthy, 0.001, 0)
+
+        self.assertEqual({healthy}, {client.get_connection('service.a') for _ in range(20)})
+
+        later = time.time() + StandardRedisClient.LOAD_STATISTICS_MAXIMUM_AGE_IN_SECONDS + 1
+        with mock.patch('pysoa.common.transport.redis_gateway.backend.base.time.time', return_value=later):
+            self.assertEqual({deep, healthy}, {client.get_connection('service.a') for _ in range(50)})
+
+    def test_load_aware_ignores_response_queues_and_unknown_connections(self):
+        client = self._set_up_client(request_queue_routing=REQUEST_QUEUE_ROUTING_LOAD_AWARE)
+
+        connection = client.get_connection('service.a!response')
+        client.record_request_queue_send('service.a!response', connection, 1.0, 100)
+        client.record_request_queue_send('service.a', connection, 1.0, 100)
+        self.assertEqual([None, None, None], client._load_statistics)
+
+        connection = client.get_connection('service.a')
+        index = client._connection_list.index(connection)
+        client.record_request_queue_send('service.a', connection, 1.0, None)
+        self.assertEqual((1.0, 0), client._load_statistics[index][:2])
+        client.record_request_queue_send('service.a', connection, 2.0, 7)
+        self.assertEqual((1.2, 7), client._load_statistics[index][:2])
+        client.record_request_queue_send('service.a', connection, 1.2, None)
+        self.assertEqual((1.2, 7), client._load_statistics[index][:2])
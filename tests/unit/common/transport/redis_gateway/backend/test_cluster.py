@@ -0,0 +1,280 @@
+from __future__ import (
+    absolute_import,
+    unicode_literals,
+)
+
+from typing import (
+    Any,
+    List,
+    Tuple,
+)
+import unittest
+
+import redis
+import redis.client
+import six
+
+from pysoa.common.transport.redis_gateway.backend.base import CannotGetConnectionError
+from pysoa.common.transport.redis_gateway.backend.cluster import (
+    ClusterRedisClient,
+    hash_tag_queue_name,
+    key_slot,
+)
+from pysoa.test.compatibility import mock
+
+
+# Slots 0-8191 are on the first master, slots 8192-16383 on the second (as returned by CLUSTER SLOTS)
+CLUSTER_SLOTS = [
+    [0, 8191, [b'192.0.2.1', 7000, b'abc'], [b'192.0.2.3', 7000, b'ghi']],
+    [8192, 16383, [b'192.0.2.2', 7000, b'def']],
+]
+
+
+class FakeCluster(object):
+    """
+    Stands in for `redis.StrictRedis.execute_command` on all nodes, recording which node got which command.
+    """
+
+    def __init__(self, responses):  # type: (List[Tuple[six.text_type, Any]]) -> None
+        # Each response is (expected host, response or exception); CLUSTER SLOTS is answered automatically
+        self.responses = list(responses)
+        self.commands = []  # type: List[Tuple[six.text_type, Tuple[Any, ...]]]
+        self.cluster_slots = CLUSTER_SLOTS
+
+    def __call__(self, node, *args, **_):
+        host = node.connection_pool.connection_kwargs['host']
+        self.commands.append((host, args))
+        if args[0] == 'CLUSTER SLOTS':
+            return self.cluster_slots
+        expected_host, response = self.responses.pop(0)
+        assert host == expected_host, '{} sent to {}, expected {}'.format(args, host, expected_host)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class TestClusterRedisClient(unittest.TestCase):
+    def test_key_slot(self):
+        # Examples from the Redis Cluster specification
+        self.assertEqual(12182, key_slot('foo'))
+        self.assertEqual(0x31C3, key_slot(b'123456789'))
+
+        # Hash tags
+        self.assertEqual(key_slot('user1000'), key_slot('{user1000}.following'))
+        self.assertEqual(key_slot('{user1000}.following'), key_slot('{user1000}.followers'))
+        self.assertEqual(key_slot('bar'), key_slot('foo{bar}{zap}'))
+        self.assertEqual(key_slot('{}'), key_slot('{}'))
+        self.assertNotEqual(key_slot(''), key_slot('foo{}{bar}'))
+
+    def test_hash_tag_queue_name(self):
+        self.assertEqual('{service.foo}', hash_tag_queue_name('service.foo'))
+        self.assertEqual('{service.foo}.priority.high', hash_tag_queue_name('service.foo.priority.high'))
+        self.assertEqual('{service.foo.abc!}.chunks.17', hash_tag_queue_name('service.foo.abc!.chunks.17'))
+        self.assertEqual('{service.foo}.chunks.17', hash_tag_queue_name('{service.foo}.chunks.17'))
+
+        # A queue shares its slot with its priority lanes and chunk queues, but not with other queues
+        request_slot = key_slot('pysoa:' + hash_tag_queue_name('service.foo'))
+        self.assertEqual(request_slot, key_slot('pysoa:' + hash_tag_queue_name('service.foo.priority.high')))
+        self.assertEqual(request_slot, key_slot('pysoa:' + hash_tag_queue_name('service.foo.priority.low')))
+
+        response_slot = key_slot('pysoa:' + hash_tag_queue_name('service.foo.abc!'))
+        self.assertEqual(response_slot, key_slot('pysoa:' + hash_tag_queue_name('service.foo.abc!.chunks.17')))
+        self.assertEqual(response_slot, key_slot('pysoa:' + hash_tag_queue_name('service.foo.abc!.chunks.18')))
+        self.assertNotEqual(response_slot, key_slot('pysoa:' + hash_tag_queue_name('service.foo.def!')))
+
+    def test_invalid_hosts(self):
+        with self.assertRaises(ValueError):
+            ClusterRedisClient(hosts='redis://localhost:1234/0')
+
+        with self.assertRaises(ValueError):
+            ClusterRedisClient(hosts=[('localhost', '1234')])  # type: ignore
+
+    def test_get_connection_by_slot(self):
+        client = ClusterRedisClient(hosts=[('192.0.2.1', 7000)])
+        fake = FakeCluster([])
+
+        with mock.patch.object(redis.StrictRedis, 'execute_command', autospec=True, side_effect=fake):
+            # 'foo' is slot 12182, and 'pysoa:service.b' is slot 7506 (calculated with `CLUSTER KEYSLOT`)
+            connection_1 = client.get_connection('foo')
+            connection_2 = client.get_connection('{foo}.chunks.1')
+            connection_3 = client.get_connection('pysoa:service.b')
+
+        self.assertEqual('192.0.2.2', connection_1.connection_pool.connection_kwargs['host'])
+        self.assertEqual(7000, connection_1.connection_pool.connection_kwargs['port'])
+        self.assertIs(connection_1, connection_2)
+        self.assertEqual('192.0.2.1', connection_3.connection_pool.connection_kwargs['host'])
+
+        # The slots were loaded only once
+        self.assertEqual([('192.0.2.1', ('CLUSTER SLOTS', ))], fake.commands)
+
+        # The key, not the other queue's connection, determines the connection for colocated queues
+        self.assertIs(connection_1, client.get_colocated_connection('foo', connection_3))
+
+        # Request queues, like all other queues, live on just one node
+        self.assertEqual([connection_1], client.get_all_connections('foo'))
+
+    def test_get_connection_tries_all_startup_nodes(self):
+        client = ClusterRedisClient(hosts=[('192.0.2.8', 7000), ('192.0.2.9', 7000)])
+
+        def execute(node, *_, **__):
+            if node.connection_pool.connection_kwargs['host'] == '192.0.2.8':
+                raise redis.exceptions.ConnectionError('Nope')
+            return CLUSTER_SLOTS
+
+        with mock.patch.object(redis.StrictRedis, 'execute_command', autospec=True, side_effect=execute):
+            connection = client.get_connection('foo')
+
+        self.assertEqual('192.0.2.2', connection.connection_pool.connection_kwargs['host'])
+
+        with mock.patch.object(
+            redis.StrictRedis,
+            'execute_command',
+            autospec=True,
+            side_effect=redis.exceptions.ConnectionError('Nope'),
+        ):
+            client.reset_clients()
+            with self.assertRaises(CannotGetConnectionError):
+                client.get_connection('foo')
+
+    def test_unserved_slot(self):
+        client = ClusterRedisClient(hosts=[('192.0.2.1', 7000)])
+        fake = FakeCluster([])
+        fake.cluster_slots = CLUSTER_SLOTS[:1]
+
+        with mock.patch.object(redis.StrictRedis, 'execute_command', autospec=True, side_effect=fake):
+            with self.assertRaises(CannotGetConnectionError):
+                client.get_connection('foo')
+
+    def test_moved_redirect(self):
+        client = ClusterRedisClient(hosts=[('192.0.2.1', 7000)])
+        fake = FakeCluster([
+            ('192.0.2.2', redis.exceptions.ResponseError('MOVED 12182 192.0.2.4:7000')),
+            ('192.0.2.4', 3),
+            ('192.0.2.4', 4),
+        ])
+
+        with mock.patch.object(redis.StrictRedis, 'execute_command', autospec=True, side_effect=fake):
+            self.assertEqual(3, client.get_connection('foo').llen('foo'))
+            # The slot really moved, so the slot map is reloaded before the next command
+            fake.cluster_slots = [
+                [0, 8191, [b'192.0.2.1', 7000, b'abc']],
+                [8192, 16383, [b'192.0.2.4', 7000, b'jkl']],
+            ]
+            self.assertEqual(4, client.get_connection('foo').llen('foo'))
+
+        self.assertEqual(
+            [
+                ('192.0.2.1', ('CLUSTER SLOTS', )),
+                ('192.0.2.2', ('LLEN', 'foo')),
+                ('192.0.2.4', ('LLEN', 'foo')),
+                ('192.0.2.1', ('CLUSTER SLOTS', )),
+                ('192.0.2.4', ('LLEN', 'foo')),
+            ],
+            fake.commands,
+        )
+
+    def test_moved_redirect_for_wrong_node_does_not_reload_slots(self):
+        client = ClusterRedisClient(hosts=[('192.0.2.1', 7000)])
+        fake = FakeCluster([
+            ('192.0.2.1', redis.exceptions.ResponseError('MOVED 12182 192.0.2.2:7000')),
+            ('192.0.2.2', 3),
+            ('192.0.2.2', 4),
+        ])
+
+        with mock.patch.object(redis.StrictRedis, 'execute_command', autospec=True, side_effect=fake):
+            # Deliberately use the connection for a different slot
+            self.assertEqual(3, client.get_connection('pysoa:service.b').llen('foo'))
+            self.assertEqual(4, client.get_connection('foo').llen('foo'))
+
+        self.assertEqual(1, len([c for c in fake.commands if c[1] == ('CLUSTER SLOTS', )]))
+
+    def test_too_many_redirects(self):
+        client = ClusterRedisClient(hosts=[('192.0.2.1', 7000)])
+        fake = FakeCluster(
+            [('192.0.2.2', redis.exceptions.ResponseError('MOVED 12182 192.0.2.2:7000'))] *
+            (ClusterRedisClient.MAXIMUM_REDIRECTS + 1)
+        )
+
+        with mock.patch.object(redis.StrictRedis, 'execute_command', autospec=True, side_effect=fake):
+            with self.assertRaises(CannotGetConnectionError):
+                client.get_connection('foo').llen('foo')
+
+    def test_ask_redirect(self):
+        client = ClusterRedisClient(hosts=[('192.0.2.1', 7000)])
+        fake = FakeCluster([('192.0.2.2', redis.exceptions.ResponseError('ASK 12182 192.0.2.4:7000'))])
+
+        with mock.patch.object(redis.StrictRedis, 'execute_command', autospec=True, side_effect=fake), \
+                mock.patch.object(redis.client.Pipeline, 'execute', autospec=True) as mock_execute:
+            mock_execute.side_effect = lambda pipeline, **_: (
+                self.assertEqual('192.0.2.4', pipeline.connection_pool.connection_kwargs['host']) or
+                self.assertEqual([('ASKING', ), ('LLEN', 'foo')], [c[0] for c in pipeline.command_stack]) or
+                [True, 5]
+            )
+            self.assertEqual(5, client.get_connection('foo').llen('foo'))
+
+        # ASK is only a temporary redirect, so the slot map stays the same
+        self.assertEqual('192.0.2.2', client.get_connection('foo').connection_pool.connection_kwargs['host'])
+
+    def test_pipeline_follows_redirects(self):
+        client = ClusterRedisClient(hosts=[('192.0.2.1', 7000)])
+        fake = FakeCluster([('192.0.2.4', b'head')])
+
+        with mock.patch.object(redis.StrictRedis, 'execute_command', autospec=True, side_effect=fake), \
+                mock.patch.object(redis.client.Pipeline, 'execute', autospec=True) as mock_execute:
+            # The slot migrated after the length was read, so only the second command is redirected
+            mock_execute.side_effect = lambda pipeline, **_: (
+                self.assertEqual('192.0.2.2', pipeline.connection_pool.connection_kwargs['host']) or
+                [3, redis.exceptions.ResponseError('MOVED 12182 192.0.2.4:7000')]
+            )
+            pipeline = client.get_connection('foo').pipeline(transaction=False)
+            pipeline.llen('foo')
+            pipeline.lindex('foo', 0)
+            self.assertEqual([3, b'head'], pipeline.execute())
+
+            # Other errors are raised as usual
+            mock_execute.side_effect = lambda pipeline, **_: [redis.exceptions.ResponseError('WRONGTYPE Oops')]
+            pipeline = client.get_connection('foo').pipeline(transaction=False)
+            pipeline.llen('foo')
+            with self.assertRaises(redis.exceptions.ResponseError) as error_context:
+                pipeline.execute()
+            self.assertIn('WRONGTYPE Oops', error_context.exception.args[0])
+
+        self.assertEqual(('192.0.2.4', ('LINDEX', 'foo', 0)), fake.commands[1])
+
+    def test_redirected_script_loaded_on_new_node(self):
+        client = ClusterRedisClient(hosts=[('192.0.2.1', 7000)])
+        sha = client.send_message_to_queue._redis_script.sha
+        fake = FakeCluster([
+            ('192.0.2.2', redis.exceptions.ResponseError('MOVED 12182 192.0.2.4:7000')),
+            ('192.0.2.4', redis.exceptions.NoScriptError('No matching script')),
+            ('192.0.2.4', sha),
+            ('192.0.2.4', None),
+        ])
+
+        with mock.patch.object(redis.StrictRedis, 'execute_command', autospec=True, side_effect=fake):
+            connection = client.get_connection('foo')
+            client.send_message_to_queue(
+                queue_key='foo',
+                message=b'hello',
+                expiry=10,
+                capacity=100,
+                connection=connection,
+            )
+
+        self.assertEqual(('EVALSHA', sha, 1, 'foo', 10, 100, b'hello'), fake.commands[1][1])
+        self.assertEqual(('SCRIPT', 'LOAD', client.send_message_to_queue._redis_script.script), fake.commands[3][1])
+        self.assertEqual(('EVALSHA', sha, 1, 'foo', 10, 100, b'hello'), fake.commands[4][1])
+
+    def test_connection_error_reloads_slots(self):
+        client = ClusterRedisClient(hosts=[('192.0.2.1', 7000)])
+        fake = FakeCluster([
+            ('192.0.2.2', redis.exceptions.ConnectionError('Gone')),
+            ('192.0.2.2', 1),
+        ])
+
+        with mock.patch.object(redis.StrictRedis, 'execute_command', autospec=True, side_effect=fake):
+            with self.assertRaises(redis.exceptions.ConnectionError):
+                client.get_connection('foo').llen('foo')
+            self.assertEqual(1, client.get_connection('foo').llen('foo'))
+
+        self.assertEqual(2, len([c for c in fake.commands if c[1] == ('CLUSTER SLOTS', )]))
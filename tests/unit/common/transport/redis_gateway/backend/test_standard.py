@@ -280,3 +280,50 @@ class TestStandardRedisClient(unittest.TestCase):
 
         self.assertIsNotNone(message)
         self.assertEqual(payload, msgpack.unpackb(message, raw=False))
+
+    def test_pop_and_return_messages(self):
+        client = self._set_up_client()
+
+        queue_key = 'test_pop_and_return_messages!'
+        connection = client.get_connection(queue_key)
+        messages = [msgpack.packb({'test': i}, use_bin_type=True) for i in range(5)]
+        connection.rpush(queue_key, *messages)
+
+        popped = client.pop_messages_from_queue(queue_key=queue_key, count=3, connection=connection)
+        self.assertEqual(messages[:3], popped)
+        self.assertEqual(messages[3:], connection.lrange(queue_key, 0, -1))
+
+        client.return_messages_to_queue(queue_key=queue_key, messages=messages[1:3], expiry=10, connection=connection)
+        self.assertEqual(messages[1:], connection.lrange(queue_key, 0, -1))
+
+        popped = client.pop_messages_from_queue(queue_key=queue_key, count=10, connection=connection)
+        self.assertEqual(messages[1:], popped)
+        self.assertEqual([], client.pop_messages_from_queue(queue_key=queue_key, count=10, connection=connection))
+
+    def test_send_all_messages_to_queue_is_all_or_nothing(self):
+        client = self._set_up_client()
+
+        queue_key = 'test_send_all_messages_to_queue_is_all_or_nothing!'
+        connection = client.get_connection(queue_key)
+        messages = [msgpack.packb({'test': i}, use_bin_type=True) for i in range(3)]
+
+        client.send_all_messages_to_queue(
+            queue_key=queue_key,
+            messages=messages,
+            expiry=10,
+            capacity=4,
+            connection=connection,
+        )
+        self.assertEqual(messages, connection.lrange(queue_key, 0, -1))
+
+        with self.assertRaises(ResponseError) as error_context:
+            client.send_all_messages_to_queue(
+                queue_key=queue_key,
+                messages=messages,
+                expiry=10,
+                capacity=4,
+                connection=connection,
+            )
+
+        self.assertEqual('queue full', error_context.exception.args[0])
+        self.assertEqual(messages, connection.lrange(queue_key, 0, -1))
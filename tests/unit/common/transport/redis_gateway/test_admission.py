@@ -0,0 +1,113 @@
+from __future__ import (
+    absolute_import,
+    unicode_literals,
+)
+
+import os
+
+import freezegun
+import pytest
+
+from pysoa.common.transport.redis_gateway.admission import AdmissionLimiter
+
+
+class TestAdmissionLimiter(object):
+    def setup_method(self, _method):
+        AdmissionLimiter._instances = {}
+
+    def test_invalid_settings(self):
+        with pytest.raises(ValueError):
+            AdmissionLimiter(high_water_mark=1.5)
+        with pytest.raises(ValueError):
+            AdmissionLimiter(minimum_rate=0)
+        with pytest.raises(ValueError):
+            AdmissionLimiter(rate_decrease_factor=0)
+
+    def test_get_instance(self):
+        limiter = AdmissionLimiter.get_instance('service.one', minimum_rate=5)
+
+        assert limiter.minimum_rate == 5
+        assert AdmissionLimiter.get_instance('service.one') is limiter
+        assert AdmissionLimiter.get_instance('service.two') is not limiter
+        assert AdmissionLimiter._instances[(os.getpid(), 'service.one')] is limiter
+
+    def test_unlimited_until_congested(self):
+        limiter = AdmissionLimiter()
+
+        for depth in range(0, 80):
+            assert limiter.try_acquire() is True
+            limiter.record_queue_depth(depth, 100)
+
+        assert limiter.rate is None
+        assert limiter.queue_depth == 79
+
+    def test_decrease_and_increase(self):
+        with freezegun.freeze_time() as frozen_time:
+            limiter = AdmissionLimiter(minimum_rate=2, rate_increase_per_second=10)
+
+            # A demand of 100 requests per second
+            for _ in range(99):
+                assert limiter.try_acquire() is True
+            frozen_time.tick(1)
+            assert limiter.try_acquire() is True
+
+            limiter.record_queue_depth(85, 100)
+            assert limiter.rate == 50
+            assert limiter.queue_depth == 85
+
+            # No tokens have accumulated yet
+            assert limiter.try_acquire() is False
+
+            # Only one decrease per second, no matter how many congestion signals
+            limiter.record_queue_depth(100, 100)
+            assert limiter.rate == 50
+
+            frozen_time.tick(0.11)
+            assert [limiter.try_acquire() for _ in range(6)] == [True] * 5 + [False]
+
+            frozen_time.tick(0.89)
+            limiter.record_queue_depth(None, 100)  # a full batch was accepted; the queue was not full
+            assert limiter.rate == pytest.approx(60)
+
+            limiter.record_queue_depth(90, 100)
+            assert limiter.rate == pytest.approx(30)
+
+            frozen_time.tick(0.5)
+            limiter.record_queue_depth(90, 100)
+            assert limiter.rate == pytest.approx(30)
+
+            for _ in range(10):
+                frozen_time.tick(1)
+                limiter.record_queue_depth(100, 100)
+            assert limiter.rate == 2
+
+    def test_lifted_once_well_above_demand(self):
+        with freezegun.freeze_time() as frozen_time:
+            limiter = AdmissionLimiter(minimum_rate=1, rate_increase_per_second=1)
+
+            for _ in range(10):
+                limiter.try_acquire()
+            frozen_time.tick(1)
+            limiter.record_queue_depth(100, 100)
+            assert limiter.rate == 5
+
+            frozen_time.tick(1)
+            limiter.try_acquire(2)
+            limiter.record_queue_depth(10, 100)
+            assert limiter.rate == 6
+
+            # The demand falls to 2 requests per second
+            frozen_time.tick(1)
+            limiter.try_acquire(2)
+            limiter.record_queue_depth(10, 100)
+            assert limiter.rate is None
+            assert limiter.try_acquire(50) is True
+
+    def test_congested_on_first_send(self):
+        limiter = AdmissionLimiter(minimum_rate=3)
+
+        limiter.try_acquire()
+        limiter.record_queue_depth(100, 100)
+
+        assert limiter.rate is not None
+        assert limiter.rate >= 3
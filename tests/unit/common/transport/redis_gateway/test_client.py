@@ -15,6 +15,10 @@ from pymetrics.recorders.noop import noop_metrics
 import six
 
 from pysoa.common.transport.base import get_hex_thread_id
+from pysoa.common.transport.errors import (
+    InvalidMessageError,
+    MessageSendError,
+)
 from pysoa.common.transport.redis_gateway.client import RedisClientTransport
 from pysoa.test.compatibility import mock
 
@@ -96,6 +100,83 @@ class TestClientTransport(unittest.TestCase):
             25,
         )
 
+    def test_send_request_messages(self, mock_core):
+        transport = self._get_transport()
+
+        message_1 = {'test': 'payload'}
+        message_2 = {'another': 'message'}
+        error = MessageSendError('Redis queue service.my_service was full after 3 retries')
+
+        mock_core.return_value.send_messages.return_value = [None, error]
+
+        results = transport.send_request_messages([(15, {'app': 'ppa'}, message_1), (16, {}, message_2)], 25)
+
+        self.assertEqual([None, error], results)
+        self.assertEqual(1, transport.requests_outstanding)
+
+        reply_to = 'service.my_service.{client_id}!{thread_id}'.format(
+            client_id=transport.client_id,
+            thread_id=get_hex_thread_id(),
+        )
+        mock_core.return_value.send_messages.assert_called_once_with(
+            'service.my_service',
+            [(15, {'app': 'ppa', 'reply_to': reply_to}, message_1), (16, {'reply_to': reply_to}, message_2)],
+            25,
+        )
+        self.assertFalse(mock_core.return_value.send_message.called)
+
+    def test_send_request_message_priority(self, mock_core):
+        transport = self._get_transport(default_priority='low')
+        self.assertNotIn('default_priority', mock_core.call_args[1])
+        mock_core.return_value.send_message.return_value = 5
+
+        transport.send_request_message(1, {}, {'control': {'priority': 'high'}})
+        transport.send_request_message(2, {}, {'control': {'priority': 'normal'}})
+        transport.send_request_message(3, {}, {'control': {}})
+
+        calls = mock_core.return_value.send_message.call_args_list
+        self.assertEqual('service.my_service.priority.high', calls[0][0][0])
+        self.assertEqual('service.my_service', calls[1][0][0])
+        self.assertEqual('service.my_service.priority.low', calls[2][0][0])
+        for call in calls:
+            self.assertIn('__sent__', call[0][2])
+
+        with self.assertRaises(InvalidMessageError):
+            transport.send_request_message(4, {}, {'control': {'priority': 'urgent'}})
+        self.assertEqual(3, transport.requests_outstanding)
+
+        # Without a priority, nothing changes
+        mock_core.return_value.send_message.reset_mock()
+        transport = self._get_transport()
+        transport.send_request_message(5, {}, {'control': {}})
+        self.assertEqual('service.my_service', mock_core.return_value.send_message.call_args[0][0])
+        self.assertNotIn('__sent__', mock_core.return_value.send_message.call_args[0][2])
+
+    def test_send_request_messages_priority(self, mock_core):
+        transport = self._get_transport()
+
+        mock_core.return_value.send_messages.side_effect = lambda queue_name, messages, _: [None] * len(messages)
+
+        results = transport.send_request_messages([
+            (1, {}, {'control': {'priority': 'low'}}),
+            (2, {}, {'control': {}}),
+            (3, {}, {'control': {'priority': 'urgent'}}),
+            (4, {}, {'control': {'priority': 'low'}}),
+        ])
+
+        self.assertIsNone(results[0])
+        self.assertIsNone(results[1])
+        self.assertIsInstance(results[2], InvalidMessageError)
+        self.assertIsNone(results[3])
+        self.assertEqual(3, transport.requests_outstanding)
+
+        calls = mock_core.return_value.send_messages.call_args_list
+        self.assertEqual(2, len(calls))
+        self.assertEqual('service.my_service.priority.low', calls[0][0][0])
+        self.assertEqual([1, 4], [request_id for request_id, _, _ in calls[0][0][1]])
+        self.assertEqual('service.my_service', calls[1][0][0])
+        self.assertEqual([2], [request_id for request_id, _, _ in calls[1][0][1]])
+
     def test_receive_response_message(self, mock_core):
         transport = self._get_transport()
         transport._requests_outstanding = 1
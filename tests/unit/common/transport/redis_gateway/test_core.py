@@ -4,16 +4,25 @@ from __future__ import (
 )
 
 import datetime
+import itertools
+import math
+import os
+import threading
 import time
 import timeit
 from typing import (
     Any,
     Dict,
+    List,
+    Set,
 )
 
 import attr
 import freezegun
+from pymetrics.instruments import TimerResolution
+from pymetrics.recorders.base import MetricsRecorder
 import pytest
+import redis
 import six
 
 from pysoa.common.serializer.json_serializer import JSONSerializer
@@ -23,12 +32,21 @@ from pysoa.common.transport.errors import (
     MessageReceiveError,
     MessageReceiveTimeout,
     MessageSendError,
+    MessageSendRejected,
     MessageTooLarge,
 )
+from pysoa.common.transport.redis_gateway.admission import AdmissionLimiter
 from pysoa.common.transport.redis_gateway.backend.base import CannotGetConnectionError
+from pysoa.common.transport.redis_gateway.backend.cluster import key_slot
+from pysoa.common.transport.redis_gateway.compression import (
+    Codec,
+    ZlibCodec,
+)
 from pysoa.common.transport.redis_gateway.constants import (
+    REDIS_BACKEND_TYPE_CLUSTER,
     REDIS_BACKEND_TYPE_SENTINEL,
     REDIS_BACKEND_TYPE_STANDARD,
+    REQUEST_PRIORITIES,
     ProtocolVersion,
 )
 from pysoa.common.transport.redis_gateway.core import (
@@ -36,6 +54,7 @@ from pysoa.common.transport.redis_gateway.core import (
     RedisTransportCore,
     RedisTransportServerCore,
 )
+from pysoa.common.transport.redis_gateway.utils import make_priority_queue_name
 from pysoa.test.compatibility import mock
 
 # To ensure all the patching over there happens over here
@@ -150,12 +169,35 @@ class TestRedisTransportCore(object):
         mock_sentinel.return_value.anything.assert_called_once_with()
         assert not mock_standard.called
 
+    @mock.patch('pysoa.common.transport.redis_gateway.core.ClusterRedisClient')
+    @mock.patch('pysoa.common.transport.redis_gateway.core.SentinelRedisClient')
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_cluster_client_created(self, mock_standard, mock_sentinel, mock_cluster):
+        # noinspection PyArgumentList
+        core = RedisTransportServerCore(
+            backend_type=REDIS_BACKEND_TYPE_CLUSTER,
+            backend_layer_kwargs={
+                'connection_kwargs': {'hello': 'world'},
+                'hosts': [('node_1', 7000), 'node_2'],
+                'redis_port': 7001,
+            },
+        )
+        core.backend_layer.anything()  # type: ignore
+
+        mock_cluster.assert_called_once_with(
+            hosts=[('node_1', 7000), ('node_2', 7001)],
+            connection_kwargs={'hello': 'world'},
+        )
+        mock_cluster.return_value.anything.assert_called_once_with()
+        assert not mock_standard.called
+        assert not mock_sentinel.called
+
     @mock.patch('pysoa.common.transport.redis_gateway.core.SentinelRedisClient')
     @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
-    def test_chunking_not_supported_on_client(self, mock_standard, mock_sentinel):
-        with pytest.raises(TypeError) as error_context:
+    def test_chunking_not_supported_on_client_before_version_4(self, mock_standard, mock_sentinel):
+        with pytest.raises(ValueError) as error_context:
             # noinspection PyArgumentList
-            RedisTransportClientCore(  # type: ignore
+            RedisTransportClientCore(
                 backend_type=REDIS_BACKEND_TYPE_SENTINEL,
                 backend_layer_kwargs={
                     'connection_kwargs': {'hello': 'world'},
@@ -171,10 +213,38 @@ class TestRedisTransportCore(object):
                 queue_full_retries=4,
                 receive_timeout_in_seconds=6,
                 default_serializer_config={'object': MockSerializer, 'kwargs': {'kwarg2': 'goodbye'}},
+                maximum_message_size_in_bytes=102400 * 5,
                 chunk_messages_larger_than_bytes=102400,
             )
 
-        assert "unexpected keyword argument 'chunk_messages_larger_than_bytes'" in error_context.value.args[0]
+        assert 'protocol_version must be at least 4' in error_context.value.args[0]
+
+        assert not mock_standard.called
+        assert not mock_sentinel.called
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.SentinelRedisClient')
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_chunking_supported_on_client(self, mock_standard, mock_sentinel):
+        # noinspection PyArgumentList
+        core = RedisTransportClientCore(
+            backend_type=REDIS_BACKEND_TYPE_STANDARD,
+            maximum_message_size_in_bytes=102400 * 5,
+            chunk_messages_larger_than_bytes=102400,
+            protocol_version=ProtocolVersion.VERSION_4,
+        )
+
+        assert core.chunk_messages_larger_than_bytes == 102400
+        assert core.maximum_message_size_in_bytes == 102400 * 5
+
+        with pytest.raises(ValueError) as error_context:
+            # noinspection PyArgumentList
+            RedisTransportClientCore(
+                backend_type=REDIS_BACKEND_TYPE_STANDARD,
+                chunk_messages_larger_than_bytes=102400,
+                protocol_version=ProtocolVersion.VERSION_4,
+            )
+
+        assert 'at least 5 times larger' in error_context.value.args[0]
 
         assert not mock_standard.called
         assert not mock_sentinel.called
@@ -488,6 +558,38 @@ class TestRedisTransportCore(object):
         assert 'received' in error_context.value.args[0]
         assert 0.9 < elapsed < 1.1
 
+    def test_blocking_pop_timeouts(self):
+        assert self._get_server_core(receive_timeout_in_seconds='0.25').receive_timeout_in_seconds == 0.25
+        core = self._get_server_core(receive_timeout_in_seconds=3.0)
+        assert core.receive_timeout_in_seconds == 3
+        assert isinstance(core.receive_timeout_in_seconds, int)
+
+        connection = mock.MagicMock()
+        connection.blpop.return_value = None
+        with mock.patch.object(core, '_get_redis_connection', return_value=connection):
+            for timeout in (None, 2.0, 0.15, 0.0001):
+                with pytest.raises(MessageReceiveTimeout):
+                    core.receive_message('test_blocking_pop_timeouts', receive_timeout_in_seconds=timeout)
+
+        timeouts = [c[1]['timeout'] for c in connection.blpop.call_args_list]
+        # Whole seconds are still sent as integers, for Redis versions before 6.0
+        assert timeouts == [3, 2, 0.15, 0.001]
+        assert [type(t) for t in timeouts] == [int, int, float, float]
+
+    def test_fractional_message_expiry(self):
+        core = self._get_client_core(message_expiry_in_seconds=0.5)
+
+        meta = {}  # type: Dict[six.text_type, Any]
+        start = time.time()
+        _, redis_expiry, _ = core._prepare_message(1, meta, {'test': 'payload'})
+        assert redis_expiry == 1
+        assert start + 0.5 <= meta['__expiry__'] < start + 0.6
+
+        meta = {}
+        _, redis_expiry, _ = core._prepare_message(1, meta, {'test': 'payload'}, message_expiry_in_seconds=0.15)
+        assert redis_expiry == 11
+        assert start + 0.15 <= meta['__expiry__'] < start + 0.25
+
     def test_expired_message(self):
         core = self._get_server_core(receive_timeout_in_seconds=3, message_expiry_in_seconds=10)
 
@@ -1006,24 +1108,26 @@ class TestRedisTransportCore(object):
 
         core.send_message('test_send_chunking_works_three_chunks', 103, meta, body)
 
-        assert mock_standard.return_value.send_message_to_queue.call_count == 3
+        assert mock_standard.return_value.send_message_to_queue.call_count == 0
+        assert mock_standard.return_value.send_all_messages_to_queue.call_count == 1
+        assert len(mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages']) == 3
 
         starts_with = b'pysoa-redis/3//content-type:application/msgpack;chunk-count:3;chunk-id:'
         starts_with_length = len(starts_with) + 2
 
         payload = b''
 
-        _, kwargs = mock_standard.return_value.send_message_to_queue.call_args_list[0]
-        assert kwargs['message'].startswith(starts_with + b'1;')
-        payload += kwargs['message'][starts_with_length:]
+        message = mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages'][0]
+        assert message.startswith(starts_with + b'1;')
+        payload += message[starts_with_length:]
 
-        _, kwargs = mock_standard.return_value.send_message_to_queue.call_args_list[1]
-        assert kwargs['message'].startswith(starts_with + b'2;')
-        payload += kwargs['message'][starts_with_length:]
+        message = mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages'][1]
+        assert message.startswith(starts_with + b'2;')
+        payload += message[starts_with_length:]
 
-        _, kwargs = mock_standard.return_value.send_message_to_queue.call_args_list[2]
-        assert kwargs['message'].startswith(starts_with + b'3;')
-        payload += kwargs['message'][starts_with_length:]
+        message = mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages'][2]
+        assert message.startswith(starts_with + b'3;')
+        payload += message[starts_with_length:]
 
         deserialized = MsgpackSerializer().blob_to_dict(payload)
         assert deserialized['request_id'] == 103
@@ -1043,28 +1147,30 @@ class TestRedisTransportCore(object):
 
         core.send_message('test_send_chunking_works_four_chunks', 115, meta, body)
 
-        assert mock_standard.return_value.send_message_to_queue.call_count == 4
+        assert mock_standard.return_value.send_message_to_queue.call_count == 0
+        assert mock_standard.return_value.send_all_messages_to_queue.call_count == 1
+        assert len(mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages']) == 4
 
         starts_with = b'pysoa-redis/3//content-type:application/json;chunk-count:4;chunk-id:'
         starts_with_length = len(starts_with) + 2
 
         payload = b''
 
-        _, kwargs = mock_standard.return_value.send_message_to_queue.call_args_list[0]
-        assert kwargs['message'].startswith(starts_with + b'1;')
-        payload += kwargs['message'][starts_with_length:]
+        message = mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages'][0]
+        assert message.startswith(starts_with + b'1;')
+        payload += message[starts_with_length:]
 
-        _, kwargs = mock_standard.return_value.send_message_to_queue.call_args_list[1]
-        assert kwargs['message'].startswith(starts_with + b'2;')
-        payload += kwargs['message'][starts_with_length:]
+        message = mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages'][1]
+        assert message.startswith(starts_with + b'2;')
+        payload += message[starts_with_length:]
 
-        _, kwargs = mock_standard.return_value.send_message_to_queue.call_args_list[2]
-        assert kwargs['message'].startswith(starts_with + b'3;')
-        payload += kwargs['message'][starts_with_length:]
+        message = mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages'][2]
+        assert message.startswith(starts_with + b'3;')
+        payload += message[starts_with_length:]
 
-        _, kwargs = mock_standard.return_value.send_message_to_queue.call_args_list[3]
-        assert kwargs['message'].startswith(starts_with + b'4;')
-        payload += kwargs['message'][starts_with_length:]
+        message = mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages'][3]
+        assert message.startswith(starts_with + b'4;')
+        payload += message[starts_with_length:]
 
         deserialized = JSONSerializer().blob_to_dict(payload)
         assert deserialized['request_id'] == 115
@@ -1084,32 +1190,34 @@ class TestRedisTransportCore(object):
 
         core.send_message('test_send_chunking_works_five_chunks', 122, meta, body)
 
-        assert mock_standard.return_value.send_message_to_queue.call_count == 5
+        assert mock_standard.return_value.send_message_to_queue.call_count == 0
+        assert mock_standard.return_value.send_all_messages_to_queue.call_count == 1
+        assert len(mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages']) == 5
 
         starts_with = b'pysoa-redis/3//content-type:application/msgpack;chunk-count:5;chunk-id:'
         starts_with_length = len(starts_with) + 2
 
         payload = b''
 
-        _, kwargs = mock_standard.return_value.send_message_to_queue.call_args_list[0]
-        assert kwargs['message'].startswith(starts_with + b'1;')
-        payload += kwargs['message'][starts_with_length:]
+        message = mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages'][0]
+        assert message.startswith(starts_with + b'1;')
+        payload += message[starts_with_length:]
 
-        _, kwargs = mock_standard.return_value.send_message_to_queue.call_args_list[1]
-        assert kwargs['message'].startswith(starts_with + b'2;')
-        payload += kwargs['message'][starts_with_length:]
+        message = mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages'][1]
+        assert message.startswith(starts_with + b'2;')
+        payload += message[starts_with_length:]
 
-        _, kwargs = mock_standard.return_value.send_message_to_queue.call_args_list[2]
-        assert kwargs['message'].startswith(starts_with + b'3;')
-        payload += kwargs['message'][starts_with_length:]
+        message = mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages'][2]
+        assert message.startswith(starts_with + b'3;')
+        payload += message[starts_with_length:]
 
-        _, kwargs = mock_standard.return_value.send_message_to_queue.call_args_list[3]
-        assert kwargs['message'].startswith(starts_with + b'4;')
-        payload += kwargs['message'][starts_with_length:]
+        message = mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages'][3]
+        assert message.startswith(starts_with + b'4;')
+        payload += message[starts_with_length:]
 
-        _, kwargs = mock_standard.return_value.send_message_to_queue.call_args_list[4]
-        assert kwargs['message'].startswith(starts_with + b'5;')
-        payload += kwargs['message'][starts_with_length:]
+        message = mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages'][4]
+        assert message.startswith(starts_with + b'5;')
+        payload += message[starts_with_length:]
 
         deserialized = MsgpackSerializer().blob_to_dict(payload)
         assert deserialized['request_id'] == 122
@@ -1133,6 +1241,57 @@ class TestRedisTransportCore(object):
         assert 'exceeds maximum message size' in error_context.value.args[0]
 
         assert not mock_standard.return_value.send_message_to_queue.called
+        assert not mock_standard.return_value.send_all_messages_to_queue.called
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.time.sleep')
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_send_chunking_retries_all_chunks_together_if_queue_full(self, mock_standard, mock_sleep):
+        core = self._get_server_core(
+            chunk_messages_larger_than_bytes=102400,
+            maximum_message_size_in_bytes=102400 * 6,
+            queue_full_retries=2,
+        )
+
+        mock_standard.return_value.send_all_messages_to_queue.side_effect = [
+            redis.exceptions.ResponseError('queue full'),
+            None,
+        ]
+
+        meta = {'protocol_version': ProtocolVersion.VERSION_3}
+        body = {'test': ['payload%i' % i for i in range(10000, 30000)]}  # 2.5 chunks needed
+
+        core.send_message('test_send_chunking_retries_all_chunks_together_if_queue_full', 104, meta, body)
+
+        assert mock_standard.return_value.send_message_to_queue.call_count == 0
+        assert mock_standard.return_value.send_all_messages_to_queue.call_count == 2
+        assert mock_sleep.call_count == 1
+
+        first_kwargs = mock_standard.return_value.send_all_messages_to_queue.call_args_list[0][1]
+        second_kwargs = mock_standard.return_value.send_all_messages_to_queue.call_args_list[1][1]
+        assert len(first_kwargs['messages']) == 3
+        assert first_kwargs['messages'] == second_kwargs['messages']
+        assert first_kwargs['capacity'] == core.queue_capacity
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.time.sleep')
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_send_chunking_queue_full_sends_no_chunks(self, mock_standard, _mock_sleep):
+        core = self._get_server_core(
+            chunk_messages_larger_than_bytes=102400,
+            maximum_message_size_in_bytes=102400 * 6,
+            queue_full_retries=1,
+        )
+
+        mock_standard.return_value.send_all_messages_to_queue.side_effect = redis.exceptions.ResponseError('queue full')
+
+        meta = {'protocol_version': ProtocolVersion.VERSION_3}
+        body = {'test': ['payload%i' % i for i in range(10000, 30000)]}  # 2.5 chunks needed
+
+        with pytest.raises(MessageSendError) as error_context:
+            core.send_message('test_send_chunking_queue_full_sends_no_chunks', 105, meta, body)
+
+        assert 'was full' in error_context.value.args[0]
+        assert mock_standard.return_value.send_message_to_queue.call_count == 0
+        assert mock_standard.return_value.send_all_messages_to_queue.call_count == 2
 
     @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
     def test_send_chunking_works_round_trip_three_chunks(self, mock_standard):
@@ -1147,12 +1306,12 @@ class TestRedisTransportCore(object):
 
         server_core.send_message('test_send_chunking_works_round_trip_three_chunks', 103, meta, body)
 
-        assert mock_standard.return_value.send_message_to_queue.call_count == 3
+        assert mock_standard.return_value.send_all_messages_to_queue.call_count == 1
 
         mock_standard.return_value.get_connection.return_value.blpop.side_effect = [
-            [True, (mock_standard.return_value.send_message_to_queue.call_args_list[0][1]['message'])],
-            [True, (mock_standard.return_value.send_message_to_queue.call_args_list[1][1]['message'])],
-            [True, (mock_standard.return_value.send_message_to_queue.call_args_list[2][1]['message'])],
+            [True, mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages'][0]],
+            [True, mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages'][1]],
+            [True, mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages'][2]],
         ]
 
         request_id, _, received_body = client_core.receive_message(
@@ -1175,14 +1334,14 @@ class TestRedisTransportCore(object):
 
         server_core.send_message('test_send_chunking_works_round_trip_five_chunks', 103, meta, body)
 
-        assert mock_standard.return_value.send_message_to_queue.call_count == 5
+        assert mock_standard.return_value.send_all_messages_to_queue.call_count == 1
 
         mock_standard.return_value.get_connection.return_value.blpop.side_effect = [
-            [True, (mock_standard.return_value.send_message_to_queue.call_args_list[0][1]['message'])],
-            [True, (mock_standard.return_value.send_message_to_queue.call_args_list[1][1]['message'])],
-            [True, (mock_standard.return_value.send_message_to_queue.call_args_list[2][1]['message'])],
-            [True, (mock_standard.return_value.send_message_to_queue.call_args_list[3][1]['message'])],
-            [True, (mock_standard.return_value.send_message_to_queue.call_args_list[4][1]['message'])],
+            [True, mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages'][0]],
+            [True, mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages'][1]],
+            [True, mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages'][2]],
+            [True, mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages'][3]],
+            [True, mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages'][4]],
         ]
 
         request_id, _, received_body = client_core.receive_message(
@@ -1208,11 +1367,11 @@ class TestRedisTransportCore(object):
 
         server_core.send_message('test_send_chunking_works_round_trip_edge_case_1', 911461, meta, body)
 
-        assert mock_standard.return_value.send_message_to_queue.call_count == 5
+        assert mock_standard.return_value.send_all_messages_to_queue.call_count == 1
 
         mock_standard.return_value.get_connection.return_value.blpop.side_effect = [
-            [True, item[1]['message']]
-            for item in mock_standard.return_value.send_message_to_queue.call_args_list
+            [True, message]
+            for message in mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages']
         ]
 
         request_id, _, received_body = client_core.receive_message(
@@ -1255,3 +1414,1171 @@ class TestRedisTransportCore(object):
         assert 'protocol_version' in meta
         assert meta['protocol_version'] == (version if version else ProtocolVersion.VERSION_3)  # 3 is the default
         assert received_body == body
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_send_messages_single_round_trip(self, mock_standard):
+        server_core = self._get_server_core()
+        client_core = self._get_client_core()
+
+        mock_standard.return_value.send_messages_to_queue.return_value = 3
+
+        results = client_core.send_messages(
+            'test_send_messages_single_round_trip',
+            [(71, {}, {'foo': 'bar'}), (72, {}, {'baz': 'qux'}), (73, {}, {'hello': 'world'})],
+        )
+
+        assert results == [None, None, None]
+        assert mock_standard.return_value.send_message_to_queue.call_count == 0
+        assert mock_standard.return_value.send_messages_to_queue.call_count == 1
+
+        call_kwargs = mock_standard.return_value.send_messages_to_queue.call_args[1]
+        assert call_kwargs['queue_key'] == 'pysoa:test_send_messages_single_round_trip'
+        assert call_kwargs['expiry'] == client_core.message_expiry_in_seconds
+        assert call_kwargs['capacity'] == client_core.queue_capacity
+        assert len(call_kwargs['messages']) == 3
+
+        mock_standard.return_value.get_connection.return_value.blpop.side_effect = [
+            [True, message] for message in call_kwargs['messages']
+        ]
+
+        for request_id, body in ((71, {'foo': 'bar'}), (72, {'baz': 'qux'}), (73, {'hello': 'world'})):
+            received = server_core.receive_message('test_send_messages_single_round_trip')
+            assert received[0] == request_id
+            assert received[2] == body
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.time.sleep')
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_send_messages_partial_accept_then_retry(self, mock_standard, mock_sleep):
+        core = self._get_client_core(queue_full_retries=3)
+
+        mock_standard.return_value.send_messages_to_queue.side_effect = [2, 0, 2]
+
+        results = core.send_messages(
+            'test_send_messages_partial_accept_then_retry',
+            [(81, {}, {'a': 1}), (82, {}, {'b': 2}), (83, {}, {'c': 3}), (84, {}, {'d': 4})],
+        )
+
+        assert results == [None, None, None, None]
+        assert mock_sleep.call_count == 2
+
+        calls = mock_standard.return_value.send_messages_to_queue.call_args_list
+        assert len(calls) == 3
+        assert len(calls[0][1]['messages']) == 4
+        assert calls[1][1]['messages'] == calls[0][1]['messages'][2:]
+        assert calls[2][1]['messages'] == calls[0][1]['messages'][2:]
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.time.sleep')
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_send_messages_queue_full(self, mock_standard, mock_sleep):
+        core = self._get_client_core(queue_full_retries=2)
+
+        mock_standard.return_value.send_messages_to_queue.side_effect = [1, 0, 0]
+
+        results = core.send_messages(
+            'test_send_messages_queue_full',
+            [(91, {}, {'a': 1}), (92, {}, {'b': 2}), (93, {}, {'c': 3})],
+        )
+
+        assert results[0] is None
+        assert isinstance(results[1], MessageSendError)
+        assert 'test_send_messages_queue_full was full' in results[1].args[0]
+        assert results[2] is results[1]
+        assert mock_sleep.call_count == 2
+        assert mock_standard.return_value.send_messages_to_queue.call_count == 3
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.time.sleep')
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_send_records_request_queue_load(self, mock_standard, _mock_sleep):
+        core = self._get_client_core(queue_full_retries=2, queue_capacity=50)
+        connection = mock_standard.return_value.get_connection.return_value
+        record = mock_standard.return_value.record_request_queue_send
+
+        mock_standard.return_value.send_message_to_queue.side_effect = [
+            redis.exceptions.ResponseError('queue full'),
+            17,
+        ]
+
+        core.send_message('test_send_records_request_queue_load', 0, {}, {'a': 1})
+
+        assert record.call_count == 2
+        assert record.call_args_list[0][0][0] == 'pysoa:test_send_records_request_queue_load'
+        assert record.call_args_list[0][0][1] is connection
+        assert record.call_args_list[0][0][2] >= 0
+        assert record.call_args_list[0][0][3] == 50
+        assert record.call_args_list[1][0][3] == 17
+
+        record.reset_mock()
+        mock_standard.return_value.send_messages_to_queue.side_effect = [1, 1]
+
+        results = core.send_messages(
+            'test_send_records_request_queue_load',
+            [(1, {}, {'a': 1}), (2, {}, {'b': 2})],
+        )
+
+        assert results == [None, None]
+        assert record.call_count == 2
+        assert record.call_args_list[0][0][3] == 50
+        assert record.call_args_list[1][0][3] is None
+
+    # The limiter refills with time, so freeze it to keep the test from depending on how fast it runs
+    @freezegun.freeze_time(ignore=['mockredis.client', 'mockredis.clock', 'timeit'])
+    @mock.patch('pysoa.common.transport.redis_gateway.core.time.sleep')
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_send_admission_control(self, mock_standard, mock_sleep):
+        AdmissionLimiter._instances = {}
+        metrics = mock.MagicMock(spec=MetricsRecorder)
+        core = self._get_client_core(queue_capacity=100, admission_control={'minimum_rate': 1}, metrics=metrics)
+        send = mock_standard.return_value.send_message_to_queue
+
+        send.side_effect = [10, 85]
+        core.send_message('test_send_admission_control', 1, {}, {'a': 1})
+        assert AdmissionLimiter.get_instance('test_send_admission_control').rate is None
+        core.send_message('test_send_admission_control', 2, {}, {'a': 1})
+
+        limiter = AdmissionLimiter.get_instance('test_send_admission_control')
+        assert limiter.rate is not None
+        assert limiter.queue_depth == 85
+        metrics.gauge.assert_any_call('client.transport.redis_gateway.send.admission.queue_depth')
+        metrics.gauge.assert_any_call('client.transport.redis_gateway.send.admission.rate_limit')
+
+        # The limiter has no tokens until time passes, so the next request is rejected without touching Redis
+        with pytest.raises(MessageSendRejected) as error_context:
+            core.send_message('test_send_admission_control', 3, {}, {'a': 1})
+        assert 'test_send_admission_control is congested' in error_context.value.args[0]
+        assert send.call_count == 2
+        metrics.counter.assert_any_call('client.transport.redis_gateway.send.admission.rejected')
+
+        results = core.send_messages('test_send_admission_control', [(4, {}, {'a': 1}), (5, {}, {'b': 2})])
+        assert isinstance(results[0], MessageSendRejected)
+        assert isinstance(results[1], MessageSendRejected)
+        assert mock_standard.return_value.send_messages_to_queue.call_count == 0
+
+        # Sending to a full queue is not retried
+        limiter._tokens = 1.0
+        send.side_effect = redis.exceptions.ResponseError('queue full')
+        with pytest.raises(MessageSendError) as error_context:
+            core.send_message('test_send_admission_control', 6, {}, {'a': 1})
+        assert not isinstance(error_context.value, MessageSendRejected)
+        assert 'was full after 0 retries' in error_context.value.args[0]
+        assert send.call_count == 3
+        assert mock_sleep.call_count == 0
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_send_admission_control_disabled_by_default(self, mock_standard):
+        AdmissionLimiter._instances = {}
+        core = self._get_client_core(queue_capacity=100)
+        mock_standard.return_value.send_message_to_queue.return_value = 100
+
+        core.send_message('test_send_admission_control_disabled', 1, {}, {'a': 1})
+        core.send_message('test_send_admission_control_disabled', 2, {}, {'a': 1})
+
+        assert AdmissionLimiter._instances == {}
+        assert mock_standard.return_value.send_message_to_queue.call_count == 2
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_send_messages_redis_error(self, mock_standard):
+        core = self._get_client_core()
+
+        mock_standard.return_value.send_messages_to_queue.side_effect = ValueError('Oops')
+
+        results = core.send_messages(
+            'test_send_messages_redis_error',
+            [(None, {}, {'a': 1}), (102, {}, {'b': 2}), (103, {}, {'c': 3})],  # type: ignore
+        )
+
+        assert isinstance(results[0], InvalidMessageError)
+        assert isinstance(results[1], MessageSendError)
+        assert results[1].args[0] == 'Unknown error sending message for service '
+        assert results[1].args[1] == 'ValueError'
+        assert results[2] is results[1]
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_send_messages_chunked_messages_sent_individually(self, mock_standard):
+        core = self._get_server_core(chunk_messages_larger_than_bytes=102400, maximum_message_size_in_bytes=1024000)
+
+        mock_standard.return_value.send_messages_to_queue.return_value = 1
+
+        results = core.send_messages(
+            'test_send_messages_chunked_messages_sent_individually',
+            [
+                (111, {'protocol_version': ProtocolVersion.VERSION_3}, {'a': 1}),
+                (112, {'protocol_version': ProtocolVersion.VERSION_3}, {'b': 'x' * 250000}),
+            ],
+        )
+
+        assert results == [None, None]
+        assert mock_standard.return_value.send_messages_to_queue.call_count == 1
+        assert len(mock_standard.return_value.send_messages_to_queue.call_args[1]['messages']) == 1
+        assert mock_standard.return_value.send_all_messages_to_queue.call_count == 1
+        assert len(mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages']) == 3
+
+    def test_prefetch_count_must_not_be_negative(self):
+        with pytest.raises(ValueError):
+            self._get_server_core(prefetch_count=-1)
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_receive_prefetch_disabled_by_default(self, mock_standard):
+        core = self._get_server_core()
+
+        mock_standard.return_value.get_connection.return_value.blpop.return_value = [
+            True,
+            MsgpackSerializer().dict_to_blob({'request_id': 15, 'meta': {}, 'body': {'foo': 'bar'}}),
+        ]
+
+        assert core.receive_message('test_receive_prefetch_disabled_by_default')[0] == 15
+        assert mock_standard.return_value.pop_messages_from_queue.call_count == 0
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_receive_prefetch(self, mock_standard):
+        core = self._get_server_core(prefetch_count=3)
+
+        serializer = MsgpackSerializer()
+        connection = mock_standard.return_value.get_connection.return_value
+        connection.blpop.side_effect = [
+            [True, serializer.dict_to_blob({'request_id': 15, 'meta': {}, 'body': {'foo': 'bar'}})],
+            [True, serializer.dict_to_blob({'request_id': 18, 'meta': {}, 'body': {'fiz': 'buz'}})],
+        ]
+        mock_standard.return_value.pop_messages_from_queue.side_effect = [
+            [
+                serializer.dict_to_blob({'request_id': 16, 'meta': {}, 'body': {'baz': 'qux'}}),
+                serializer.dict_to_blob({'request_id': 17, 'meta': {}, 'body': {'hello': 'world'}}),
+            ],
+            [],
+        ]
+
+        request_id, meta, body = core.receive_message('test_receive_prefetch')
+        assert request_id == 15
+        assert body == {'foo': 'bar'}
+        mock_standard.return_value.pop_messages_from_queue.assert_called_once_with(
+            queue_key='pysoa:test_receive_prefetch',
+            count=3,
+            connection=connection,
+        )
+
+        request_id, meta, body = core.receive_message('test_receive_prefetch')
+        assert request_id == 16
+        assert body == {'baz': 'qux'}
+
+        request_id, meta, body = core.receive_message('test_receive_prefetch')
+        assert request_id == 17
+        assert body == {'hello': 'world'}
+
+        assert connection.blpop.call_count == 1
+        assert mock_standard.return_value.pop_messages_from_queue.call_count == 1
+
+        request_id, meta, body = core.receive_message('test_receive_prefetch')
+        assert request_id == 18
+        assert body == {'fiz': 'buz'}
+
+        assert connection.blpop.call_count == 2
+        assert mock_standard.return_value.pop_messages_from_queue.call_count == 2
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_receive_prefetch_error_does_not_fail_receive(self, mock_standard):
+        core = self._get_server_core(prefetch_count=3)
+
+        mock_standard.return_value.get_connection.return_value.blpop.return_value = [
+            True,
+            MsgpackSerializer().dict_to_blob({'request_id': 15, 'meta': {}, 'body': {'foo': 'bar'}}),
+        ]
+        mock_standard.return_value.pop_messages_from_queue.side_effect = ValueError('Oops')
+
+        assert core.receive_message('test_receive_prefetch_error_does_not_fail_receive')[0] == 15
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_receive_prefetch_drops_expired_messages(self, mock_standard):
+        core = self._get_server_core(prefetch_count=3)
+
+        serializer = MsgpackSerializer()
+        mock_standard.return_value.get_connection.return_value.blpop.return_value = [
+            True,
+            serializer.dict_to_blob({'request_id': 15, 'meta': {'__expiry__': time.time() - 1}, 'body': {}}),
+        ]
+        mock_standard.return_value.pop_messages_from_queue.return_value = [
+            serializer.dict_to_blob({'request_id': 16, 'meta': {'__expiry__': time.time() - 1}, 'body': {}}),
+            serializer.dict_to_blob({'request_id': 17, 'meta': {'__expiry__': time.time() + 10}, 'body': {'a': 'b'}}),
+            serializer.dict_to_blob({'request_id': 18, 'meta': {'__expiry__': time.time() - 1}, 'body': {}}),
+        ]
+
+        request_id, meta, body = core.receive_message('test_receive_prefetch_drops_expired_messages')
+        assert request_id == 17
+        assert body == {'a': 'b'}
+
+        with pytest.raises(MessageReceiveTimeout):
+            core.receive_message('test_receive_prefetch_drops_expired_messages')
+
+        assert mock_standard.return_value.get_connection.return_value.blpop.call_count == 1
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_receive_prefetch_from_two_threads_loses_no_messages(self, mock_standard):
+        core = self._get_server_core(prefetch_count=3, receive_timeout_in_seconds=1)
+
+        serializer = MsgpackSerializer()
+        queue = [serializer.dict_to_blob({'request_id': i, 'meta': {}, 'body': {}}) for i in range(1, 9)]
+        queue_lock = threading.Lock()
+        blocked = set()  # type: Set[int]
+        received_first = set()  # type: Set[int]
+
+        def rendezvous(arrived):  # type: (Set[int]) -> None
+            # Wait (with a generous limit) for the other thread to get here, too
+            with queue_lock:
+                arrived.add(threading.current_thread().ident or 0)
+            deadline = time.time() + 5
+            while len(arrived) < 2 and time.time() < deadline:
+                time.sleep(0.001)
+
+        def blpop(keys, timeout):
+            if len(blocked) < 2:
+                # Both threads block before either has prefetched anything, so both prefetch
+                rendezvous(blocked)
+            with queue_lock:
+                return [keys[0], queue.pop(0)] if queue else None
+
+        def pop_messages_from_queue(queue_key, count, connection):
+            with queue_lock:
+                messages, queue[:count] = queue[:count], []
+            return messages
+
+        mock_standard.return_value.get_connection.return_value.blpop.side_effect = blpop
+        mock_standard.return_value.pop_messages_from_queue.side_effect = pop_messages_from_queue
+
+        received = []  # type: List[int]
+
+        def receive():
+            # Both threads have stored what they prefetched before either receives any prefetched message
+            received.append(core.receive_message('test_receive_prefetch_from_two_threads')[0])
+            rendezvous(received_first)
+            while True:
+                try:
+                    received.append(core.receive_message('test_receive_prefetch_from_two_threads')[0])
+                except MessageReceiveTimeout:
+                    return
+
+        threads = [threading.Thread(target=receive) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+
+        assert mock_standard.return_value.pop_messages_from_queue.call_count == 2
+        assert sorted(received) == list(range(1, 9))
+        assert core._prefetched_messages == {}
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_return_prefetched_messages(self, mock_standard):
+        core = self._get_server_core(prefetch_count=3, message_expiry_in_seconds=30)
+
+        serializer = MsgpackSerializer()
+        connection = mock_standard.return_value.get_connection.return_value
+        connection.blpop.return_value = [
+            True,
+            serializer.dict_to_blob({'request_id': 15, 'meta': {}, 'body': {'foo': 'bar'}}),
+        ]
+        prefetched = [
+            serializer.dict_to_blob({'request_id': 16, 'meta': {}, 'body': {'baz': 'qux'}}),
+            serializer.dict_to_blob({'request_id': 17, 'meta': {}, 'body': {'hello': 'world'}}),
+            serializer.dict_to_blob({'request_id': 18, 'meta': {}, 'body': {'fiz': 'buz'}}),
+        ]
+        mock_standard.return_value.pop_messages_from_queue.return_value = prefetched
+
+        assert core.receive_message('test_return_prefetched_messages')[0] == 15
+        assert core.receive_message('test_return_prefetched_messages')[0] == 16
+
+        core.return_prefetched_messages()
+
+        mock_standard.return_value.return_messages_to_queue.assert_called_once_with(
+            queue_key='pysoa:test_return_prefetched_messages',
+            messages=prefetched[1:],
+            expiry=30,
+            connection=connection,
+        )
+
+        mock_standard.return_value.return_messages_to_queue.reset_mock()
+        core.return_prefetched_messages()
+        assert mock_standard.return_value.return_messages_to_queue.call_count == 0
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_return_prefetched_messages_error(self, mock_standard):
+        core = self._get_server_core(prefetch_count=3)
+
+        serializer = MsgpackSerializer()
+        mock_standard.return_value.get_connection.return_value.blpop.return_value = [
+            True,
+            serializer.dict_to_blob({'request_id': 15, 'meta': {}, 'body': {'foo': 'bar'}}),
+        ]
+        mock_standard.return_value.pop_messages_from_queue.return_value = [
+            serializer.dict_to_blob({'request_id': 16, 'meta': {}, 'body': {'baz': 'qux'}}),
+        ]
+        mock_standard.return_value.return_messages_to_queue.side_effect = ValueError('Oops')
+
+        assert core.receive_message('test_return_prefetched_messages_error')[0] == 15
+
+        with pytest.raises(MessageSendError):
+            core.return_prefetched_messages()
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_get_queue_stats(self, mock_standard):
+        core = self._get_server_core(message_expiry_in_seconds=60)
+        shards = [mockredis.mock_redis_client(), mockredis.mock_redis_client()]
+        mock_standard.return_value.get_all_connections.return_value = shards
+
+        with freezegun.freeze_time(ignore=['mockredis.client', 'mockredis.clock', 'timeit']) as frozen_time:
+            # Without a sent header, the age is estimated from the expiry header (the body is not even valid here)
+            shards[0].rpush('pysoa:test_get_queue_stats', *[
+                'pysoa-redis/6//content-type:application/msgpack;expiry:{!r};not-msgpack'.format(
+                    time.time() + 60,
+                ).encode('utf-8'),
+                b'pysoa-redis/6//not-msgpack',
+            ])
+            frozen_time.tick(5)
+            messages, _, _ = core._prepare_message(
+                3,
+                {'protocol_version': ProtocolVersion.VERSION_6},
+                {'test': 'payload'},
+                message_expiry_in_seconds=30,
+            )
+            shards[1].rpush('pysoa:test_get_queue_stats.priority.high', *messages)
+            frozen_time.tick(2)
+
+            stats = core.get_queue_stats('test_get_queue_stats')
+            lane_stats = core.get_queue_stats('test_get_queue_stats', priorities=REQUEST_PRIORITIES)
+
+        assert [(s.priority, s.shard, s.depth) for s in stats] == [(None, 0, 2), (None, 1, 0)]
+        assert stats[0].oldest_message_age_in_seconds == pytest.approx(7)
+        assert stats[1].oldest_message_age_in_seconds is None
+
+        assert [(s.priority, s.shard, s.depth) for s in lane_stats] == [
+            ('high', 0, 0),
+            ('normal', 0, 2),
+            ('low', 0, 0),
+            ('high', 1, 1),
+            ('normal', 1, 0),
+            ('low', 1, 0),
+        ]
+        assert lane_stats[1].oldest_message_age_in_seconds == pytest.approx(7)
+        assert lane_stats[3].oldest_message_age_in_seconds == pytest.approx(2)
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_get_queue_stats_does_not_deserialize_messages(self, mock_standard):
+        core = self._get_server_core(message_expiry_in_seconds=60)
+        shard = mockredis.mock_redis_client()
+        mock_standard.return_value.get_all_connections.return_value = [shard]
+
+        # Messages sent with protocol versions before 6 have no plain-text headers, so their age is unknown
+        messages, _, _ = core._prepare_message(1, {'protocol_version': ProtocolVersion.VERSION_3}, {'test': 'payload'})
+        shard.rpush('pysoa:test_get_queue_stats_does_not_deserialize_messages', *messages)
+
+        with mock.patch.object(MsgpackSerializer, 'blob_to_dict') as mock_blob_to_dict:
+            stats = core.get_queue_stats('test_get_queue_stats_does_not_deserialize_messages')
+
+        assert stats[0].depth == 1
+        assert stats[0].oldest_message_age_in_seconds is None
+        assert mock_blob_to_dict.call_count == 0
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_get_queue_stats_with_message_expiry_override(self, mock_standard):
+        core = self._get_server_core(message_expiry_in_seconds=60)
+        shard = mockredis.mock_redis_client()
+        mock_standard.return_value.get_all_connections.return_value = [shard]
+
+        with freezegun.freeze_time(ignore=['mockredis.client', 'mockredis.clock', 'timeit']) as frozen_time:
+            messages, _, _ = core._prepare_message(
+                1,
+                {'protocol_version': ProtocolVersion.VERSION_6},
+                {'test': 'payload'},
+                message_expiry_in_seconds=5,
+            )
+            shard.rpush('pysoa:test_get_queue_stats_with_message_expiry_override', *messages)
+            frozen_time.tick(2)
+
+            stats = core.get_queue_stats('test_get_queue_stats_with_message_expiry_override')
+
+        # The age comes from the send time, not from the expiry, which is much shorter than the configured one
+        assert stats[0].depth == 1
+        assert stats[0].oldest_message_age_in_seconds == pytest.approx(2)
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_receive_from_all_shards_sweeps_without_blocking(self, mock_standard):
+        metrics = mock.MagicMock(spec=MetricsRecorder)
+        core = self._get_server_core(receive_from_all_shards=True, metrics=metrics)
+        core._shard_offsets = itertools.count(0)
+
+        serializer = MsgpackSerializer()
+        shards = [mock.MagicMock(), mock.MagicMock(), mock.MagicMock()]
+        mock_standard.return_value.get_all_connections.return_value = shards
+        shards[0].lpop.return_value = None
+        shards[1].lpop.return_value = None
+        shards[2].lpop.return_value = serializer.dict_to_blob({'request_id': 15, 'meta': {}, 'body': {'foo': 'bar'}})
+
+        request_id, meta, body = core.receive_message('test_receive_from_all_shards_sweeps_without_blocking')
+
+        assert request_id == 15
+        assert body == {'foo': 'bar'}
+        mock_standard.return_value.get_all_connections.assert_called_once_with(
+            'pysoa:test_receive_from_all_shards_sweeps_without_blocking',
+        )
+        for shard in shards:
+            shard.lpop.assert_called_once_with('pysoa:test_receive_from_all_shards_sweeps_without_blocking')
+            assert shard.blpop.call_count == 0
+        assert mock_standard.return_value.get_connection.call_count == 0
+        metrics.timer.assert_any_call(
+            'server.transport.redis_gateway.receive.shard.2.wait',
+            resolution=TimerResolution.MICROSECONDS,
+        )
+        assert metrics.timer.return_value.set.call_count == 1
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_receive_from_all_shards_is_fair(self, mock_standard):
+        core = self._get_server_core(receive_from_all_shards=True)
+        core._shard_offsets = itertools.count(0)
+
+        serializer = MsgpackSerializer()
+        shards = [mock.MagicMock(), mock.MagicMock(), mock.MagicMock()]
+        mock_standard.return_value.get_all_connections.return_value = shards
+        for index, shard in enumerate(shards):
+            # Every shard has a backlog
+            shard.lpop.side_effect = [
+                serializer.dict_to_blob({'request_id': index * 10 + i, 'meta': {}, 'body': {}}) for i in range(3)
+            ]
+
+        received = [core.receive_message('test_receive_from_all_shards_is_fair')[0] for _ in range(7)]
+
+        assert received == [0, 10, 20, 1, 11, 21, 2]
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_receive_from_all_shards_blocks_on_one_shard_at_a_time(self, mock_standard):
+        core = self._get_server_core(receive_from_all_shards=True, prefetch_count=2)
+        core._shard_offsets = itertools.count(1)
+
+        serializer = MsgpackSerializer()
+        shards = [mock.MagicMock(), mock.MagicMock()]
+        mock_standard.return_value.get_all_connections.return_value = shards
+        shards[0].lpop.return_value = None
+        shards[1].lpop.return_value = None
+        shards[0].blpop.side_effect = [
+            [True, serializer.dict_to_blob({'request_id': 15, 'meta': {}, 'body': {'foo': 'bar'}})],
+        ]
+        shards[1].blpop.return_value = None
+        mock_standard.return_value.pop_messages_from_queue.return_value = [
+            serializer.dict_to_blob({'request_id': 16, 'meta': {}, 'body': {'baz': 'qux'}}),
+        ]
+
+        assert core.receive_message('test_receive_from_all_shards_blocks_on_one_shard_at_a_time')[0] == 15
+
+        # The first round blocked on shard 1, and the second round on shard 0, each for just one second
+        queue_key = 'pysoa:test_receive_from_all_shards_blocks_on_one_shard_at_a_time'
+        shards[1].blpop.assert_called_once_with([queue_key], timeout=1)
+        shards[0].blpop.assert_called_once_with([queue_key], timeout=1)
+        assert shards[0].lpop.call_count == 2
+        assert shards[1].lpop.call_count == 2
+
+        # The requests prefetched with the request come from the same shard, and come next
+        mock_standard.return_value.pop_messages_from_queue.assert_called_once_with(
+            queue_key='pysoa:test_receive_from_all_shards_blocks_on_one_shard_at_a_time',
+            count=2,
+            connection=shards[0],
+        )
+        assert core.receive_message('test_receive_from_all_shards_blocks_on_one_shard_at_a_time')[0] == 16
+        assert shards[0].blpop.call_count == 1
+        assert shards[1].blpop.call_count == 1
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_receive_from_all_shards_timeout(self, mock_standard):
+        core = self._get_server_core(receive_from_all_shards=True, receive_timeout_in_seconds=1)
+
+        shards = [mock.MagicMock(), mock.MagicMock()]
+        mock_standard.return_value.get_all_connections.return_value = shards
+        for shard in shards:
+            shard.lpop.return_value = None
+            shard.blpop.side_effect = lambda *_, **__: time.sleep(0.3)
+
+        start = time.time()
+        with pytest.raises(MessageReceiveTimeout):
+            core.receive_message('test_receive_from_all_shards_timeout')
+
+        assert 0.9 < time.time() - start < 2
+        assert 3 <= shards[0].blpop.call_count + shards[1].blpop.call_count <= 4
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_receive_from_all_shards_blocks_no_longer_than_the_deadline(self, mock_standard):
+        core = self._get_server_core(receive_from_all_shards=True, receive_timeout_in_seconds=1.5)
+
+        timeouts = []  # type: List[float]
+
+        with freezegun.freeze_time(ignore=['mockredis.client', 'mockredis.clock', 'timeit']) as frozen_time:
+            def blpop(_keys, timeout):
+                timeouts.append(timeout)
+                frozen_time.tick(timeout)
+
+            shards = [mock.MagicMock(), mock.MagicMock()]
+            mock_standard.return_value.get_all_connections.return_value = shards
+            for shard in shards:
+                shard.lpop.return_value = None
+                shard.blpop.side_effect = blpop
+
+            with pytest.raises(MessageReceiveTimeout):
+                core.receive_message('test_receive_from_all_shards_blocks_no_longer_than_the_deadline')
+
+        # The second round blocks only for what is left of the receive timeout, not for another whole second
+        assert timeouts == [1, 0.5]
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_receive_from_all_shards_with_one_shard(self, mock_standard):
+        core = self._get_server_core(receive_from_all_shards=True)
+
+        connection = mock_standard.return_value.get_connection.return_value
+        mock_standard.return_value.get_all_connections.return_value = [connection]
+        connection.blpop.return_value = [
+            True,
+            MsgpackSerializer().dict_to_blob({'request_id': 15, 'meta': {}, 'body': {'foo': 'bar'}}),
+        ]
+
+        assert core.receive_message('test_receive_from_all_shards_with_one_shard')[0] == 15
+        connection.blpop.assert_called_once_with(['pysoa:test_receive_from_all_shards_with_one_shard'], timeout=5)
+        assert connection.lpop.call_count == 0
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_receive_from_all_shards_error(self, mock_standard):
+        core = self._get_server_core(receive_from_all_shards=True)
+
+        shards = [mock.MagicMock(), mock.MagicMock()]
+        mock_standard.return_value.get_all_connections.return_value = shards
+        shards[0].lpop.side_effect = redis.exceptions.ConnectionError('Nope')
+        shards[1].lpop.side_effect = redis.exceptions.ConnectionError('Nope')
+
+        with pytest.raises(MessageReceiveError):
+            core.receive_message('test_receive_from_all_shards_error')
+
+        mock_standard.return_value.get_all_connections.side_effect = CannotGetConnectionError('Also nope')
+
+        with pytest.raises(MessageReceiveError) as error_context:
+            core.receive_message('test_receive_from_all_shards_error')
+
+        assert error_context.value.args[0] == 'Cannot get connection: Also nope'
+
+    def test_priority_lanes_invalid(self):
+        with pytest.raises(ValueError) as error_context:
+            self._get_server_core(priority_lanes={'urgent': 5})
+        assert 'urgent' in error_context.value.args[0]
+
+        with pytest.raises(ValueError):
+            self._get_server_core(priority_lanes={'high': 0})
+
+        with pytest.raises(ValueError):
+            self._get_server_core(priority_lanes={}, receive_from_all_shards=True)
+
+        core = self._get_server_core(priority_lanes={'low': 3})
+        assert core.priority_lanes == {'high': 4, 'normal': 2, 'low': 3}
+
+    def test_priority_lanes_share_hash_slot_with_cluster(self):
+        # noinspection PyArgumentList
+        core = RedisTransportServerCore(backend_type=REDIS_BACKEND_TYPE_CLUSTER, priority_lanes={})
+
+        queue_keys = [core._get_queue_key(make_priority_queue_name('service.foo', p)) for p in REQUEST_PRIORITIES]
+        assert queue_keys == [
+            'pysoa:{service.foo}.priority.high',
+            'pysoa:{service.foo}',
+            'pysoa:{service.foo}.priority.low',
+        ]
+        assert len({key_slot(k) for k in queue_keys}) == 1
+
+        # Other backends leave the queue names alone
+        assert self._get_server_core()._get_queue_key('service.foo.priority.high') == 'pysoa:service.foo.priority.high'
+
+    def test_priority_lane_order(self):
+        core = self._get_server_core(priority_lanes={})
+
+        orders = [core._get_priority_lane_order() for _ in range(70)]
+
+        assert orders[0] == ['high', 'normal', 'low']
+        assert sum(1 for order in orders if order[0] == 'high') == 40
+        assert sum(1 for order in orders if order[0] == 'normal') == 20
+        assert sum(1 for order in orders if order[0] == 'low') == 10
+        for order in orders:
+            assert sorted(order) == ['high', 'low', 'normal']
+            assert [p for p in order[1:]] == [p for p in ('high', 'normal', 'low') if p != order[0]]
+
+    def test_receive_from_priority_lanes(self):
+        metrics = mock.MagicMock(spec=MetricsRecorder)
+        core = self._get_server_core(priority_lanes={}, metrics=metrics)
+        connection = core.backend_layer.get_connection('pysoa:test_receive_from_priority_lanes')
+
+        queues = [
+            'pysoa:test_receive_from_priority_lanes.priority.low',
+            'pysoa:test_receive_from_priority_lanes',
+            'pysoa:test_receive_from_priority_lanes.priority.high',
+        ]
+        for request_id, queue_key in enumerate(queues * 3):
+            meta = {'__sent__': time.time() - 2} if queue_key != queues[1] else {}
+            messages, _, _ = core._prepare_message(request_id, meta, {'test': request_id})
+            connection.rpush(queue_key, messages[0])
+
+        received = [core.receive_message('test_receive_from_priority_lanes').request_id for _ in range(9)]
+
+        # High-priority requests come first most of the time, but the normal and low lanes get their share
+        assert received == [2, 1, 5, 0, 8, 4, 7, 3, 6]
+
+        with pytest.raises(MessageReceiveTimeout):
+            core.receive_message('test_receive_from_priority_lanes', receive_timeout_in_seconds=1)
+
+        metrics.timer.assert_any_call(
+            'server.transport.redis_gateway.receive.priority.high.wait',
+            resolution=TimerResolution.MICROSECONDS,
+        )
+        metrics.timer.assert_any_call(
+            'server.transport.redis_gateway.receive.priority.low.wait',
+            resolution=TimerResolution.MICROSECONDS,
+        )
+        assert mock.call(
+            'server.transport.redis_gateway.receive.priority.normal.wait',
+            resolution=TimerResolution.MICROSECONDS,
+        ) not in metrics.timer.call_args_list
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_receive_chunking_on_server_requires_chunk_queue(self, mock_standard):
+        core = self._get_server_core()
+
+        message = {'request_id': 79, 'meta': {'yes': 'no'}, 'body': {'baz': 'qux'}}
+        serialized = MsgpackSerializer().dict_to_blob(message)
+
+        mock_standard.return_value.get_connection.return_value.blpop.side_effect = [
+            [True, (b'pysoa-redis/4//chunk-count:2;chunk-id:1;' + serialized[0:10])],
+        ]
+
+        with pytest.raises(InvalidMessageError) as error_context:
+            core.receive_message('test_receive_chunking_on_server_requires_chunk_queue')
+
+        assert 'Unsupported chunked request' in error_context.value.args[0]
+        assert mock_standard.return_value.pop_messages_from_queue.call_count == 0
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_receive_chunking_on_server_missing_chunks(self, mock_standard):
+        core = self._get_server_core()
+        mock_standard.return_value.get_colocated_connection.side_effect = lambda _key, connection: connection
+
+        message = {'request_id': 79, 'meta': {'yes': 'no'}, 'body': {'baz': 'qux'}}
+        serialized = MsgpackSerializer().dict_to_blob(message)
+
+        mock_standard.return_value.get_connection.return_value.blpop.side_effect = [
+            [True, (b'pysoa-redis/4//chunk-count:3;chunk-id:1;chunk-queue:a.b!c.chunks.79;' + serialized[0:10])],
+        ]
+        mock_standard.return_value.pop_messages_from_queue.return_value = [
+            b'pysoa-redis/4//chunk-count:3;chunk-id:2;' + serialized[10:20],
+        ]
+
+        with pytest.raises(InvalidMessageError) as error_context:
+            core.receive_message('test_receive_chunking_on_server_missing_chunks')
+
+        assert 'Invalid chunked request missing chunk 3 of 3' in error_context.value.args[0]
+        mock_standard.return_value.pop_messages_from_queue.assert_called_once_with(
+            queue_key='pysoa:a.b!c.chunks.79',
+            count=2,
+            connection=mock_standard.return_value.get_connection.return_value,
+        )
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_send_request_chunking_fails_if_protocol_version_does_not_support(self, mock_standard):
+        core = self._get_client_core(
+            chunk_messages_larger_than_bytes=102400,
+            maximum_message_size_in_bytes=102400 * 6,
+            protocol_version=ProtocolVersion.VERSION_4,
+        )
+
+        meta = {'protocol_version': ProtocolVersion.VERSION_3}
+        body = {'test': ['payload%i' % i for i in range(10000, 30000)]}  # 2.5 chunks needed
+
+        with pytest.raises(MessageTooLarge) as error_context:
+            core.send_message('test_send_request_chunking_fails_if_protocol_version_does_not_support', 17, meta, body)
+
+        assert 'protocol version does not support chunking' in error_context.value.args[0]
+        assert mock_standard.return_value.send_message_to_queue.call_count == 0
+        assert mock_standard.return_value.send_messages_to_queue.call_count == 0
+        assert mock_standard.return_value.send_all_messages_to_queue.call_count == 0
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_send_request_chunking_round_trip_interleaved(self, mock_standard):
+        server_core = self._get_server_core()
+        client_core_1 = self._get_client_core(
+            chunk_messages_larger_than_bytes=102400,
+            maximum_message_size_in_bytes=102400 * 6,
+            protocol_version=ProtocolVersion.VERSION_4,
+        )
+        client_core_2 = self._get_client_core(
+            chunk_messages_larger_than_bytes=102400,
+            maximum_message_size_in_bytes=102400 * 6,
+            protocol_version=ProtocolVersion.VERSION_4,
+        )
+
+        body_1 = {'test': ['payload%i' % i for i in range(10000, 30000)]}  # 2.5 chunks needed
+        body_2 = {'test': ['other%i' % i for i in range(10000, 50000)]}  # 4.2 chunks needed
+        body_3 = {'small': 'request'}
+
+        # Both clients use the same request ID, so only the reply-to queue keeps their chunks apart
+        queue_name = 'test_send_request_chunking_round_trip_interleaved'
+        client_core_1.send_message(queue_name, 41, {'reply_to': 'service.x.client1!'}, body_1)
+        client_core_2.send_message(queue_name, 41, {'reply_to': 'service.x.client2!'}, body_2)
+        client_core_2.send_message(queue_name, 42, {'reply_to': 'service.x.client2!'}, body_3)
+
+        # Only the first chunk of each request, plus the unchunked request, goes on the shared request queue
+        send_calls = mock_standard.return_value.send_message_to_queue.call_args_list
+        assert len(send_calls) == 3
+        assert all(c[1]['queue_key'] == 'pysoa:' + queue_name for c in send_calls)
+        assert b'chunk-id:1;chunk-queue:service.x.client1!.chunks.41;' in send_calls[0][1]['message']
+        assert b'chunk-id:1;chunk-queue:service.x.client2!.chunks.41;' in send_calls[1][1]['message']
+        assert b'chunk' not in send_calls[2][1]['message'][:50]
+
+        chunk_queues = {}
+        for c in mock_standard.return_value.send_all_messages_to_queue.call_args_list:
+            chunk_queues[c[1]['queue_key']] = c[1]['messages']
+        assert len(chunk_queues['pysoa:service.x.client1!.chunks.41']) == 2
+        assert len(chunk_queues['pysoa:service.x.client2!.chunks.41']) == 4
+
+        mock_standard.return_value.get_connection.return_value.blpop.side_effect = [
+            [True, c[1]['message']] for c in send_calls
+        ]
+        mock_standard.return_value.pop_messages_from_queue.side_effect = (
+            lambda queue_key, count, connection: chunk_queues.pop(queue_key)[:count]
+        )
+
+        request_id, meta, received_body = server_core.receive_message(queue_name)
+        assert request_id == 41
+        assert meta['reply_to'] == 'service.x.client1!'
+        assert meta['protocol_version'] == ProtocolVersion.VERSION_4
+        assert received_body == body_1
+
+        request_id, meta, received_body = server_core.receive_message(queue_name)
+        assert request_id == 41
+        assert meta['reply_to'] == 'service.x.client2!'
+        assert received_body == body_2
+
+        request_id, meta, received_body = server_core.receive_message(queue_name)
+        assert request_id == 42
+        assert meta['reply_to'] == 'service.x.client2!'
+        assert received_body == body_3
+
+        assert chunk_queues == {}
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.time.sleep')
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_send_request_chunking_cleans_up_chunks_if_request_queue_full(self, mock_standard, _mock_sleep):
+        core = self._get_client_core(
+            chunk_messages_larger_than_bytes=102400,
+            maximum_message_size_in_bytes=102400 * 6,
+            protocol_version=ProtocolVersion.VERSION_4,
+            queue_full_retries=1,
+        )
+
+        mock_standard.return_value.send_message_to_queue.side_effect = redis.exceptions.ResponseError('queue full')
+        mock_standard.return_value.get_colocated_connection.side_effect = lambda _key, connection: connection
+
+        body = {'test': ['payload%i' % i for i in range(10000, 30000)]}  # 2.5 chunks needed
+
+        with pytest.raises(MessageSendError) as error_context:
+            core.send_message('test_send_request_chunking_cleans_up', 19, {'reply_to': 'service.x.client!'}, body)
+
+        assert 'was full' in error_context.value.args[0]
+        mock_standard.return_value.get_connection.return_value.delete.assert_called_once_with(
+            'pysoa:service.x.client!.chunks.19',
+        )
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_receive_chunking_many_chunks_joined_once(self, mock_standard):
+        """
+        Reassembling a message with many chunks references each chunk's payload in place and joins them all once, at
+        the end, instead of appending each chunk to (and so copying) everything received so far.
+        """
+        client_core = self._get_client_core(maximum_message_size_in_bytes=1024 * 1024 * 50)
+
+        chunk_count = 400
+        data = b'x' * (chunk_count * 1024)
+        serialized = MsgpackSerializer().dict_to_blob({'request_id': 27, 'meta': {}, 'body': {'data': data}})
+        chunk_size = int(math.ceil(len(serialized) / float(chunk_count)))
+        connection = mock_standard.return_value.get_connection.return_value
+        connection.blpop.side_effect = [
+            [True, b'pysoa-redis/3//content-type:application/msgpack;chunk-count:%d;chunk-id:%d;' % (
+                chunk_count,
+                i + 1,
+            ) + serialized[i * chunk_size:(i + 1) * chunk_size]]
+            for i in range(chunk_count)
+        ]
+
+        with mock.patch(
+            'pysoa.common.transport.redis_gateway.core.memoryview',
+            side_effect=memoryview,
+            create=True,
+        ) as mock_memoryview:
+            request_id, _, body = client_core.receive_message('test_receive_chunking_many_chunks')
+
+        assert request_id == 27
+        assert body['data'] == data
+        assert connection.blpop.call_count == chunk_count
+        assert mock_memoryview.call_count == chunk_count - 1
+
+    def test_compression_not_supported_on_client_before_version_5(self):
+        with pytest.raises(ValueError) as error_context:
+            self._get_client_core(compress_messages_larger_than_bytes=1024, protocol_version=ProtocolVersion.VERSION_4)
+
+        assert 'protocol_version must be at least 5' in error_context.value.args[0]
+
+        core = self._get_client_core(
+            compress_messages_larger_than_bytes=1024,
+            protocol_version=ProtocolVersion.VERSION_5,
+        )
+        assert core.compress_messages_larger_than_bytes == 1024
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_compression_round_trip(self, mock_standard):
+        metrics = mock.MagicMock(spec=MetricsRecorder)
+        client_core = self._get_client_core(
+            compress_messages_larger_than_bytes=1024,
+            protocol_version=ProtocolVersion.VERSION_5,
+            metrics=metrics,
+        )
+        server_core = self._get_server_core(compress_messages_larger_than_bytes=1024)
+
+        body = {'users': [{'first_name': 'Jane', 'last_name': 'Doe', 'id': i} for i in range(500)]}
+
+        client_core.send_message('test_compression_round_trip', 71, {'reply_to': 'test_compression_round_trip!'}, body)
+
+        message = mock_standard.return_value.send_message_to_queue.call_args[1]['message']
+        assert message.startswith(b'pysoa-redis/5//content-type:application/msgpack;content-encoding:zlib;')
+        assert len(message) < len(MsgpackSerializer().dict_to_blob(body)) / 4
+
+        metrics.histogram.assert_any_call('client.transport.redis_gateway.send.compression.bytes_before')
+        metrics.histogram.assert_any_call('client.transport.redis_gateway.send.compression.bytes_after')
+
+        mock_standard.return_value.get_connection.return_value.blpop.return_value = [True, message]
+        request_id, meta, received_body = server_core.receive_message('test_compression_round_trip')
+
+        assert request_id == 71
+        assert meta['protocol_version'] == ProtocolVersion.VERSION_5
+        assert received_body == body
+
+        # The server compresses the response, too, because the request says the client understands compression
+        server_core.send_message('test_compression_round_trip!', 71, meta, {'response': body})
+
+        message = mock_standard.return_value.send_message_to_queue.call_args[1]['message']
+        assert message.startswith(b'pysoa-redis/5//content-type:application/msgpack;content-encoding:zlib;')
+
+        mock_standard.return_value.get_connection.return_value.blpop.return_value = [True, message]
+        request_id, _, received_body = client_core.receive_message('test_compression_round_trip!')
+
+        assert request_id == 71
+        assert received_body == {'response': body}
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_compression_skipped_below_threshold_or_for_older_clients(self, mock_standard):
+        core = self._get_server_core(compress_messages_larger_than_bytes=1024)
+
+        core.send_message('test_compression_skipped', 72, {'protocol_version': ProtocolVersion.VERSION_5}, {'a': 'b'})
+        message = mock_standard.return_value.send_message_to_queue.call_args[1]['message']
+        assert message.startswith(b'pysoa-redis/5//content-type:application/msgpack;\x83')
+
+        body = {'test': ['payload'] * 1000}
+        core.send_message('test_compression_skipped', 73, {'protocol_version': ProtocolVersion.VERSION_4}, body)
+        message = mock_standard.return_value.send_message_to_queue.call_args[1]['message']
+        assert b'content-encoding' not in message
+        assert message.endswith(MsgpackSerializer().dict_to_blob(body)[-100:])
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_compression_applied_before_chunking(self, mock_standard):
+        server_core = self._get_server_core(
+            chunk_messages_larger_than_bytes=102400,
+            maximum_message_size_in_bytes=102400 * 6,
+            compress_messages_larger_than_bytes=0,
+            compression_codec_config={'object': ZlibCodec, 'kwargs': {'level': 1}},
+        )
+        client_core = self._get_client_core()
+
+        # Random data does not compress, so this still needs 2.5 chunks, but it would be too large to send uncompressed
+        random_data = os.urandom(250000)
+        body = {'random': random_data, 'repeated': ['payload'] * 200000}
+
+        meta = {'protocol_version': ProtocolVersion.VERSION_5}
+        server_core.send_message('test_compression_applied_before_chunking', 74, meta, body)
+
+        messages = mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages']
+        assert len(messages) == 3
+        for message in messages:
+            assert message.startswith(b'pysoa-redis/5//content-type:application/msgpack;content-encoding:zlib;')
+
+        mock_standard.return_value.get_connection.return_value.blpop.side_effect = [[True, m] for m in messages]
+        request_id, _, received_body = client_core.receive_message('test_compression_applied_before_chunking')
+
+        assert request_id == 74
+        assert received_body == body
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_receive_unsupported_content_encoding(self, mock_standard):
+        core = self._get_client_core()
+
+        mock_standard.return_value.get_connection.return_value.blpop.return_value = [
+            True,
+            b'pysoa-redis/5//content-type:application/msgpack;content-encoding:brotli;garbage',
+        ]
+
+        with pytest.raises(InvalidMessageError) as error_context:
+            core.receive_message('test_receive_unsupported_content_encoding')
+
+        assert 'Unsupported content encoding brotli' in error_context.value.args[0]
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_send_routing_headers(self, mock_standard):
+        core = self._get_client_core(protocol_version=ProtocolVersion.VERSION_6)
+
+        core.send_message(
+            'test_send_routing_headers',
+            81,
+            {'reply_to': 'test_send_routing_headers!'},
+            {'control': {}, 'actions': [{'action': 'get_user', 'body': {}}, {'action': 'get_event.v2'}]},
+        )
+
+        message = mock_standard.return_value.send_message_to_queue.call_args[1]['message']
+        assert message.startswith(b'pysoa-redis/6//content-type:application/msgpack;expiry:')
+
+        headers, serialized_message = RedisTransportCore._extract_supported_headers(
+            ProtocolVersion.extract_version(message)[1],
+        )
+        assert headers['request-id'] == '81'
+        assert headers['actions'] == 'get_user,get_event.v2'
+        assert float(headers['expiry']) == MsgpackSerializer().blob_to_dict(serialized_message)['meta']['__expiry__']
+        assert float(headers['expiry']) - float(headers['sent']) == pytest.approx(core.message_expiry_in_seconds)
+
+        # Action names with characters not permitted in headers are left out rather than breaking the message
+        core.send_message('test_send_routing_headers', 82, {}, {'actions': [{'action': 'get:user;'}]})
+
+        message = mock_standard.return_value.send_message_to_queue.call_args[1]['message']
+        headers, _ = RedisTransportCore._extract_supported_headers(ProtocolVersion.extract_version(message)[1])
+        assert headers['request-id'] == '82'
+        assert 'actions' not in headers
+
+        # Older protocol versions do not get the headers
+        core.send_message('test_send_routing_headers', 83, {'protocol_version': ProtocolVersion.VERSION_5}, {})
+
+        message = mock_standard.return_value.send_message_to_queue.call_args[1]['message']
+        headers, _ = RedisTransportCore._extract_supported_headers(ProtocolVersion.extract_version(message)[1])
+        assert headers == {'content-type': 'application/msgpack'}
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_receive_drops_expired_message_without_deserializing(self, mock_standard):
+        metrics = mock.MagicMock(spec=MetricsRecorder)
+        core = self._get_server_core(prefetch_count=2, metrics=metrics)
+
+        valid = MsgpackSerializer().dict_to_blob(
+            {'request_id': 85, 'meta': {'__expiry__': time.time() + 10}, 'body': {}},
+        )
+        mock_standard.return_value.get_connection.return_value.blpop.return_value = [
+            True,
+            b'pysoa-redis/6//content-type:application/msgpack;expiry:%d;request-id:84;not a valid message' % (
+                int(time.time()) - 1,
+            ),
+        ]
+        mock_standard.return_value.pop_messages_from_queue.return_value = [
+            b'pysoa-redis/6//content-type:application/msgpack;expiry:%d;request-id:85;' % (int(time.time()) + 10, ) +
+            valid,
+        ]
+
+        with mock.patch.object(MsgpackSerializer, 'blob_to_dict', wraps=MsgpackSerializer().blob_to_dict) as mock_b2d:
+            request_id, _, _ = core.receive_message('test_receive_drops_expired_message_without_deserializing')
+
+        assert request_id == 85
+        assert mock_b2d.call_count == 1
+        metrics.counter.assert_any_call('server.transport.redis_gateway.receive.message_expired_before_deserialize')
+        metrics.counter.assert_any_call('server.transport.redis_gateway.receive.error.message_expired')
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_receive_drops_expired_chunked_response_without_reassembling(self, mock_standard):
+        server_core = self._get_server_core(
+            chunk_messages_larger_than_bytes=102400,
+            maximum_message_size_in_bytes=102400 * 6,
+        )
+        client_core = self._get_client_core()
+
+        body = {'test': ['payload%i' % i for i in range(10000, 30000)]}  # 2.5 chunks needed
+        meta = {'protocol_version': ProtocolVersion.VERSION_6}
+
+        server_core.send_message('test_receive_drops_expired_chunked_response', 86, meta, body, 1)
+        chunks = mock_standard.return_value.send_all_messages_to_queue.call_args[1]['messages']
+        assert len(chunks) == 3
+        for chunk in chunks:
+            assert b';expiry:' in chunk[:200]
+
+        mock_standard.return_value.get_connection.return_value.blpop.side_effect = [[True, c] for c in chunks]
+        with freezegun.freeze_time(ignore=['timeit']) as frozen_time:
+            frozen_time.tick(datetime.timedelta(seconds=2))
+            with mock.patch.object(MsgpackSerializer, 'blob_to_dict') as mock_b2d, \
+                    mock.patch.object(client_core, '_find_supported_headers') as mock_find_headers, \
+                    pytest.raises(MessageReceiveTimeout) as error_context:
+                client_core.receive_message('test_receive_drops_expired_chunked_response')
+
+        assert 'expired' in error_context.value.args[0]
+        assert mock_b2d.call_count == 0
+        # The remaining chunks are drained from the response queue, but their headers are never parsed
+        assert mock_find_headers.call_count == 0
+        assert mock_standard.return_value.get_connection.return_value.blpop.call_count == 3
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_receive_drops_expired_chunked_request_without_receiving_chunks(self, mock_standard):
+        server_core = self._get_server_core()
+        client_core = self._get_client_core(
+            chunk_messages_larger_than_bytes=102400,
+            maximum_message_size_in_bytes=102400 * 6,
+            message_expiry_in_seconds=1,
+            protocol_version=ProtocolVersion.VERSION_6,
+        )
+
+        body = {'test': ['payload%i' % i for i in range(10000, 30000)]}  # 2.5 chunks needed
+        queue_name = 'test_receive_drops_expired_chunked_request'
+        client_core.send_message(queue_name, 87, {'reply_to': 'service.x.client1!'}, body)
+
+        first_chunk = mock_standard.return_value.send_message_to_queue.call_args[1]['message']
+        assert b'chunk-id:1;chunk-queue:service.x.client1!.chunks.87;' in first_chunk
+        connection = mock_standard.return_value.get_connection.return_value
+        connection.blpop.return_value = [True, first_chunk]
+        mock_standard.return_value.get_colocated_connection.return_value = connection
+
+        with freezegun.freeze_time(ignore=['timeit']) as frozen_time:
+            frozen_time.tick(datetime.timedelta(seconds=2))
+            with mock.patch.object(MsgpackSerializer, 'blob_to_dict') as mock_b2d, \
+                    pytest.raises(MessageReceiveTimeout) as error_context:
+                server_core.receive_message(queue_name)
+
+        assert 'expired' in error_context.value.args[0]
+        assert mock_b2d.call_count == 0
+        assert mock_standard.return_value.pop_messages_from_queue.call_count == 0
+        connection.delete.assert_called_once_with('pysoa:service.x.client1!.chunks.87')
+
+    @mock.patch('pysoa.common.transport.redis_gateway.core.StandardRedisClient')
+    def test_receive_invalid_expiry_header(self, mock_standard):
+        core = self._get_server_core()
+
+        mock_standard.return_value.get_connection.return_value.blpop.return_value = [
+            True,
+            b'pysoa-redis/6//content-type:application/msgpack;expiry:soon;garbage',
+        ]
+
+        with pytest.raises(InvalidMessageError) as error_context:
+            core.receive_message('test_receive_invalid_expiry_header')
+
+        assert 'Invalid expiry header soon' in error_context.value.args[0]
+
+
+class TestCodec(object):
+    def test_codec_registry(self):
+        assert 'zlib' in Codec.all_supported_encodings
+        assert isinstance(Codec.resolve_codec('zlib'), ZlibCodec)
+
+        with pytest.raises(ValueError):
+            Codec.resolve_codec('not-a-codec')
+
+        with pytest.raises(ValueError):
+            # noinspection PyUnusedLocal
+            class DuplicateCodec(ZlibCodec):
+                pass
+
+    def test_zlib_codec(self):
+        data = b'{"hello": "world"}' * 100
+
+        compressed = ZlibCodec(level=9).compress(data)
+        assert len(compressed) < len(data)
+        assert ZlibCodec().decompress(compressed) == data
@@ -0,0 +1,192 @@
+from __future__ import (
+    absolute_import,
+    unicode_literals,
+)
+
+import concurrent.futures
+import threading
+import time
+from typing import (
+    Dict,
+    List,
+)
+import unittest
+
+from pymetrics.recorders.noop import noop_metrics
+import six
+
+from pysoa.client.client import Client
+from pysoa.common.transport.errors import MessageReceiveTimeout
+from pysoa.common.transport.redis_gateway.client import RedisClientTransport
+from pysoa.common.transport.redis_gateway.constants import (
+    REDIS_BACKEND_TYPE_STANDARD,
+    RESPONSE_ID_META_KEY,
+)
+from pysoa.common.transport.redis_gateway.demultiplexer import ResponseDemultiplexer
+from pysoa.common.transport.redis_gateway.server import RedisServerTransport
+
+
+class _FakeBackend(object):
+    """
+    A thread-safe fake Redis backend, because the demultiplexer receives responses in its own thread.
+    """
+    def __init__(self):
+        self._container = {}  # type: Dict[six.text_type, List[six.binary_type]]
+        self._lock = threading.Lock()
+
+    def get_connection(self, *_):
+        return self
+
+    def send_message_to_queue(self, queue_key, message, *_, **__):
+        with self._lock:
+            self._container.setdefault(queue_key, list()).append(message)
+
+    def record_request_queue_send(self, *_, **__):
+        pass
+
+    def blpop(self, keys, *_, **__):
+        with self._lock:
+            if self._container.get(keys[0]):
+                return [keys[0], self._container[keys[0]].pop(0)]
+        time.sleep(0.01)
+        return None
+
+
+class TestResponseDemultiplexer(unittest.TestCase):
+    def setUp(self):
+        ResponseDemultiplexer._instances.clear()
+        self.backend = _FakeBackend()
+
+    def _get_client_transport(self, service_name='demux', **kwargs):
+        transport = RedisClientTransport(
+            service_name,
+            noop_metrics,
+            backend_type=REDIS_BACKEND_TYPE_STANDARD,
+            demultiplex_responses=True,
+            **kwargs
+        )
+        transport.core._backend_layer = self.backend  # type: ignore
+        assert transport._demultiplexer is not None
+        transport._demultiplexer.core._backend_layer = self.backend  # type: ignore
+        return transport
+
+    def _respond(self, service_name='demux', count=1, body=None):
+        server_transport = RedisServerTransport(service_name, noop_metrics, 1, backend_type=REDIS_BACKEND_TYPE_STANDARD)
+        server_transport.core._backend_layer = self.backend  # type: ignore
+        for _ in range(count):
+            request_id, meta, request_body = server_transport.receive_request_message()
+            server_transport.send_response_message(request_id, meta, body or request_body)
+
+    def test_one_instance_per_redis_configuration(self):
+        transport_1 = self._get_client_transport('demux_1')
+        transport_2 = self._get_client_transport('demux_2')
+        transport_3 = RedisClientTransport(
+            'demux_1',
+            noop_metrics,
+            backend_type=REDIS_BACKEND_TYPE_STANDARD,
+            backend_layer_kwargs={'hosts': [('169.254.7.1', 6379)]},
+            demultiplex_responses=True,
+        )
+        transport_4 = RedisClientTransport('demux_1', noop_metrics, backend_type=REDIS_BACKEND_TYPE_STANDARD)
+
+        self.assertIs(transport_1._demultiplexer, transport_2._demultiplexer)
+        self.assertIsNot(transport_1._demultiplexer, transport_3._demultiplexer)
+        self.assertIsNone(transport_4._demultiplexer)
+
+        # All clients in the process share the same response queue
+        assert transport_1._demultiplexer is not None
+        self.assertEqual(transport_1._demultiplexer.queue_name, transport_1._get_reply_to())
+        self.assertEqual(transport_1._get_reply_to(), transport_2._get_reply_to())
+        self.assertTrue(transport_1._get_reply_to().endswith('!'))
+
+        with self.assertRaises(ValueError):
+            transport_4.get_response_future(1)
+
+    def test_responses_routed_to_their_clients(self):
+        transport_1 = self._get_client_transport()
+        transport_2 = self._get_client_transport()
+
+        # Both clients use the same request IDs, which only the response IDs tell apart
+        transport_1.send_request_message(1, {}, {'client': 1, 'request': 1})
+        transport_2.send_request_message(1, {}, {'client': 2, 'request': 1})
+        transport_1.send_request_message(2, {}, {'client': 1, 'request': 2})
+        self.assertEqual(2, transport_1.requests_outstanding)
+        self.assertEqual(1, transport_2.requests_outstanding)
+
+        self._respond(count=3)
+
+        request_id, meta, body = transport_2.receive_response_message()
+        self.assertEqual(1, request_id)
+        self.assertEqual({'client': 2, 'request': 1}, body)
+        self.assertNotIn(RESPONSE_ID_META_KEY, meta)
+        self.assertEqual(0, transport_2.requests_outstanding)
+        self.assertEqual((None, None, None), transport_2.receive_response_message())
+
+        self.assertEqual(
+            [(1, {'client': 1, 'request': 1}), (2, {'client': 1, 'request': 2})],
+            [transport_1.receive_response_message()[::2] for _ in range(2)],
+        )
+        self.assertEqual(0, transport_1.requests_outstanding)
+
+    def test_futures_complete_on_their_own(self):
+        transport = self._get_client_transport()
+
+        for request_id in range(1, 6):
+            transport.send_request_message(request_id, {}, {'request': request_id})
+        futures = {request_id: transport.get_response_future(request_id) for request_id in range(1, 6)}
+        self.assertEqual(0, transport.requests_outstanding)
+
+        with self.assertRaises(ValueError):
+            transport.get_response_future(1)
+
+        callback_results = []
+        futures[3].add_done_callback(lambda f: callback_results.append(f.result().body))
+
+        responder = threading.Thread(target=self._respond, kwargs={'count': 5})
+        responder.start()
+
+        completed = [f.result().request_id for f in concurrent.futures.as_completed(futures.values(), timeout=5)]
+        responder.join(timeout=5)
+
+        self.assertEqual([1, 2, 3, 4, 5], sorted(completed))
+        self.assertEqual([{'request': 3}], callback_results)
+
+        done, not_done = concurrent.futures.wait(futures.values(), timeout=0)
+        self.assertEqual(5, len(done))
+        self.assertEqual(0, len(not_done))
+
+    def test_expired_futures_fail(self):
+        transport = self._get_client_transport()
+        assert transport._demultiplexer is not None
+
+        future = transport._demultiplexer.register('nobody.1', 0)
+        with self.assertRaises(MessageReceiveTimeout):
+            future.result(timeout=5)
+        self.assertEqual(0, transport._demultiplexer.futures_outstanding)
+
+        transport.send_request_message(1, {}, {'request': 1})
+        with self.assertRaises(MessageReceiveTimeout):
+            transport.receive_response_message(receive_timeout_in_seconds=1)
+        self.assertEqual(1, transport.requests_outstanding)
+
+    def test_client_response_future(self):
+        client = Client({
+            'demux': {
+                'transport': {
+                    'path': 'pysoa.common.transport.redis_gateway.client:RedisClientTransport',
+                    'kwargs': {'backend_type': REDIS_BACKEND_TYPE_STANDARD, 'demultiplex_responses': True},
+                },
+            },
+        })
+        transport = client._get_handler('demux').transport
+        transport.core._backend_layer = self.backend  # type: ignore
+        transport._demultiplexer.core._backend_layer = self.backend  # type: ignore
+
+        request_id = client.send_request('demux', [{'action': 'hello'}])
+        future = client.get_response_future('demux', request_id)
+
+        self._respond(body={'actions': [{'action': 'hello', 'body': {'greeting': 'hi'}}]})
+
+        response = future.result(timeout=5)
+        self.assertEqual({'greeting': 'hi'}, response.actions[0].body)
+        self.assertEqual([], list(client.get_all_responses('demux')))
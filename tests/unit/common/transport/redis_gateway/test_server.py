@@ -109,3 +109,10 @@ class TestServerTransport(unittest.TestCase):
             meta,
             message,
         )
+
+    def test_shutdown_returns_prefetched_messages(self, mock_core):
+        transport = self._get_transport()
+
+        transport.shutdown()
+
+        mock_core.return_value.return_prefetched_messages.assert_called_once_with()
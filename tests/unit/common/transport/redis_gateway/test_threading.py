@@ -36,6 +36,9 @@ class _FakeBackend(object):
         # print('\n    - send: {} / {} / {}\n'.format(queue_key, type(message), message))
         self._container.setdefault(queue_key, list()).append(message)
 
+    def record_request_queue_send(self, *_, **__):
+        pass
+
     def blpop(self, keys, *_, **__):
         if self._container.get(keys[0]):
             message = self._container[keys[0]].pop(0)
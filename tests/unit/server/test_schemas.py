@@ -8,6 +8,7 @@ import uuid
 import pytest
 import six
 
+from pysoa.common.constants import REQUEST_PRIORITIES
 from pysoa.server.schemas import (
     ActionRequestSchema,
     ContextHeaderSchema,
@@ -38,6 +39,16 @@ class TestControlHeaderSchema:
         assert len(errors) == 1
         assert errors[0].pointer == 'continue_on_error'
 
+    def test_priority(self, control_header):
+        for priority in REQUEST_PRIORITIES:
+            control_header['priority'] = priority
+            assert not ControlHeaderSchema.errors(control_header)
+
+        control_header['priority'] = 'urgent'
+        errors = ControlHeaderSchema.errors(control_header)
+        assert len(errors) == 1
+        assert errors[0].pointer == 'priority'
+
 
 class TestContextHeaderSchema:
 
@@ -0,0 +1,243 @@
+from __future__ import (
+    absolute_import,
+    unicode_literals,
+)
+
+import asyncio
+import concurrent.futures
+import threading
+import time
+from typing import (
+    Any,
+    Dict,
+    List,
+    Tuple,
+)
+from unittest import TestCase
+
+from conformity import fields
+from pymetrics.recorders.noop import noop_metrics
+import six
+
+from pysoa.common.constants import ERROR_CODE_ACTION_TIMEOUT
+from pysoa.common.logging import PySOALogContextFilter
+from pysoa.common.transport.base import ServerTransport
+from pysoa.common.transport.errors import MessageReceiveTimeout
+from pysoa.server.action.base import Action
+from pysoa.server.internal.metrics import ThreadSafeMetricsRecorder
+from pysoa.server.middleware import ServerMiddleware
+from pysoa.server.server import Server
+from pysoa.test import factories
+
+
+class SleepAction(Action):
+    cancelled = []  # type: List[six.text_type]
+
+    async def run(self, request):  # noqa: E999
+        started = time.time()
+        try:
+            await asyncio.sleep(request.body.get('seconds', 0.3))
+        except asyncio.CancelledError:
+            self.cancelled.append(request.context['correlation_id'])
+            raise
+        return {
+            'started': started,
+            'request_id': PySOALogContextFilter.get_logging_request_context()['request_id'],
+            'action_name': PySOALogContextFilter.get_logging_action_name(),
+        }
+
+
+class SyncAction(Action):
+    def run(self, request):
+        return {'thread': threading.current_thread().name}
+
+
+class ConcurrentJobsServer(Server):
+    service_name = 'test_service'
+    action_class_map = {
+        'sleep': SleepAction,
+        'sync': SyncAction,
+    }
+
+
+class RecordingMiddleware(ServerMiddleware):
+    jobs = []  # type: List[six.text_type]
+    actions = []  # type: List[six.text_type]
+
+    def job(self, process):
+        def handler(request):
+            self.jobs.append(request.context['correlation_id'])
+            return process(request)
+        return handler
+
+    def action(self, process):
+        def handler(request):
+            self.actions.append(request.action)
+            return process(request)
+        return handler
+
+
+@fields.ClassConfigurationSchema.provider(fields.Dictionary({}))
+class QueueServerTransport(ServerTransport):
+    def __init__(self, service_name, metrics=noop_metrics, instance_index=1):
+        super(QueueServerTransport, self).__init__(service_name, metrics, instance_index)
+        self.requests = []  # type: List[Tuple[int, Dict[six.text_type, Any], Dict[six.text_type, Any]]]
+        self.responses = {}  # type: Dict[int, Dict[six.text_type, Any]]
+        self.received = []  # type: List[Tuple[int, float]]
+
+    def receive_request_message(self):
+        if not self.requests:
+            raise MessageReceiveTimeout()
+        request = self.requests.pop(0)
+        self.received.append((request[0], time.time()))
+        return request
+
+    def send_response_message(self, request_id, meta, body):
+        self.responses[request_id] = body
+
+
+def _make_job(request_id, *actions):
+    return (
+        request_id,
+        {},
+        {
+            'control': {'continue_on_error': False},
+            'context': {'switches': [], 'correlation_id': six.text_type(request_id)},
+            'actions': [{'action': action, 'body': body} for action, body in actions],
+        },
+    )
+
+
+class TestConcurrentJobs(TestCase):
+    def setUp(self):
+        RecordingMiddleware.jobs = []
+        RecordingMiddleware.actions = []
+        SleepAction.cancelled = []
+
+    def _make_server(self, max_concurrent_jobs, harakiri_timeout=300):
+        settings = factories.ServerSettingsFactory(data={
+            'max_concurrent_jobs': max_concurrent_jobs,
+            'harakiri': {'timeout': harakiri_timeout, 'shutdown_grace': 30},
+        })
+        settings['middleware'].append({'object': RecordingMiddleware})
+        server = ConcurrentJobsServer(settings=settings)
+        server.transport = QueueServerTransport(server.service_name)
+
+        # This is what `Server.run` does before its loop
+        assert server._async_event_loop_thread is not None
+        server._async_event_loop_thread.start()
+        if max_concurrent_jobs > 1:
+            server._concurrent_job_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent_jobs)
+        self.addCleanup(self._stop_server, server)
+
+        return server
+
+    @staticmethod
+    def _stop_server(server):
+        if server._concurrent_job_executor:
+            server._wait_for_concurrent_jobs(0, stop_on_shutdown=False)
+            server._concurrent_job_executor.shutdown()
+        assert server._async_event_loop_thread is not None
+        server._async_event_loop_thread.join()
+
+    @staticmethod
+    def _handle_requests(server, count):
+        while len(server.transport.responses) < count:
+            server.handle_next_request()
+
+    def test_coroutine_action_without_concurrency(self):
+        server = self._make_server(1)
+        self.assertNotIsInstance(server.metrics, ThreadSafeMetricsRecorder)
+        server.transport.requests.append(_make_job(1, ('sleep', {'seconds': 0.01}), ('sync', {})))
+
+        server.handle_next_request()
+
+        response = server.transport.responses[1]
+        self.assertEqual([], response['errors'])
+        self.assertEqual(1, response['actions'][0]['body']['request_id'])
+        self.assertEqual('sleep', response['actions'][0]['body']['action_name'])
+        self.assertEqual(threading.current_thread().name, response['actions'][1]['body']['thread'])
+
+    def test_coroutine_jobs_run_concurrently(self):
+        server = self._make_server(4)
+        self.assertIsInstance(server.metrics, ThreadSafeMetricsRecorder)
+        server.transport.requests.extend(_make_job(i, ('sleep', {'seconds': 0.5})) for i in range(1, 5))
+
+        start = time.time()
+        self._handle_requests(server, 4)
+        elapsed = time.time() - start
+
+        self.assertLess(elapsed, 1.5)
+        for i in range(1, 5):
+            response = server.transport.responses[i]
+            self.assertEqual([], response['errors'])
+            self.assertEqual(i, response['actions'][0]['body']['request_id'])
+            self.assertEqual('sleep', response['actions'][0]['body']['action_name'])
+
+        self.assertEqual(['1', '2', '3', '4'], sorted(RecordingMiddleware.jobs))
+        self.assertEqual(['sleep'] * 4, RecordingMiddleware.actions)
+        # Jobs finish up just after sending their responses
+        server._wait_for_concurrent_jobs(0, stop_on_shutdown=False)
+        self.assertEqual(0, len(server._concurrent_jobs))
+        self.assertIsNone(PySOALogContextFilter.get_logging_request_context())
+
+    def test_backpressure(self):
+        server = self._make_server(2)
+        server.transport.requests.extend(_make_job(i, ('sleep', {'seconds': 0.5})) for i in range(1, 4))
+
+        self._handle_requests(server, 3)
+
+        received = dict(server.transport.received)
+        self.assertLess(received[2] - received[1], 0.25)
+        # The third request was not received until one of the first two jobs finished
+        self.assertGreater(received[3] - received[1], 0.4)
+
+    def test_sync_jobs_run_in_the_main_thread(self):
+        server = self._make_server(2)
+        server.transport.requests.extend([
+            _make_job(1, ('sleep', {'seconds': 0.5})),
+            _make_job(2, ('sleep', {'seconds': 0.01}), ('sync', {})),
+            _make_job(3, ('status', {})),
+        ])
+
+        server.handle_next_request()
+        self.assertEqual(1, len(server._concurrent_jobs))
+
+        server.handle_next_request()
+        self.assertIn(2, server.transport.responses)
+        self.assertEqual(
+            threading.current_thread().name,
+            server.transport.responses[2]['actions'][1]['body']['thread'],
+        )
+
+        server.handle_next_request()
+        self.assertIn(3, server.transport.responses)
+        self.assertNotIn(1, server.transport.responses)
+
+        self._handle_requests(server, 3)
+        self.assertEqual([], server.transport.responses[1]['errors'])
+
+    def test_harakiri_interrupts_only_the_overdue_job(self):
+        server = self._make_server(2, harakiri_timeout=1)
+        server.transport.requests.extend([
+            _make_job(1, ('sleep', {'seconds': 30}), ('sleep', {'seconds': 0.01})),
+            _make_job(2, ('sleep', {'seconds': 0.1})),
+        ])
+
+        start = time.time()
+        self._handle_requests(server, 2)
+
+        self.assertLess(time.time() - start, 5)
+        self.assertFalse(server.shutting_down)
+        self.assertEqual([], server.transport.responses[2]['errors'])
+
+        response = server.transport.responses[1]
+        self.assertEqual(1, len(response['actions']))
+        self.assertEqual(ERROR_CODE_ACTION_TIMEOUT, response['actions'][0]['errors'][0]['code'])
+
+        # The interrupted coroutine was cancelled
+        for _ in range(50):
+            if SleepAction.cancelled:
+                break
+            time.sleep(0.01)
+        self.assertEqual(['1'], SleepAction.cancelled)
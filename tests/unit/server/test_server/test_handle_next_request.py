@@ -3,16 +3,26 @@ from __future__ import (
     unicode_literals,
 )
 
-from typing import Mapping
+from typing import (
+    Dict,
+    List,
+    Mapping,
+)
 from unittest import TestCase
 
 from conformity import fields
+from pymetrics.recorders.base import MetricsRecorder
 import six
 
-from pysoa.common.transport.base import ServerTransport
+from pysoa.common.transport.base import (
+    QueueStats,
+    ServerTransport,
+)
+from pysoa.common.transport.errors import MessageReceiveError
 from pysoa.server.server import Server
 from pysoa.server.types import ActionType
 from pysoa.test import factories
+from pysoa.test.compatibility import mock
 
 
 class HandleNextRequestServer(Server):
@@ -56,3 +66,47 @@ class TestProcessNextRequests(TestCase):
         errors = response['errors']
         self.assertEqual(len(errors), 3)
         self.assertEqual({'actions', 'control', 'context'}, set([e.get('field', None) for e in errors]))
+
+    def test_request_queue_stats_published_at_interval(self):
+        settings = factories.ServerSettingsFactory(data={'queue_stats_interval_in_seconds': 10})
+        server = HandleNextRequestServer(settings=settings)
+        server.transport = SimplePassthroughServerTransport(server.service_name)
+        server.metrics = mock.MagicMock(spec=MetricsRecorder)
+        gauges = {}  # type: Dict[six.text_type, List[int]]
+        server.metrics.gauge.side_effect = lambda name: mock.MagicMock(
+            set=lambda value: gauges.setdefault(name, []).append(value),
+        )
+
+        # The default transport implementation does not support queue stats
+        server.perform_idle_actions()
+        self.assertEqual({}, gauges)
+
+        server._queue_stats_last_publish = 0.0
+        with mock.patch.object(server.transport, 'get_request_queue_stats') as mock_get_stats:
+            mock_get_stats.return_value = [
+                QueueStats(priority='high', shard=0, depth=3, oldest_message_age_in_seconds=1.5),
+                QueueStats(priority='normal', shard=0, depth=0, oldest_message_age_in_seconds=None),
+                QueueStats(priority='high', shard=1, depth=4, oldest_message_age_in_seconds=0.25),
+                QueueStats(priority='normal', shard=1, depth=1, oldest_message_age_in_seconds=2.0),
+            ]
+            server.perform_idle_actions()
+            server.perform_post_request_actions()
+
+            self.assertEqual(1, mock_get_stats.call_count)
+            self.assertEqual({
+                'server.queue.depth': [8],
+                'server.queue.oldest_message_age': [2000],
+                'server.queue.shard.0.depth': [3],
+                'server.queue.shard.0.oldest_message_age': [1500],
+                'server.queue.shard.1.depth': [5],
+                'server.queue.shard.1.oldest_message_age': [2000],
+                'server.queue.priority.high.depth': [7],
+                'server.queue.priority.high.oldest_message_age': [1500],
+                'server.queue.priority.normal.depth': [1],
+                'server.queue.priority.normal.oldest_message_age': [2000],
+            }, gauges)
+
+            server._queue_stats_last_publish = 0.0
+            mock_get_stats.side_effect = MessageReceiveError('Nope')
+            server.perform_post_request_actions()
+            server.metrics.counter.assert_called_once_with('server.error.queue_stats')
@@ -3,9 +3,13 @@ from __future__ import (
     unicode_literals,
 )
 
+import time
 from unittest import TestCase
 
-from pysoa.common.constants import ERROR_CODE_INVALID
+from pysoa.common.constants import (
+    ERROR_CODE_DEADLINE_EXCEEDED,
+    ERROR_CODE_INVALID,
+)
 from pysoa.common.errors import Error
 from pysoa.server.errors import ActionError
 from pysoa.server.middleware import ServerMiddleware
@@ -147,3 +151,43 @@ class TestProcessJob(TestCase):
         # Make sure the middleware set a flag in it
         self.assertEqual(len(job_response.actions), 1)
         self.assertEqual(job_response.actions[0].body, {'middleware': True})
+
+    def test_job_deadline_from_message_expiry(self):
+        job_request = self.make_job('respond_empty', {})
+        self.server._set_job_deadline({'__expiry__': 1000}, job_request)
+        self.assertEqual(1000.0, job_request['context']['deadline'])
+
+        # An earlier deadline supplied by the caller is kept, and a later one is replaced
+        self.server._set_job_deadline({'__expiry__': 2000.0}, job_request)
+        self.assertEqual(1000.0, job_request['context']['deadline'])
+        self.server._set_job_deadline({'__expiry__': 500.0}, job_request)
+        self.assertEqual(500.0, job_request['context']['deadline'])
+
+        job_request = self.make_job('respond_empty', {})
+        self.server._set_job_deadline({}, job_request)
+        self.assertNotIn('deadline', job_request['context'])
+
+    def test_make_client_propagates_deadline(self):
+        deadline = time.time() + 30
+        client = self.server.make_client({'correlation_id': '1', 'switches': [], 'deadline': deadline})
+        self.assertEqual(deadline, client.deadline)
+        self.assertEqual(deadline, client.context['deadline'])
+
+        self.assertIsNone(self.server.make_client({'correlation_id': '1', 'switches': []}).deadline)
+
+    def test_deadline_exceeded_skips_actions(self):
+        job_request = self.make_job('respond_empty', {})
+        job_request['actions'].append({'action': 'respond_empty', 'body': {}})
+        job_request['context']['deadline'] = time.time() + 30
+        job_response = self.server.process_job(job_request)
+        self.assertEqual([], job_response.errors)
+        self.assertEqual(2, len(job_response.actions))
+
+        job_request = self.make_job('respond_empty', {})
+        job_request['actions'].append({'action': 'respond_empty', 'body': {}})
+        job_request['context']['deadline'] = time.time() - 1
+        job_response = self.server.process_job(job_request)
+        self.assertEqual([], job_response.actions)
+        self.assertEqual(1, len(job_response.errors))
+        self.assertEqual(ERROR_CODE_DEADLINE_EXCEEDED, job_response.errors[0].code)
+        self.assertIn('2 of 2 actions', job_response.errors[0].message)
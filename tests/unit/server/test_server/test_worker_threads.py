@@ -0,0 +1,208 @@
+from __future__ import (
+    absolute_import,
+    unicode_literals,
+)
+
+import signal
+import threading
+import time
+from typing import (
+    Any,
+    Dict,
+    List,
+    Tuple,
+    cast,
+)
+from unittest import TestCase
+
+from conformity import fields
+from pymetrics.recorders.base import MetricsRecorder
+from pymetrics.recorders.noop import noop_metrics
+import six
+from six.moves import queue
+
+from pysoa.common.constants import ERROR_CODE_ACTION_TIMEOUT
+from pysoa.common.logging import PySOALogContextFilter
+from pysoa.common.transport.base import ServerTransport
+from pysoa.common.transport.errors import (
+    MessageReceiveTimeout,
+    TransientPySOATransportError,
+)
+from pysoa.server.action.base import Action
+from pysoa.server.internal.metrics import ThreadSafeMetricsRecorder
+from pysoa.server.server import Server
+from pysoa.test import factories
+from pysoa.test.compatibility import mock
+
+
+class WorkAction(Action):
+    started = {}  # type: Dict[int, threading.Event]
+
+    def run(self, request):
+        # Rendezvous with the other jobs named in the request, which can only happen if they all run at the same time
+        request_id = PySOALogContextFilter.get_logging_request_context()['request_id']
+        self.started[request_id].set()
+        all_started = all(self.started[i].wait(10) for i in request.body.get('wait_for', []))
+
+        # Sleep in small steps, the way Python code that is busy doing something would run
+        for _ in range(int(request.body.get('seconds', 0) * 100)):
+            time.sleep(0.01)
+        return {
+            'thread': threading.current_thread().name,
+            'request_id': request_id,
+            'all_started': all_started,
+        }
+
+
+class WorkerThreadsServer(Server):
+    service_name = 'test_service'
+    action_class_map = {
+        'work': WorkAction,
+    }
+
+
+@fields.ClassConfigurationSchema.provider(fields.Dictionary({}))
+class QueueServerTransport(ServerTransport):
+    def __init__(self, service_name, metrics=noop_metrics, instance_index=1):
+        super(QueueServerTransport, self).__init__(service_name, metrics, instance_index)
+        self.requests = queue.Queue()  # type: queue.Queue
+        self.responses = {}  # type: Dict[int, Dict[six.text_type, Any]]
+        self.expected_responses = 0
+        self.server = None  # type: Any
+
+    def receive_request_message(self):
+        try:
+            return self.requests.get(timeout=0.05)
+        except queue.Empty:
+            raise MessageReceiveTimeout()
+
+    def send_response_message(self, request_id, meta, body):
+        self.responses[request_id] = body
+        if len(self.responses) >= self.expected_responses:
+            self.server.shutting_down = True
+
+
+def _make_job(request_id, seconds=0.0, wait_for=None):
+    body = {'seconds': seconds}  # type: Dict[six.text_type, Any]
+    if wait_for:
+        body['wait_for'] = wait_for
+    job = (
+        request_id,
+        {},
+        {
+            'control': {'continue_on_error': False},
+            'context': {'switches': [], 'correlation_id': six.text_type(request_id)},
+            'actions': [{'action': 'work', 'body': body}],
+        },
+    )  # type: Tuple[int, Dict[six.text_type, Any], Dict[six.text_type, Any]]
+    return job
+
+
+class TestWorkerThreads(TestCase):
+    def setUp(self):
+        self._signal_handlers = {s: signal.getsignal(s) for s in (signal.SIGINT, signal.SIGTERM, signal.SIGALRM)}
+
+    def tearDown(self):
+        signal.alarm(0)
+        for signal_number, handler in self._signal_handlers.items():
+            signal.signal(signal_number, handler)
+
+    @staticmethod
+    def _make_server(worker_threads, harakiri_timeout=300):
+        settings = factories.ServerSettingsFactory(data={
+            'worker_threads': worker_threads,
+            'harakiri': {'timeout': harakiri_timeout, 'shutdown_grace': 30},
+        })
+        server = WorkerThreadsServer(settings=settings)
+        server.transport = QueueServerTransport(server.service_name)
+        server.transport.server = server
+        return server
+
+    @staticmethod
+    def _run(server, jobs):  # type: (WorkerThreadsServer, List[Tuple[int, Any, Any]]) -> None
+        transport = cast(QueueServerTransport, server.transport)
+        transport.expected_responses = len(jobs)
+        WorkAction.started = {job[0]: threading.Event() for job in jobs}
+        for job in jobs:
+            transport.requests.put(job)
+
+        timeout = threading.Timer(20, lambda: setattr(server, 'shutting_down', True))
+        timeout.start()
+        try:
+            server.run()
+        finally:
+            timeout.cancel()
+
+    def test_jobs_processed_by_worker_threads(self):
+        server = self._make_server(3)
+        self.assertIsInstance(server.metrics, ThreadSafeMetricsRecorder)
+
+        self._run(server, [_make_job(i, wait_for=[1, 2, 3] if i < 4 else [4, 5, 6]) for i in range(1, 7)])
+
+        self.assertEqual(6, len(server.transport.responses))
+        threads = set()
+        for i in range(1, 7):
+            response = server.transport.responses[i]
+            self.assertEqual([], response['errors'])
+            self.assertEqual(i, response['actions'][0]['body']['request_id'])
+            self.assertTrue(response['actions'][0]['body']['all_started'])
+            threads.add(response['actions'][0]['body']['thread'])
+        self.assertEqual({'pysoa-worker-1', 'pysoa-worker-2', 'pysoa-worker-3'}, threads)
+        self.assertFalse([t for t in threading.enumerate() if t.name.startswith('pysoa-worker')])
+
+    def test_harakiri_interrupts_only_the_overdue_worker_thread(self):
+        server = self._make_server(2, harakiri_timeout=1)
+
+        self._run(server, [_make_job(1, 15), _make_job(2, wait_for=[1]), _make_job(3, wait_for=[1])])
+
+        self.assertEqual(ERROR_CODE_ACTION_TIMEOUT, server.transport.responses[1]['actions'][0]['errors'][0]['code'])
+        self.assertEqual([], server.transport.responses[2]['actions'][0]['errors'])
+        self.assertEqual([], server.transport.responses[3]['actions'][0]['errors'])
+        self.assertTrue(server.transport.responses[2]['actions'][0]['body']['all_started'])
+        self.assertTrue(server.transport.responses[3]['actions'][0]['body']['all_started'])
+
+    def test_transport_errors_shut_down_all_worker_threads(self):
+        server = self._make_server(2)
+
+        with mock.patch.object(
+            server.transport,
+            'receive_request_message',
+            side_effect=TransientPySOATransportError('Redis is gone'),
+        ) as mock_receive, mock.patch('pysoa.server.server.time.sleep'):
+            self._run(server, [])
+
+        # Each worker thread gives up after its seventh consecutive error, and neither one is restarted
+        self.assertTrue(server.shutting_down)
+        self.assertLessEqual(mock_receive.call_count, 14)
+        self.assertFalse([t for t in threading.enumerate() if t.name.startswith('pysoa-worker')])
+
+    def test_busy_metrics(self):
+        server = self._make_server(3)
+        server.metrics = mock.MagicMock(spec=MetricsRecorder)
+        gauges = {}  # type: Dict[six.text_type, List[int]]
+        server.metrics.gauge.side_effect = lambda name: mock.MagicMock(
+            set=lambda value: gauges.setdefault(name, []).append(value),
+        )
+
+        release = threading.Event()
+
+        def busy(entered):  # type: (threading.Event) -> None
+            server._set_busy_metrics(True)
+            entered.set()
+            release.wait(5)
+            server._set_busy_metrics(False)
+
+        entered_events = [threading.Event(), threading.Event()]
+        threads = [threading.Thread(target=busy, args=(entered, )) for entered in entered_events]
+        for thread in threads:
+            thread.start()
+        for entered in entered_events:
+            self.assertTrue(entered.wait(5))
+        server._set_busy_metrics(False)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([3, 3, 3, 3, 3], gauges['server.worker.running'])
+        self.assertEqual([1, 2, 2], gauges['server.worker.busy'][:3])
+        self.assertEqual(0, gauges['server.worker.busy'][-1])
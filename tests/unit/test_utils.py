@@ -10,7 +10,15 @@ from typing import (
 )
 from unittest import TestCase
 
+import pytest
+
+from pysoa.common.types import (
+    JobResponse,
+    UnicodeKeysDict,
+)
 from pysoa.utils import (
+    canonical_digest,
+    copy_job_response,
     dict_to_hashable,
     get_python_interpreter_arguments,
 )
@@ -96,6 +104,35 @@ class TestDictToHashable(TestCase):
         self.assertEqual(2, len(cache))
 
 
+def test_canonical_digest():
+    digest = canonical_digest({'b': [1, {'y': 2, 'x': 'z'}], 'a': {3, 1, 2}, 'c': None})
+
+    assert digest == canonical_digest({'c': None, 'a': {1, 2, 3}, 'b': [1, {'x': 'z', 'y': 2}]})
+    assert len(digest) == 64
+    assert digest != canonical_digest({'c': None, 'a': {1, 2, 3}, 'b': [{'x': 'z', 'y': 2}, 1]})
+
+    with pytest.raises(TypeError):
+        canonical_digest({1: 'a', 'b': 2})
+
+
+def test_copy_job_response():
+    response = JobResponse(
+        errors=[],
+        context={'request_id': 1},
+        actions=[{
+            'action': 'get_users',
+            'body': UnicodeKeysDict([('users', UnicodeKeysDict([(7, {'tags': ['a']})]))]),
+        }],
+    )
+
+    copied = copy_job_response(response)
+
+    assert copied == response
+    assert copied.actions[0].body == {'users': {7: {'tags': ['a']}}}
+    copied.actions[0].body['users'][7]['tags'].append('b')
+    assert response.actions[0].body['users'][7]['tags'] == ['a']
+
+
 def test_get_python_interpreter_arguments():
     args = get_python_interpreter_arguments()
     assert len(args) > 1